@@ -0,0 +1,115 @@
+"""
+Benchmark: write and read throughput of raw XRF data saved by ``save_data_to_hdf5``
+with different storage layouts (chunk shape, compression filter and shuffle filter).
+
+The synthetic XRF maps are generated using ``pyxrf.simulation.sim_xrf_scan_data``.
+Poisson noise is added to the spectra, so that the data is not trivially compressible.
+Read throughput is measured by loading the map block by block using the chunks
+selected by ``plan_xrf_map_chunks`` (the same way the data is loaded for processing).
+
+Compression filters ``lz4``, ``zstd`` and ``blosc`` require ``hdf5plugin`` package.
+The layouts that can not be created are skipped.
+
+Example:
+
+.. code:: bash
+
+    python benchmarks/hdf5_storage_layout.py --nx 100 --ny 100 --n-repeat 3
+"""
+
+import argparse
+import os
+import tempfile
+import time as ttime
+
+import h5py
+import numpy as np
+
+from pyxrf.core.map_processing import plan_xrf_map_chunks
+from pyxrf.model.load_data_from_db import save_data_to_hdf5
+from pyxrf.simulation.sim_xrf_scan_data import gen_xrf_map_const
+
+# (name, kwargs of 'save_data_to_hdf5')
+_LAYOUTS = [
+    ("gzip (default)", {}),
+    ("gzip, pixel blocks", {"chunks": "auto", "compression": "gzip"}),
+    ("lzf, pixel blocks, shuffle", {"chunks": "auto", "compression": "lzf", "shuffle": True}),
+    ("lz4, pixel blocks", {"chunks": "auto", "compression": "lz4"}),
+    ("lz4, pixel blocks, shuffle", {"chunks": "auto", "compression": "lz4", "shuffle": True}),
+    ("zstd, pixel blocks, shuffle", {"chunks": "auto", "compression": "zstd", "shuffle": True}),
+    ("blosc, pixel blocks, shuffle", {"chunks": "auto", "compression": "blosc", "shuffle": True}),
+    ("no compression, pixel blocks", {"chunks": "auto", "compression": None}),
+]
+
+
+def generate_xrf_map(*, nx, ny, n_spectrum_points=4096):
+    """
+    Generate synthetic XRF map (``float32``) with Poisson noise.
+    """
+    element_groups = {"Fe_K": {"area": 5e4}, "Ca_K": {"area": 2e4}, "Pt_M": {"area": 1e4}}
+    xrf_map, _ = gen_xrf_map_const(
+        element_groups, nx=nx, ny=ny, n_spectrum_points=n_spectrum_points, background_area=1e4
+    )
+    rng = np.random.default_rng(0)
+    return rng.poisson(xrf_map).astype(np.float32)
+
+
+def _read_by_blocks(fpath, dset_name):
+    with h5py.File(fpath, "r") as f:
+        dset = f[dset_name]
+        ny, nx, _ = dset.shape
+        plan = plan_xrf_map_chunks(dset.shape, dtype=dset.dtype, data_chunksize=(dset.chunks or (1, 1))[0:2])
+        cy, cx = plan.chunk_size
+        for y0 in range(0, ny, cy):
+            for x0 in range(0, nx, cx):
+                dset[y0 : y0 + cy, x0 : x0 + cx, :]
+        return dset.id.get_storage_size(), dset.chunks, plan.chunk_size
+
+
+def run_benchmark(*, nx, ny, n_spectrum_points=4096, n_repeat=3, wd=None):
+    """
+    Run the benchmark and print the table of results.
+    """
+    xrf_map = generate_xrf_map(nx=nx, ny=ny, n_spectrum_points=n_spectrum_points)
+    data = {"det_sum": xrf_map}
+    n_bytes = xrf_map.nbytes
+    mb = 1024**2
+
+    print(f"XRF map: {xrf_map.shape}, {n_bytes / mb:.1f} MB")
+    print(f"{'Layout':32s} {'Write, MB/s':>12s} {'Read, MB/s':>12s} {'Ratio':>7s}  Chunks, processing blocks")
+
+    with tempfile.TemporaryDirectory(dir=wd) as tmp_dir:
+        fpath = os.path.join(tmp_dir, "benchmark.h5")
+        for name, kwargs in _LAYOUTS:
+            t_write, t_read = [], []
+            try:
+                for _ in range(n_repeat):
+                    t0 = ttime.perf_counter()
+                    save_data_to_hdf5(fpath, data, file_overwrite_existing=True, **kwargs)
+                    t_write.append(ttime.perf_counter() - t0)
+
+                    t0 = ttime.perf_counter()
+                    storage_size, chunks, block_size = _read_by_blocks(fpath, "xrfmap/detsum/counts")
+                    t_read.append(ttime.perf_counter() - t0)
+            except Exception as ex:
+                print(f"{name:32s} skipped: {ex}")
+                continue
+
+            write_speed = n_bytes / min(t_write) / mb
+            read_speed = n_bytes / min(t_read) / mb
+            ratio = n_bytes / storage_size if storage_size else float("nan")
+            print(f"{name:32s} {write_speed:12.1f} {read_speed:12.1f} {ratio:7.2f}  {chunks}, {block_size}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of HDF5 storage layouts for raw XRF data")
+    parser.add_argument("--nx", type=int, default=100, help="horizontal size of the map")
+    parser.add_argument("--ny", type=int, default=100, help="vertical size of the map")
+    parser.add_argument("--n-spectrum-points", type=int, default=4096, help="number of spectrum points")
+    parser.add_argument("--n-repeat", type=int, default=3, help="number of repetitions (the best time is used)")
+    parser.add_argument("--wd", default=None, help="directory for temporary files")
+    args = parser.parse_args()
+
+    run_benchmark(
+        nx=args.nx, ny=args.ny, n_spectrum_points=args.n_spectrum_points, n_repeat=args.n_repeat, wd=args.wd
+    )
@@ -4,7 +4,17 @@
 
 from pyxrf import __version__ as pyxrf_version
 
-from .api_dev import *  # noqa: F401, F403
+from . import api_dev
+from .api_dev import __all__  # noqa: F401
+
+
+def __getattr__(name):
+    # The API functions are imported on first use (see 'pyxrf.api_dev')
+    return getattr(api_dev, name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(api_dev.__all__))
 
 
 def pyxrf_api():
@@ -14,13 +24,16 @@ def pyxrf_api():
 
         Loading data:
           make_hdf - load XRF mapping data from databroker
+          LiveMapFitter - fitting of XRF maps while the data is loaded (see make_hdf)
 
         Data processing:
           pyxrf_batch - batch processing of XRF maps
+          BlockResultCache - on-disk cache of fitting results for repeated batch processing
           build_xanes_map - generation and processing of XANES maps
 
         Dask client:
           dask_client_create - returns Dask client for use in batch scripts
+          dask_cluster_manager - configures the shared Dask cluster used by default
 
         Simulation of datasets:
           gen_hdf5_qa_dataset - generate quantitative analysis dataset
@@ -1,26 +1,38 @@
 # Use this file if you need to import PyXRF APIs into a custom script.
 # Use 'pyxrf.api' if you are interactively importing APIs into an IPython session.
 
+import importlib
 import logging
 
-from .core.map_processing import dask_client_create  # noqa: F401
-from .gui_support.gpc_class import autofind_emission_lines  # noqa: F401, E402
-from .model.command_tools import fit_pixel_data_and_save, pyxrf_batch  # noqa: F401
-from .model.fileio import combine_data_to_recon  # noqa: F401
-from .model.fileio import create_movie  # noqa: F401
-from .model.fileio import export_to_view  # noqa: F401
-from .model.fileio import h5file_for_recon  # noqa: F401
-from .model.fileio import make_hdf_stitched  # noqa: F401
-from .model.fileio import read_data_from_hdf5  # noqa: F401, E402
-from .model.fileio import spec_to_hdf  # noqa: F401
-from .model.fileio import stitch_fitted_results  # noqa: F401
-from .model.load_data_from_db import save_data_to_hdf5  # noqa: F401, E402
-from .model.load_data_from_db import export1d, make_hdf  # noqa: F401
-from .simulation.sim_xrf_scan_data import gen_hdf5_qa_dataset, gen_hdf5_qa_dataset_preset_1  # noqa: F401
-from .xanes_maps.xanes_maps_api import build_xanes_map  # noqa: F401
-
-# Note:  the statement '# noqa: F401' is telling flake8 to ignore violation F401 at the given line
-#     Violation F401 - the package is imported but unused
+# The API functions and classes are imported from the respective modules on first use
+#   (e.g. 'from pyxrf.api_dev import pyxrf_batch' imports only the modules needed for
+#   batch processing). Importing all modules (GUI models, catalogs, XANES maps, simulation etc.)
+#   takes several seconds, which is significant for short batch scripts.
+_api_modules = {
+    "BlockResultCache": ".core.block_cache",
+    "dask_client_create": ".core.map_processing",
+    "dask_cluster_manager": ".core.map_processing",
+    "autofind_emission_lines": ".gui_support.gpc_class",
+    "fit_pixel_data_and_save": ".model.command_tools",
+    "pyxrf_batch": ".model.command_tools",
+    "combine_data_to_recon": ".model.fileio",
+    "create_movie": ".model.fileio",
+    "export_to_view": ".model.fileio",
+    "h5file_for_recon": ".model.fileio",
+    "make_hdf_stitched": ".model.fileio",
+    "read_data_from_hdf5": ".model.fileio",
+    "spec_to_hdf": ".model.fileio",
+    "stitch_fitted_results": ".model.fileio",
+    "LiveMapFitter": ".model.fit_spectrum",
+    "save_data_to_hdf5": ".model.load_data_from_db",
+    "export1d": ".model.load_data_from_db",
+    "make_hdf": ".model.load_data_from_db",
+    "gen_hdf5_qa_dataset": ".simulation.sim_xrf_scan_data",
+    "gen_hdf5_qa_dataset_preset_1": ".simulation.sim_xrf_scan_data",
+    "build_xanes_map": ".xanes_maps.xanes_maps_api",
+}
+
+__all__ = list(_api_modules) + ["db", "db_analysis"]  # noqa: F822
 
 
 logger = logging.getLogger("pyxrf")
@@ -34,15 +46,28 @@ stream_handler.setFormatter(formatter)
 stream_handler.setLevel(logging.INFO)
 logger.addHandler(stream_handler)
 
-try:
-    from .model.load_data_from_db import db
-except ImportError:
-    db = None
-    logger.error("Databroker is not available.")
-
-try:
-    from .model.load_data_from_db import db_analysis
-except ImportError:
-    db_analysis = None
-    # We don't use 'analysis' databroker, so disable the message for now
-    # logger.error("'Analysis' databroker is not available.")
+# We don't use 'analysis' databroker
+db_analysis = None
+
+
+def __getattr__(name):
+    if name in _api_modules:
+        module = importlib.import_module(_api_modules[name], __package__)
+        value = getattr(module, name)
+    elif name == "db":
+        # The catalog is opened when 'db' is accessed for the first time
+        try:
+            from .model.load_data_from_db import db as value
+        except ImportError:
+            value = None
+            logger.error("Databroker is not available.")
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # The following calls do not invoke '__getattr__'
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,277 @@
+import getpass
+import hashlib
+import logging
+import os
+import platform
+import tempfile
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _default_cache_dir():
+    """
+    Default location of the cache: user-specific directory in the system temporary
+    directory on Linux or `~/.pyxrf/block_cache` on other systems.
+    """
+    if platform.system() == "Linux":
+        return os.path.join(tempfile.gettempdir(), getpass.getuser(), "pyxrf", "block_cache")
+    else:
+        return os.path.expanduser(os.path.join("~", ".pyxrf", "block_cache"))
+
+
+class BlockResultCache:
+    """
+    On-disk cache of results of processing of blocks of XRF maps. The cache is used by
+    `fit_xrf_map` and `compute_selected_rois` to skip processing of the blocks that
+    were already processed with the same parameters, e.g. if the map is refitted in order
+    to save the results in different formats or with different normalization.
+
+    Each entry is saved as a separate `.npy` file. The key of the entry is computed
+    as a hash of the raw data of the block and the processing parameters (e.g. `matv`,
+    `data_sel_indices`, `snip_param`), so the entry is never reused if the data
+    or the model is changed. The total size of the cache is limited by `max_size`:
+    the least recently used entries are removed once the size is exceeded.
+
+    The object is lightweight and may be passed to Dask workers. The cache may be used
+    by multiple processes at the same time.
+
+    Examples
+    --------
+    .. code-block:: python
+
+        cache = BlockResultCache(max_size=2 * 1024**3)
+        result = fit_xrf_map(data, data_sel_indices, matv, snip_param, cache=cache)
+        # Repeated call with the same data and parameters: the results are loaded from the cache
+        result = fit_xrf_map(data, data_sel_indices, matv, snip_param, cache=cache)
+
+    Parameters
+    ----------
+    cache_dir: str or None
+        directory for cached data. The directory is created if it does not exist.
+        The default directory is used if `None`.
+    max_size: int
+        maximum total size of cached data, bytes
+    """
+
+    def __init__(self, cache_dir=None, *, max_size=1024**3):
+        if not isinstance(max_size, int) or max_size <= 0:
+            raise ValueError(f"Parameter 'max_size' must be a positive integer: max_size = {max_size!r}")
+        self.cache_dir = os.path.abspath(cache_dir if cache_dir is not None else _default_cache_dir())
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f"BlockResultCache(cache_dir={self.cache_dir!r}, max_size={self.max_size})"
+
+    @staticmethod
+    def compute_key(data, params_digest):
+        """
+        Compute the key of the cache entry for the block of data.
+
+        Parameters
+        ----------
+        data: ndarray
+            block of raw data
+        params_digest: str
+            digest of the processing parameters (see `params_digest`)
+
+        Returns
+        -------
+        str
+            key of the entry
+        """
+        data = np.ascontiguousarray(data)
+        h = hashlib.sha1(params_digest.encode())
+        h.update(f"{data.shape}{data.dtype.str}".encode())
+        h.update(memoryview(data).cast("B"))
+        return h.hexdigest()
+
+    @staticmethod
+    def params_digest(*args):
+        """
+        Compute the digest of processing parameters. Arrays are hashed based on
+        their contents, other parameters are hashed based on their `repr`, dictionaries
+        are sorted by key.
+
+        Parameters
+        ----------
+        args: tuple
+            processing parameters
+
+        Returns
+        -------
+        str
+            hex digest of the parameters
+        """
+        h = hashlib.sha1()
+
+        def _update(v):
+            if isinstance(v, np.ndarray):
+                v = np.ascontiguousarray(v)
+                h.update(f"ndarray{v.shape}{v.dtype.str}".encode())
+                h.update(memoryview(v).cast("B"))
+            elif isinstance(v, dict):
+                h.update(b"dict")
+                for k in sorted(v, key=str):
+                    _update(k)
+                    _update(v[k])
+            elif isinstance(v, (list, tuple)):
+                h.update(f"{type(v).__name__}{len(v)}".encode())
+                for _ in v:
+                    _update(_)
+            else:
+                h.update(repr(v).encode())
+
+        for v in args:
+            _update(v)
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        """
+        Load the entry from the cache.
+
+        Parameters
+        ----------
+        key: str
+            key of the entry
+
+        Returns
+        -------
+        ndarray or None
+            cached data or `None` if the entry does not exist or can not be loaded
+        """
+        fpath = self._entry_path(key)
+        try:
+            data = np.load(fpath, allow_pickle=False)
+            # The modification time is used to find the least recently used entries
+            os.utime(fpath)
+        except Exception:
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Save the entry to the cache. The file is written atomically, so that
+        the entry could not be partially read by other processes. Errors are logged
+        and ignored: the processing results are not affected if the cache is not writable.
+
+        Parameters
+        ----------
+        key: str
+            key of the entry
+        data: ndarray
+            data to save
+        """
+        fpath = self._entry_path(key)
+        tmp_path = os.path.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, data, allow_pickle=False)
+            os.replace(tmp_path, fpath)
+        except Exception as ex:
+            logger.warning(f"Failed to save the block of results to the cache {self.cache_dir!r}: {ex}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _list_entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".npy"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:  # The entry was removed by other process
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    @property
+    def size(self):
+        """
+        Total size of the cached data, bytes.
+        """
+        return sum([_[1] for _ in self._list_entries()])
+
+    @property
+    def n_entries(self):
+        """
+        The number of cached entries.
+        """
+        return len(self._list_entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size of the cache
+        does not exceed `max_size`.
+
+        Returns
+        -------
+        int
+            the number of removed entries
+        """
+        entries = sorted(self._list_entries())
+        total_size = sum([_[1] for _ in entries])
+        n_removed = 0
+        for _, size, fpath in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            n_removed += 1
+        if n_removed:
+            logger.debug(f"{n_removed} entries were removed from the block cache {self.cache_dir!r}")
+        return n_removed
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        for _, _, fpath in self._list_entries():
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+
+
+def cached_block_func(data, *, block_func, cache, params_digest, **kwargs):
+    """
+    Call the block processing function `block_func(data, **kwargs)` if the result is not found
+    in the cache and save the result to the cache. The function is intended to be called using
+    `map_blocks` function instead of `block_func`.
+
+    Parameters
+    ----------
+    data: ndarray
+        block of an XRF dataset
+    block_func: callable
+        block processing function, e.g. `_fit_xrf_block`
+    cache: BlockResultCache or None
+        reference to the cache. `block_func` is always called if `None`.
+    params_digest: str
+        digest of all parameters of `block_func`, which may influence the result
+    kwargs: dict
+        parameters passed to `block_func`
+
+    Returns
+    -------
+    ndarray
+        result of processing of the block
+    """
+    if cache is None:
+        return block_func(data, **kwargs)
+
+    key = cache.compute_key(data, params_digest)
+    result = cache.get(key)
+    if result is None:
+        result = block_func(data, **kwargs)
+        cache.put(key, result)
+    return result
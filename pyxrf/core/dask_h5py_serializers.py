@@ -1,10 +1,23 @@
 # The original code for serializers/deserializers can be found in
 # 'distributed/protocols/h5py.py'
 
+import threading
+
 import distributed.protocol.h5py  # noqa: F401
 from distributed.protocol.serialize import dask_deserialize, dask_serialize
 
-deserialized_files = set()
+try:
+    # Registers additional HDF5 compression filters (LZ4, Zstd, Blosc etc.), which are needed
+    #   to read the data compressed with those filters. The package is optional.
+    import hdf5plugin  # noqa: F401
+except ImportError:
+    pass
+
+# The files opened by the deserializers: {file name: file object}. The datasets from the same file
+#   (e.g. the channels of a multi-channel detector) are opened using the same file object: the objects
+#   that belong to a file opened multiple times may remain open after all file objects are closed.
+deserialized_files = {}
+_deserialized_files_lock = threading.Lock()
 
 
 def serialize_h5py_file(f):
@@ -25,8 +38,11 @@ def deserialize_h5py_file(header, frames):
 
     filename = header["filename"]
     if filename:
-        file = h5py.File(filename, mode="r")
-        deserialized_files.add(file)
+        with _deserialized_files_lock:
+            file = deserialized_files.get(filename, None)
+            if not file:
+                file = h5py.File(filename, mode="r")
+                deserialized_files[filename] = file
     else:
         file = None
     return file
@@ -49,7 +65,8 @@ def dask_set_custom_serializers():
 
 
 def dask_close_all_files():
-    while deserialized_files:
-        file = deserialized_files.pop()
-        if file:
-            file.close()
+    with _deserialized_files_lock:
+        while deserialized_files:
+            _, file = deserialized_files.popitem()
+            if file:
+                file.close()
@@ -1,4 +1,5 @@
 import numpy as np
+from numba import jit
 from scipy.optimize import nnls
 
 
@@ -100,7 +101,11 @@ def fit_spectrum(data, ref_spectra, *, method="nnls", axis=0, maxiter=100, rate=
         spectra, then ``ref_spectra`` has dimensions (K,Q), where K is the number of energy points.
 
     method : str
-        optimization method used for fitting. Currently supported methods are "nnls" and "admm".
+        optimization method used for fitting. Currently supported methods are "nnls", "nnls_gram"
+        and "admm". The "nnls_gram" method solves the same problem as "nnls", but the products
+        ``A^T A`` and ``A^T b`` are computed once for all spectra and each spectrum is
+        fitted in compiled code. It is much faster when many spectra are fitted using a small
+        number of references (e.g. processing of XRF maps).
 
     axis : int
         the number of the axis in the ``data`` array that hold the spectral information. If ``data``
@@ -130,9 +135,9 @@ def fit_spectrum(data, ref_spectra, *, method="nnls", axis=0, maxiter=100, rate=
     results_dict : dict
         dictionary that contains additional information returned by a fitting routine. The contents of
         the dictionary depends on the optimization routine. Common information: ``method`` - string
-        that contains the name of the optimization method (``nnls`` or ``admm``).
+        that contains the name of the optimization method (``nnls``, ``nnls_gram`` or ``admm``).
 
-        NNLS optimization:
+        NNLS optimization (``nnls`` and ``nnls_gram``):
 
             - ``residual`` - an array that contains values of least-squares difference between the observed
             and fitted spectra. The same shape as ``rfactor``.
@@ -146,7 +151,7 @@ def fit_spectrum(data, ref_spectra, *, method="nnls", axis=0, maxiter=100, rate=
     """
     # Explicitly check if one of the supported optimisation method is specified
     method = method.lower()
-    supported_fitting_methods = ("nnls", "admm")
+    supported_fitting_methods = ("nnls", "nnls_gram", "admm")
     assert (
         method in supported_fitting_methods
     ), f"Fitting method '{method}' is not supported. Supported methods: {supported_fitting_methods}"
@@ -197,6 +202,8 @@ def fit_spectrum(data, ref_spectra, *, method="nnls", axis=0, maxiter=100, rate=
         weights, rfactor, convergence, feasibility = _fitting_admm(
             data_1D, ref_spectra, rate=rate, maxiter=maxiter, epsilon=epsilon
         )
+    elif method == "nnls_gram":
+        weights, rfactor, residual = _fitting_nnls_gram(data_1D, ref_spectra, maxiter=maxiter)
     else:
         # Call the default "nnls" method, since this is the only choice left.
         weights, rfactor, residual = _fitting_nnls(data_1D, ref_spectra, maxiter=maxiter)
@@ -205,12 +212,12 @@ def fit_spectrum(data, ref_spectra, *, method="nnls", axis=0, maxiter=100, rate=
     if not data_dims:
         weights = np.squeeze(weights, axis=1)
         rfactor = rfactor[0]
-        if method == "nnls":
+        if method != "admm":
             residual = residual[0]
     elif len(data_dims) > 1:
         weights = np.reshape(weights, np.insert(data_dims, 0, n_refs))
         rfactor = np.reshape(rfactor, data_dims)
-        if method == "nnls":
+        if method != "admm":
             residual = np.reshape(residual, data_dims)
 
     # Now swap back the results of fitting (coefficients are along the same axis as the spectrum points)
@@ -234,6 +241,47 @@ def fit_spectrum(data, ref_spectra, *, method="nnls", axis=0, maxiter=100, rate=
     return weights, rfactor, results_dict
 
 
+def factorize_references(ref_spectra, *, method="nnls", rate=0.2):
+    r"""
+    Compute the matrices that depend only on the reference spectra and may be reused for fitting
+    of any number of spectra (e.g. blocks of pixels of a XANES map). For NNLS, the matrix
+    ``A^T A`` is computed. For ADMM, the matrix ``(A^T A + rate * I)^-1`` is also computed.
+
+    Parameters
+    ----------
+    ref_spectra : ndarray (2D)
+        array with columns representing the reference spectra, shape (K,Q).
+
+    method : str
+        optimization method: "nnls", "nnls_gram" or "admm".
+
+    rate : float
+        descent rate for ADMM optimization algorithm (1/lambda).
+
+    Returns
+    -------
+    dict
+        dictionary with the keys ``method``, ``gram`` (``A^T A``) and ``admm_matrix``
+        (None unless the method is ``admm``).
+    """
+    method = method.lower()
+    supported_fitting_methods = ("nnls", "nnls_gram", "admm")
+    assert (
+        method in supported_fitting_methods
+    ), f"Fitting method '{method}' is not supported. Supported methods: {supported_fitting_methods}"
+
+    ref_spectra = np.asarray(ref_spectra, dtype=np.float64)
+    assert ref_spectra.ndim == 2, f"The array 'ref_spectra' must have 2 dimensions instead of {ref_spectra.ndim}"
+    assert rate > 0.0, f"The parameter 'rate' is zero or negative ({rate:.6g})"
+
+    gram = np.matmul(np.transpose(ref_spectra), ref_spectra)
+    admm_matrix = None
+    if method == "admm":
+        admm_matrix = np.linalg.inv(gram + np.eye(gram.shape[0], dtype=float) * rate)
+
+    return {"method": method, "gram": gram, "admm_matrix": admm_matrix}
+
+
 def _fitting_nnls(data, ref_spectra, *, maxiter=100):
     r"""
     Fitting of multiple spectra using NNLS method.
@@ -293,7 +341,203 @@ def _fitting_nnls(data, ref_spectra, *, maxiter=100):
     return map_data_fitted, map_rfactor, map_residual
 
 
-def _fitting_admm(data, ref_spectra, *, rate=0.2, maxiter=100, epsilon=1e-30, non_negative=True):
+def _fitting_nnls_gram(data, ref_spectra, *, maxiter=100, gram=None):
+    r"""
+    Fitting of multiple spectra using NNLS method. The matrices ``A^T A`` and ``A^T b``
+    are computed once for all spectra and then the NNLS problem is solved for each spectrum
+    using Fast NNLS algorithm (active set method operating on the normal equations).
+    The results are the same as produced by ``_fitting_nnls`` within numerical precision.
+    The matrix ``A^T A`` may be computed in advance using ``factorize_references`` and
+    reused for fitting of multiple blocks of data.
+
+    Parameters
+    ----------
+
+    data : ndarray(float), 2D
+        array holding multiple observed spectra, shape (K, N), where K is the number of energy points,
+        and N is the number of spectra
+
+    absorption_refs : ndarray(float), 2D
+        array of references, shape (K, Q), where Q is the number of references.
+
+    maxiter : int
+        maximum number of iterations. Optimization may stop prematurely if convergence criteria are met.
+
+    gram : ndarray(float), 2D or None
+        precomputed matrix ``A^T A``, shape (Q, Q). The matrix is computed if ``gram`` is None.
+
+    Returns
+    -------
+
+    map_data_fitted : ndarray(float), 2D
+        fitting results, shape (Q, N), where Q is the number of references and N is the number of spectra.
+
+    map_rfactor : ndarray(float), 2D
+        map that represents R-factor for the fitting, shape (M,N).
+
+    map_residual : ndarray(float), 2D
+        residual (the same as returned by ``scipy.optimize.nnls``)
+
+    References
+    ----------
+
+    .. [1] R. Bro, S. De Jong, "A fast non-negativity-constrained least squares algorithm",
+           Journal of Chemometrics, vol. 11, pp. 393-401, 1997.
+    """
+    assert data.ndim == 2, "Data array 'data' must have 2 dimensions"
+    assert ref_spectra.ndim == 2, "Data array 'ref_spectra' must have 2 dimensions"
+
+    n_pts = data.shape[0]
+    n_pts_2 = ref_spectra.shape[0]
+    n_refs = ref_spectra.shape[1]
+
+    assert (
+        n_pts == n_pts_2
+    ), f"The number of spectrum points in data ({n_pts}) and references ({n_pts_2}) do not match."
+
+    assert maxiter > 0, f"The parameter 'maxiter' is zero or negative ({maxiter})"
+
+    data = np.asarray(data, dtype=np.float64)
+    ref_spectra = np.asarray(ref_spectra, dtype=np.float64)
+
+    # The matrices are computed once for all spectra
+    ref_t = np.ascontiguousarray(np.transpose(ref_spectra))
+    if gram is None:
+        gram = np.matmul(ref_t, ref_spectra)
+    gram = np.asarray(gram, dtype=np.float64)
+    assert gram.shape == (n_refs, n_refs), f"Matrix 'gram' has incorrect shape {gram.shape}"
+    atb = np.matmul(ref_t, data)
+
+    # The tolerance is similar to the one used by 'scipy.optimize.nnls'
+    tol = 10 * max(n_pts, n_refs) * np.finfo(np.float64).eps
+    map_data_fitted = _nnls_gram_solve(gram, atb, maxiter, tol)
+
+    # R-factor and residual are computed for all spectra at once
+    data_fitted = np.matmul(ref_spectra, map_data_fitted)
+    map_rfactor = rfactor(data, data_fitted)
+    map_residual = np.linalg.norm(data - data_fitted, axis=0)
+
+    return map_data_fitted, map_rfactor, map_residual
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _nnls_gram_solve_passive(gram, atb, passive):
+    """
+    Solve unconstrained least squares problem for the variables from the passive set.
+    The remaining variables are set to zero. The least squares solution is computed if
+    the Gram matrix of the passive set is singular (e.g. some references are collinear).
+    """
+    n_refs = atb.size
+    indices = np.nonzero(passive)[0]
+    n_passive = indices.size
+    gram_p = np.empty((n_passive, n_passive))
+    atb_p = np.empty(n_passive)
+    for i in range(n_passive):
+        atb_p[i] = atb[indices[i]]
+        for j in range(n_passive):
+            gram_p[i, j] = gram[indices[i], indices[j]]
+    s = np.zeros(n_refs)
+    if n_passive:
+        try:
+            s_p = np.linalg.solve(gram_p, atb_p)
+        except Exception:
+            s_p = np.linalg.lstsq(gram_p, atb_p)[0]
+        if not np.all(np.isfinite(s_p)):
+            s_p = np.linalg.lstsq(gram_p, atb_p)[0]
+        for i in range(n_passive):
+            s[indices[i]] = s_p[i]
+    return s
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _nnls_gram_solve_single(gram, atb, maxiter, tol):
+    """
+    Fast NNLS for a single spectrum: ``gram = A^T A``, ``atb = A^T b``.
+    """
+    n_refs = atb.size
+    x = np.zeros(n_refs)
+    passive = np.zeros(n_refs, dtype=np.bool_)
+
+    # Tolerance for the gradient is relative to the magnitude of 'A^T b'
+    w_tol = tol * max(np.max(np.abs(atb)), 1e-300)
+
+    w = atb.copy()
+    n_iter = 0
+    while n_iter < maxiter:
+        # Select the variable that is moved to the passive set
+        n_sel, w_max = -1, w_tol
+        for n in range(n_refs):
+            if not passive[n] and w[n] > w_max:
+                n_sel, w_max = n, w[n]
+        if n_sel < 0:
+            break
+        passive[n_sel] = True
+
+        feasible = False
+        while True:
+            n_iter += 1
+            s = _nnls_gram_solve_passive(gram, atb, passive)
+
+            alpha, n_min = 2.0, -1
+            for n in range(n_refs):
+                if passive[n] and s[n] <= 0:
+                    # The variable may be zero in both solutions (e.g. the Gram matrix is singular)
+                    d = x[n] - s[n]
+                    a = x[n] / d if d > 0 else 0.0
+                    if a < alpha:
+                        alpha, n_min = a, n
+            if n_min < 0:
+                feasible = True
+                break
+
+            # Move towards 's' until one of the variables becomes zero
+            for n in range(n_refs):
+                if passive[n]:
+                    x[n] = x[n] + alpha * (s[n] - x[n])
+            x[n_min] = 0
+            for n in range(n_refs):
+                if passive[n] and x[n] <= 0:
+                    passive[n] = False
+                    x[n] = 0
+            if n_iter >= maxiter:
+                break
+
+        if not feasible:
+            # The maximum number of iterations is reached. The solution 's' may contain
+            #   negative values, so the last feasible solution is returned.
+            for n in range(n_refs):
+                x[n] = max(x[n], 0.0)
+            break
+
+        x = s
+        for n in range(n_refs):
+            if not passive[n]:
+                x[n] = 0
+
+        # The selected variable could be immediately removed from the passive set
+        #   only because of limited numerical precision. The solution can not be improved.
+        if not passive[n_sel]:
+            break
+
+        w = atb - gram @ x
+
+    return x
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _nnls_gram_solve(gram, atb, maxiter, tol):
+    """
+    Solve NNLS problem for each column of ``atb``. Returns the array of weights
+    with the same shape as ``atb``.
+    """
+    n_refs, n_spectra = atb.shape
+    weights = np.zeros((n_refs, n_spectra))
+    for n in range(n_spectra):
+        weights[:, n] = _nnls_gram_solve_single(gram, np.ascontiguousarray(atb[:, n]), maxiter, tol)
+    return weights
+
+
+def _fitting_admm(data, ref_spectra, *, rate=0.2, maxiter=100, epsilon=1e-30, non_negative=True, admm_matrix=None):
     r"""
     Fitting of multiple spectra using ADMM method.
 
@@ -319,6 +563,10 @@ def _fitting_admm(data, ref_spectra, *, rate=0.2, maxiter=100, epsilon=1e-30, no
     non_negative : bool
         if True, then the solution is guaranteed to be non-negative
 
+    admm_matrix : ndarray(float), 2D or None
+        precomputed matrix ``(A^T A + rate * I)^-1``, shape (Q, Q), which depends only on the references
+        and the descent rate (see ``factorize_references``). The matrix is computed if ``admm_matrix`` is None.
+
     Returns
     -------
 
@@ -360,7 +608,6 @@ def _fitting_admm(data, ref_spectra, *, rate=0.2, maxiter=100, epsilon=1e-30, no
     At = np.transpose(A)
 
     z = np.matmul(At, y)
-    c = np.matmul(At, A)
 
     # Initialize variables
     w = np.ones(shape=[n_refs, n_pixels])
@@ -370,8 +617,10 @@ def _fitting_admm(data, ref_spectra, *, rate=0.2, maxiter=100, epsilon=1e-30, no
     convergence = np.zeros(shape=[maxiter])
     feasibility = np.zeros(shape=[maxiter])
 
-    dg = np.eye(n_refs, dtype=float) * rate
-    m1 = np.linalg.inv((c + dg))
+    if admm_matrix is None:
+        admm_matrix = factorize_references(ref_spectra, method="admm", rate=rate)["admm_matrix"]
+    m1 = admm_matrix
+    assert m1.shape == (n_refs, n_refs), f"ADMM fitting: matrix 'admm_matrix' has incorrect shape {m1.shape}"
 
     n_iter = 0
     for i in range(maxiter):
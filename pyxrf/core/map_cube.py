@@ -0,0 +1,229 @@
+import logging
+
+import numpy as np
+
+from .utils import normalize_data_by_scaler
+
+logger = logging.getLogger(__name__)
+
+
+class MapCube(dict):
+    """
+    Dictionary of XRF maps (e.g. results of fitting), which are stored as one contiguous
+    array of shape `(n_maps, ny, nx)`. The keys are map names (emission lines etc.),
+    the values are views of the respective slices of the array, so the maps are accessed
+    without copying data. The object may be used anywhere a dictionary of 2D maps is
+    expected.
+
+    The array `data` contains the maps in the order of keys. If the dictionary is modified
+    (maps are added, replaced or removed using the dictionary interface), then the array
+    is assembled again from the maps when `data` is accessed next time and the values are
+    replaced with the views of the new array.
+
+    Examples
+    --------
+    .. code-block:: python
+
+        cube = MapCube(["Fe_K", "Ca_K"], np.random.random((2, 10, 20)))
+        fe_map = cube["Fe_K"]  # View of cube.data[0, :, :]
+        cube.add_maps(["Zn_K"])  # Add zero map
+        cube_norm = cube.normalize_by_scaler(scaler)  # All maps are normalized at once
+
+    Parameters
+    ----------
+    names: iterable(str or bytes)
+        the list of map names. Names represented as bytes are decoded.
+    data: ndarray or None
+        3D array with the shape `(n_maps, ny, nx)`, where `n_maps` is the number of names.
+        The array is referenced, not copied, if it is C-contiguous. `None` creates
+        an empty cube.
+    """
+
+    def __init__(self, names=(), data=None):
+        names = [_ if isinstance(_, str) else _.decode() for _ in names]
+        if data is None:
+            data = np.zeros(shape=(len(names), 0, 0))
+        data = np.ascontiguousarray(data)
+        if data.ndim != 3 or data.shape[0] != len(names):
+            raise ValueError(
+                f"Map data must be 3D array with the shape (n_maps, ny, nx), n_maps = {len(names)}: "
+                f"data.shape = {data.shape}"
+            )
+        if len(set(names)) != len(names):
+            raise ValueError(f"The list of map names contains repeated names: {names}")
+
+        super().__init__(zip(names, data))
+        self._data = data
+        self._map_shape = data.shape[1:]
+        self._synced = True
+
+    @classmethod
+    def from_dict(cls, maps):
+        """
+        Create the cube from a dictionary of 2D maps. The maps are copied to the new array.
+        All maps must have the same shape.
+
+        Parameters
+        ----------
+        maps: dict(ndarray)
+            dictionary of maps: key - map name, value - 2D array
+
+        Returns
+        -------
+        MapCube
+            new cube
+        """
+        if isinstance(maps, MapCube):
+            return maps.copy()
+        names = list(maps.keys())
+        return cls(names, _stack_maps([maps[_] for _ in names]) if names else None)
+
+    @classmethod
+    def from_hdf5(cls, group, *, data_name="xrf_fit", names_name="xrf_fit_name"):
+        """
+        Load the cube from HDF5 group. The maps are loaded with a single read.
+
+        Parameters
+        ----------
+        group: h5py.Group
+            HDF5 group, e.g. `f["xrfmap/detsum"]`
+        data_name: str
+            name of the dataset that contains the maps (shape `(n_maps, ny, nx)`)
+        names_name: str
+            name of the dataset that contains the map names
+
+        Returns
+        -------
+        MapCube
+            loaded cube
+        """
+        return cls(group[names_name][()], group[data_name][()])
+
+    @property
+    def data(self):
+        """
+        The array `(n_maps, ny, nx)` that contains the maps in the order of the keys.
+        """
+        if not self._synced:
+            maps = list(self.values())
+            self._data = _stack_maps(maps) if maps else np.zeros(shape=(0, *self._map_shape))
+            self._map_shape = self._data.shape[1:]
+            super().update(zip(self.keys(), self._data))
+            self._synced = True
+        return self._data
+
+    @property
+    def names(self):
+        """
+        The list of map names.
+        """
+        return list(self.keys())
+
+    def add_maps(self, names, data=None):
+        """
+        Add several maps to the cube. The array is reallocated only once.
+
+        Parameters
+        ----------
+        names: list(str)
+            names of the new maps. The names must not exist in the cube.
+        data: ndarray or None
+            array with the shape `(len(names), ny, nx)`. The maps are filled with
+            zeros if `None`.
+        """
+        names = [_ if isinstance(_, str) else _.decode() for _ in names]
+        existing = [_ for _ in names if _ in self]
+        if existing:
+            raise ValueError(f"Maps already exist: {existing}")
+
+        cube = self.data
+        if data is None:
+            data = np.zeros(shape=(len(names), *cube.shape[1:]), dtype=cube.dtype)
+        new_cube = MapCube(self.names + names, np.concatenate([cube, data], axis=0))
+        super().clear()
+        super().update(new_cube)
+        self._data, self._map_shape = new_cube._data, new_cube._map_shape
+
+    def normalize_by_scaler(self, scaler, *, use_average=False, names_not_scalable=None):
+        """
+        Normalize all maps by the scaler at once. Zeros in the scaler are replaced with the mean
+        value of the scaler (see `normalize_data_by_scaler`). The maps are not normalized if
+        the scaler is all zeros or has different shape.
+
+        Parameters
+        ----------
+        scaler: ndarray
+            2D array with scaler data
+        use_average: bool
+            multiply the normalized data by the mean value of the scaler
+        names_not_scalable: list(str) or None
+            names of the maps that should not be normalized (the maps are copied)
+
+        Returns
+        -------
+        MapCube
+            new cube with normalized maps
+        """
+        data = self.data
+        # 'scale' is 1/scaler with zeros replaced by the mean value, or ones if scaling is not possible
+        scale = normalize_data_by_scaler(np.ones(shape=data.shape[1:]), scaler)
+        if use_average:
+            scale = scale * np.mean(scaler)
+
+        if names_not_scalable:
+            scale = np.broadcast_to(scale, data.shape).copy()
+            for n, name in enumerate(self.keys()):
+                if name in names_not_scalable:
+                    scale[n] = 1
+        return MapCube(self.names, data * scale)
+
+    def copy(self):
+        """
+        Returns shallow copy of the cube (the new cube references the same array).
+        """
+        return MapCube(self.names, self.data)
+
+    def __deepcopy__(self, memo):
+        return MapCube(self.names, self.data.copy())
+
+    def __reduce__(self):
+        return (MapCube, (self.names, self.data))
+
+    # The following methods modify the dictionary. The array is assembled again when it is accessed.
+    def __setitem__(self, key, value):
+        self._synced = False
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._synced = False
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self._synced = False
+        super().update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._synced = False
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self._synced = False
+        return super().pop(*args)
+
+    def popitem(self):
+        self._synced = False
+        return super().popitem()
+
+    def clear(self):
+        self._synced = False
+        super().clear()
+
+
+def _stack_maps(maps):
+    """
+    Stack the list of 2D maps into 3D array. The maps must have the same shape.
+    """
+    shapes = set([np.shape(_) for _ in maps])
+    if len(shapes) != 1 or len(next(iter(shapes))) != 2:
+        raise ValueError(f"All maps must be 2D arrays of the same shape: shapes = {shapes}")
+    return np.stack(maps, axis=0)
@@ -1,21 +1,29 @@
+import atexit
+import collections
+import contextlib
 import getpass
 import logging
 import math
 import os
 import platform
 import tempfile
+import threading
 import time as ttime
 
 import dask
 import dask.array as da
 import h5py
 import numpy as np
-from dask.distributed import Client, wait
-from numba import jit
+from dask.distributed import Client, LocalCluster, as_completed, wait
+from dask.system import CPU_COUNT
+from distributed.system import MEMORY_LIMIT
+from numba import jit, prange
 from progress.bar import Bar
 
+from .block_cache import BlockResultCache, cached_block_func
 from .dask_h5py_serializers import dask_close_all_files, dask_set_custom_serializers
-from .fitting import fit_spectrum
+from .fitting import _fitting_admm, _fitting_nnls, _fitting_nnls_gram, factorize_references, fit_spectrum
+from .shared_array import SharedArray
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +46,9 @@ def dask_client_create(**kwargs):
         # <-- code that runs computations -->
         client.close()  # Close Dask client
 
+    Processing functions called without Dask client use the shared local cluster
+    (see ``DaskClusterManager``), which is created once per process.
+
     Parameters
     ----------
     kwargs: dict, optional
@@ -54,6 +65,17 @@ def dask_client_create(**kwargs):
 
     logger.info("Creating Dask Client ...")
 
+    _dask_set_config()
+
+    client = Client(**_kwargs)
+    return client
+
+
+def _dask_set_config():
+    """
+    Set Dask configuration parameters used by PyXRF: temporary data is kept
+    in the user-specific directory instead of the current directory.
+    """
     dask.config.set(shuffle="disk")
 
     current_os = platform.system()
@@ -67,8 +89,199 @@ def dask_client_create(**kwargs):
 
     dask.config.set({"temporary_directory": path_dask_data})
 
-    client = Client(**_kwargs)
-    return client
+
+class DaskClusterManager:
+    """
+    Manages the local Dask cluster shared by the processing functions. The cluster
+    is created when the client is requested for the first time and is reused by
+    the following calls, so the cost of starting the cluster is paid only once
+    per process. Processing functions use the shared cluster if they are called
+    without a Dask client (``client=None``). The instance of the manager for
+    the process is ``dask_cluster_manager``.
+
+    The cluster is configured using the ``configure`` method. If the configuration
+    is changed while the cluster is running, the cluster is closed and then
+    recreated with the new configuration next time the client is requested.
+
+    Examples
+    --------
+    .. code-block:: python
+
+        from pyxrf.core.map_processing import dask_cluster_manager
+
+        # Optional: configure the cluster (the cluster is not created at this point)
+        dask_cluster_manager.configure(n_workers=4, threads_per_worker=2, memory_limit="4GB")
+
+        client = dask_cluster_manager.get_client()  # Creates the cluster
+        # <-- code that runs computations -->
+        client = dask_cluster_manager.get_client()  # Returns the same client
+        dask_cluster_manager.shutdown()  # Optional: the cluster is closed at exit
+
+    Parameters
+    ----------
+    n_workers: int or None
+        the number of workers. If None, then the number is selected by Dask based on
+        the number of available CPU cores.
+    threads_per_worker: int or None
+        the number of threads per worker. If None, then the number is selected by Dask.
+    processes: bool
+        True - workers are started as separate processes, False - workers are threads
+        in the current process.
+    memory_limit: str, float, int or None
+        memory limit per worker, e.g. ``"4GB"``. The value ``"auto"`` distributes
+        the system memory between workers.
+    adaptive: bool
+        enable adaptive scaling of the cluster. The number of workers is changed
+        between ``minimum_workers`` and ``maximum_workers`` depending on the load.
+    minimum_workers: int
+        minimum number of workers for adaptive scaling.
+    maximum_workers: int or None
+        maximum number of workers for adaptive scaling. If None, then the number
+        of workers of the cluster at the time of creation is used.
+    """
+
+    def __init__(
+        self,
+        *,
+        n_workers=None,
+        threads_per_worker=None,
+        processes=True,
+        memory_limit="auto",
+        adaptive=False,
+        minimum_workers=1,
+        maximum_workers=None,
+    ):
+        self._lock = threading.RLock()
+        self._cluster = None
+        self._client = None
+        self._config = {}
+        self.configure(
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            processes=processes,
+            memory_limit=memory_limit,
+            adaptive=adaptive,
+            minimum_workers=minimum_workers,
+            maximum_workers=maximum_workers,
+        )
+
+    @property
+    def config(self):
+        """Copy of the current configuration of the cluster (dict)."""
+        return self._config.copy()
+
+    @property
+    def is_running(self):
+        """True if the cluster is created and the client is connected."""
+        with self._lock:
+            return (self._client is not None) and (self._client.status == "running")
+
+    @property
+    def n_workers(self):
+        """The number of workers of the running cluster or 0 if the cluster is not running."""
+        with self._lock:
+            if not self.is_running:
+                return 0
+            return len(self._client.scheduler_info()["workers"])
+
+    def configure(self, **kwargs):
+        """
+        Change the configuration of the cluster. The parameters are the same as
+        the parameters of the constructor. The parameters that are not specified
+        remain unchanged. The running cluster is closed if the configuration is changed.
+        """
+        supported_keys = (
+            "n_workers",
+            "threads_per_worker",
+            "processes",
+            "memory_limit",
+            "adaptive",
+            "minimum_workers",
+            "maximum_workers",
+        )
+        unsupported_keys = [_ for _ in kwargs if _ not in supported_keys]
+        if unsupported_keys:
+            raise ValueError(
+                f"Unsupported configuration parameters: {unsupported_keys}. Supported parameters: {supported_keys}"
+            )
+
+        config = self._config.copy()
+        config.update(kwargs)
+
+        for key in ("n_workers", "threads_per_worker", "maximum_workers"):
+            if (config[key] is not None) and (config[key] < 1):
+                raise ValueError(f"Parameter {key!r} must be a positive integer or None: {key}={config[key]}")
+        if config["minimum_workers"] < 0:
+            raise ValueError(f"Parameter 'minimum_workers' must be non-negative: {config['minimum_workers']}")
+
+        with self._lock:
+            if config != self._config:
+                self.shutdown()
+                self._config = config
+
+    def get_client(self):
+        """
+        Returns the client connected to the shared cluster. The cluster is created if it
+        is not running. The client should not be closed by the caller.
+
+        Returns
+        -------
+        client: dask.distributed.Client
+            Dask client object
+        """
+        with self._lock:
+            if not self.is_running:
+                self.shutdown()
+                self._start()
+            return self._client
+
+    def _start(self):
+        logger.info("Creating local Dask cluster ...")
+        _dask_set_config()
+
+        config = self._config
+        cluster_kwargs = {
+            "processes": config["processes"],
+            "memory_limit": config["memory_limit"],
+            "silence_logs": logging.ERROR,
+        }
+        for key in ("n_workers", "threads_per_worker"):
+            if config[key] is not None:
+                cluster_kwargs[key] = config[key]
+
+        self._cluster = LocalCluster(**cluster_kwargs)
+        if config["adaptive"]:
+            maximum = config["maximum_workers"]
+            if maximum is None:
+                maximum = len(self._cluster.workers)
+            self._cluster.adapt(minimum=config["minimum_workers"], maximum=maximum)
+        self._client = Client(self._cluster)
+
+        n_workers = len(self._client.scheduler_info()["workers"])
+        logger.info(f"Local Dask cluster is created: {n_workers} workers")
+
+    def shutdown(self):
+        """
+        Close the client and the cluster. The new cluster is created next time
+        the client is requested.
+        """
+        with self._lock:
+            client, cluster = self._client, self._cluster
+            self._client, self._cluster = None, None
+
+            for obj in (client, cluster):
+                if obj is not None:
+                    try:
+                        obj.close()
+                    except Exception as ex:
+                        logger.debug(f"Failed to close Dask object {obj!r}: {ex}")
+            if cluster is not None:
+                logger.info("Local Dask cluster is closed")
+
+
+# Cluster manager shared by all processing functions
+dask_cluster_manager = DaskClusterManager()
+atexit.register(dask_cluster_manager.shutdown)
 
 
 class TerminalProgressBar:
@@ -188,7 +401,7 @@ class RawHDF5Dataset:
         self.shape = shape
 
 
-def _compute_optimal_chunk_size(chunk_pixels, data_chunksize, data_shape, n_chunks_min=4):
+def compute_optimal_chunk_size(chunk_pixels, data_chunksize, data_shape, n_chunks_min=4):
     """
     Compute the best chunk size for the 'data' array based on existing size and
     chunk size of the `data` array and the desired number of pixels in the chunk.
@@ -240,6 +453,199 @@ def _compute_optimal_chunk_size(chunk_pixels, data_chunksize, data_shape, n_chun
     return chunk_y, chunk_x
 
 
+class ChunkPlan:
+    """
+    Block shape selected for processing of an XRF map. The object is returned by
+    `plan_xrf_map_chunks` and contains the chunk size and the parameters used to select it.
+
+    Attributes
+    ----------
+    chunk_size: tuple(int, int)
+        selected block shape `(chunk_y, chunk_x)` along axes 0 and 1 of the map
+    chunk_pixels: int
+        the desired number of pixels in the block (the target for `chunk_size`)
+    n_chunks_min: int
+        the minimum number of blocks
+    n_chunks: int
+        the number of blocks in the map for the selected block shape
+    chunk_nbytes: int
+        the size of the data block (input data) in bytes
+    data_chunksize: tuple(int, int)
+        the existing chunk size (e.g. on-disk HDF5 chunks) the blocks are aligned with.
+        `(1, 1)` if no alignment is performed.
+    n_threads: int
+        the total number of worker threads available for processing
+    memory_per_thread: int or None
+        the memory available per worker thread in bytes. `None` if the chunk
+        size was not selected based on memory.
+    """
+
+    def __init__(
+        self,
+        *,
+        chunk_size,
+        chunk_pixels,
+        n_chunks_min,
+        n_chunks,
+        chunk_nbytes,
+        data_chunksize,
+        n_threads,
+        memory_per_thread,
+    ):
+        self.chunk_size = chunk_size
+        self.chunk_pixels = chunk_pixels
+        self.n_chunks_min = n_chunks_min
+        self.n_chunks = n_chunks
+        self.chunk_nbytes = chunk_nbytes
+        self.data_chunksize = data_chunksize
+        self.n_threads = n_threads
+        self.memory_per_thread = memory_per_thread
+
+    def __repr__(self):
+        return (
+            f"ChunkPlan(chunk_size={self.chunk_size}, n_chunks={self.n_chunks}, "
+            f"chunk_nbytes={self.chunk_nbytes}, chunk_pixels={self.chunk_pixels}, "
+            f"n_chunks_min={self.n_chunks_min}, data_chunksize={self.data_chunksize}, "
+            f"n_threads={self.n_threads}, memory_per_thread={self.memory_per_thread})"
+        )
+
+
+# The default maximum number of pixels in a block
+_CHUNK_PIXELS_MAX = 5000
+# The number of blocks per worker thread. More blocks than threads improves load balancing.
+_CHUNKS_PER_THREAD = 2
+# The fraction of memory of a worker thread that may be occupied by the data block
+_CHUNK_MEMORY_FRACTION = 0.25
+# Processing of a block (conversion to 'float64', background, residuals etc.) requires
+#   several arrays of the size of the block, so the memory estimate is multiplied by this factor.
+_CHUNK_MEMORY_OVERHEAD = 4
+# Numpy arrays of this size or larger are placed in shared memory (see `prepare_xrf_map`)
+_SHARED_ARRAY_MIN_NBYTES = 64 * 1024**2
+
+
+def _get_worker_resources(client=None):
+    """
+    Returns the total number of worker threads and the memory (bytes) available per thread.
+    The information is requested from the scheduler if the client is provided, otherwise
+    the resources of the local machine are used.
+    """
+    if client is not None:
+        workers = list(client.scheduler_info()["workers"].values())
+        n_threads = sum([_["nthreads"] for _ in workers])
+        memory = [_["memory_limit"] / _["nthreads"] for _ in workers if _.get("memory_limit") and _["nthreads"]]
+        if n_threads and memory:
+            return n_threads, int(min(memory))
+        elif n_threads:
+            return n_threads, int(MEMORY_LIMIT / n_threads)
+
+    n_threads = max(CPU_COUNT, 1)
+    return n_threads, int(MEMORY_LIMIT / n_threads)
+
+
+def plan_xrf_map_chunks(
+    data_shape,
+    *,
+    dtype="float64",
+    data_chunksize=None,
+    chunk_pixels=None,
+    n_chunks_min=None,
+    n_threads=None,
+    memory_per_thread=None,
+    client=None,
+):
+    """
+    Select block shape for processing an XRF map with Dask. The parameters that are not
+    specified are selected automatically based on the resources of the Dask workers:
+
+    - the number of pixels in the block is limited so that processing of a block
+      fits into a fraction of the memory available to a worker thread (long
+      spectra result in smaller blocks);
+
+    - the minimum number of blocks is selected so that each worker thread
+      receives several blocks (small maps are split between all workers);
+
+    - the blocks contain whole number of existing chunks (e.g. on-disk HDF5 chunks)
+      unless one existing chunk exceeds the memory budget.
+
+    The selected plan is reported in the log.
+
+    Parameters
+    ----------
+    data_shape: tuple(int)
+        shape of the XRF map `(ny, nx, ne)`
+    dtype: str or numpy.dtype
+        data type of the XRF map
+    data_chunksize: tuple(int, int) or None
+        existing chunk size `(chunk_y, chunk_x)` of the map (e.g. HDF5 chunks). `None`
+        if the data is not chunked.
+    chunk_pixels: int or None
+        the desired number of pixels in the block. Selected based on memory if `None`.
+    n_chunks_min: int or None
+        the minimum number of blocks. Selected based on the number of worker threads if `None`.
+    n_threads: int or None
+        the total number of worker threads. Requested from the client (or the local
+        machine) if `None`.
+    memory_per_thread: int or None
+        memory available per worker thread in bytes. Requested from the client (or the local
+        machine) if `None`.
+    client: dask.distributed.Client or None
+        Dask client used to determine the worker resources. If `None`, then the resources
+        of the local machine are used.
+
+    Returns
+    -------
+    ChunkPlan
+        the object that contains the selected block shape (attribute `chunk_size`)
+    """
+    if not isinstance(data_shape, tuple) or len(data_shape) != 3:
+        raise ValueError(f"Parameter 'data_shape' must be a tuple (ny, nx, ne): data_shape = {data_shape}")
+
+    ny, nx, ne = data_shape
+    itemsize = np.dtype(dtype).itemsize
+
+    if (n_threads is None) or ((memory_per_thread is None) and (chunk_pixels is None)):
+        _n_threads, _memory_per_thread = _get_worker_resources(client)
+        n_threads = n_threads if (n_threads is not None) else _n_threads
+        memory_per_thread = memory_per_thread if (memory_per_thread is not None) else _memory_per_thread
+
+    if n_chunks_min is None:
+        n_chunks_min = n_threads * _CHUNKS_PER_THREAD
+
+    if chunk_pixels is None:
+        # Block is converted to 'float64' during processing
+        pixel_nbytes = max(ne, 1) * max(itemsize, 8) * _CHUNK_MEMORY_OVERHEAD
+        chunk_pixels_memory = int(memory_per_thread * _CHUNK_MEMORY_FRACTION // pixel_nbytes)
+        chunk_pixels = max(min(_CHUNK_PIXELS_MAX, chunk_pixels_memory), 1)
+    else:
+        memory_per_thread = None
+
+    data_chunksize = tuple(data_chunksize) if data_chunksize else (1, 1)
+    if (memory_per_thread is not None) and (data_chunksize[0] * data_chunksize[1] > chunk_pixels):
+        logger.info(
+            f"The existing chunks {data_chunksize} exceed the memory budget for the block "
+            f"({chunk_pixels} pixels): the blocks are not aligned with the existing chunks."
+        )
+        data_chunksize = (1, 1)
+
+    chunk_size = compute_optimal_chunk_size(
+        chunk_pixels=chunk_pixels, data_chunksize=data_chunksize, data_shape=(ny, nx), n_chunks_min=n_chunks_min
+    )
+    n_chunks = int(math.ceil(ny / chunk_size[0]) * math.ceil(nx / chunk_size[1]))
+
+    plan = ChunkPlan(
+        chunk_size=chunk_size,
+        chunk_pixels=chunk_pixels,
+        n_chunks_min=n_chunks_min,
+        n_chunks=n_chunks,
+        chunk_nbytes=chunk_size[0] * chunk_size[1] * ne * itemsize,
+        data_chunksize=data_chunksize,
+        n_threads=n_threads,
+        memory_per_thread=memory_per_thread,
+    )
+    logger.info(f"XRF map {data_shape} is split into blocks: {plan}")
+    return plan
+
+
 def _chunk_numpy_array(data, chunk_size):
     """
     Convert a numpy array into Dask array with chunks of given size. The function
@@ -321,16 +727,17 @@ def _array_numpy_to_dask(data, chunk_pixels, n_chunks_min=4):
     ny, nx = data.shape[0:2]
     # Since numpy array is not chunked by default, set the original chunk size to (1,1)
     #   because here we are performing 'original' chunking
-    chunk_y, chunk_x = _compute_optimal_chunk_size(
+    chunk_y, chunk_x = compute_optimal_chunk_size(
         chunk_pixels=chunk_pixels, data_chunksize=(1, 1), data_shape=(ny, nx), n_chunks_min=n_chunks_min
     )
 
     return _chunk_numpy_array(data, (chunk_y, chunk_x))
 
 
-def prepare_xrf_map(data, chunk_pixels=5000, n_chunks_min=4):
+def prepare_xrf_map(data, chunk_pixels=None, n_chunks_min=None, *, client=None, shared_memory=None):
     """
     Convert XRF map from it's initial representation to properly chunked Dask array.
+    The block shape is selected using `plan_xrf_map_chunks`.
 
     Parameters
     ----------
@@ -338,15 +745,27 @@ def prepare_xrf_map(data, chunk_pixels=5000, n_chunks_min=4):
         Raw XRF map represented as Dask array, numpy array or reference to a dataset in
         HDF5 file. The XRF map must have dimensions `(ny, nx, ne)`, where `ny` and `nx`
         define image size and `ne` is the number of spectrum points
-    chunk_pixels: int
+    chunk_pixels: int or None
         The number of pixels in a single chunk. The XRF map will be rechunked so that
         each block contains approximately `chunk_pixels` pixels and contain all `ne`
-        spectrum points for each pixel.
-    n_chunks_min: int
+        spectrum points for each pixel. If `None`, then the number is selected based on
+        the memory available to Dask workers.
+    n_chunks_min: int or None
         Minimum number of chunks. The algorithm will try to split the map into the number
         of chunks equal or greater than `n_chunks_min`. If HDF5 dataset is not chunked,
         then the whole map is treated as one chunk. This should happen only to very small
-        files, so parallelism is not important.
+        files, so parallelism is not important. If `None`, then the number is selected
+        based on the number of Dask worker threads.
+    client: dask.distributed.Client or None
+        Dask client used to determine resources of the workers. If `None`, then
+        the resources of the local machine are used.
+    shared_memory: bool or None
+        If `True`, then the XRF map represented as numpy array is copied to shared memory
+        (see `SharedArray`) and Dask workers read the blocks of the map directly from shared
+        memory instead of receiving serialized copies of the blocks with the task graph.
+        If `False`, then the blocks are included in the task graph. If `None`, then shared
+        memory is used for the arrays larger than 64 MB. The parameter is ignored unless
+        `data` is a numpy array.
 
     Returns
     -------
@@ -354,29 +773,53 @@ def prepare_xrf_map(data, chunk_pixels=5000, n_chunks_min=4):
         XRF map represented as Dask array with proper chunk size. The XRF map may be loaded
         block by block when processing using `dask.array.map_blocks` and `dask.array.blockwise`
         functions with Dask multiprocessing scheduler.
-    file_obj: h5py.File object
-        File object that points to HDF5 file. `None` if input parameter `data` is Dask or
-        numpy array. Note, that `file_obj` must be kept alive until processing is completed.
-        Closing the file will invalidate references to the dataset in the respective
-        Dask array.
+    file_obj: h5py.File object, SharedArray or None
+        File object that points to HDF5 file or the copy of numpy array in shared memory.
+        `None` if input parameter `data` is Dask array or numpy array that is not placed in
+        shared memory. Note, that `file_obj` must be kept alive until processing is completed
+        and closed after processing. Closing the file will invalidate references to the dataset
+        in the respective Dask array.
 
     Raises
     ------
     TypeError if input parameter `data` is not one of supported types.
     """
 
-    file_obj = None  # It will remain None, unless 'data' is 'RawHDF5Dataset'
+    file_obj = None  # It will remain None, unless 'data' is 'RawHDF5Dataset' or placed in shared memory
 
-    if isinstance(data, da.core.Array):
-        chunk_size = _compute_optimal_chunk_size(
+    def _plan_chunks(data_shape, dtype, data_chunksize):
+        plan = plan_xrf_map_chunks(
+            tuple(data_shape),
+            dtype=dtype,
+            data_chunksize=data_chunksize,
             chunk_pixels=chunk_pixels,
-            data_chunksize=data.chunksize[0:2],
-            data_shape=data.shape[0:2],
             n_chunks_min=n_chunks_min,
+            client=client,
         )
+        return plan.chunk_size
+
+    if isinstance(data, da.core.Array):
+        chunk_size = _plan_chunks(data.shape, data.dtype, data.chunksize[0:2])
         data = data.rechunk(chunks=(*chunk_size, data.shape[2]))
     elif isinstance(data, np.ndarray):
-        data = _array_numpy_to_dask(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min)
+        if data.ndim < 2:
+            raise ValueError(
+                f"Parameter 'data' must numpy array with at least 2 dimensions: type(data)={type(data)}"
+            )
+        # Since numpy array is not chunked, the original chunk size is (1, 1)
+        chunk_size = _plan_chunks((*data.shape[0:2], int(np.prod(data.shape[2:]))), data.dtype, None)
+        if shared_memory is None:
+            shared_memory = data.nbytes >= _SHARED_ARRAY_MIN_NBYTES
+        if shared_memory:
+            try:
+                file_obj = SharedArray(data)
+            except OSError as ex:
+                logger.warning(f"Failed to place XRF map in shared memory: {ex}")
+        if file_obj is not None:
+            # The workers read the blocks directly from shared memory
+            data = da.from_array(file_obj, chunks=(*chunk_size, *data.shape[2:]))
+        else:
+            data = _chunk_numpy_array(data, chunk_size)
     elif isinstance(data, RawHDF5Dataset):
         fpath, dset_name = data.abs_path, data.dset_name
 
@@ -391,12 +834,7 @@ def prepare_xrf_map(data, chunk_pixels=5000, n_chunks_min=4):
         ny, nx, ne = dset.shape
 
         if dset.chunks:
-            chunk_size = _compute_optimal_chunk_size(
-                chunk_pixels=chunk_pixels,
-                data_chunksize=dset.chunks[0:2],
-                data_shape=(ny, nx),
-                n_chunks_min=n_chunks_min,
-            )
+            chunk_size = _plan_chunks(dset.shape, dset.dtype, dset.chunks[0:2])
         else:
             # The data is not chunked. Process data as one chunk.
             chunk_size = (ny, nx)
@@ -451,9 +889,36 @@ def _prepare_xrf_mask(data, mask=None, selection=None):
         if len(selection) != 4:
             raise TypeError(f"Parameter 'selection' must be iterable with 4 elements: selection = {selection}")
 
+    mask = _combine_mask_and_selection(data.shape[0:2], mask=mask, selection=selection)
+    if mask is not None:
+        chunk_y, chunk_x = data.chunksize[0:2]
+        mask = _chunk_numpy_array(mask, (chunk_y, chunk_x))
+
+    return mask
+
+
+def _combine_mask_and_selection(map_shape, *, mask=None, selection=None):
+    """
+    Combine the mask and the selected area into a single mask (see `_prepare_xrf_mask`).
+
+    Parameters
+    ----------
+    map_shape: tuple(int)
+        the shape of the map `(ny, nx)`
+    mask: ndarray or None
+        mask represented as numpy array with dimensions (ny, nx)
+    selection: tuple or list or None
+        selected area represented as (y0, x0, ny_sel, nx_sel)
+
+    Returns
+    -------
+    ndarray or None
+        mask with the shape `(ny, nx)`, which contains ones for the selected pixels and zeros
+        for the pixels that are not selected. `None` if both `mask` and `selection` are `None`.
+    """
     if selection is not None:
         y0, x0, ny, nx = selection
-        mask_sel = np.zeros(shape=data.shape[0:2])
+        mask_sel = np.zeros(shape=map_shape)
         mask_sel[y0 : y0 + ny, x0 : x0 + nx] = 1
 
         if mask is None:
@@ -463,8 +928,6 @@ def _prepare_xrf_mask(data, mask=None, selection=None):
 
     if mask is not None:
         mask = (mask > 0).astype(dtype=int)
-        chunk_y, chunk_x = data.chunksize[0:2]
-        mask = _chunk_numpy_array(mask, (chunk_y, chunk_x))
 
     return mask
 
@@ -476,7 +939,7 @@ def _masked_sum(data, mask):
 
 
 def compute_total_spectrum(
-    data, *, selection=None, mask=None, chunk_pixels=5000, n_chunks_min=4, progress_bar=None, client=None
+    data, *, selection=None, mask=None, chunk_pixels=None, n_chunks_min=None, progress_bar=None, client=None
 ):
     """
     Parameters
@@ -489,18 +952,20 @@ def compute_total_spectrum(
         selected area represented as (y0, x0, ny_sel, nx_sel)
     mask: ndarray or None
         mask represented as numpy array with dimensions (ny, nx)
-    chunk_pixels: int
+    chunk_pixels: int or None
         The number of pixels in a single chunk. The XRF map will be rechunked so that
         each block contains approximately `chunk_pixels` pixels and contain all `ne`
-        spectrum points for each pixel.
-    n_chunks_min: int
+        spectrum points for each pixel. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
+    n_chunks_min: int or None
         Minimum number of chunks. The algorithm will try to split the map into the number
-        of chunks equal or greater than `n_chunks_min`.
+        of chunks equal or greater than `n_chunks_min`. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
     progress_bar: callable or None
         reference to the callable object that implements progress bar. The example of
         such a class for progress bar object is `TerminalProgressBar`.
     client: dask.distributed.Client or None
-        Dask client. If None, then local client will be created
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
 
     Returns
     -------
@@ -511,45 +976,41 @@ def compute_total_spectrum(
     if not isinstance(mask, np.ndarray) and (mask is not None):
         raise TypeError(f"Parameter 'mask' must be a numpy array or None: type(mask) = {type(mask)}")
 
-    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min)
-    mask = _prepare_xrf_mask(data, mask=mask, selection=selection)
-
     if client is None:
-        client = dask_client_create()
-        client_is_local = True
-    else:
-        client_is_local = False
+        client = dask_cluster_manager.get_client()
 
-    client.run(dask_set_custom_serializers)
-    dask_set_custom_serializers()
+    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client)
+    try:
+        mask = _prepare_xrf_mask(data, mask=mask, selection=selection)
 
-    n_workers = len(client.scheduler_info()["workers"])
-    logger.info(f"Dask distributed client: {n_workers} workers")
+        client.run(dask_set_custom_serializers)
+        dask_set_custom_serializers()
 
-    if mask is None:
-        result_fut = da.sum(da.sum(data, axis=0), axis=0).persist(scheduler=client)
-    else:
-        result_fut = da.blockwise(_masked_sum, "ijk", data, "ijk", mask, "ij", dtype="float").persist(
-            scheduler=client
-        )
+        n_workers = len(client.scheduler_info()["workers"])
+        logger.info(f"Dask distributed client: {n_workers} workers")
+
+        if mask is None:
+            result_fut = da.sum(da.sum(data, axis=0), axis=0).persist(scheduler=client)
+        else:
+            result_fut = da.blockwise(_masked_sum, "ijk", data, "ijk", mask, "ij", dtype="float").persist(
+                scheduler=client
+            )
 
-    # Call the progress monitor
-    wait_and_display_progress(result_fut, progress_bar)
+        # Call the progress monitor
+        wait_and_display_progress(result_fut, progress_bar)
 
-    result = result_fut.compute(scheduler=client)
-    if file_obj:
-        file_obj.close()
+        result = result_fut.compute(scheduler=client)
 
-    client.run(dask_close_all_files)
-    dask_close_all_files()
+    finally:
+        if file_obj:
+            file_obj.close()
+        client.run(dask_close_all_files)
+        dask_close_all_files()
 
     # # The following code is needed to cause Dask 'distributed>=2021.7.0' to close the h5file.
     # del result_fut
     # _dask_release_file_descriptors(client=client)
 
-    if client_is_local:
-        client.close()
-
     if mask is not None:
         # The sum computed for each block still needs to be assembled,
         #   but 'result' is much smaller array than 'data'
@@ -566,15 +1027,41 @@ def _process_block(data):
 
 def _process_block_with_mask(data, mask):
     data = data[0]  # Data is passed as a list of ndarrays
-    mask = np.broadcast_to(np.expand_dims(mask, axis=2), data.shape)
-    masked_data = data * mask
-    _spectrum = np.sum(np.sum(masked_data, axis=0), axis=0)
-    _count_total = np.sum(masked_data, axis=2)
+    # The masked copy of the data is not created
+    _spectrum = _weighted_block_spectrum(data, mask)
+    _count_total = np.sum(data, axis=2) * mask
     return np.array([[{"spectrum": _spectrum, "count_total": _count_total}]])
 
 
+def _weighted_block_spectrum(data, weights):
+    """
+    Returns the sum of spectra of the block of XRF data multiplied by the pixel weights.
+
+    Parameters
+    ----------
+    data: ndarray
+        block of XRF data, shape `(ny, nx, ne)`
+    weights: ndarray
+        weights of the pixels (e.g. the mask), shape `(ny, nx)`
+
+    Returns
+    -------
+    ndarray
+        weighted sum of the spectra, shape `(ne,)`
+    """
+    # Weights may be negative, so integer data is multiplied by floating point weights
+    weights = weights.astype(data.dtype if data.dtype.kind == "f" else np.float64, copy=False)
+    spectrum = np.zeros(shape=data.shape[2], dtype=np.float64)
+    # Rows are processed one by one in order to avoid creating the weighted copy of the block.
+    #   The sum is accumulated in double precision.
+    for n in range(data.shape[0]):
+        if weights[n].any():
+            spectrum += weights[n] @ data[n]
+    return spectrum
+
+
 def compute_total_spectrum_and_count(
-    data, *, selection=None, mask=None, chunk_pixels=5000, n_chunks_min=4, progress_bar=None, client=None
+    data, *, selection=None, mask=None, chunk_pixels=None, n_chunks_min=None, progress_bar=None, client=None
 ):
     """
     The function is similar to `compute_total_spectrum`, but computes both total
@@ -590,18 +1077,20 @@ def compute_total_spectrum_and_count(
         selected area represented as (y0, x0, ny_sel, nx_sel)
     mask: ndarray or None
         mask represented as numpy array with dimensions (ny, nx)
-    chunk_pixels: int
+    chunk_pixels: int or None
         The number of pixels in a single chunk. The XRF map will be rechunked so that
         each block contains approximately `chunk_pixels` pixels and contain all `ne`
-        spectrum points for each pixel.
-    n_chunks_min: int
+        spectrum points for each pixel. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
+    n_chunks_min: int or None
         Minimum number of chunks. The algorithm will try to split the map into the number
-        of chunks equal or greater than `n_chunks_min`.
+        of chunks equal or greater than `n_chunks_min`. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
     progress_bar: callable or None
         reference to the callable object that implements progress bar. The example of
         such a class for progress bar object is `TerminalProgressBar`.
     client: dask.distributed.Client or None
-        Dask client. If None, then local client will be created
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
 
     Returns
     -------
@@ -612,46 +1101,41 @@ def compute_total_spectrum_and_count(
     if not isinstance(mask, np.ndarray) and (mask is not None):
         raise TypeError(f"Parameter 'mask' must be a numpy array or None: type(mask) = {type(mask)}")
 
-    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min)
-    mask = _prepare_xrf_mask(data, mask=mask, selection=selection)
-
     if client is None:
-        client = dask_client_create()
-        client_is_local = True
-    else:
-        client_is_local = False
+        client = dask_cluster_manager.get_client()
 
-    client.run(dask_set_custom_serializers)
-    dask_set_custom_serializers()
+    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client)
+    try:
+        mask = _prepare_xrf_mask(data, mask=mask, selection=selection)
 
-    n_workers = len(client.scheduler_info()["workers"])
-    logger.info(f"Dask distributed client: {n_workers} workers")
+        client.run(dask_set_custom_serializers)
+        dask_set_custom_serializers()
 
-    if mask is None:
-        result_fut = da.blockwise(_process_block, "ij", data, "ijk", dtype=float).persist(scheduler=client)
-    else:
-        result_fut = da.blockwise(_process_block_with_mask, "ij", data, "ijk", mask, "ij", dtype=float).persist(
-            scheduler=client
-        )
+        n_workers = len(client.scheduler_info()["workers"])
+        logger.info(f"Dask distributed client: {n_workers} workers")
 
-    # Call the progress monitor
-    wait_and_display_progress(result_fut, progress_bar)
+        if mask is None:
+            result_fut = da.blockwise(_process_block, "ij", data, "ijk", dtype=float).persist(scheduler=client)
+        else:
+            result_fut = da.blockwise(
+                _process_block_with_mask, "ij", data, "ijk", mask, "ij", dtype=float
+            ).persist(scheduler=client)
 
-    result = result_fut.compute(scheduler=client)
+        # Call the progress monitor
+        wait_and_display_progress(result_fut, progress_bar)
 
-    if file_obj:
-        file_obj.close()
+        result = result_fut.compute(scheduler=client)
 
-    client.run(dask_close_all_files)
-    dask_close_all_files()
+    finally:
+        if file_obj:
+            file_obj.close()
+        client.run(dask_close_all_files)
+        dask_close_all_files()
 
     # # The following code is needed to cause Dask 'distributed>=2021.7.0' to close the h5file.
     # del result_fut
     # _dask_release_file_descriptors(client=client)
 
-    if client_is_local:
-        client.close()
-
     # Assemble results
     total_counts = np.block([[_2["count_total"] for _2 in _1] for _1 in result])
     total_spectrum = sum([_["spectrum"] for _ in result.flatten()])
@@ -659,7 +1143,285 @@ def compute_total_spectrum_and_count(
     return total_spectrum, total_counts
 
 
-def _fit_xrf_block(data, data_sel_indices, matv, snip_param, use_snip):
+def _compute_weighted_block_spectra(data, weights, block_indices, offsets, *, progress_bar=None, client):
+    """
+    Compute weighted sums of spectra for the selected blocks of XRF data (see `TotalSpectrumIndex`).
+    Returns the sum of the results for all blocks. Only the selected blocks are loaded.
+    """
+    if not block_indices:
+        return 0
+
+    offsets_y, offsets_x = offsets
+    # Only a few blocks are typically loaded, so the map is not copied to shared memory
+    data, file_obj = prepare_xrf_map(data, client=client, shared_memory=False)
+    try:
+        client.run(dask_set_custom_serializers)
+        dask_set_custom_serializers()
+
+        tasks = []
+        for iy, ix in block_indices:
+            y0, y1 = offsets_y[iy], offsets_y[iy + 1]
+            x0, x1 = offsets_x[ix], offsets_x[ix + 1]
+            tasks.append(dask.delayed(_weighted_block_spectrum)(data[y0:y1, x0:x1, :], weights[y0:y1, x0:x1]))
+        futures = client.compute(tasks)
+        wait_and_display_progress(futures, progress_bar)
+        results = client.gather(futures)
+    finally:
+        if file_obj:
+            file_obj.close()
+        client.run(dask_close_all_files)
+        dask_close_all_files()
+
+    return np.sum(results, axis=0)
+
+
+class TotalSpectrumIndex:
+    """
+    Index of partial sums of XRF map, which is used to compute the total spectrum and the total
+    count map for changing spatial ROI (selection) and mask without processing the whole map.
+
+    The index is built in a single pass over the data (the same pass as
+    `compute_total_spectrum_and_count`). The index contains the total count map and the sum of spectra
+    for each block of the map (the blocks match the chunks of the XRF map). The total count map for
+    any selection and mask is computed from the stored map without loading the data. The total spectrum
+    is computed as the sum of precomputed spectra of the blocks that are fully selected and the weighted
+    sums of spectra of the partially selected blocks (only those blocks are loaded). Alternatively,
+    the spectrum is computed by applying the difference between the new and the last selection
+    (e.g. the mask was edited or selected area was moved) to the last computed spectrum: only
+    the blocks that contain the changed pixels are loaded. The method that requires loading
+    the smallest number of blocks is selected.
+
+    Examples
+    --------
+    .. code-block:: python
+
+        index = TotalSpectrumIndex(data)  # Processes the whole map
+        spectrum, count = index.get_spectrum_and_count(selection=(10, 20, 50, 60))
+        spectrum, count = index.get_spectrum_and_count(selection=(10, 22, 50, 60), mask=mask)
+
+    Parameters
+    ----------
+    data: da.core.Array, np.ndarray or RawHDF5Dataset (this is a custom type)
+        Raw XRF map with dimensions `(ny, nx, ne)` (see `compute_total_spectrum_and_count`).
+        The reference to the data is kept by the object.
+    chunk_pixels: int or None
+        The number of pixels in a single chunk (see `compute_total_spectrum_and_count`).
+    n_chunks_min: int or None
+        Minimum number of chunks (see `compute_total_spectrum_and_count`).
+    progress_bar: callable or None
+        reference to the callable object that implements progress bar.
+    client: dask.distributed.Client or None
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+    """
+
+    def __init__(self, data, *, chunk_pixels=None, n_chunks_min=None, progress_bar=None, client=None):
+        if client is None:
+            client = dask_cluster_manager.get_client()
+
+        self._data = data
+        data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client)
+        try:
+            client.run(dask_set_custom_serializers)
+            dask_set_custom_serializers()
+
+            result_fut = da.blockwise(_process_block, "ij", data, "ijk", dtype=float).persist(scheduler=client)
+            wait_and_display_progress(result_fut, progress_bar)
+            result = result_fut.compute(scheduler=client)
+
+        finally:
+            if file_obj:
+                file_obj.close()
+            client.run(dask_close_all_files)
+            dask_close_all_files()
+
+        self._offsets = (np.cumsum((0,) + data.chunks[0]), np.cumsum((0,) + data.chunks[1]))
+        # Sums of spectra for each block, shape (n_blocks_y, n_blocks_x, ne)
+        self._block_spectra = np.array([[_2["spectrum"] for _2 in _1] for _1 in result], dtype=np.float64)
+        self._total_count = np.block([[_2["count_total"] for _2 in _1] for _1 in result])
+        self._block_n_pixels = np.outer(data.chunks[0], data.chunks[1])
+
+        # The last selection (combined mask) and the respective total spectrum
+        self._last_mask = None
+        self._last_spectrum = None
+
+    @property
+    def map_shape(self):
+        """
+        The shape of the map `(ny, nx)`.
+        """
+        return self._total_count.shape
+
+    def _sum_over_blocks(self, mask):
+        # The sum of values of 'mask' over each block
+        offsets_y, offsets_x = self._offsets
+        return np.add.reduceat(np.add.reduceat(mask, offsets_y[:-1], axis=0), offsets_x[:-1], axis=1)
+
+    def get_spectrum_and_count(self, *, selection=None, mask=None, progress_bar=None, client=None):
+        """
+        Compute the total spectrum and the total count map for the selected area and mask.
+        The results are the same as the results of `compute_total_spectrum_and_count`.
+
+        Parameters
+        ----------
+        selection: tuple or list or None
+            selected area represented as (y0, x0, ny_sel, nx_sel)
+        mask: ndarray or None
+            mask represented as numpy array with dimensions (ny, nx)
+        progress_bar: callable or None
+            reference to the callable object that implements progress bar.
+        client: dask.distributed.Client or None
+            Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+
+        Returns
+        -------
+        total_spectrum: ndarray
+            total spectrum, shape `(ne,)`
+        total_count: ndarray
+            total count map, shape `(ny, nx)`
+        """
+        if not isinstance(mask, np.ndarray) and (mask is not None):
+            raise TypeError(f"Parameter 'mask' must be a numpy array or None: type(mask) = {type(mask)}")
+        if (mask is not None) and (mask.shape != self.map_shape):
+            raise TypeError(
+                f"The shape of the mask {mask.shape} does not match the shape of the map {self.map_shape}"
+            )
+        if selection is not None and len(selection) != 4:
+            raise TypeError(f"Parameter 'selection' must be iterable with 4 elements: selection = {selection}")
+
+        mask = _combine_mask_and_selection(self.map_shape, mask=mask, selection=selection)
+        if mask is None:
+            return np.sum(self._block_spectra, axis=(0, 1)), self._total_count.copy()
+
+        # Blocks that need to be loaded if the spectrum is computed from the precomputed block sums
+        n_selected = self._sum_over_blocks(mask)
+        blocks_full = n_selected == self._block_n_pixels
+        blocks_partial = (n_selected > 0) & ~blocks_full
+
+        # Blocks that need to be loaded if the spectrum is computed based on the last spectrum
+        mask_diff, blocks_changed = None, None
+        if self._last_mask is not None:
+            mask_diff = mask - self._last_mask
+            blocks_changed = self._sum_over_blocks(np.abs(mask_diff)) > 0
+
+        if client is None:
+            client = dask_cluster_manager.get_client()
+
+        if (blocks_changed is not None) and (np.sum(blocks_changed) < np.sum(blocks_partial)):
+            logger.debug(f"Updating the total spectrum: {np.sum(blocks_changed)} blocks are changed.")
+            block_indices = list(zip(*np.nonzero(blocks_changed)))
+            spectrum = self._last_spectrum + _compute_weighted_block_spectra(
+                self._data, mask_diff, block_indices, self._offsets, progress_bar=progress_bar, client=client
+            )
+        else:
+            logger.debug(f"Computing the total spectrum: {np.sum(blocks_partial)} blocks are partially selected.")
+            block_indices = list(zip(*np.nonzero(blocks_partial)))
+            spectrum = np.tensordot(blocks_full.astype(float), self._block_spectra, axes=((0, 1), (0, 1)))
+            spectrum = spectrum + _compute_weighted_block_spectra(
+                self._data, mask, block_indices, self._offsets, progress_bar=progress_bar, client=client
+            )
+
+        self._last_mask, self._last_spectrum = mask, spectrum
+        return spectrum.copy(), self._total_count * mask
+
+
+def bin_xrf_map(
+    data, *, pixel_bin=1, bin_energy=1, chunk_pixels=None, n_chunks_min=None, client=None, shared_memory=None
+):
+    """
+    Bin XRF map spatially and/or along the energy axis. The binning is performed lazily:
+    the function returns Dask array, which may be passed to `fit_xrf_map` or other functions
+    processing XRF maps. The counts in each `pixel_bin x pixel_bin` window of pixels and
+    in each group of `bin_energy` adjacent energy bins are summed. The pixels and energy bins
+    that do not fit into whole windows at the end of each axis are discarded.
+
+    Parameters
+    ----------
+    data: da.core.Array, np.ndarray or RawHDF5Dataset
+        Raw XRF map, shape `(ny, nx, ne)` (see `prepare_xrf_map`).
+    pixel_bin: int
+        the size of the window of binned pixels along each axis (1 - no binning, 2 - 2x2 pixels etc.)
+    bin_energy: int
+        the number of adjacent energy bins that are summed (1 - no binning)
+    chunk_pixels: int or None
+        The number of pixels in a single chunk of the raw map (see `prepare_xrf_map`).
+    n_chunks_min: int or None
+        Minimum number of chunks of the raw map (see `prepare_xrf_map`).
+    client: dask.distributed.Client or None
+        Dask client used to determine resources of the workers (see `prepare_xrf_map`).
+    shared_memory: bool or None
+        copy in-memory map to shared memory (see `prepare_xrf_map`).
+
+    Returns
+    -------
+    data: da.core.Array
+        binned XRF map, shape `(ny // pixel_bin, nx // pixel_bin, ne // bin_energy)`.
+    file_obj: h5py.File object, SharedArray or None
+        File object returned by `prepare_xrf_map`. Must be kept open until processing is completed.
+    """
+    for name, value in (("pixel_bin", pixel_bin), ("bin_energy", bin_energy)):
+        if not isinstance(value, (int, np.integer)) or value < 1:
+            raise ValueError(f"Parameter {name!r} must be a positive integer: {name} = {value!r}")
+
+    data, file_obj = prepare_xrf_map(
+        data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client, shared_memory=shared_memory
+    )
+
+    ny, nx, ne = data.shape
+    ny_bin, nx_bin, ne_bin = ny // pixel_bin, nx // pixel_bin, ne // bin_energy
+    if not ny_bin or not nx_bin or not ne_bin:
+        if file_obj:
+            file_obj.close()
+        raise ValueError(
+            f"XRF map of shape {data.shape} is too small for binning: "
+            f"pixel_bin = {pixel_bin}, bin_energy = {bin_energy}"
+        )
+
+    if (pixel_bin == 1) and (bin_energy == 1):
+        return data, file_obj
+
+    # Each chunk must contain whole number of binning windows
+    data = data[: ny_bin * pixel_bin, : nx_bin * pixel_bin, : ne_bin * bin_energy]
+    chunk_y, chunk_x = [max(_ // pixel_bin, 1) * pixel_bin for _ in data.chunksize[0:2]]
+    data = data.rechunk(chunks=(chunk_y, chunk_x, data.shape[2]))
+
+    return da.coarsen(np.sum, data, {0: pixel_bin, 1: pixel_bin, 2: bin_energy}), file_obj
+
+
+def bin_map(data, *, pixel_bin=1, average=False):
+    """
+    Bin 2D map (e.g. scaler or positional data) in the same way as XRF map is binned by `bin_xrf_map`:
+    the values in each `pixel_bin x pixel_bin` window of pixels are summed or averaged.
+    The pixels that do not fit into whole windows at the end of each axis are discarded.
+    Scalers are summed (the same as counts in XRF map), positions are averaged.
+
+    Parameters
+    ----------
+    data: ndarray
+        2D map, shape `(ny, nx)`
+    pixel_bin: int
+        the size of the window of binned pixels along each axis (1 or 0 - no binning)
+    average: bool
+        compute the mean of the values in each window instead of the sum
+
+    Returns
+    -------
+    ndarray
+        binned map, shape `(ny // pixel_bin, nx // pixel_bin)`
+    """
+    data = np.asarray(data)
+    pixel_bin = max(int(pixel_bin), 1)
+    if data.ndim != 2:
+        raise ValueError(f"Parameter 'data' must be 2D array: data.shape = {data.shape}")
+    if pixel_bin == 1:
+        return data
+
+    ny_bin, nx_bin = data.shape[0] // pixel_bin, data.shape[1] // pixel_bin
+    data = data[: ny_bin * pixel_bin, : nx_bin * pixel_bin]
+    data = np.reshape(data, (ny_bin, pixel_bin, nx_bin, pixel_bin))
+    return np.mean(data, axis=(1, 3)) if average else np.sum(data, axis=(1, 3))
+
+
+def _fit_xrf_block(data, data_sel_indices, matv, snip_param, use_snip, fitting_method="nnls"):
     """
     Spectrum fitting for a block of XRF dataset. The function is intended to be
     called using `map_blocks` function for parallel processing using Dask distributed
@@ -682,6 +1444,8 @@ def _fit_xrf_block(data, data_sel_indices, matv, snip_param, use_snip):
         `b_width` (width of the window that defines resolution of the snip algorithm).
     use_snip: bool, optional
         enable/disable background removal using snip algorithm
+    fitting_method: str, optional
+        method used for fitting, passed to `fit_spectrum`: `nnls` or `nnls_gram`.
 
     Returns
     -------
@@ -691,31 +1455,49 @@ def _fit_xrf_block(data, data_sel_indices, matv, snip_param, use_snip):
         line spectra; background area (only in the selected energy range), error (R-factor),
         total count in the selected energy range, total count of the full experimental spectrum.
     """
-    spec = data
-    spec_sel = spec[:, :, data_sel_indices[0] : data_sel_indices[1]]
-
-    if use_snip:
-        bg_sel = np.apply_along_axis(
-            snip_method_numba,
-            2,
-            spec_sel,
-            snip_param["e_offset"],
-            snip_param["e_linear"],
-            snip_param["e_quadratic"],
-            width=snip_param["b_width"],
-        )
+    spec_sel = data[:, :, data_sel_indices[0] : data_sel_indices[1]]
+    bg_sel = _snip_block_background(spec_sel, snip_param) if use_snip else None
+
+    return _fit_block_spectra(
+        spec_sel,
+        bg_sel,
+        matv,
+        fitting_method=fitting_method,
+        sel_cnt=np.sum(spec_sel, axis=2),
+        total_cnt=np.sum(data, axis=2),
+    )
+
+
+def _snip_block_background(spec_sel, snip_param):
+    """
+    Estimate the background of each spectrum in the block using SNIP algorithm.
+    `spec_sel` is the block of XRF data (shape `(ny, nx, n_sel)`) limited to the selected
+    range of energies. See `_fit_xrf_block` for the description of `snip_param`.
+    """
+    return snip_method_numba_block(
+        spec_sel,
+        snip_param["e_offset"],
+        snip_param["e_linear"],
+        snip_param["e_quadratic"],
+        width=snip_param["b_width"],
+    )
 
+
+def _fit_block_spectra(spec_sel, bg_sel, matv, *, fitting_method, sel_cnt, total_cnt):
+    """
+    Fit the spectra of the block of XRF data (see `_fit_xrf_block`). The background
+    `bg_sel` is computed by `_snip_block_background` or `None` if background is not removed.
+    `sel_cnt` and `total_cnt` are the maps of total counts in the selected energy range and
+    in the full spectrum. Returns the array with the same layout as `_fit_xrf_block`.
+    """
+    if bg_sel is not None:
         y = spec_sel - bg_sel
         bg_sum = np.sum(bg_sel, axis=2)
-
     else:
         y = spec_sel
-        bg_sum = np.zeros(shape=data.shape[0:2])
+        bg_sum = np.zeros(shape=spec_sel.shape[0:2])
 
-    weights, rfactor, _ = fit_spectrum(y, matv, axis=2, method="nnls")
-
-    total_cnt = np.sum(spec, axis=2)
-    sel_cnt = np.sum(spec_sel, axis=2)
+    weights, rfactor, _ = fit_spectrum(y, matv, axis=2, method=fitting_method)
 
     # Stack depth-wise (along axis 2)
     data_out = np.dstack((weights, bg_sum, rfactor, sel_cnt, total_cnt))
@@ -749,69 +1531,131 @@ def _fit_xrf_block(data, data_sel_indices, matv, snip_param, use_snip):
 #         client.run(trim_memory)
 
 
-def fit_xrf_map(
-    data,
-    data_sel_indices,
-    matv,
-    snip_param=None,
-    use_snip=True,
-    chunk_pixels=5000,
-    n_chunks_min=4,
-    progress_bar=None,
-    client=None,
-):
+def _check_cache_type(cache):
+    if (cache is not None) and not isinstance(cache, BlockResultCache):
+        raise TypeError(f"Parameter 'cache' must be BlockResultCache or None: type(cache) = {type(cache)}")
+
+
+def _create_hdf5_output_dataset(output, *, data_shape, chunk_size):
     """
-    Fit XRF map.
+    Create (or recreate) the dataset for the XRF maps specified by `output`. The dataset
+    has the shape `(n_maps, ny, nx)` and is chunked so that each chunk contains a part
+    of a single map matching the processing blocks.
 
     Parameters
     ----------
-    data: da.core.Array, np.ndarray or RawHDF5Dataset (this is a custom type)
-        Raw XRF map represented as Dask array, numpy array or reference to a dataset in
-        HDF5 file. The XRF map must have dimensions `(ny, nx, ne)`, where `ny` and `nx`
-        define image size and `ne` is the number of spectrum points
-    data_sel_indices: tuple
-        tuple `(n_start, n_end)` which defines the indices along axis 2 of `data` array
-        that are used for fitting. Note that `ne` (in `data`) and `ne_model` (in `matv`)
-        are not equal. But `n_end - n_start` MUST be equal to `ne_model`! Indexes
-        `n_start .. n_end - 1` will be selected from each pixel.
-    matv: array
-        Matrix of spectra of the selected elements (emission lines). Shape=(ne_model, n_lines)
-    snip_param: dict
-        Dictionary of parameters forwarded to 'snip' method for background removal.
-        Keys: `e_offset`, `e_linear`, `e_quadratic` (parameters of the energy axis approximation),
-        `b_width` (width of the window that defines resolution of the snip algorithm).
-        It may be an empty dictionary or None if `use_snip` is `False`.
-    use_snip: bool, optional
-        enable/disable background removal using snip algorithm
-    chunk_pixels: int
-        The number of pixels in a single chunk. The XRF map will be rechunked so that
-        each block contains approximately `chunk_pixels` pixels and contain all `ne`
-        spectrum points for each pixel.
-    n_chunks_min: int
-        Minimum number of chunks. The algorithm will try to split the map into the number
-        of chunks equal or greater than `n_chunks_min`.
-    progress_bar: callable or None
-        reference to the callable object that implements progress bar. The example of
-        such a class for progress bar object is `TerminalProgressBar`.
-    client: dask.distributed.Client or None
-        Dask client. If None, then local client will be created
+    output: RawHDF5Dataset
+        reference to the output dataset. `output.shape` must be `(n_maps, ny, nx)`.
+    data_shape: tuple(int)
+        `(ny, nx)` - the dimensions of the XRF map
+    chunk_size: tuple(int)
+        `(chunk_y, chunk_x)` - the size of the processing blocks
+    """
+    n_maps, ny, nx = output.shape
+    if (ny, nx) != tuple(data_shape):
+        raise ValueError(
+            f"The shape of the output dataset {output.shape} does not match the shape of the map {data_shape}"
+        )
 
-    Returns
-    -------
-    results: ndarray
-        array with fitting results. Shape: `(ny, nx, ne_model + 4)`. For each pixel
-        the output data contains: `ne_model` values that represent area under the emission
-        line spectra; background area (only in the selected energy range), error (R-factor),
-        total count in the selected energy range, total count of the full experimental spectrum.
+    chunks = (1, min(chunk_size[0], ny), min(chunk_size[1], nx))
+    with h5py.File(output.abs_path, "a") as f:
+        if output.dset_name in f:
+            del f[output.dset_name]
+        dset = f.create_dataset(output.dset_name, shape=output.shape, dtype="float64", chunks=chunks, fillvalue=0)
+        dset.attrs["comments"] = " "
+
+
+def _compute_and_save_blocks(data, output, *, client, progress_bar=None, weights_scale=None, n_features=None):
     """
+    Compute blocks of the Dask array `data` and write each block to the preallocated
+    HDF5 dataset as soon as it is computed. The blocks are released as soon as
+    they are written, so the complete array is never held in memory.
 
-    logger.info("Starting single-pixel fitting ...")
-    logger.info(f"Baseline subtraction (SNIP): {'enabled' if use_snip else 'disabled'}.")
+    Parameters
+    ----------
+    data: da.core.Array
+        Dask array of the shape `(ny, nx, n_features)`, chunked only along axes 0 and 1.
+    output: RawHDF5Dataset or list(RawHDF5Dataset)
+        reference to the existing dataset of the shape `(n_maps, ny, nx)`. The dataset may
+        contain more maps than `n_features`. The remaining maps are not modified. If `output`
+        is a list of datasets, then the features are split between the datasets: the dataset
+        `output[n]` receives `n_features[n]` consecutive features.
+    client: dask.distributed.Client
+        Dask client
+    progress_bar: callable or None
+        reference to the callable object that implements progress bar. The example of
+        such a class for progress bar object is `TerminalProgressBar`.
+    weights_scale: ndarray, list(ndarray) or None
+        1D array of scaling factors, which are applied to the features `0 .. len(weights_scale) - 1`
+        before they are written to the file. If `output` is a list, then `weights_scale` is a list
+        of arrays (or `None`) for each dataset.
+    n_features: list(int) or None
+        the number of features written to each dataset. Required if `output` is a list.
+    """
+    if isinstance(output, RawHDF5Dataset):
+        output, weights_scale, n_features = [output], [weights_scale], [data.shape[2]]
+    elif weights_scale is None:
+        weights_scale = [None] * len(output)
+    offsets_features = np.cumsum([0] + list(n_features))
 
-    if snip_param is None:
-        snip_param = {}  # For consistency
+    offsets_y = np.cumsum((0,) + data.chunks[0])
+    offsets_x = np.cumsum((0,) + data.chunks[1])
 
-    # Verify that input parameters are valid
+    blocks = data.to_delayed()
+    block_indices = [(ny, nx) for ny in range(blocks.shape[0]) for nx in range(blocks.shape[1])]
+    futures = client.compute([blocks[ny, nx, 0] for ny, nx in block_indices])
+    future_indices = {fut.key: ind for fut, ind in zip(futures, block_indices)}
+
+    if progress_bar is not None and hasattr(progress_bar, "start"):
+        progress_bar.start()
+
+    n_total, n_completed = len(futures), 0
+    with contextlib.ExitStack() as stack:
+        # The datasets may be located in the same file
+        files = {}
+        for out in output:
+            if out.abs_path not in files:
+                files[out.abs_path] = stack.enter_context(h5py.File(out.abs_path, "a"))
+        dsets = [files[_.abs_path][_.dset_name] for _ in output]
+
+        for fut in as_completed(futures):
+            block = fut.result()
+            ny, nx = future_indices[fut.key]
+            fut.release()
+
+            y0, y1 = offsets_y[ny], offsets_y[ny + 1]
+            x0, x1 = offsets_x[nx], offsets_x[nx + 1]
+            for n, dset in enumerate(dsets):
+                block_out = block[:, :, offsets_features[n] : offsets_features[n + 1]]
+                if weights_scale[n] is not None:
+                    n_scaled = len(weights_scale[n])
+                    block_out = np.array(block_out)
+                    block_out[:, :, :n_scaled] = block_out[:, :, :n_scaled] * weights_scale[n]
+                dset[0 : block_out.shape[2], y0:y1, x0:x1] = np.moveaxis(block_out, 2, 0)
+
+            n_completed += 1
+            if progress_bar is not None:
+                progress_bar(n_completed / n_total * 100.0)
+
+    if progress_bar is not None and hasattr(progress_bar, "finish"):
+        progress_bar.finish()
+
+
+def _copy_hdf5_dataset(src, dest):
+    """
+    Copy the dataset `src` (RawHDF5Dataset) to `dest` (RawHDF5Dataset). The existing
+    dataset `dest` is replaced.
+    """
+    with h5py.File(dest.abs_path, "a") as f_dest, h5py.File(src.abs_path, "r") as f_src:
+        if dest.dset_name in f_dest:
+            del f_dest[dest.dset_name]
+        f_src.copy(f_src[src.dset_name], f_dest, name=dest.dset_name)
+
+
+def _check_data_sel_indices(data_sel_indices):
+    """
+    Verify that `data_sel_indices` is a valid selection of energy bins. Raises `TypeError` or `ValueError`.
+    """
     if not isinstance(data_sel_indices, (tuple, list)):
         raise TypeError(
             f"Parameter 'data_sel_indices' must be tuple or list: "
@@ -834,6 +1678,13 @@ def fit_xrf_map(
             f"data_sel_indices = {data_sel_indices}"
         )
 
+
+def _check_fit_xrf_map_params(data_sel_indices, matv, snip_param, use_snip, fitting_method):
+    """
+    Verify that the parameters of `fit_xrf_map` are valid. Raises `TypeError` or `ValueError`.
+    """
+    _check_data_sel_indices(data_sel_indices)
+
     if not isinstance(matv, np.ndarray) or matv.ndim != 2:
         raise TypeError(f"Parameter 'matv' must be 2D ndarray: type(matv) = {type(matv)}, matv = {matv}")
 
@@ -848,6 +1699,12 @@ def fit_xrf_map(
     if not isinstance(snip_param, dict):
         raise TypeError(f"Parameter 'snip_param' must be a dictionary: type(snip_param) = {type(snip_param)}")
 
+    supported_fitting_methods = ("nnls", "nnls_gram")
+    if fitting_method not in supported_fitting_methods:
+        raise ValueError(
+            f"Fitting method {fitting_method!r} is not supported. Supported methods: {supported_fitting_methods}"
+        )
+
     required_keys = ("e_offset", "e_linear", "e_quadratic", "b_width")
     if use_snip and not all([_ in snip_param.keys() for _ in required_keys]):
         raise TypeError(
@@ -855,145 +1712,135 @@ def fit_xrf_map(
             f"snip_param.keys() = {snip_param.keys()}"
         )
 
-    # Convert data to Dask array
-    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min)
-    data_is_from_file = bool(file_obj)
-
-    # Verify that selection makes sense (data is Dask array at this point)
-    _, _, ne = data.shape
-    if data_sel_indices[0] >= ne or data_sel_indices[1] > ne:
-        raise ValueError(f"Selection indices {data_sel_indices} are outside the allowed range 0 .. {ne}")
-
-    if client is None:
-        client = dask_client_create()
-        client_is_local = True
-    else:
-        client_is_local = False
-
-    client.run(dask_set_custom_serializers)
-    dask_set_custom_serializers()
-
-    n_workers = len(client.scheduler_info()["workers"])
-    logger.info(f"Dask distributed client: {n_workers} workers")
-
-    matv_fut = client.scatter(matv)
-    result_fut = da.map_blocks(
-        _fit_xrf_block,
-        data,
-        # Parameters of the '_fit_xrf_block' function
-        data_sel_indices=data_sel_indices,
-        matv=matv_fut,
-        snip_param=snip_param,
-        use_snip=use_snip,
-        # Output data type
-        dtype="float",
-    ).persist(scheduler=client)
-
-    # Call the progress monitor
-    wait_and_display_progress(result_fut, progress_bar)
-
-    result = result_fut.compute(scheduler=client)
-
-    if data_is_from_file:
-        file_obj.close()
-
-    client.run(dask_close_all_files)
-    dask_close_all_files()
-
-    # # The following code is needed to cause Dask 'distributed>=2021.7.0' to close the h5file.
-    # del result_fut
-    # _dask_release_file_descriptors(client=client)
-
-    if client_is_local:
-        client.close()
 
-    return result
+# Futures of the arrays scattered to the workers (see `_scatter_cached`)
+_scattered_arrays = collections.OrderedDict()
+_scattered_arrays_lock = threading.Lock()
+# The maximum number of scattered arrays kept on the workers
+_SCATTERED_ARRAYS_MAX = 8
 
 
-def _compute_roi(data, data_sel_indices, roi_bands, snip_param, use_snip):
+def _scatter_cached(client, data):
     """
-    Compute intensity for ROIs (energy bands) in XRF datasets. The function is intended to be
-    called using `map_blocks` function for parallel processing using Dask distributed
-    package.
+    Scatter the array (e.g. `matv`) to the workers. The array is sent to the workers only once:
+    if the array with the same contents was already scattered using the same client, then
+    the existing future is returned. Only a few most recently scattered arrays are kept on
+    the workers.
 
     Parameters
     ----------
-    data : ndarray
-        block of an XRF dataset. Shape=(ny, nx, ne).
-    data_sel_indices: tuple
-        tuple `(n_start, n_end)` which defines the indices along axis 2 of `data` array
-        that are used for fitting. Note that `ne` (in `data`). Indexes
-        `n_start .. n_end - 1` will be selected from each pixel.
-    roi_bands: list(tuple)
-        list of ROI bands, elements are tuples `(left_val, right_val)`, where `left_val` and
-        `right_val` are energy values in keV that define the ROI band. If `left_val >= right_val`,
-        then the width of the band is considered zero and and ROI will be zero.
-    snip_param: dict
-        Dictionary of parameters forwarded to 'snip' method for background removal.
-        Keys: `e_offset`, `e_linear`, `e_quadratic` (parameters of the energy axis approximation),
-        `b_width` (width of the window that defines resolution of the snip algorithm).
-        The values of `e_offset` and `e_linear` are used to compute indices for ROIs, so they
-        need to be always provided.
-    use_snip: bool, optional
-        enable/disable background removal using snip algorithm
+    client: dask.distributed.Client
+        Dask client
+    data: ndarray
+        the array to scatter
 
     Returns
     -------
-    data_out: ndarray
-        array with ROI counts. Shape: `(ny, nx, len(roi_bands))`. For each pixel
-        the output data contains `len(roi_bands)` values that represent area under
-        the experimental spectrum inside the band.
+    dask.distributed.Future
+        future that references the scattered array
     """
-    spec = data
-    spec_sel = spec[:, :, data_sel_indices[0] : data_sel_indices[1]]
+    key = (client.id, dask.base.tokenize(data))
+    with _scattered_arrays_lock:
+        future = _scattered_arrays.get(key, None)
+        if (future is not None) and (future.status == "finished"):
+            _scattered_arrays.move_to_end(key)
+            return future
 
-    e_offset = snip_param["e_offset"]
-    e_linear = snip_param["e_linear"]
-    e_quadratic = snip_param["e_quadratic"]
-
-    if use_snip:
-        bg_sel = np.apply_along_axis(
-            snip_method_numba, 2, spec_sel, e_offset, e_linear, e_quadratic, width=snip_param["b_width"]
-        )
-        y = spec_sel - bg_sel
+        future = client.scatter(data)
+        _scattered_arrays[key] = future
+        while len(_scattered_arrays) > _SCATTERED_ARRAYS_MAX:
+            _scattered_arrays.popitem(last=False)
+        return future
 
-    else:
-        y = spec_sel
 
-    # The number of available spectrum points
-    ny, nx, n_pts = y.shape
-    n_sel_start = data_sel_indices[0]
+def _create_fit_xrf_map_graph(
+    data,
+    data_sel_indices,
+    matv,
+    snip_param,
+    use_snip,
+    *,
+    chunk_pixels,
+    n_chunks_min,
+    client,
+    fitting_method,
+    cache,
+):
+    """
+    Convert the XRF map to Dask array and create the graph for fitting of the map. The parameters
+    are the same as for `fit_xrf_map` and must be verified using `_check_fit_xrf_map_params`.
 
-    def _energy_to_index(energy):
-        # 'y' is truncated array, and energy axis is aligned with the full array
-        n_index = int(round((energy - e_offset) / e_linear)) - n_sel_start
-        n_index = int(np.clip(n_index, a_min=0, a_max=n_pts - 1))
-        return n_index
+    Returns
+    -------
+    result: da.core.Array
+        Dask array with the results of fitting, shape `(ny, nx, n_lines + 4)`
+    file_obj: h5py.File or None
+        file object returned by `prepare_xrf_map`. The file must be kept open until the
+        processing is completed.
+    """
+    # Convert data to Dask array
+    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client)
+
+    try:
+        # Verify that selection makes sense (data is Dask array at this point)
+        ne = data.shape[2]
+        if data_sel_indices[0] >= ne or data_sel_indices[1] > ne:
+            raise ValueError(f"Selection indices {data_sel_indices} are outside the allowed range 0 .. {ne}")
+
+        # The digest of the parameters that define the results (used only if the cache is enabled)
+        params_digest = (
+            cache.params_digest("fit_xrf_block", data_sel_indices, matv, snip_param, use_snip, fitting_method)
+            if cache is not None
+            else None
+        )
 
-    roi_data = np.zeros(shape=(ny, nx, len(roi_bands)))
-    for n, band in enumerate(roi_bands):
-        n_left = _energy_to_index(band[0])
-        n_right = _energy_to_index(band[1])
-        roi_data[:, :, n] = (
-            np.sum(y[:, :, n_left:n_right], axis=2) if n_right > n_left else np.zeros(shape=(ny, nx))
+        matv_fut = _scatter_cached(client, matv)
+        result = da.map_blocks(
+            cached_block_func,
+            data,
+            block_func=_fit_xrf_block,
+            cache=cache,
+            params_digest=params_digest,
+            # Parameters of the '_fit_xrf_block' function
+            data_sel_indices=data_sel_indices,
+            matv=matv_fut,
+            snip_param=snip_param,
+            use_snip=use_snip,
+            fitting_method=fitting_method,
+            # The output blocks have different size along axis 2
+            chunks=(*data.chunks[0:2], (matv.shape[1] + 4,)),
+            # Output data type
+            dtype="float",
         )
+    except Exception:
+        if file_obj:
+            file_obj.close()
+        raise
 
-    return roi_data
+    return result, file_obj
 
 
-def compute_selected_rois(
+def fit_xrf_map(
     data,
     data_sel_indices,
-    roi_dict,
+    matv,
     snip_param=None,
     use_snip=True,
-    chunk_pixels=5000,
-    n_chunks_min=4,
+    chunk_pixels=None,
+    n_chunks_min=None,
     progress_bar=None,
     client=None,
+    fitting_method="nnls",
+    output=None,
+    output_weights_scale=None,
+    cache=None,
 ):
     """
-    Compute XRF map based on ROIs for XRF dataset.
+    Fit XRF map.
+
+    The results are returned as a numpy array. Alternatively, the results may be written
+    directly to the HDF5 file as processing of each block is completed (see parameter `output`).
+    In this case the complete array of results is never assembled in memory.
 
     Parameters
     ----------
@@ -1003,91 +1850,82 @@ def compute_selected_rois(
         define image size and `ne` is the number of spectrum points
     data_sel_indices: tuple
         tuple `(n_start, n_end)` which defines the indices along axis 2 of `data` array
-        that are used for fitting. Note that `ne` (in `data`). Indexes
+        that are used for fitting. Note that `ne` (in `data`) and `ne_model` (in `matv`)
+        are not equal. But `n_end - n_start` MUST be equal to `ne_model`! Indexes
         `n_start .. n_end - 1` will be selected from each pixel.
-    roi_dict: dict
-        Dictionary that specifies ROIs for the selected emission lines:
-        key - emission line, value - tuple (left_val, right_val).
-        Energy values are in keV.
+    matv: array
+        Matrix of spectra of the selected elements (emission lines). Shape=(ne_model, n_lines)
     snip_param: dict
         Dictionary of parameters forwarded to 'snip' method for background removal.
         Keys: `e_offset`, `e_linear`, `e_quadratic` (parameters of the energy axis approximation),
         `b_width` (width of the window that defines resolution of the snip algorithm).
-        The values of `e_offset` and `e_linear` are used to compute indices for ROIs, so they
-        need to be always provided.
+        It may be an empty dictionary or None if `use_snip` is `False`.
     use_snip: bool, optional
         enable/disable background removal using snip algorithm
-    chunk_pixels: int
+    chunk_pixels: int or None
         The number of pixels in a single chunk. The XRF map will be rechunked so that
         each block contains approximately `chunk_pixels` pixels and contain all `ne`
-        spectrum points for each pixel.
-    n_chunks_min: int
+        spectrum points for each pixel. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
+    n_chunks_min: int or None
         Minimum number of chunks. The algorithm will try to split the map into the number
-        of chunks equal or greater than `n_chunks_min`.
+        of chunks equal or greater than `n_chunks_min`. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
     progress_bar: callable or None
         reference to the callable object that implements progress bar. The example of
         such a class for progress bar object is `TerminalProgressBar`.
     client: dask.distributed.Client or None
-        Dask client. If None, then local client will be created
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+    fitting_method: str
+        Method used for fitting of each pixel: `nnls` (default, `scipy.optimize.nnls` is
+        called for each pixel) or `nnls_gram` (NNLS with the precomputed matrix `matv^T matv`,
+        much faster for large maps). See `fit_spectrum` for details.
+    output: RawHDF5Dataset or None
+        Reference to the HDF5 dataset for the results. If `None` (default), then the results are
+        returned by the function. Otherwise the dataset with the shape `output.shape` is created
+        (existing dataset is replaced) and the results are written to the dataset. The shape must be
+        `(n_maps, ny, nx)`, where `n_maps >= n_lines + 4`. The maps `0 .. n_lines + 3` contain
+        the results (same order as in the returned array), the remaining maps are filled with zeros.
+        The file may be the same file that contains the raw data.
+    output_weights_scale: ndarray or None
+        1D array with `n_lines` elements. The weights are multiplied by the scaling factors
+        before they are written to the HDF5 file. The parameter is ignored if `output` is `None`.
+    cache: BlockResultCache or None
+        Reference to the on-disk cache of processed blocks. The blocks that were processed with
+        the same data and parameters are loaded from the cache instead of being refitted.
+        The cache is not used if `None` (default).
 
     Returns
     -------
-    roi_dict_computed: dict
-        Dictionary with XRF maps computed for ROIs specified by `roi_dict`.
-        Key: emission line. Value: numpy array with shape `(ny, nx)`.
-        XRF map values represent area under of the experimental spectrum computed
-        over ROI.
+    results: ndarray or None
+        array with fitting results. Shape: `(ny, nx, ne_model + 4)`. For each pixel
+        the output data contains: `ne_model` values that represent area under the emission
+        line spectra; background area (only in the selected energy range), error (R-factor),
+        total count in the selected energy range, total count of the full experimental spectrum.
+        `None` is returned if the results are written to the HDF5 file.
     """
 
-    logger.info("Starting ROI computation ...")
+    logger.info("Starting single-pixel fitting ...")
     logger.info(f"Baseline subtraction (SNIP): {'enabled' if use_snip else 'disabled'}.")
 
-    # Verify that input parameters are valid
-    if not isinstance(data_sel_indices, (tuple, list)):
-        raise TypeError(
-            f"Parameter 'data_sel_indices' must be tuple or list: "
-            f"type(data_sel_indices) = {type(data_sel_indices)}"
-        )
-
-    if not len(data_sel_indices) == 2:
-        raise TypeError(
-            f"Parameter 'data_sel_indices' must contain two elements: data_sel_indices = {data_sel_indices}"
-        )
-
-    if any([_ < 0 for _ in data_sel_indices]):
-        raise ValueError(
-            f"Some of the indices in 'data_sel_indices' are negative: data_sel_indices = {data_sel_indices}"
-        )
-
-    if data_sel_indices[1] <= data_sel_indices[0]:
-        raise ValueError(
-            f"Parameter 'data_sel_indices' must select at least 1 element: "
-            f"data_sel_indices = {data_sel_indices}"
-        )
-
-    if not isinstance(snip_param, dict):
-        raise TypeError(f"Parameter 'snip_param' must be a dictionary: type(snip_param) = {type(snip_param)}")
+    if snip_param is None:
+        snip_param = {}  # For consistency
 
-    required_keys = ("e_offset", "e_linear", "e_quadratic", "b_width")
-    if not all([_ in snip_param.keys() for _ in required_keys]):
-        raise TypeError(
-            f"Parameter 'snip_param' must a dictionary with keys {required_keys}: "
-            f"snip_param.keys() = {snip_param.keys()}"
-        )
+    _check_fit_xrf_map_params(data_sel_indices, matv, snip_param, use_snip, fitting_method)
 
-    # Convert data to Dask array
-    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min)
+    if output is not None:
+        if not isinstance(output, RawHDF5Dataset):
+            raise TypeError(f"Parameter 'output' must be RawHDF5Dataset or None: type(output) = {type(output)}")
+        if len(output.shape) != 3 or output.shape[0] < matv.shape[1] + 4:
+            raise ValueError(
+                f"Output dataset must have the shape (n_maps, ny, nx), n_maps >= {matv.shape[1] + 4}: "
+                f"output.shape = {output.shape}"
+            )
 
-    # Verify that selection makes sense (data is Dask array at this point)
-    _, _, ne = data.shape
-    if data_sel_indices[0] >= ne or data_sel_indices[1] > ne:
-        raise ValueError(f"Selection indices {data_sel_indices} are outside the allowed range 0 .. {ne}")
+    _check_cache_type(cache)
 
     if client is None:
-        client = dask_client_create()
-        client_is_local = True
-    else:
-        client_is_local = False
+        client = dask_cluster_manager.get_client()
 
     client.run(dask_set_custom_serializers)
     dask_set_custom_serializers()
@@ -1095,156 +1933,1166 @@ def compute_selected_rois(
     n_workers = len(client.scheduler_info()["workers"])
     logger.info(f"Dask distributed client: {n_workers} workers")
 
-    # Prepare ROI bands in the form of a list
-    roi_band_keys = []
-    roi_bands = []
-    for k, v in roi_dict.items():
-        roi_band_keys.append(k)
-        roi_bands.append(v)
-
-    result_fut = da.map_blocks(
-        _compute_roi,
-        data,
-        # Parameters of the '_fit_xrf_block' function
-        data_sel_indices=data_sel_indices,
-        roi_bands=roi_bands,
-        snip_param=snip_param,
-        use_snip=use_snip,
-        # Output data type
-        dtype="float",
-    ).persist(scheduler=client)
-
-    # Call the progress monitor
-    wait_and_display_progress(result_fut, progress_bar)
+    output_final, file_obj = output, None
+    try:
+        result_fut, file_obj = _create_fit_xrf_map_graph(
+            data,
+            data_sel_indices,
+            matv,
+            snip_param,
+            use_snip,
+            chunk_pixels=chunk_pixels,
+            n_chunks_min=n_chunks_min,
+            client=client,
+            fitting_method=fitting_method,
+            cache=cache,
+        )
+        data_is_from_file = isinstance(file_obj, h5py.File)
+        ny, nx, _ = result_fut.shape
 
-    result = result_fut.compute(scheduler=client)
+        if (output is not None) and (tuple(output.shape[1:]) != (ny, nx)):
+            raise ValueError(
+                f"The map size of the output dataset {tuple(output.shape[1:])} does not match "
+                f"the map size of the input data {(ny, nx)}"
+            )
 
-    roi_dict_computed = {roi_band_keys[_]: result[:, :, _] for _ in range(len(roi_band_keys))}
+        if output is not None:
+            # The file can not be opened for writing while raw data is read from the file.
+            #   In this case the results are written to a temporary file and then copied.
+            if data_is_from_file and (os.path.abspath(file_obj.filename) == output.abs_path):
+                fd, tmp_path = tempfile.mkstemp(suffix=".h5", dir=os.path.dirname(output.abs_path))
+                os.close(fd)
+                output = RawHDF5Dataset(tmp_path, "xrf_fit", shape=output.shape)
+            _create_hdf5_output_dataset(output, data_shape=(ny, nx), chunk_size=result_fut.chunksize[0:2])
 
-    if file_obj:
-        file_obj.close()
+        if output is None:
+            result_fut = result_fut.persist(scheduler=client)
 
-    client.run(dask_close_all_files)
-    dask_close_all_files()
+            # Call the progress monitor
+            wait_and_display_progress(result_fut, progress_bar)
 
-    # The following code is needed to cause Dask 'distributed>=2021.7.0' to close the h5file.
-    # del result_fut
-    # _dask_release_file_descriptors(client=client)
+            result = result_fut.compute(scheduler=client)
+        else:
+            _compute_and_save_blocks(
+                result_fut, output, client=client, progress_bar=progress_bar, weights_scale=output_weights_scale
+            )
+            result = None
 
-    if client_is_local:
-        client.close()
+    except Exception:
+        if (output is not None) and (output is not output_final):
+            os.remove(output.abs_path)
+        raise
 
-    return roi_dict_computed
+    finally:
+        if file_obj:
+            file_obj.close()
+        client.run(dask_close_all_files)
+        dask_close_all_files()
 
+    if cache is not None:
+        cache.evict()
 
-# The following function `snip_method_numba` is a copy of the function
-# 'snip_method' from scikit-beam, converted to work with numba.
-# It may be considered to move this function to scikit-beam if there
-# is interest. The output of this function is tested to match the
-# output of 'snip_method' to make sure the functions are equivalent.
+    # # The following code is needed to cause Dask 'distributed>=2021.7.0' to close the h5file.
+    # del result_fut
+    # _dask_release_file_descriptors(client=client)
 
+    if (output is not None) and (output is not output_final):
+        # Copy the results from the temporary file (the raw data file is closed at this point)
+        try:
+            _copy_hdf5_dataset(output, output_final)
+        finally:
+            os.remove(output.abs_path)
 
-_default_con_val_no_bin = 3
-_default_con_val_bin = 5
-_default_iter_num_no_bin = 3
-_default_iter_num_bin = 5
+    return result
 
 
-@jit(nopython=True, nogil=True)
-def snip_method_numba(
-    spectrum,
-    e_off,
-    e_lin,
-    e_quad,
-    xmin=0,
-    xmax=4096,
-    epsilon=2.96,
-    width=0.5,
-    decrease_factor=np.sqrt(2),
-    spectral_binning=None,
-    con_val=None,
-    iter_num=None,
-    width_threshold=0.5,
+def fit_xrf_map_batch(
+    maps,
+    *,
+    use_snip=True,
+    chunk_pixels=None,
+    n_chunks_min=None,
+    progress_bar=None,
+    client=None,
+    fitting_method="nnls",
+    cache=None,
 ):
     """
-    Use snip algorithm to obtain background.
-
-    The code of this function is borrowed from scikit-beam and changed to
-    to work with numba.
+    Fit a batch of XRF maps. The graphs for all maps are submitted to the Dask client at once
+    and the results are gathered as the processing of each map is completed, so the workers
+    are kept busy even if each map is small. The results are the same as the results of
+    calling `fit_xrf_map` for each map.
 
     Parameters
     ----------
-    spectrum : array
-        intensity spectrum
-    e_off : float
-        energy calibration, such as e_off + e_lin * energy + e_quad * energy^2
-    e_lin : float
-        energy calibration, such as e_off + e_lin * energy + e_quad * energy^2
-    e_quad : float
-        energy calibration, such as e_off + e_lin * energy + e_quad * energy^2
-    xmin : float, optional
-        smallest index to define the range
-    xmax : float, optional
-        largest index to define the range
-    epsilon : float, optional
-        energy to create a hole-electron pair
-        for Ge 2.96, for Si 3.61 at 300K
-        needs to double check this value
-    width : int, optional
-        window size to adjust how much to shift background
-    decrease_factor : float, optional
-        gradually decrease of window size, default as sqrt(2)
-    spectral_binning : float, optional
-        bin the data into different size
-    con_val : int, optional
-        size of scipy.signal.boxcar to convolve the spectrum.
+    maps: list(tuple)
+        list of tuples `(data, data_sel_indices, matv, snip_param)`, one tuple per XRF map.
+        The maps may have different size and may be fitted using different models.
+        See `fit_xrf_map` for the description of the parameters.
+    use_snip: bool, optional
+        enable/disable background removal using snip algorithm
+    chunk_pixels: int or None
+        The number of pixels in a single chunk (see `fit_xrf_map`).
+    n_chunks_min: int or None
+        Minimum number of chunks for each map (see `fit_xrf_map`).
+    progress_bar: callable or None
+        reference to the callable object that implements progress bar. The progress is
+        updated when processing of each map is completed.
+    client: dask.distributed.Client or None
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+    fitting_method: str
+        Method used for fitting of each pixel: `nnls` (default) or `nnls_gram`.
+    cache: BlockResultCache or None
+        Reference to the on-disk cache of processed blocks. The cache is not used if `None` (default).
+
+    Returns
+    -------
+    list(ndarray)
+        list of arrays with fitting results in the same order as `maps`. See `fit_xrf_map`
+        for the description of the arrays.
+    """
+    for _, data_sel_indices, matv, snip_param in maps:
+        _check_fit_xrf_map_params(data_sel_indices, matv, snip_param or {}, use_snip, fitting_method)
+    _check_cache_type(cache)
+
+    if client is None:
+        client = dask_cluster_manager.get_client()
+
+    client.run(dask_set_custom_serializers)
+    dask_set_custom_serializers()
+
+    logger.info(f"Fitting the batch of {len(maps)} XRF maps ...")
+
+    results = [None] * len(maps)
+    file_objs = []
+    try:
+        futures = {}
+        for n, (data, data_sel_indices, matv, snip_param) in enumerate(maps):
+            result_graph, file_obj = _create_fit_xrf_map_graph(
+                data,
+                data_sel_indices,
+                matv,
+                snip_param or {},
+                use_snip,
+                chunk_pixels=chunk_pixels,
+                n_chunks_min=n_chunks_min,
+                client=client,
+                fitting_method=fitting_method,
+                cache=cache,
+            )
+            file_objs.append(file_obj)
+            fut = client.compute(result_graph)
+            futures[id(fut)] = (n, fut)
+
+        if progress_bar is not None:
+            if hasattr(progress_bar, "start"):
+                progress_bar.start()
+            progress_bar(1.0)
+
+        n_completed = 0
+        for fut in as_completed([_[1] for _ in futures.values()]):
+            n, _ = futures.pop(id(fut))
+            results[n] = fut.result()
+            n_completed += 1
+            if progress_bar is not None:
+                progress_bar(n_completed / len(maps) * 100.0)
+
+        if (progress_bar is not None) and hasattr(progress_bar, "finish"):
+            progress_bar.finish()
+
+    finally:
+        for file_obj in file_objs:
+            if file_obj:
+                file_obj.close()
+        client.run(dask_close_all_files)
+        dask_close_all_files()
+
+    if cache is not None:
+        cache.evict()
+
+    return results
+
+
+def _get_xrf_map_shape(data):
+    """
+    Returns the shape and the data type of the XRF map represented as Dask array, numpy array
+    or `RawHDF5Dataset`.
+    """
+    if isinstance(data, RawHDF5Dataset):
+        with h5py.File(data.abs_path, "r") as f:
+            dset = f[data.dset_name]
+            return tuple(dset.shape), dset.dtype
+    elif isinstance(data, (da.core.Array, np.ndarray)):
+        return tuple(data.shape), data.dtype
+    else:
+        raise TypeError(f"Type of parameter 'data' is not supported: type(data)={type(data)}")
+
+
+def _fit_xrf_channels_block(
+    *blocks, groups, data_sel_indices, matv, snip_param, use_snip, fitting_method, cache, params_digests
+):
+    """
+    Fit co-located blocks of several XRF maps (e.g. the sum and the channels of a multi-channel
+    detector). The blocks that are fitted using the same model are stacked along axis 0 and
+    fitted in one call to `_fit_xrf_block`.
+
+    Parameters
+    ----------
+    blocks: tuple(ndarray)
+        co-located blocks of the XRF maps, each block has the shape `(ny, nx, ne)`
+    groups: list(list(int))
+        indices of the blocks fitted using the same model (one list for each model)
+    data_sel_indices, matv, snip_param: list
+        parameters of `_fit_xrf_block` for each model
+    use_snip, fitting_method:
+        parameters of `_fit_xrf_block` (same for all models)
+    cache: BlockResultCache or None
+        reference to the cache of processed blocks
+    params_digests: list(str) or list(None)
+        digests of the parameters for each model (used only if the cache is enabled)
+
+    Returns
+    -------
+    ndarray
+        results of fitting of the blocks (see `_fit_xrf_block`) concatenated along axis 2
+        in the order of the blocks
+    """
+    results = [None] * len(blocks)
+    for n, channels in enumerate(groups):
+        data = np.concatenate([blocks[_] for _ in channels], axis=0) if len(channels) > 1 else blocks[channels[0]]
+        result = cached_block_func(
+            data,
+            block_func=_fit_xrf_block,
+            cache=cache,
+            params_digest=params_digests[n],
+            data_sel_indices=data_sel_indices[n],
+            matv=matv[n],
+            snip_param=snip_param[n],
+            use_snip=use_snip,
+            fitting_method=fitting_method,
+        )
+        for ch, res in zip(channels, np.split(result, len(channels), axis=0)):
+            results[ch] = res
+    return np.concatenate(results, axis=2)
+
+
+def fit_xrf_map_channels(
+    maps,
+    *,
+    use_snip=True,
+    chunk_pixels=None,
+    n_chunks_min=None,
+    progress_bar=None,
+    client=None,
+    fitting_method="nnls",
+    outputs=None,
+    output_weights_scales=None,
+    cache=None,
+):
+    """
+    Fit several XRF maps of the same size (e.g. the sum and the individual channels of
+    a multi-channel detector) in a single pass. Each task of the Dask graph loads co-located blocks
+    of all maps and fits them, so the raw data is read and the blocks are scheduled once for all maps.
+    The blocks of the maps that are fitted using the same model (`data_sel_indices`, `matv` and
+    `snip_param`) are stacked and fitted together. The results are the same as the results of
+    calling `fit_xrf_map` for each map.
+
+    Parameters
+    ----------
+    maps: list(tuple)
+        list of tuples `(data, data_sel_indices, matv, snip_param)`, one tuple per XRF map.
+        The maps must have the same size `(ny, nx)` and may be fitted using different models.
+        See `fit_xrf_map` for the description of the parameters.
+    use_snip: bool, optional
+        enable/disable background removal using snip algorithm
+    chunk_pixels: int or None
+        The number of pixels in a single chunk (see `fit_xrf_map`). If `None`, then the number
+        is selected so that co-located blocks of all maps fit into the memory of a worker thread.
+    n_chunks_min: int or None
+        Minimum number of chunks (see `fit_xrf_map`).
+    progress_bar: callable or None
+        reference to the callable object that implements progress bar.
+    client: dask.distributed.Client or None
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+    fitting_method: str
+        Method used for fitting of each pixel: `nnls` (default) or `nnls_gram`.
+    outputs: list(RawHDF5Dataset) or None
+        References to the HDF5 datasets for the results, one dataset per map (see parameter `output`
+        of `fit_xrf_map`). If `None` (default), then the results are returned by the function.
+    output_weights_scales: list(ndarray) or None
+        scaling factors for the weights of each map (see parameter `output_weights_scale` of
+        `fit_xrf_map`). The parameter is ignored if `outputs` is `None`.
+    cache: BlockResultCache or None
+        Reference to the on-disk cache of processed blocks. The cache is not used if `None` (default).
+
+    Returns
+    -------
+    list(ndarray) or None
+        list of arrays with fitting results in the same order as `maps` (see `fit_xrf_map`).
+        `None` is returned if the results are written to the HDF5 files.
+    """
+    if not isinstance(maps, (list, tuple)) or not maps:
+        raise ValueError(
+            "Parameter 'maps' must be a non-empty list of tuples (data, data_sel_indices, matv, snip_param)"
+        )
+    maps = [
+        (data, tuple(data_sel_indices), matv, snip_param or {})
+        for data, data_sel_indices, matv, snip_param in maps
+    ]
+    for _, data_sel_indices, matv, snip_param in maps:
+        _check_fit_xrf_map_params(data_sel_indices, matv, snip_param, use_snip, fitting_method)
+    _check_cache_type(cache)
+
+    n_features = [_[2].shape[1] + 4 for _ in maps]
+    if outputs is not None:
+        if not isinstance(outputs, (list, tuple)) or len(outputs) != len(maps):
+            raise ValueError(f"Parameter 'outputs' must be None or a list of {len(maps)} RawHDF5Dataset objects")
+        for output, n_maps in zip(outputs, n_features):
+            if not isinstance(output, RawHDF5Dataset):
+                raise TypeError(f"Parameter 'outputs' must contain RawHDF5Dataset objects: type = {type(output)}")
+            if len(output.shape) != 3 or output.shape[0] < n_maps:
+                raise ValueError(
+                    f"Output dataset must have the shape (n_maps, ny, nx), n_maps >= {n_maps}: "
+                    f"output.shape = {output.shape}"
+                )
+        if output_weights_scales is None:
+            output_weights_scales = [None] * len(maps)
+
+    map_shapes, map_dtypes = zip(*[_get_xrf_map_shape(_[0]) for _ in maps])
+    map_size = map_shapes[0][0:2]
+    if any([_[0:2] != map_size for _ in map_shapes]):
+        raise ValueError(f"XRF maps must have the same size: {[_[0:2] for _ in map_shapes]}")
+
+    if client is None:
+        client = dask_cluster_manager.get_client()
+
+    client.run(dask_set_custom_serializers)
+    dask_set_custom_serializers()
+
+    if chunk_pixels is None:
+        # The blocks of all maps are processed by the same task
+        ne_total = sum([int(np.prod(_[2:])) for _ in map_shapes])
+        chunk_pixels = plan_xrf_map_chunks(
+            (*map_size, ne_total), dtype=np.result_type(*map_dtypes), n_chunks_min=n_chunks_min, client=client
+        ).chunk_pixels
+
+    logger.info(f"Fitting {len(maps)} XRF maps in a single pass ...")
+
+    file_objs, tmp_paths = [], {}
+    try:
+        data_list = []
+        for data, data_sel_indices, _, _ in maps:
+            data, file_obj = prepare_xrf_map(
+                data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client
+            )
+            file_objs.append(file_obj)
+            if data_list and data.chunks[0:2] != data_list[0].chunks[0:2]:
+                data = data.rechunk(chunks=(*data_list[0].chunks[0:2], data.shape[2]))
+            ne = data.shape[2]
+            if data_sel_indices[0] >= ne or data_sel_indices[1] > ne:
+                raise ValueError(f"Selection indices {data_sel_indices} are outside the allowed range 0 .. {ne}")
+            data_list.append(data)
+
+        # The maps with the same number of spectrum points fitted using the same model are stacked
+        groups, group_keys = [], {}
+        for n, (data, (_, data_sel_indices, matv, snip_param)) in enumerate(zip(data_list, maps)):
+            key = (data.shape[2], data_sel_indices, dask.base.tokenize(matv), dask.base.tokenize(snip_param))
+            if key not in group_keys:
+                group_keys[key] = len(groups)
+                groups.append([])
+            groups[group_keys[key]].append(n)
+        models = [maps[_[0]][1:] for _ in groups]
+
+        params_digests = [
+            (
+                cache.params_digest("fit_xrf_block", data_sel_indices, matv, snip_param, use_snip, fitting_method)
+                if cache is not None
+                else None
+            )
+            for data_sel_indices, matv, snip_param in models
+        ]
+
+        result_graph = da.map_blocks(
+            _fit_xrf_channels_block,
+            *data_list,
+            groups=groups,
+            data_sel_indices=[_[0] for _ in models],
+            matv=[_scatter_cached(client, _[1]) for _ in models],
+            snip_param=[_[2] for _ in models],
+            use_snip=use_snip,
+            fitting_method=fitting_method,
+            cache=cache,
+            params_digests=params_digests,
+            chunks=(*data_list[0].chunks[0:2], (sum(n_features),)),
+            dtype="float",
+        )
+
+        if outputs is None:
+            result_fut = result_graph.persist(scheduler=client)
+            wait_and_display_progress(result_fut, progress_bar)
+            result = result_fut.compute(scheduler=client)
+            offsets = np.cumsum([0] + n_features)
+            results = [result[:, :, offsets[n] : offsets[n + 1]] for n in range(len(maps))]
+        else:
+            # The files can not be opened for writing while raw data is read from the files.
+            #   In this case the results are written to a temporary file and then copied.
+            raw_paths = {os.path.abspath(_.filename) for _ in file_objs if isinstance(_, h5py.File)}
+            outputs_tmp = []
+            for n, output in enumerate(outputs):
+                if output.abs_path in raw_paths:
+                    if output.abs_path not in tmp_paths:
+                        fd, tmp_paths[output.abs_path] = tempfile.mkstemp(
+                            suffix=".h5", dir=os.path.dirname(output.abs_path)
+                        )
+                        os.close(fd)
+                    output = RawHDF5Dataset(tmp_paths[output.abs_path], f"xrf_fit_{n}", shape=output.shape)
+                _create_hdf5_output_dataset(output, data_shape=map_size, chunk_size=result_graph.chunksize[0:2])
+                outputs_tmp.append(output)
+
+            _compute_and_save_blocks(
+                result_graph,
+                outputs_tmp,
+                client=client,
+                progress_bar=progress_bar,
+                weights_scale=output_weights_scales,
+                n_features=n_features,
+            )
+            results = None
+
+    except Exception:
+        for tmp_path in tmp_paths.values():
+            os.remove(tmp_path)
+        raise
+
+    finally:
+        for file_obj in file_objs:
+            if file_obj:
+                file_obj.close()
+        client.run(dask_close_all_files)
+        dask_close_all_files()
+
+    if tmp_paths:
+        # Copy the results from the temporary files (the raw data files are closed at this point)
+        try:
+            for output, output_tmp in zip(outputs, outputs_tmp):
+                if output_tmp.abs_path != output.abs_path:
+                    _copy_hdf5_dataset(output_tmp, output)
+        finally:
+            for tmp_path in tmp_paths.values():
+                os.remove(tmp_path)
+
+    if cache is not None:
+        cache.evict()
+
+    return results
+
+
+def _fit_xanes_block(data, ref_spectra, factors, *, maxiter, rate, epsilon):
+    """
+    Fit XANES spectra for a block of pixels. The function is intended to be called
+    by Dask workers (see `fit_xanes_map`).
+
+    Parameters
+    ----------
+    data: ndarray
+        block of the XANES stack. Shape=(ny, nx, ne).
+    ref_spectra: ndarray
+        array of references, shape (ne, n_refs)
+    factors: dict
+        matrices computed by `factorize_references`, which are shared by all blocks
+    maxiter, rate, epsilon: int, float, float
+        parameters of the optimization algorithm (see `fit_spectrum`)
+
+    Returns
+    -------
+    dict
+        dictionary with the keys `weights` (shape `(ny, nx, n_refs)`) and `rfactor` (shape `(ny, nx)`).
+        For NNLS the dictionary also contains `residual` (shape `(ny, nx)`), for ADMM -
+        `convergence` and `feasibility` (1D arrays, one element per iteration).
+    """
+    ny, nx, ne = data.shape
+    n_refs = ref_spectra.shape[1]
+    data_1D = np.transpose(np.reshape(data, (ny * nx, ne)))
+
+    result = {}
+    if factors["method"] == "admm":
+        weights, rfactor, result["convergence"], result["feasibility"] = _fitting_admm(
+            data_1D, ref_spectra, rate=rate, maxiter=maxiter, epsilon=epsilon, admm_matrix=factors["admm_matrix"]
+        )
+    elif factors["method"] == "nnls_gram":
+        weights, rfactor, residual = _fitting_nnls_gram(
+            data_1D, ref_spectra, maxiter=maxiter, gram=factors["gram"]
+        )
+        result["residual"] = np.reshape(residual, (ny, nx))
+    else:
+        weights, rfactor, residual = _fitting_nnls(data_1D, ref_spectra, maxiter=maxiter)
+        result["residual"] = np.reshape(residual, (ny, nx))
+
+    result["weights"] = np.reshape(np.transpose(weights), (ny, nx, n_refs))
+    result["rfactor"] = np.reshape(rfactor, (ny, nx))
+    return result
+
+
+def fit_xanes_map(
+    data,
+    ref_spectra,
+    *,
+    method="nnls",
+    axis=0,
+    maxiter=100,
+    rate=0.2,
+    epsilon=1e-30,
+    chunk_pixels=None,
+    n_chunks_min=None,
+    progress_bar=None,
+    client=None,
+):
+    """
+    Fit XANES spectra for each pixel of the stack of XRF maps. The stack is split into
+    blocks of pixels, which are fitted in parallel by Dask workers. The matrices that depend
+    only on the references (``A^T A`` for NNLS or ``(A^T A + rate * I)^-1`` for ADMM)
+    are computed once and shared by all blocks. Since each block is processed independently,
+    ADMM iterations stop separately for each block and the convergence data is returned per block.
+
+    Parameters
+    ----------
+    data: ndarray
+        3D array that contains the stack of XRF maps. The spectral data is placed along the
+        axis ``axis``, e.g. the shape is `(ne, ny, nx)` if ``axis=0``.
+    ref_spectra: ndarray
+        2D array with columns representing the reference spectra, shape `(ne, n_refs)`.
+    method: str
+        optimization method: `nnls` (default, `scipy.optimize.nnls` is called for each pixel),
+        `nnls_gram` (NNLS with the precomputed matrix `A^T A`, much faster for large maps)
+        or `admm` (see `fit_spectrum`).
+    axis: int
+        the axis of ``data`` that holds the spectral data
+    maxiter: int
+        maximum number of iterations.
+    rate: float
+        descent rate for ADMM optimization algorithm (1/lambda).
+    epsilon: float
+        small value used in stopping criterion of ADMM optimization algorithm.
+    chunk_pixels: int or None
+        The number of pixels in a single block. If `None`, then the number is selected based on
+        the memory available to Dask workers (see `prepare_xrf_map`).
+    n_chunks_min: int or None
+        Minimum number of blocks. If `None`, then the number is selected based on the number
+        of Dask worker threads.
+    progress_bar: callable or None
+        reference to the callable object that implements progress bar. The example of
+        such a class for progress bar object is `TerminalProgressBar`.
+    client: dask.distributed.Client or None
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+
+    Returns
+    -------
+    weights: ndarray
+        array of the same shape as ``data`` with fitted weights of the references placed along
+        the axis ``axis`` instead of spectral data.
+    rfactor: ndarray
+        2D array with R-factor values for each pixel.
+    results_dict: dict
+        dictionary with additional information: ``method``; ``residual`` (2D array, NNLS only);
+        ``blocks`` - the list of block boundaries ``((y0, y1), (x0, x1))``; ``convergence``
+        and ``feasibility`` (ADMM only) - the lists of 1D arrays, one array per block.
+    """
+    method = method.lower()
+    supported_fitting_methods = ("nnls", "nnls_gram", "admm")
+    if method not in supported_fitting_methods:
+        raise ValueError(
+            f"Fitting method {method!r} is not supported. Supported methods: {supported_fitting_methods}"
+        )
+
+    data = np.asarray(data)
+    ref_spectra = np.asarray(ref_spectra, dtype=np.float64)
+    if data.ndim != 3:
+        raise ValueError(f"Parameter 'data' must be 3D array: data.shape = {data.shape}")
+    if ref_spectra.ndim != 2:
+        raise ValueError(f"Parameter 'ref_spectra' must be 2D array: ref_spectra.shape = {ref_spectra.shape}")
+    if not -data.ndim <= axis < data.ndim:
+        raise ValueError(f"Specified axis {axis} does not exist in data array")
+
+    # Pixels along axes 0 and 1, spectra along axis 2
+    data = np.moveaxis(data, axis, 2)
+    ny, nx, ne = data.shape
+    if ne != ref_spectra.shape[0]:
+        raise ValueError(
+            f"The number of spectrum points in data ({ne}) and references ({ref_spectra.shape[0]}) do not match."
+        )
+    n_refs = ref_spectra.shape[1]
+
+    if client is None:
+        client = dask_cluster_manager.get_client()
+
+    factors = factorize_references(ref_spectra, method=method, rate=rate)
+
+    data_dask, file_obj = prepare_xrf_map(
+        data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client
+    )
+    try:
+        offsets_y = np.cumsum((0,) + data_dask.chunks[0])
+        offsets_x = np.cumsum((0,) + data_dask.chunks[1])
+        block_indices = [(iy, ix) for iy in range(len(offsets_y) - 1) for ix in range(len(offsets_x) - 1)]
+
+        logger.info(f"Fitting XANES map ({ny}x{nx} pixels, {ne} points) in {len(block_indices)} blocks ...")
+
+        # The references and the factorized matrices are small and sent with each task
+        blocks = data_dask.to_delayed()
+        tasks = [
+            dask.delayed(_fit_xanes_block)(
+                blocks[iy, ix, 0], ref_spectra, factors, maxiter=maxiter, rate=rate, epsilon=epsilon
+            )
+            for iy, ix in block_indices
+        ]
+        futures = client.compute(tasks)
+        wait_and_display_progress(futures, progress_bar)
+        results = client.gather(futures)
+    finally:
+        if file_obj:
+            file_obj.close()
+
+    weights = np.zeros(shape=(ny, nx, n_refs))
+    rfactor = np.zeros(shape=(ny, nx))
+    residual = np.zeros(shape=(ny, nx)) if method != "admm" else None
+    blocks_list, convergence, feasibility = [], [], []
+    for (iy, ix), res in zip(block_indices, results):
+        y0, y1 = offsets_y[iy], offsets_y[iy + 1]
+        x0, x1 = offsets_x[ix], offsets_x[ix + 1]
+        blocks_list.append(((y0, y1), (x0, x1)))
+        weights[y0:y1, x0:x1, :] = res["weights"]
+        rfactor[y0:y1, x0:x1] = res["rfactor"]
+        if method == "admm":
+            convergence.append(res["convergence"])
+            feasibility.append(res["feasibility"])
+        else:
+            residual[y0:y1, x0:x1] = res["residual"]
+
+    results_dict = {"method": method, "blocks": blocks_list}
+    if method == "admm":
+        results_dict.update({"convergence": convergence, "feasibility": feasibility})
+        n_iter = [len(_) for _ in convergence]
+        logger.info(
+            f"ADMM fitting: the number of iterations per block is in the range {min(n_iter)} .. {max(n_iter)}"
+        )
+    else:
+        results_dict["residual"] = residual
+
+    return np.moveaxis(weights, 2, axis), rfactor, results_dict
+
+
+def _compute_roi(data, data_sel_indices, roi_bands, snip_param, use_snip):
+    """
+    Compute intensity for ROIs (energy bands) in XRF datasets. The function is intended to be
+    called using `map_blocks` function for parallel processing using Dask distributed
+    package.
+
+    Parameters
+    ----------
+    data : ndarray
+        block of an XRF dataset. Shape=(ny, nx, ne).
+    data_sel_indices: tuple
+        tuple `(n_start, n_end)` which defines the indices along axis 2 of `data` array
+        that are used for fitting. Note that `ne` (in `data`). Indexes
+        `n_start .. n_end - 1` will be selected from each pixel.
+    roi_bands: list(tuple)
+        list of ROI bands, elements are tuples `(left_val, right_val)`, where `left_val` and
+        `right_val` are energy values in keV that define the ROI band. If `left_val >= right_val`,
+        then the width of the band is considered zero and and ROI will be zero.
+    snip_param: dict
+        Dictionary of parameters forwarded to 'snip' method for background removal.
+        Keys: `e_offset`, `e_linear`, `e_quadratic` (parameters of the energy axis approximation),
+        `b_width` (width of the window that defines resolution of the snip algorithm).
+        The values of `e_offset` and `e_linear` are used to compute indices for ROIs, so they
+        need to be always provided.
+    use_snip: bool, optional
+        enable/disable background removal using snip algorithm
+
+    Returns
+    -------
+    data_out: ndarray
+        array with ROI counts. Shape: `(ny, nx, len(roi_bands))`. For each pixel
+        the output data contains `len(roi_bands)` values that represent area under
+        the experimental spectrum inside the band.
+    """
+    spec_sel = data[:, :, data_sel_indices[0] : data_sel_indices[1]]
+    bg_sel = _snip_block_background(spec_sel, snip_param) if use_snip else None
+
+    return _sum_block_rois(spec_sel, bg_sel, data_sel_indices, roi_bands, snip_param)
+
+
+def _sum_block_rois(spec_sel, bg_sel, data_sel_indices, roi_bands, snip_param):
+    """
+    Compute ROI counts for the block of XRF data (see `_compute_roi`). `spec_sel` is the block
+    limited to the selected range of energies, `bg_sel` is the background computed by
+    `_snip_block_background` or `None` if background is not removed.
+    """
+    e_offset = snip_param["e_offset"]
+    e_linear = snip_param["e_linear"]
+
+    y = spec_sel - bg_sel if bg_sel is not None else spec_sel
+
+    # The number of available spectrum points
+    ny, nx, n_pts = y.shape
+    n_sel_start = data_sel_indices[0]
+
+    def _energy_to_index(energy):
+        # 'y' is truncated array, and energy axis is aligned with the full array
+        n_index = int(round((energy - e_offset) / e_linear)) - n_sel_start
+        n_index = int(np.clip(n_index, a_min=0, a_max=n_pts - 1))
+        return n_index
+
+    roi_data = np.zeros(shape=(ny, nx, len(roi_bands)))
+    for n, band in enumerate(roi_bands):
+        n_left = _energy_to_index(band[0])
+        n_right = _energy_to_index(band[1])
+        roi_data[:, :, n] = (
+            np.sum(y[:, :, n_left:n_right], axis=2) if n_right > n_left else np.zeros(shape=(ny, nx))
+        )
+
+    return roi_data
+
+
+def _check_compute_roi_params(data_sel_indices, snip_param):
+    """
+    Verify that the parameters of `compute_selected_rois` are valid. Raises `TypeError` or `ValueError`.
+    """
+    _check_data_sel_indices(data_sel_indices)
+
+    if not isinstance(snip_param, dict):
+        raise TypeError(f"Parameter 'snip_param' must be a dictionary: type(snip_param) = {type(snip_param)}")
+
+    required_keys = ("e_offset", "e_linear", "e_quadratic", "b_width")
+    if not all([_ in snip_param.keys() for _ in required_keys]):
+        raise TypeError(
+            f"Parameter 'snip_param' must a dictionary with keys {required_keys}: "
+            f"snip_param.keys() = {snip_param.keys()}"
+        )
+
+
+def compute_selected_rois(
+    data,
+    data_sel_indices,
+    roi_dict,
+    snip_param=None,
+    use_snip=True,
+    chunk_pixels=None,
+    n_chunks_min=None,
+    progress_bar=None,
+    client=None,
+    cache=None,
+):
+    """
+    Compute XRF map based on ROIs for XRF dataset.
+
+    Parameters
+    ----------
+    data: da.core.Array, np.ndarray or RawHDF5Dataset (this is a custom type)
+        Raw XRF map represented as Dask array, numpy array or reference to a dataset in
+        HDF5 file. The XRF map must have dimensions `(ny, nx, ne)`, where `ny` and `nx`
+        define image size and `ne` is the number of spectrum points
+    data_sel_indices: tuple
+        tuple `(n_start, n_end)` which defines the indices along axis 2 of `data` array
+        that are used for fitting. Note that `ne` (in `data`). Indexes
+        `n_start .. n_end - 1` will be selected from each pixel.
+    roi_dict: dict
+        Dictionary that specifies ROIs for the selected emission lines:
+        key - emission line, value - tuple (left_val, right_val).
+        Energy values are in keV.
+    snip_param: dict
+        Dictionary of parameters forwarded to 'snip' method for background removal.
+        Keys: `e_offset`, `e_linear`, `e_quadratic` (parameters of the energy axis approximation),
+        `b_width` (width of the window that defines resolution of the snip algorithm).
+        The values of `e_offset` and `e_linear` are used to compute indices for ROIs, so they
+        need to be always provided.
+    use_snip: bool, optional
+        enable/disable background removal using snip algorithm
+    chunk_pixels: int or None
+        The number of pixels in a single chunk. The XRF map will be rechunked so that
+        each block contains approximately `chunk_pixels` pixels and contain all `ne`
+        spectrum points for each pixel. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
+    n_chunks_min: int or None
+        Minimum number of chunks. The algorithm will try to split the map into the number
+        of chunks equal or greater than `n_chunks_min`. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
+    progress_bar: callable or None
+        reference to the callable object that implements progress bar. The example of
+        such a class for progress bar object is `TerminalProgressBar`.
+    client: dask.distributed.Client or None
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+    cache: BlockResultCache or None
+        Reference to the on-disk cache of processed blocks (see `fit_xrf_map`).
+        The cache is not used if `None` (default).
+
+    Returns
+    -------
+    roi_dict_computed: dict
+        Dictionary with XRF maps computed for ROIs specified by `roi_dict`.
+        Key: emission line. Value: numpy array with shape `(ny, nx)`.
+        XRF map values represent area under of the experimental spectrum computed
+        over ROI.
+    """
+
+    logger.info("Starting ROI computation ...")
+    logger.info(f"Baseline subtraction (SNIP): {'enabled' if use_snip else 'disabled'}.")
+
+    # Verify that input parameters are valid
+    _check_compute_roi_params(data_sel_indices, snip_param)
+    _check_cache_type(cache)
+
+    if client is None:
+        client = dask_cluster_manager.get_client()
+
+    # Convert data to Dask array
+    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client)
+
+    try:
+        # Verify that selection makes sense (data is Dask array at this point)
+        _, _, ne = data.shape
+        if data_sel_indices[0] >= ne or data_sel_indices[1] > ne:
+            raise ValueError(f"Selection indices {data_sel_indices} are outside the allowed range 0 .. {ne}")
+
+        client.run(dask_set_custom_serializers)
+        dask_set_custom_serializers()
+
+        n_workers = len(client.scheduler_info()["workers"])
+        logger.info(f"Dask distributed client: {n_workers} workers")
+
+        # Prepare ROI bands in the form of a list
+        roi_band_keys = []
+        roi_bands = []
+        for k, v in roi_dict.items():
+            roi_band_keys.append(k)
+            roi_bands.append(v)
+
+        params_digest = (
+            cache.params_digest("compute_roi", data_sel_indices, roi_bands, snip_param, use_snip)
+            if cache is not None
+            else None
+        )
+
+        result_fut = da.map_blocks(
+            cached_block_func,
+            data,
+            block_func=_compute_roi,
+            cache=cache,
+            params_digest=params_digest,
+            # Parameters of the '_compute_roi' function
+            data_sel_indices=data_sel_indices,
+            roi_bands=roi_bands,
+            snip_param=snip_param,
+            use_snip=use_snip,
+            # Output data type
+            dtype="float",
+        ).persist(scheduler=client)
+
+        # Call the progress monitor
+        wait_and_display_progress(result_fut, progress_bar)
+
+        result = result_fut.compute(scheduler=client)
+
+        roi_dict_computed = {roi_band_keys[_]: result[:, :, _] for _ in range(len(roi_band_keys))}
+
+    finally:
+        if file_obj:
+            file_obj.close()
+        client.run(dask_close_all_files)
+        dask_close_all_files()
+
+    if cache is not None:
+        cache.evict()
+
+    # The following code is needed to cause Dask 'distributed>=2021.7.0' to close the h5file.
+    # del result_fut
+    # _dask_release_file_descriptors(client=client)
+
+    return roi_dict_computed
+
+
+# Processing stages supported by `process_xrf_map`
+_XRF_MAP_STAGES = ("fit", "roi", "total_count", "total_spectrum", "sel_count")
+
+
+def _process_xrf_block(
+    data, mask=None, *, stages, data_sel_indices, snip_param, use_snip, matv, fitting_method, roi_bands
+):
+    """
+    Run the processing stages for a block of XRF dataset (see `process_xrf_map`). The background
+    is computed once and shared by fitting and ROI computation. The function is intended to be
+    called using `blockwise` function for parallel processing using Dask distributed package.
+
+    Returns
+    -------
+    ndarray
+        object array with the shape `(1, 1)`, which contains the dictionary with the results
+        computed for the block: key - the name of the stage, value - the results of the stage.
+    """
+    data = data[0]  # Data is passed as a list of ndarrays
+    stages = set(stages)
+    results = {}
+
+    spec_sel, sel_cnt = None, None
+    if data_sel_indices is not None:
+        spec_sel = data[:, :, data_sel_indices[0] : data_sel_indices[1]]
+        sel_cnt = np.sum(spec_sel, axis=2)
+    total_cnt = np.sum(data, axis=2) if stages & {"fit", "total_count"} else None
+
+    bg_sel = None
+    if use_snip and (stages & {"fit", "roi"}):
+        bg_sel = _snip_block_background(spec_sel, snip_param)
+
+    if "fit" in stages:
+        results["fit"] = _fit_block_spectra(
+            spec_sel, bg_sel, matv, fitting_method=fitting_method, sel_cnt=sel_cnt, total_cnt=total_cnt
+        )
+    if "roi" in stages:
+        results["roi"] = _sum_block_rois(spec_sel, bg_sel, data_sel_indices, roi_bands, snip_param)
+    if "total_count" in stages:
+        results["total_count"] = total_cnt * mask if mask is not None else total_cnt
+    if "total_spectrum" in stages:
+        if mask is not None:
+            results["total_spectrum"] = _weighted_block_spectrum(data, mask)
+        else:
+            results["total_spectrum"] = np.sum(np.sum(data, axis=0), axis=0)
+    if "sel_count" in stages:
+        results["sel_count"] = sel_cnt
+
+    return np.array([[results]])
+
+
+def process_xrf_map(
+    data,
+    stages,
+    *,
+    data_sel_indices=None,
+    snip_param=None,
+    use_snip=True,
+    matv=None,
+    fitting_method="nnls",
+    roi_dict=None,
+    selection=None,
+    mask=None,
+    chunk_pixels=None,
+    n_chunks_min=None,
+    progress_bar=None,
+    client=None,
+):
+    """
+    Run multiple processing stages for XRF map in a single pass over the raw data. Each block
+    of the raw data is loaded once and all selected stages are applied to the loaded block.
+    The background is computed once for each block and used for fitting and ROI computation.
+    The results of each stage are the same as the results produced by the respective function
+    (`fit_xrf_map`, `compute_selected_rois` or `compute_total_spectrum_and_count`), but
+    the data is read only once, which is important if the data is loaded from slow storage.
+
+    Supported stages:
+
+    - `fit` - fitting of the spectra (see `fit_xrf_map`);
+
+    - `roi` - ROI maps (see `compute_selected_rois`);
+
+    - `total_count` - total count map (see `compute_total_spectrum_and_count`), the pixels
+      excluded by `mask` and `selection` are set to zero;
+
+    - `total_spectrum` - the sum of the spectra of the pixels selected by `mask` and
+      `selection` (see `compute_total_spectrum_and_count`);
+
+    - `sel_count` - the map of total counts in the selected energy range `data_sel_indices`.
+
+    Parameters
+    ----------
+    data: da.core.Array, np.ndarray or RawHDF5Dataset (this is a custom type)
+        Raw XRF map represented as Dask array, numpy array or reference to a dataset in
+        HDF5 file. The XRF map must have dimensions `(ny, nx, ne)`, where `ny` and `nx`
+        define image size and `ne` is the number of spectrum points
+    stages: str or list(str)
+        the name of the stage or the list of stages, e.g. `["fit", "roi", "total_spectrum"]`
+    data_sel_indices: tuple or None
+        tuple `(n_start, n_end)` which defines the indices along axis 2 of `data` array
+        that are used for fitting and ROI computation (see `fit_xrf_map`). Required for
+        the stages `fit`, `roi` and `sel_count`.
+    snip_param: dict or None
+        Dictionary of parameters forwarded to 'snip' method for background removal
+        (see `fit_xrf_map` and `compute_selected_rois`). Required for the stage `roi` and
+        for the stage `fit` if `use_snip` is `True`.
+    use_snip: bool, optional
+        enable/disable background removal using snip algorithm
+    matv: ndarray or None
+        Matrix of spectra of the selected emission lines, shape `(ne_model, n_lines)`
+        (see `fit_xrf_map`). Required for the stage `fit`.
+    fitting_method: str
+        Method used for fitting: `nnls` (default) or `nnls_gram` (see `fit_xrf_map`).
+    roi_dict: dict or None
+        Dictionary that specifies ROIs (see `compute_selected_rois`). Required for the stage `roi`.
+    selection: tuple or list or None
+        selected area represented as (y0, x0, ny_sel, nx_sel). Used by the stages `total_count`
+        and `total_spectrum`.
+    mask: ndarray or None
+        mask represented as numpy array with dimensions (ny, nx). Used by the stages `total_count`
+        and `total_spectrum`.
+    chunk_pixels: int or None
+        The number of pixels in a single chunk. Selected automatically if `None`
+        (see `plan_xrf_map_chunks`).
+    n_chunks_min: int or None
+        Minimum number of chunks. Selected automatically if `None` (see `plan_xrf_map_chunks`).
+    progress_bar: callable or None
+        reference to the callable object that implements progress bar. The example of
+        such a class for progress bar object is `TerminalProgressBar`.
+    client: dask.distributed.Client or None
+        Dask client. If None, then the shared local cluster managed by `dask_cluster_manager` is used
+
+    Returns
+    -------
+    dict
+        Results of the selected stages. Keys: the names of the stages. Values: `fit` - array
+        with the shape `(ny, nx, n_lines + 4)` (see `fit_xrf_map`); `roi` - dictionary of ROI maps
+        (see `compute_selected_rois`); `total_count` and `sel_count` - arrays with the shape
+        `(ny, nx)`; `total_spectrum` - array with the shape `(ne,)`.
+
+    Raises
+    ------
+    TypeError, ValueError
+        invalid parameters
+    """
+    stages = [stages] if isinstance(stages, str) else list(stages)
+    if not stages:
+        raise ValueError("No processing stages are selected")
+    unsupported_stages = [_ for _ in stages if _ not in _XRF_MAP_STAGES]
+    if unsupported_stages:
+        raise ValueError(
+            f"Processing stages {unsupported_stages} are not supported. Supported stages: {_XRF_MAP_STAGES}"
+        )
+
+    if snip_param is None:
+        snip_param = {}  # For consistency
+
+    if "fit" in stages:
+        _check_fit_xrf_map_params(data_sel_indices, matv, snip_param, use_snip, fitting_method)
+    if "roi" in stages:
+        _check_compute_roi_params(data_sel_indices, snip_param)
+        if not isinstance(roi_dict, dict):
+            raise TypeError(f"Parameter 'roi_dict' must be a dictionary: type(roi_dict) = {type(roi_dict)}")
+    if "sel_count" in stages:
+        _check_data_sel_indices(data_sel_indices)
+    if not {"fit", "roi", "sel_count"} & set(stages):
+        data_sel_indices = None  # The energy range is not used
+
+    if not isinstance(mask, np.ndarray) and (mask is not None):
+        raise TypeError(f"Parameter 'mask' must be a numpy array or None: type(mask) = {type(mask)}")
+
+    logger.info(f"Processing XRF map in a single pass. Stages: {stages}")
 
-        Default value is controlled by the keys `con_val_no_bin`
-        and `con_val_bin` in the defaults dictionary, depending
-        on if spectral_binning is used or not
+    if client is None:
+        client = dask_cluster_manager.get_client()
 
-    iter_num : int, optional
-        Number of iterations.
+    data, file_obj = prepare_xrf_map(data, chunk_pixels=chunk_pixels, n_chunks_min=n_chunks_min, client=client)
 
-        Default value is controlled by the keys `iter_num_no_bin`
-        and `iter_num_bin` in the defaults dictionary, depending
-        on if spectral_binning is used or not
+    try:
+        # Verify that selection makes sense (data is Dask array at this point)
+        ne = data.shape[2]
+        if (data_sel_indices is not None) and (data_sel_indices[0] >= ne or data_sel_indices[1] > ne):
+            raise ValueError(f"Selection indices {data_sel_indices} are outside the allowed range 0 .. {ne}")
 
-    width_threshold : float, optional
-        stop point of the algorithm
+        # The mask is used only for total spectrum and total count map
+        if {"total_count", "total_spectrum"} & set(stages):
+            mask = _prepare_xrf_mask(data, mask=mask, selection=selection)
+        else:
+            mask = None
+
+        client.run(dask_set_custom_serializers)
+        dask_set_custom_serializers()
+
+        n_workers = len(client.scheduler_info()["workers"])
+        logger.info(f"Dask distributed client: {n_workers} workers")
+
+        roi_band_keys = list(roi_dict.keys()) if "roi" in stages else []
+        roi_bands = [roi_dict[_] for _ in roi_band_keys]
+
+        block_args = (data, "ijk") if mask is None else (data, "ijk", mask, "ij")
+        result_fut = da.blockwise(
+            _process_xrf_block,
+            "ij",
+            *block_args,
+            dtype=object,
+            # Parameters of the '_process_xrf_block' function
+            stages=stages,
+            data_sel_indices=data_sel_indices,
+            snip_param=snip_param,
+            use_snip=use_snip,
+            matv=_scatter_cached(client, matv) if "fit" in stages else None,
+            fitting_method=fitting_method,
+            roi_bands=roi_bands,
+        ).persist(scheduler=client)
 
-    Returns
-    -------
-    background : array
-        output results with peak removed
+        # Call the progress monitor
+        wait_and_display_progress(result_fut, progress_bar)
 
-    References
-    ----------
+        result = result_fut.compute(scheduler=client)
 
-    .. [1] C.G. Ryan etc, "SNIP, a statistics-sensitive background
-           treatment for the quantitative analysis of PIXE spectra in
-           geoscience applications", Nuclear Instruments and Methods in
-           Physics Research Section B, vol. 34, 1998.
-    """
+    finally:
+        if file_obj:
+            file_obj.close()
 
-    # clean input a bit
-    if con_val is None:
-        if spectral_binning is None:
-            con_val = _default_con_val_no_bin
-        else:
-            con_val = _default_con_val_bin
+        client.run(dask_close_all_files)
+        dask_close_all_files()
 
-    if iter_num is None:
-        if spectral_binning is None:
-            iter_num = _default_iter_num_no_bin
+    # Assemble results
+    def _assemble_maps(stage):
+        return np.concatenate([np.concatenate([_2[stage] for _2 in _1], axis=1) for _1 in result], axis=0)
+
+    results = {}
+    for stage in stages:
+        if stage == "roi":
+            roi_maps = _assemble_maps(stage)
+            results[stage] = {roi_band_keys[_]: roi_maps[:, :, _] for _ in range(len(roi_band_keys))}
+        elif stage == "total_spectrum":
+            results[stage] = sum([_[stage] for _ in result.flatten()])
         else:
-            iter_num = _default_iter_num_bin
+            results[stage] = _assemble_maps(stage)
 
-    # np.array(spectrum) is not supported by numba so we have to use this:
-    # background = np.asarray(spectrum).copy()  # Also a problem (since Jan. 2024)
-    background = spectrum.copy()
-    n_background = background.size
+    return results
+
+
+# The following function `snip_method_numba` is a copy of the function
+# 'snip_method' from scikit-beam, converted to work with numba.
+# It may be considered to move this function to scikit-beam if there
+# is interest. The output of this function is tested to match the
+# output of 'snip_method' to make sure the functions are equivalent.
+
+
+_default_con_val_no_bin = 3
+_default_con_val_bin = 5
+_default_iter_num_no_bin = 3
+_default_iter_num_bin = 5
+
+
+@jit(nopython=True, nogil=True)
+def _snip_window_indices(
+    n_background,
+    e_off,
+    e_lin,
+    e_quad,
+    xmin,
+    xmax,
+    epsilon,
+    width,
+    decrease_factor,
+    spectral_binning,
+    iter_num,
+    width_threshold,
+):
+    """
+    Compute the indices of the left and right ends of the SNIP clipping window for each
+    step of the algorithm. The indices depend only on the energy axis and the parameters
+    of the algorithm, so they may be computed once and reused for any number of spectra.
 
+    Returns
+    -------
+    lo_index, hi_index : ndarray(int32)
+        2D arrays of the shape ``(n_steps, n_background)``. Row ``k`` contains
+        the window indices used at step ``k`` of the algorithm.
+    """
     energy = np.arange(n_background, dtype=np.float64)
 
     if spectral_binning is not None:
@@ -1258,6 +3106,81 @@ def snip_method_numba(
     tmp[tmp < 0] = 0
     fwhm = std_fwhm * np.sqrt(tmp)
 
+    window_p = width * fwhm / e_lin
+    if spectral_binning is not None and spectral_binning > 0:
+        window_p = window_p / 2.0
+
+    index = np.arange(n_background)
+
+    def _clip(arr, vmin, vmax):
+        """`np.clip` is not supported by numba, but the following works"""
+        arr[arr < vmin] = vmin
+        arr[arr > vmax] = vmax
+        return arr
+
+    v_xmin, v_xmax = max(xmin, 0), min(xmax, n_background - 1)
+
+    # Count the steps of the second stage (decreasing window width)
+    n_steps = iter_num
+    current_width = window_p
+    max_current_width = np.amax(current_width)
+    while max_current_width >= width_threshold:
+        n_steps += 1
+        current_width = current_width / decrease_factor
+        max_current_width = np.amax(current_width)
+
+    lo_index = np.empty((n_steps, n_background), dtype=np.int32)
+    hi_index = np.empty((n_steps, n_background), dtype=np.int32)
+
+    # FIRST SNIPPING (constant window width)
+    for j in range(iter_num):
+        lo_index[j, :] = _clip(index - window_p, v_xmin, v_xmax).astype(np.int32)
+        hi_index[j, :] = _clip(index + window_p, v_xmin, v_xmax).astype(np.int32)
+
+    # SECOND SNIPPING (gradually decreasing window width)
+    current_width = window_p
+    for j in range(iter_num, n_steps):
+        lo_index[j, :] = _clip(index - current_width, v_xmin, v_xmax).astype(np.int32)
+        hi_index[j, :] = _clip(index + current_width, v_xmin, v_xmax).astype(np.int32)
+        current_width = current_width / decrease_factor
+
+    return lo_index, hi_index
+
+
+@jit(nopython=True, nogil=True)
+def _snip_convolve(background, s):
+    # Modifies the contents of the 'background' array.
+    # This implementation of convolution replaces the original
+    #   implementation based on 'np.convolve'. Seems to work as fast
+    #   as the original implementation.
+    s_len = len(s)
+    n_beg = (s_len - 1) // 2
+    A = s.sum()
+    source = np.hstack(
+        (
+            np.zeros(n_beg, dtype=background.dtype),
+            background,
+            np.zeros(s_len - n_beg, dtype=background.dtype),
+        )
+    )
+    for n in range(len(background)):
+        # Equivalent to 'np.sum(source[n : n + s_len] * s)', but doesn't allocate temporary arrays
+        v = source[n] * s[0]
+        for k in range(1, s_len):
+            v += source[n + k] * s[k]
+        background[n] = v / A
+
+
+@jit(nopython=True, nogil=True)
+def _snip_spectrum(spectrum, con_val, lo_index, hi_index):
+    """
+    Apply SNIP algorithm to a single spectrum using precomputed window indices
+    (see ``_snip_window_indices``). Returns the estimated background.
+    """
+    # np.array(spectrum) is not supported by numba so we have to use this:
+    # background = np.asarray(spectrum).copy()  # Also a problem (since Jan. 2024)
+    background = spectrum.copy()
+
     # smooth the background
     s = np.ones(int(con_val), background.dtype)
 
@@ -1265,26 +3188,7 @@ def snip_method_numba(
     # where there are peaks. On the boundary part, we don't care
     # the accuracy so much. But we need to pay attention to edge
     # effects in general convolution.
-
-    def convolve(background, s):
-        # Modifies the contents of the 'background' array.
-        # This implementation of convolution replaces the original
-        #   implementation based on 'np.convolve'. Seems to work as fast
-        #   as the original implementation.
-        s_len = len(s)
-        n_beg = (s_len - 1) // 2
-        A = s.sum()
-        source = np.hstack(
-            (
-                np.zeros(n_beg, dtype=background.dtype),
-                background,
-                np.zeros(s_len - n_beg, dtype=background.dtype),
-            )
-        )
-        for n in range(len(background)):
-            background[n] = np.sum(source[n : n + s_len] * s) / A
-
-    convolve(background, s)
+    _snip_convolve(background, s)
 
     # # The following implementation of convolution stopped working because of
     # # unclear issues with 'np.convolve' (gave 'List index out of range' error),
@@ -1297,61 +3201,239 @@ def snip_method_numba(
     # n_end = n_beg - mg  # Negative
     # background = background[n_beg:n_end]
 
-    window_p = width * fwhm / e_lin
-    if spectral_binning is not None and spectral_binning > 0:
-        window_p = window_p / 2.0
-
     background = np.log(np.log(background + 1) + 1)
 
-    index = np.arange(n_background)
+    n_background = len(background)
+    temp = np.empty_like(background)
+    for j in range(lo_index.shape[0]):
+        # 'temp' must be computed for all points before 'background' is modified
+        for n in range(n_background):
+            temp[n] = (background[lo_index[j, n]] + background[hi_index[j, n]]) / 2.0
+        # The following numpy based line of code stopped working with numba v0.61.0
+        # background[bg_index] = temp[bg_index]
+        # The following code is the workaround. Seems fast enough.
+        for n in range(n_background):
+            if background[n] > temp[n]:
+                background[n] = temp[n]
 
-    def _clip(arr, vmin, vmax):
-        """`np.clip` is not supported by numba, but the following works"""
-        arr[arr < vmin] = vmin
-        arr[arr > vmax] = vmax
-        return arr
+    background = np.exp(np.exp(background) - 1) - 1
 
-    v_xmin, v_xmax = max(xmin, 0), min(xmax, n_background - 1)
+    inf_ind = np.where(~np.isfinite(background))
+    background[inf_ind] = 0.0
 
-    # FIRST SNIPPING
-    for j in range(iter_num):
-        lo_index = _clip(index - window_p, v_xmin, v_xmax)
-        hi_index = _clip(index + window_p, v_xmin, v_xmax)
+    return background
 
-        temp = (background[lo_index.astype(np.int32)] + background[hi_index.astype(np.int32)]) / 2.0
 
-        bg_index = background > temp
-        # The following numpy based line of code stopped working with numba v0.61.0
-        # background[bg_index] = temp[bg_index]
-        # The following code is the workaround. Seems fast enough.
-        for n in range(len(background)):
-            if bg_index[n]:
-                background[n] = temp[n]
+def _snip_default_con_val_and_iter_num(spectral_binning, con_val, iter_num):
+    """Select default values of ``con_val`` and ``iter_num`` the same way as ``snip_method_numba``"""
+    if con_val is None:
+        con_val = _default_con_val_no_bin if spectral_binning is None else _default_con_val_bin
+    if iter_num is None:
+        iter_num = _default_iter_num_no_bin if spectral_binning is None else _default_iter_num_bin
+    return con_val, iter_num
 
-    current_width = window_p
-    max_current_width = np.amax(current_width)
 
-    while max_current_width >= width_threshold:
-        lo_index = _clip(index - current_width, v_xmin, v_xmax)
-        hi_index = _clip(index + current_width, v_xmin, v_xmax)
+@jit(nopython=True, nogil=True)
+def snip_method_numba(
+    spectrum,
+    e_off,
+    e_lin,
+    e_quad,
+    xmin=0,
+    xmax=4096,
+    epsilon=2.96,
+    width=0.5,
+    decrease_factor=np.sqrt(2),
+    spectral_binning=None,
+    con_val=None,
+    iter_num=None,
+    width_threshold=0.5,
+):
+    """
+    Use snip algorithm to obtain background.
 
-        temp = (background[lo_index.astype(np.int32)] + background[hi_index.astype(np.int32)]) / 2.0
+    The code of this function is borrowed from scikit-beam and changed to
+    to work with numba.
 
-        bg_index = background > temp
-        # The following numpy based line of code stopped working with numba v0.61.0
-        # background[bg_index] = temp[bg_index]
-        # The following code is the workaround. Seems fast enough.
-        for n in range(len(background)):
-            if bg_index[n]:
-                background[n] = temp[n]
+    Parameters
+    ----------
+    spectrum : array
+        intensity spectrum
+    e_off : float
+        energy calibration, such as e_off + e_lin * energy + e_quad * energy^2
+    e_lin : float
+        energy calibration, such as e_off + e_lin * energy + e_quad * energy^2
+    e_quad : float
+        energy calibration, such as e_off + e_lin * energy + e_quad * energy^2
+    xmin : float, optional
+        smallest index to define the range
+    xmax : float, optional
+        largest index to define the range
+    epsilon : float, optional
+        energy to create a hole-electron pair
+        for Ge 2.96, for Si 3.61 at 300K
+        needs to double check this value
+    width : int, optional
+        window size to adjust how much to shift background
+    decrease_factor : float, optional
+        gradually decrease of window size, default as sqrt(2)
+    spectral_binning : float, optional
+        bin the data into different size
+    con_val : int, optional
+        size of scipy.signal.boxcar to convolve the spectrum.
 
-        # decrease the width and repeat
-        current_width = current_width / decrease_factor
-        max_current_width = np.amax(current_width)
+        Default value is controlled by the keys `con_val_no_bin`
+        and `con_val_bin` in the defaults dictionary, depending
+        on if spectral_binning is used or not
 
-    background = np.exp(np.exp(background) - 1) - 1
+    iter_num : int, optional
+        Number of iterations.
+
+        Default value is controlled by the keys `iter_num_no_bin`
+        and `iter_num_bin` in the defaults dictionary, depending
+        on if spectral_binning is used or not
+
+    width_threshold : float, optional
+        stop point of the algorithm
+
+    Returns
+    -------
+    background : array
+        output results with peak removed
+
+    References
+    ----------
+
+    .. [1] C.G. Ryan etc, "SNIP, a statistics-sensitive background
+           treatment for the quantitative analysis of PIXE spectra in
+           geoscience applications", Nuclear Instruments and Methods in
+           Physics Research Section B, vol. 34, 1998.
+    """
+
+    # clean input a bit (new variables are introduced so that numba could prune
+    #   the branches and the variables are not typed as optional)
+    if con_val is None:
+        if spectral_binning is None:
+            _con_val = _default_con_val_no_bin
+        else:
+            _con_val = _default_con_val_bin
+    else:
+        _con_val = con_val
+
+    if iter_num is None:
+        if spectral_binning is None:
+            _iter_num = _default_iter_num_no_bin
+        else:
+            _iter_num = _default_iter_num_bin
+    else:
+        _iter_num = iter_num
+
+    lo_index, hi_index = _snip_window_indices(
+        spectrum.size,
+        e_off,
+        e_lin,
+        e_quad,
+        xmin,
+        xmax,
+        epsilon,
+        width,
+        decrease_factor,
+        spectral_binning,
+        _iter_num,
+        width_threshold,
+    )
+
+    return _snip_spectrum(spectrum, _con_val, lo_index, hi_index)
 
-    inf_ind = np.where(~np.isfinite(background))
-    background[inf_ind] = 0.0
 
+def _snip_block_kernel(spectra, con_val, lo_index, hi_index):
+    """
+    Apply SNIP algorithm to each row of 2D array ``spectra`` (shape ``(n_spectra, ne)``).
+    The function is compiled in two versions: ``_snip_block_serial`` and ``_snip_block_parallel``.
+    """
+    n_spectra, ne = spectra.shape
+    # The first spectrum determines the data type of the output array
+    bg = _snip_spectrum(spectra[0, :], con_val, lo_index, hi_index)
+    background = np.empty((n_spectra, ne), dtype=bg.dtype)
+    background[0, :] = bg
+    for n in prange(1, n_spectra):
+        background[n, :] = _snip_spectrum(spectra[n, :], con_val, lo_index, hi_index)
     return background
+
+
+_snip_block_serial = jit(nopython=True, nogil=True)(_snip_block_kernel)
+_snip_block_parallel = jit(nopython=True, nogil=True, parallel=True)(_snip_block_kernel)
+
+
+def snip_method_numba_block(
+    data,
+    e_off,
+    e_lin,
+    e_quad,
+    xmin=0,
+    xmax=4096,
+    epsilon=2.96,
+    width=0.5,
+    decrease_factor=np.sqrt(2),
+    spectral_binning=None,
+    con_val=None,
+    iter_num=None,
+    width_threshold=0.5,
+    parallel=False,
+):
+    """
+    Apply SNIP algorithm to each spectrum of a block of XRF data. The result is identical
+    to the result of applying ``snip_method_numba`` to each spectrum along axis 2
+    (e.g. using ``np.apply_along_axis``), but the windows of the algorithm are computed
+    only once for the whole block and all spectra are processed in one compiled loop.
+
+    Parameters
+    ----------
+    data : ndarray
+        block of an XRF dataset with spectra placed along the last axis. Typically
+        the shape is ``(ny, nx, ne)``.
+    e_off, e_lin, e_quad, xmin, xmax, epsilon, width, decrease_factor, spectral_binning,
+    con_val, iter_num, width_threshold
+        parameters of the SNIP algorithm. See ``snip_method_numba`` for description.
+    parallel : bool, optional
+        process spectra in parallel using numba threads. Keep the default ``False`` if
+        the function is called from multiple threads concurrently (e.g. by threaded
+        Dask workers), since the default numba threading layer is not thread-safe.
+
+    Returns
+    -------
+    background : ndarray
+        array of the same shape as ``data`` that contains the estimated background
+        for each spectrum.
+    """
+    data = np.asarray(data)
+    if data.ndim < 1:
+        raise ValueError(f"Parameter 'data' must have at least 1 dimension: data.ndim = {data.ndim}")
+
+    shape = data.shape
+    if not data.size:
+        return np.zeros(shape=shape)
+
+    con_val, iter_num = _snip_default_con_val_and_iter_num(spectral_binning, con_val, iter_num)
+
+    lo_index, hi_index = _snip_window_indices(
+        shape[-1],
+        e_off,
+        e_lin,
+        e_quad,
+        xmin,
+        xmax,
+        epsilon,
+        width,
+        decrease_factor,
+        spectral_binning,
+        iter_num,
+        width_threshold,
+    )
+
+    # Reshaping usually returns a view, since only the last axis of the block may be truncated
+    spectra = np.reshape(data, (-1, shape[-1]))
+    snip_block = _snip_block_parallel if parallel else _snip_block_serial
+    background = snip_block(spectra, con_val, lo_index, hi_index)
+
+    return np.reshape(background, shape)
@@ -9,6 +9,7 @@ import jsonschema
 import numpy as np
 import yaml
 
+from .map_cube import MapCube
 from .utils import convert_time_to_nexus_string, normalize_data_by_scaler
 from .xrf_utils import (
     check_if_eline_supported,
@@ -1746,6 +1747,95 @@ class ParamQuantitativeAnalysis:
         if name_not_scalable and (data_name in name_not_scalable):
             return data_in, is_quant_normalization_applied
 
+        quant_params = self._get_quantitative_normalization_params(
+            data_name, scaler_dict=scaler_dict, ref_name=ref_name
+        )
+
+        if quant_params is not None:
+            # Quantitative calibration for the emission line is loaded, so normalization is
+            #   performed. The scaler used to obtain calibration is used. Note, that
+            #   if the scaler is None, then the function returns data without change
+            scaler_name, scaling_coef = quant_params
+            scaler = None if scaler_name is None else scaler_dict[scaler_name]
+            data_arr = normalize_data_by_scaler(
+                data_in=data_in, scaler=scaler, data_name=data_name, name_not_scalable=name_not_scalable
+            )
+            # Normalization function above returns reference if not transformations were applied
+            #   Make a copy in this case.
+            if data_arr is data_in:
+                data_arr = data_in.copy()
+            data_arr *= scaling_coef
+            is_quant_normalization_applied = True
+        else:
+            # The following condition also takes care of the case when 'scaler_name_fixed' is None
+            if scaler_name_default in scaler_dict:
+                data_arr = normalize_data_by_scaler(
+                    data_in=data_in,
+                    scaler=scaler_dict[scaler_name_default],
+                    data_name=data_name,
+                    name_not_scalable=name_not_scalable,
+                )
+            else:
+                data_arr = data_in
+
+        return data_arr, is_quant_normalization_applied
+
+    def apply_quantitative_normalization_to_maps(
+        self, maps, *, scaler_dict, ref_name=None, name_not_scalable=None
+    ):
+        r"""
+        Apply quantitative normalization to multiple XRF maps. The maps normalized using the same
+        scaler are processed at once. The results are the same as the results of calling
+        ``apply_quantitative_normalization`` for each map with ``scaler_name_default=None``.
+
+        Parameters
+        ----------
+
+        maps: dict(str, ndarray)
+            dictionary of XRF maps: key - map name (e.g. emission line), value - 2D array.
+        scaler_dict: dict(key: str, value: ndarray)
+            Dictionary of the available scaler data for the experimental scan.
+        ref_name: str or None
+            Name of the reference emission line (see ``apply_quantitative_normalization``).
+        name_not_scalable: list or None
+            List of map names that are not supposed to be normalized.
+
+        Returns
+        -------
+
+        dict(str, ndarray)
+            dictionary of normalized maps. The dictionary contains only the maps to which
+            quantitative normalization was applied. The order of the maps is preserved.
+        """
+        # Maps with the same scaler and shape are normalized together
+        groups = {}
+        for data_name, data_in in maps.items():
+            if data_in is None or (name_not_scalable and (data_name in name_not_scalable)):
+                continue
+            quant_params = self._get_quantitative_normalization_params(
+                data_name, scaler_dict=scaler_dict, ref_name=ref_name
+            )
+            if quant_params is not None:
+                scaler_name, scaling_coef = quant_params
+                groups.setdefault((scaler_name, np.shape(data_in)), []).append((data_name, scaling_coef))
+
+        maps_normalized = {}
+        for (scaler_name, _), items in groups.items():
+            names = [_[0] for _ in items]
+            coefs = np.array([_[1] for _ in items])
+            cube = MapCube.from_dict({_: maps[_] for _ in names})
+            if scaler_name is not None:
+                cube = cube.normalize_by_scaler(scaler_dict[scaler_name])
+            maps_normalized.update(MapCube(names, cube.data * coefs[:, np.newaxis, np.newaxis]))
+
+        return {_: maps_normalized[_] for _ in maps if _ in maps_normalized}
+
+    def _get_quantitative_normalization_params(self, data_name, *, scaler_dict, ref_name=None):
+        r"""
+        Find parameters of quantitative normalization for the map ``data_name``. Returns
+        the tuple ``(scaler_name, scaling_coef)`` or ``None`` if quantitative normalization can
+        not be applied. ``scaler_name`` is ``None`` if normalization by scaler is not needed.
+        """
         e_info = self.get_eline_calibration(ref_name if ref_name else data_name)
         # Scaler is not strictly required to perform quanitative calibration, so it is allowed
         #   to run the function without a scaler. The scaler name is None if the standard was
@@ -1802,57 +1892,32 @@ class ParamQuantitativeAnalysis:
                 logger.error(ex)
                 run_quant = False
 
-        if run_quant:
-            # Quantitative calibration for the emission line is loaded, so normalization is
-            #   performed. The scaler used to obtain calibration is used. Note, that
-            #   if the scaler is None, then the function returns data without change
-            if e_info_scaler is None:
-                scaler = None
-            else:
-                scaler = scaler_dict[e_info_scaler]
-            data_arr = normalize_data_by_scaler(
-                data_in=data_in, scaler=scaler, data_name=data_name, name_not_scalable=name_not_scalable
+        if not run_quant:
+            return None
+
+        scaling_coef = e_info["density"] / e_info["fluorescence"] * atomic_scaling_factor
+        # If distance to sample is set for calibration data and current scan, then apply correction
+        #   If either value is ZERO, then don't perform the correction.
+        r1 = e_info["distance_to_sample"]
+        r2 = self.experiment_distance_to_sample
+        if (
+            (r1 is not None)
+            and (r2 is not None)
+            and (r1 > 0)
+            and (r2 > 0)
+            and not math.isclose(r1, r2, abs_tol=1e-20)
+        ):
+            # Element density increase as the distance becomes larger
+            #   (fluorescence is reduced as r**2)
+            scaling_coef *= (r2 / r1) ** 2
+            logger.info(
+                f"Emission line {data_name}. Correction for distance-to-sample was performed "
+                f"(standard: {r1}, sample: {r2})"
             )
-            # Normalization function above returns reference if not transformations were applied
-            #   Make a copy in this case.
-            if data_arr is data_in:
-                data_arr = data_in.copy()
-            scaling_coef = e_info["density"] / e_info["fluorescence"] * atomic_scaling_factor
-            data_arr *= scaling_coef
-            # If distance to sample is set for calibration data and current scan, then apply correction
-            #   If either value is ZERO, then don't perform the correction.
-            r1 = e_info["distance_to_sample"]
-            r2 = self.experiment_distance_to_sample
-            if (
-                (r1 is not None)
-                and (r2 is not None)
-                and (r1 > 0)
-                and (r2 > 0)
-                and not math.isclose(r1, r2, abs_tol=1e-20)
-            ):
-                # Element density increase as the distance becomes larger
-                #   (fluorescence is reduced as r**2)
-                data_arr *= (r2 / r1) ** 2
-                logger.info(
-                    f"Emission line {data_name}. Correction for distance-to-sample was performed "
-                    f"(standard: {r1}, sample: {r2})"
-                )
-            else:
-                logger.info(
-                    f"Emission line {data_name}. Correction for distance-to-sample was skipped "
-                    f"(standard: {r1}, sample: {r2})"
-                )
-            is_quant_normalization_applied = True
         else:
-            # The following condition also takes care of the case when 'scaler_name_fixed' is None
-            if scaler_name_default in scaler_dict:
-                data_arr = normalize_data_by_scaler(
-                    data_in=data_in,
-                    scaler=scaler_dict[scaler_name_default],
-                    data_name=data_name,
-                    name_not_scalable=name_not_scalable,
-                )
-            else:
-                data_arr = data_in
+            logger.info(
+                f"Emission line {data_name}. Correction for distance-to-sample was skipped "
+                f"(standard: {r1}, sample: {r2})"
+            )
 
-        return data_arr, is_quant_normalization_applied
+        return e_info_scaler, scaling_coef
@@ -0,0 +1,142 @@
+import getpass
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import uuid
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _default_shared_dir(nbytes):
+    """
+    Default location of the shared arrays: the directory backed by shared memory (`/dev/shm`)
+    on Linux if it exists and has enough free space for `nbytes` bytes, otherwise user-specific
+    directory in the system temporary directory.
+    """
+    shm_dir = "/dev/shm"
+    if (
+        platform.system() == "Linux"
+        and os.path.isdir(shm_dir)
+        and os.access(shm_dir, os.W_OK)
+        and shutil.disk_usage(shm_dir).free > 2 * nbytes
+    ):
+        return os.path.join(shm_dir, f"pyxrf_{getpass.getuser()}")
+    else:
+        return os.path.join(tempfile.gettempdir(), getpass.getuser(), "pyxrf", "shared")
+
+
+def _remove_file(fpath):
+    try:
+        os.remove(fpath)
+    except OSError as ex:
+        logger.debug(f"Failed to remove the file with shared array {fpath!r}: {ex}")
+
+
+class SharedArray:
+    """
+    Read-only copy of a numpy array placed in a memory-mapped temporary file (in shared
+    memory on Linux). The object is lightweight: only the file name, shape and data type
+    are serialized when the object is sent to Dask workers. The workers attach to the
+    file and read the requested slices directly from the shared memory instead of
+    receiving serialized copies of the data in the task graph.
+
+    The object supports slicing and may be converted to Dask array using `da.from_array`.
+    The file is removed by the process that created the array when `close()` is called or
+    when the object is garbage collected. The copies of the object sent to the workers
+    never remove the file.
+
+    Examples
+    --------
+    .. code-block:: python
+
+        with SharedArray(data) as data_shared:
+            data_dask = da.from_array(data_shared, chunks=(10, 10, data.shape[2]))
+            result = data_dask.sum(axis=2).compute()
+
+    Parameters
+    ----------
+    data: ndarray
+        the array copied to the shared memory
+    shared_dir: str or None
+        directory for the shared files. The default directory is used if `None`.
+    """
+
+    def __init__(self, data, *, shared_dir=None):
+        data = np.asarray(data)
+        shared_dir = os.path.abspath(shared_dir if shared_dir is not None else _default_shared_dir(data.nbytes))
+        os.makedirs(shared_dir, exist_ok=True)
+        # Writing to memory-mapped file on a full device crashes the process instead of raising an exception
+        if shutil.disk_usage(shared_dir).free <= data.nbytes:
+            raise OSError(f"Not enough space in the directory {shared_dir!r} to share {data.nbytes} bytes")
+
+        self.fpath = os.path.join(shared_dir, f"{uuid.uuid4().hex}.npy")
+        self.shape = data.shape
+        self.dtype = data.dtype
+
+        try:
+            mmap = np.lib.format.open_memmap(self.fpath, mode="w+", dtype=self.dtype, shape=self.shape)
+            mmap[...] = data
+            mmap.flush()
+            del mmap
+        except Exception:
+            _remove_file(self.fpath)
+            raise
+
+        self._view = None
+        # The file is removed only by the object that created it
+        self._finalizer = weakref.finalize(self, _remove_file, self.fpath)
+
+    def __repr__(self):
+        return f"SharedArray(fpath={self.fpath!r}, shape={self.shape}, dtype={self.dtype})"
+
+    def __dask_tokenize__(self):
+        return (type(self).__name__, self.fpath)
+
+    def __getstate__(self):
+        # The memory map is opened independently by each process. The finalizer is not sent.
+        return {"fpath": self.fpath, "shape": self.shape, "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._view = None
+        self._finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def closed(self):
+        """
+        `True` if the shared file was removed. The copies of the object sent to other
+        processes are never closed.
+        """
+        return self._finalizer is not None and not self._finalizer.alive
+
+    def __getitem__(self, key):
+        if self._view is None:
+            if self.closed:
+                raise ValueError(f"The shared array is closed: {self.fpath!r}")
+            self._view = np.load(self.fpath, mmap_mode="r")
+        # Return a copy, so that the block does not depend on the shared file
+        return np.array(self._view[key])
+
+    def close(self):
+        """
+        Remove the shared file. The data is released once all processes that read the data
+        drop the references to the memory map. The function does nothing in other processes.
+        """
+        self._view = None
+        if self._finalizer is not None:
+            self._finalizer()
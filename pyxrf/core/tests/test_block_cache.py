@@ -0,0 +1,97 @@
+import os
+import pickle
+import time as ttime
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from pyxrf.core.block_cache import BlockResultCache, cached_block_func
+
+
+def test_BlockResultCache_1(tmp_path):
+    """
+    Basic operations: saving and loading entries, keys
+    """
+    cache = BlockResultCache(str(tmp_path / "cache"))
+    assert os.path.isdir(cache.cache_dir)
+    assert cache.n_entries == 0
+    assert cache.size == 0
+
+    data = np.random.random((3, 4, 10))
+    digest = cache.params_digest("fit", (2, 8), np.ones((6, 3)), {"b": 1, "a": 2}, True)
+    # Digest does not depend on the order of keys in the dictionary
+    assert digest == cache.params_digest("fit", (2, 8), np.ones((6, 3)), {"a": 2, "b": 1}, True)
+    assert digest != cache.params_digest("fit", (2, 8), np.ones((6, 3)) * 2, {"a": 2, "b": 1}, True)
+    assert digest != cache.params_digest("fit", (2, 8), np.ones((6, 3)), {"a": 2, "b": 1}, False)
+
+    key = cache.compute_key(data, digest)
+    assert key != cache.compute_key(data + 1, digest)
+    assert key != cache.compute_key(data.reshape(4, 3, 10), digest)
+    assert key != cache.compute_key(data, digest + "0")
+
+    assert cache.get(key) is None
+    result = np.random.random((3, 4, 5))
+    cache.put(key, result)
+    npt.assert_array_equal(cache.get(key), result)
+    assert cache.n_entries == 1
+    assert cache.size > result.nbytes
+
+    # The object may be sent to Dask workers
+    cache2 = pickle.loads(pickle.dumps(cache))
+    npt.assert_array_equal(cache2.get(key), result)
+
+    cache.clear()
+    assert cache.n_entries == 0
+    assert cache.get(key) is None
+
+
+def test_BlockResultCache_2(tmp_path):
+    """
+    Least recently used entries are removed first
+    """
+    entry_size = np.zeros(100).nbytes
+    cache = BlockResultCache(str(tmp_path), max_size=3 * entry_size + 500)
+
+    keys = [f"key{_}" for _ in range(5)]
+    for n, key in enumerate(keys):
+        cache.put(key, np.ones(100) * n)
+        # Make sure that modification times are different
+        t = ttime.time() - 100 + n
+        os.utime(cache._entry_path(key), (t, t))
+
+    # Access the oldest entry: it becomes the most recent
+    assert cache.get(keys[0]) is not None
+
+    assert cache.evict() == 2
+    assert cache.n_entries == 3
+    assert cache.size <= cache.max_size
+    assert [cache.get(_) is not None for _ in keys] == [True, False, False, True, True]
+
+
+def test_cached_block_func(tmp_path):
+    n_calls = []
+
+    def func(data, *, factor):
+        n_calls.append(1)
+        return data * factor
+
+    data = np.random.random((2, 3, 4))
+    cache = BlockResultCache(str(tmp_path))
+    digest = cache.params_digest(2)
+
+    npt.assert_array_equal(
+        cached_block_func(data, block_func=func, cache=None, params_digest=None, factor=2), data * 2
+    )
+    assert len(n_calls) == 1 and cache.n_entries == 0
+
+    for _ in range(3):
+        result = cached_block_func(data, block_func=func, cache=cache, params_digest=digest, factor=2)
+        npt.assert_array_equal(result, data * 2)
+    assert len(n_calls) == 2 and cache.n_entries == 1
+
+
+@pytest.mark.parametrize("max_size", [0, -1, 1.5, None])
+def test_BlockResultCache_fail(max_size, tmp_path):
+    with pytest.raises(ValueError, match="Parameter 'max_size' must be a positive integer"):
+        BlockResultCache(str(tmp_path), max_size=max_size)
@@ -2,7 +2,16 @@ import numpy as np
 import numpy.testing as npt
 import pytest
 
-from pyxrf.core.fitting import _fitting_admm, _fitting_nnls, fit_spectrum, rfactor_compute
+from pyxrf.core.fitting import (
+    _fitting_admm,
+    _fitting_nnls,
+    _fitting_nnls_gram,
+    _nnls_gram_solve_passive,
+    _nnls_gram_solve_single,
+    factorize_references,
+    fit_spectrum,
+    rfactor_compute,
+)
 
 # ------------------------------------------------------------------------------
 #  useful functions for generating of datasets for testing of fitting algorithms
@@ -291,6 +300,132 @@ def test_fitting_nnls_fail():
         _fitting_nnls(spectra, data_input)
 
 
+# fmt: off
+@pytest.mark.parametrize("dataset_params", [
+    {"n_data_dimensions": (8,)},
+    {"n_data_dimensions": (15,), "n_spectra": 10},
+    # Some of the weights are negative, so the constraints are active
+    {"n_data_dimensions": (15,), "n_spectra": 10, "weights_range": (-1, 1)},
+])
+# fmt: on
+def test_fitting_nnls_gram(dataset_params):
+    """
+    Results of `_fitting_nnls_gram` must match the results of `_fitting_nnls`
+    """
+    fitting_data = DataForFittingTest(**dataset_params)
+
+    spectra = fitting_data.spectra
+    data_input = fitting_data.data_input
+    # Add some noise
+    data_input = data_input + np.random.random(data_input.shape) * 0.01
+
+    weights_expected, rfactor_expected, residual_expected = _fitting_nnls(data_input, spectra)
+    weights_estimated, rfactor, residual = _fitting_nnls_gram(data_input, spectra)
+
+    assert weights_estimated.shape == weights_expected.shape
+    assert np.all(weights_estimated >= 0), "Some of the weights are negative"
+    # The references overlap significantly, so the problem is poorly conditioned. Small differences
+    #   in weights are expected, but the quality of the fit (residual) must be the same.
+    npt.assert_array_almost_equal(weights_estimated, weights_expected, decimal=4)
+    npt.assert_array_almost_equal(rfactor, rfactor_expected, decimal=10)
+    npt.assert_array_almost_equal(residual, residual_expected, decimal=10)
+
+
+def test_fitting_nnls_gram_special_cases():
+    """
+    Zero reference spectra, zero and negative data
+    """
+    fitting_data = DataForFittingTest(n_data_dimensions=(10,), n_spectra=5)
+
+    spectra = fitting_data.spectra.copy()
+    spectra[:, 2] = 0  # One of the references is zero
+    data_input = fitting_data.data_input.copy()
+    data_input[:, 3] = 0  # All-zero spectrum
+    data_input[:, 4] = -data_input[:, 4]  # Negative spectrum
+
+    weights_expected, _, _ = _fitting_nnls(data_input, spectra)
+    weights_estimated, _, _ = _fitting_nnls_gram(data_input, spectra)
+
+    npt.assert_array_almost_equal(weights_estimated, weights_expected)
+    assert np.all(weights_estimated[2, :] == 0)
+    assert np.all(weights_estimated[:, 3] == 0)
+    assert np.all(weights_estimated[:, 4] == 0)
+
+    # Check the arguments
+    with pytest.raises(AssertionError, match="'maxiter' is zero or negative"):
+        _fitting_nnls_gram(data_input, spectra, maxiter=0)
+    with pytest.raises(AssertionError, match="number of spectrum points in data .+ do not match"):
+        _fitting_nnls_gram(data_input[:-1, :], spectra)
+
+
+@pytest.mark.parametrize("maxiter", [1, 2, 3, 5, 8, 11])
+def test_fitting_nnls_gram_maxiter(maxiter):
+    """
+    The weights are non-negative if fitting is stopped after reaching the maximum
+    number of iterations (strongly correlated references, many active constraints).
+    """
+    rng = np.random.default_rng(0)
+    n_pts, n_refs, n_spectra = 30, 10, 100
+    spectra = rng.random((n_pts, 2)) @ rng.random((2, n_refs)) + 0.1 * rng.random((n_pts, n_refs))
+    data_input = rng.random((n_pts, n_spectra))
+
+    weights, rfactor, _ = _fitting_nnls_gram(data_input, spectra, maxiter=maxiter)
+
+    assert np.all(weights >= 0), f"Some of the weights are negative: {np.min(weights)}"
+    assert np.all(np.isfinite(rfactor))
+
+
+def test_fitting_nnls_gram_collinear():
+    """
+    Duplicate and collinear references: the Gram matrix of the passive set is singular.
+    """
+    fitting_data = DataForFittingTest(n_data_dimensions=(10,), n_spectra=5)
+
+    spectra = fitting_data.spectra.copy()
+    spectra = np.hstack([spectra, spectra[:, 0:1], 2 * spectra[:, 1:2]])
+    data_input = fitting_data.data_input
+
+    _, _, residual_expected = _fitting_nnls(data_input, spectra)
+    weights, _, residual = _fitting_nnls_gram(data_input, spectra)
+
+    assert np.all(np.isfinite(weights))
+    assert np.all(weights >= 0)
+    npt.assert_array_almost_equal(residual, residual_expected, decimal=6)
+
+    # Singular Gram matrix of the passive set: the least squares solution is returned
+    gram = np.array([[1.0, 1.0, 0.0], [1.0, 1.0, 0.0], [0.0, 0.0, 2.0]])
+    atb = np.array([2.0, 2.0, 1.0])
+    s = _nnls_gram_solve_passive(gram, atb, np.array([True, True, False]))
+    npt.assert_array_almost_equal(s, [1.0, 1.0, 0.0])
+
+
+def test_fitting_nnls_gram_zero_and_duplicate():
+    """
+    Zero and duplicate references: the variable added to the passive set may be zero
+    in the current and in the new solution.
+    """
+    fitting_data = DataForFittingTest(n_data_dimensions=(10,), n_spectra=5)
+
+    spectra = fitting_data.spectra.copy()
+    spectra[:, 2] = 0
+    spectra = np.hstack([spectra, spectra[:, 0:1], spectra[:, 2:3]])
+    data_input = fitting_data.data_input
+
+    _, _, residual_expected = _fitting_nnls(data_input, spectra)
+    weights, _, residual = _fitting_nnls_gram(data_input, spectra)
+
+    assert np.all(np.isfinite(weights))
+    assert np.all(weights >= 0)
+    assert np.all(weights[[2, 6], :] == 0)
+    npt.assert_array_almost_equal(residual, residual_expected, decimal=6)
+
+    # The Gram matrix contains zero column, but 'A^T b' is not zero due to limited numerical precision
+    gram = np.array([[1.0, 0.0], [0.0, 0.0]])
+    atb = np.array([1.0, 1.0])
+    x = _nnls_gram_solve_single(gram, atb, 100, 1e-12)
+    npt.assert_array_almost_equal(x, [1.0, 0.0])
+
+
 # fmt: off
 @pytest.mark.parametrize("dataset_params", [
     {"n_data_dimensions": (8,), "non_negative": True},
@@ -443,6 +578,7 @@ def test_fitting_admm_fail():
 @pytest.mark.parametrize("process_params", [
     {},  # The default method is "nnls"
     {"method": "nnls"},
+    {"method": "nnls_gram"},
     {"method": "admm"},
 ])
 # fmt: on
@@ -494,9 +630,9 @@ def test_fit_spectrum(dataset_params, process_params):
             "The returned 'convergence' and 'feasibility' arrays must have the same size "
             "(ADMM optimization method)"
         )
-    elif params["method"] == "nnls":
+    elif params["method"] in ("nnls", "nnls_gram"):
         assert (
-            results_dict["method"] == "nnls"
+            results_dict["method"] == params["method"]
         ), f"Incorrect method '{results_dict['method']}' is reported by NNLS optimization function"
         assert (
             "residual" in results_dict
@@ -565,3 +701,34 @@ def test_fit_spectrum_fail():
     data_input = np.zeros(shape=[n_pts, n_refs])
     with pytest.raises(AssertionError, match="number of spectrum points in data .+ do not match"):
         fit_spectrum(spectra, data_input)
+
+
+@pytest.mark.parametrize("method", ["nnls", "nnls_gram", "admm"])
+def test_factorize_references(method):
+    """
+    Fitting with precomputed matrices produces the same results as fitting without them.
+    """
+    fitting_data = DataForFittingTest(n_data_dimensions=(15,))
+    spectra, data_input = fitting_data.spectra, fitting_data.data_input
+
+    factors = factorize_references(spectra, method=method, rate=0.3)
+    assert factors["method"] == method
+    npt.assert_array_almost_equal(factors["gram"], np.matmul(spectra.T, spectra))
+
+    if method == "admm":
+        npt.assert_array_almost_equal(
+            factors["admm_matrix"], np.linalg.inv(np.matmul(spectra.T, spectra) + 0.3 * np.eye(spectra.shape[1]))
+        )
+        results = _fitting_admm(data_input, spectra, rate=0.3, admm_matrix=factors["admm_matrix"])
+        results_expected = _fitting_admm(data_input, spectra, rate=0.3)
+    else:
+        assert factors["admm_matrix"] is None
+        results = _fitting_nnls_gram(data_input, spectra, gram=factors["gram"])
+        results_expected = _fitting_nnls_gram(data_input, spectra)
+
+    for res, res_expected in zip(results, results_expected):
+        npt.assert_array_almost_equal(res, res_expected)
+    fitting_data.validate_output_weights(results[0], decimal=8)
+
+    with pytest.raises(AssertionError, match="is not supported"):
+        factorize_references(spectra, method="abc")
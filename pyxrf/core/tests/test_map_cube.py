@@ -0,0 +1,149 @@
+import copy
+import pickle
+
+import h5py
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from pyxrf.core.map_cube import MapCube
+from pyxrf.core.utils import normalize_data_by_scaler
+
+
+def test_MapCube_1():
+    """
+    Basic functionality of ``MapCube``: dictionary interface, views of the array
+    """
+    names = ["Fe_K", b"Ca_K", "total_cnt"]
+    data = np.random.random((3, 5, 7))
+
+    cube = MapCube(names, data)
+    assert isinstance(cube, dict)
+    assert cube.names == ["Fe_K", "Ca_K", "total_cnt"]
+    assert list(cube.keys()) == cube.names
+    assert cube.data is data
+    for n, name in enumerate(cube.names):
+        assert np.shares_memory(cube[name], data)
+        npt.assert_array_equal(cube[name], data[n])
+
+    # Replace one map using dictionary interface
+    cube["Ca_K"] = np.ones(shape=(5, 7))
+    npt.assert_array_equal(cube.data[1], np.ones(shape=(5, 7)))
+    assert np.shares_memory(cube["Ca_K"], cube.data)
+
+    # Delete the map
+    del cube["Fe_K"]
+    assert cube.names == ["Ca_K", "total_cnt"]
+    npt.assert_array_equal(cube.data, np.stack([np.ones(shape=(5, 7)), data[2]]))
+
+    # Add maps
+    cube.add_maps(["Zn_K", "Cu_K"])
+    assert cube.names == ["Ca_K", "total_cnt", "Zn_K", "Cu_K"]
+    assert cube.data.shape == (4, 5, 7)
+    npt.assert_array_equal(cube["Zn_K"], np.zeros(shape=(5, 7)))
+    assert np.shares_memory(cube["Zn_K"], cube.data)
+
+    cube.add_maps(["Pt_M"], np.ones(shape=(1, 5, 7)) * 2)
+    npt.assert_array_equal(cube["Pt_M"], np.ones(shape=(5, 7)) * 2)
+
+    cube.clear()
+    assert cube.data.shape == (0, 5, 7)
+
+
+def test_MapCube_2():
+    """
+    Creating the cube from dictionary, copying and pickling
+    """
+    maps = {"Fe_K": np.random.random((4, 6)), "Ca_K": np.random.random((4, 6))}
+    cube = MapCube.from_dict(maps)
+    assert cube.names == list(maps.keys())
+    for name in maps:
+        npt.assert_array_equal(cube[name], maps[name])
+
+    cube_copy = cube.copy()
+    assert isinstance(cube_copy, MapCube)
+    assert cube_copy.data is cube.data
+
+    cube_deepcopy = copy.deepcopy(cube)
+    assert isinstance(cube_deepcopy, MapCube)
+    assert not np.shares_memory(cube_deepcopy.data, cube.data)
+    npt.assert_array_equal(cube_deepcopy.data, cube.data)
+
+    cube_unpickled = pickle.loads(pickle.dumps(cube))
+    assert isinstance(cube_unpickled, MapCube)
+    assert cube_unpickled.names == cube.names
+    npt.assert_array_equal(cube_unpickled.data, cube.data)
+
+    assert MapCube.from_dict({}).data.shape[0] == 0
+
+
+def test_MapCube_3(tmp_path):
+    """
+    Loading the cube from HDF5 file
+    """
+    names = ["Fe_K", "Ca_K"]
+    data = np.random.random((2, 5, 7))
+    fpath = str(tmp_path / "test.h5")
+    with h5py.File(fpath, "w") as f:
+        f.create_dataset("xrfmap/detsum/xrf_fit", data=data)
+        f.create_dataset("xrfmap/detsum/xrf_fit_name", data=np.array(names).astype("|S20"))
+
+    with h5py.File(fpath, "r") as f:
+        cube = MapCube.from_hdf5(f["xrfmap/detsum"])
+
+    assert cube.names == names
+    npt.assert_array_equal(cube.data, data)
+
+
+@pytest.mark.parametrize("use_average", [False, True])
+@pytest.mark.parametrize(
+    "scaler",
+    [
+        np.random.random((5, 7)) + 0.1,
+        np.concatenate([np.zeros(shape=(1, 7)), np.random.random((4, 7)) + 0.1]),
+        np.zeros(shape=(5, 7)),
+        np.ones(shape=(4, 7)),
+    ],
+)
+def test_MapCube_normalize_by_scaler(scaler, use_average):
+    """
+    Vectorized normalization produces the same results as normalization of each map
+    """
+    names = ["Fe_K", "Ca_K", "x_pos"]
+    data = np.random.random((3, 5, 7))
+    data_copy = data.copy()
+    cube = MapCube(names, data)
+
+    cube_norm = cube.normalize_by_scaler(scaler, use_average=use_average, names_not_scalable=["x_pos"])
+    assert isinstance(cube_norm, MapCube)
+    assert cube_norm.names == names
+    # Original data is not modified
+    npt.assert_array_equal(cube.data, data_copy)
+
+    for name in names[:2]:
+        expected = normalize_data_by_scaler(cube[name], scaler)
+        if use_average:
+            expected = expected * np.mean(scaler)
+        npt.assert_array_almost_equal(cube_norm[name], expected)
+    npt.assert_array_equal(cube_norm["x_pos"], cube["x_pos"])
+
+
+# fmt: off
+@pytest.mark.parametrize("names, data, msg", [
+    (["Fe_K"], np.zeros(shape=(2, 5, 7)), "Map data must be 3D array"),
+    (["Fe_K", "Ca_K"], np.zeros(shape=(5, 7)), "Map data must be 3D array"),
+    (["Fe_K", "Fe_K"], np.zeros(shape=(2, 5, 7)), "contains repeated names"),
+])
+# fmt: on
+def test_MapCube_fail(names, data, msg):
+    with pytest.raises(ValueError, match=msg):
+        MapCube(names, data)
+
+
+def test_MapCube_fail2():
+    cube = MapCube(["Fe_K"], np.zeros(shape=(1, 5, 7)))
+    with pytest.raises(ValueError, match="Maps already exist"):
+        cube.add_maps(["Fe_K"])
+
+    with pytest.raises(ValueError, match="must be 2D arrays of the same shape"):
+        MapCube.from_dict({"Fe_K": np.zeros(shape=(5, 7)), "Ca_K": np.zeros(shape=(5, 6))})
@@ -1,4 +1,5 @@
 import logging
+import math
 import os
 import uuid
 
@@ -9,25 +10,39 @@ import numpy.testing as npt
 import pytest
 from skbeam.core.fitting.background import snip_method
 
+import pyxrf.core.map_processing as map_processing
+from pyxrf.core.block_cache import BlockResultCache
 from pyxrf.core.fitting import fit_spectrum
 from pyxrf.core.map_processing import (
+    ChunkPlan,
+    DaskClusterManager,
     RawHDF5Dataset,
     TerminalProgressBar,
+    TotalSpectrumIndex,
     _array_numpy_to_dask,
     _chunk_numpy_array,
-    _compute_optimal_chunk_size,
     _compute_roi,
     _fit_xrf_block,
     _prepare_xrf_mask,
+    _scatter_cached,
+    bin_xrf_map,
+    compute_optimal_chunk_size,
     compute_selected_rois,
     compute_total_spectrum,
     compute_total_spectrum_and_count,
     dask_client_create,
+    fit_xanes_map,
     fit_xrf_map,
+    fit_xrf_map_batch,
+    fit_xrf_map_channels,
+    plan_xrf_map_chunks,
     prepare_xrf_map,
+    process_xrf_map,
     snip_method_numba,
+    snip_method_numba_block,
     wait_and_display_progress,
 )
+from pyxrf.core.shared_array import SharedArray
 from pyxrf.core.tests.test_fitting import DataForFittingTest
 
 logger = logging.getLogger(__name__)
@@ -66,6 +81,80 @@ def test_dask_client_create(tmpdir):
     assert not os.path.exists(dask_worker_space_path), "Temporary directory was created in the current directory"
 
 
+def test_DaskClusterManager(tmpdir):
+    """Basic functionality of `DaskClusterManager`"""
+    os.chdir(tmpdir)
+    dask_worker_space_path = os.path.join(tmpdir, "dask-worker-space")
+
+    manager = DaskClusterManager(n_workers=2, threads_per_worker=1)
+    try:
+        # The cluster is created only when the client is requested
+        assert not manager.is_running
+        assert manager.n_workers == 0
+
+        client = manager.get_client()
+        assert manager.is_running
+        assert manager.n_workers == 2
+        # The same client is returned by the following calls
+        assert manager.get_client() is client
+
+        data = da.random.random(size=(100, 100), chunks=(10, 10))
+        npt.assert_array_almost_equal(data.sum(axis=0).compute(scheduler=client), np.sum(data.compute(), axis=0))
+
+        # Setting the same configuration does not restart the cluster
+        manager.configure(n_workers=2)
+        assert manager.get_client() is client
+
+        # Change of configuration restarts the cluster
+        manager.configure(n_workers=3)
+        assert not manager.is_running
+        assert manager.config["n_workers"] == 3
+        client2 = manager.get_client()
+        assert client2 is not client
+        assert manager.n_workers == 3
+
+        # The cluster is recreated if the client was closed externally
+        client2.close()
+        assert manager.get_client() is not client2
+        assert manager.n_workers == 3
+    finally:
+        manager.shutdown()
+
+    assert not manager.is_running
+    assert not os.path.exists(dask_worker_space_path), "Temporary directory was created in the current directory"
+
+
+def test_DaskClusterManager_adaptive():
+    """`DaskClusterManager`: adaptive scaling of the cluster"""
+    manager = DaskClusterManager(
+        n_workers=1, threads_per_worker=1, processes=False, adaptive=True, minimum_workers=1, maximum_workers=2
+    )
+    try:
+        client = manager.get_client()
+        data = da.random.random(size=(100, 100), chunks=(10, 10))
+        npt.assert_array_almost_equal(data.sum(axis=0).compute(scheduler=client), np.sum(data.compute(), axis=0))
+        assert 1 <= manager.n_workers <= 2
+    finally:
+        manager.shutdown()
+
+
+# fmt: off
+@pytest.mark.parametrize("kwargs, err_msg", [
+    ({"n_workers_max": 2}, "Unsupported configuration parameters"),
+    ({"n_workers": 0}, "Parameter 'n_workers' must be a positive integer"),
+    ({"threads_per_worker": -1}, "Parameter 'threads_per_worker' must be a positive integer"),
+    ({"maximum_workers": 0}, "Parameter 'maximum_workers' must be a positive integer"),
+    ({"minimum_workers": -1}, "Parameter 'minimum_workers' must be non-negative"),
+])
+# fmt: on
+def test_DaskClusterManager_configure_fail(kwargs, err_msg):
+    """`DaskClusterManager`: invalid configuration"""
+    manager = DaskClusterManager()
+    with pytest.raises(ValueError, match=err_msg):
+        manager.configure(**kwargs)
+    assert not manager.is_running
+
+
 def test_TerminalProgressBar():
     """Basic functionality of `TerminalProgressBar`"""
 
@@ -187,16 +276,16 @@ def test_RawHDF5Dataset(tmpdir):
 ])
 # fmt: on
 def test_compute_optimal_chunk_size(data_chunksize, chunk_optimal, n_pixels, data_shape):
-    """Basic functionality of the '_compute_optimal_chunk_size'"""
+    """Basic functionality of the 'compute_optimal_chunk_size'"""
 
     # Call with kwargs
-    res = _compute_optimal_chunk_size(
+    res = compute_optimal_chunk_size(
         chunk_pixels=n_pixels, data_chunksize=data_chunksize, data_shape=data_shape, n_chunks_min=4
     )
     assert res == chunk_optimal, "Computed optimal chunks size doesn't match the expected"
 
     # Call with args
-    res = _compute_optimal_chunk_size(n_pixels, data_chunksize, data_shape, 4)
+    res = compute_optimal_chunk_size(n_pixels, data_chunksize, data_shape, 4)
     assert res == chunk_optimal, "Computed optimal chunks size doesn't match the expected"
 
 
@@ -213,7 +302,69 @@ def test_compute_optimal_chunk_size(data_chunksize, chunk_optimal, n_pixels, dat
 def test_compute_optimal_chunk_size_fail(data_chunksize, data_shape):
     """Failing cases for `compute_optimal_chunk_size`"""
     with pytest.raises(ValueError, match="Unsupported value of parameter"):
-        _compute_optimal_chunk_size(10, data_chunksize, data_shape, 4)
+        compute_optimal_chunk_size(10, data_chunksize, data_shape, 4)
+
+
+# fmt: off
+@pytest.mark.parametrize("data_shape, kwargs, chunk_size_expected", [
+    # Explicitly specified parameters: the result is the same as for 'compute_optimal_chunk_size'
+    ((100, 100, 4096), {"chunk_pixels": 100, "n_chunks_min": 4}, (10, 10)),
+    ((100, 100, 4096), {"chunk_pixels": 100, "n_chunks_min": 4, "data_chunksize": (3, 3)}, (9, 12)),
+    # Memory limited: 2**20 * 0.25 / (1024 * 8 * 4) = 8 pixels
+    ((100, 100, 1024), {"n_threads": 1, "memory_per_thread": 2**20}, (3, 3)),
+    # Long spectra: block size is reduced, 2**20 * 0.25 / (4096 * 8 * 4) = 2 pixels
+    ((100, 100, 4096), {"n_threads": 1, "memory_per_thread": 2**20}, (1, 2)),
+    # Plenty of memory: the maximum number of pixels is used
+    ((1000, 1000, 4096), {"n_threads": 1, "memory_per_thread": 2**40}, (71, 71)),
+    # Small map: the blocks are distributed between all threads (64 threads, 2 blocks per thread)
+    ((40, 40, 4096), {"n_threads": 64, "memory_per_thread": 2**40}, (3, 4)),
+    # Alignment with existing chunks
+    ((1000, 1000, 4096), {"n_threads": 1, "memory_per_thread": 2**40, "data_chunksize": (10, 20)}, (70, 80)),
+    # Existing chunks exceed the memory budget: no alignment
+    ((100, 100, 1024), {"n_threads": 1, "memory_per_thread": 2**20, "data_chunksize": (10, 10)}, (3, 3)),
+])
+# fmt: on
+def test_plan_xrf_map_chunks(data_shape, kwargs, chunk_size_expected):
+    """Basic functionality of `plan_xrf_map_chunks`"""
+    plan = plan_xrf_map_chunks(data_shape, **kwargs)
+    assert isinstance(plan, ChunkPlan)
+    assert plan.chunk_size == chunk_size_expected
+    n_chunks = math.ceil(data_shape[0] / plan.chunk_size[0]) * math.ceil(data_shape[1] / plan.chunk_size[1])
+    assert plan.n_chunks == n_chunks
+    assert plan.chunk_nbytes == plan.chunk_size[0] * plan.chunk_size[1] * data_shape[2] * 8
+    assert plan.n_chunks >= min(plan.n_chunks_min, data_shape[0] * data_shape[1])
+
+
+def test_plan_xrf_map_chunks_client():
+    """`plan_xrf_map_chunks`: worker resources are requested from the client"""
+    client = dask_client_create(n_workers=2, threads_per_worker=1, memory_limit="1GB")
+    try:
+        plan = plan_xrf_map_chunks((1000, 1000, 4096), dtype="float32", client=client)
+    finally:
+        client.close()
+
+    assert plan.n_threads == 2
+    assert plan.n_chunks_min == 4
+    assert plan.memory_per_thread == 10**9
+    # 10**9 * 0.25 / (4096 * 8 * 4) = 1907 pixels
+    assert plan.chunk_pixels == 1907
+    assert plan.chunk_nbytes == plan.chunk_size[0] * plan.chunk_size[1] * 4096 * 4
+
+
+def test_plan_xrf_map_chunks_fail():
+    """`plan_xrf_map_chunks`: invalid shape of the map"""
+    with pytest.raises(ValueError, match="Parameter 'data_shape' must be a tuple"):
+        plan_xrf_map_chunks((100, 100))
+
+
+def test_prepare_xrf_data_auto_chunks():
+    """`prepare_xrf_map`: the chunk size is selected automatically"""
+    data_numpy = np.random.random((20, 30, 50))
+    data, file_obj = prepare_xrf_map(data_numpy)
+    plan = plan_xrf_map_chunks(data_numpy.shape)
+    assert file_obj is None
+    assert data.chunksize == (*plan.chunk_size, 50)
+    npt.assert_array_equal(data.compute(), data_numpy)
 
 
 # fmt: off
@@ -411,6 +562,29 @@ def test_prepare_xrf_data_hdf5_not_chunked(tmpdir):
     )
 
 
+@pytest.mark.parametrize("shared_memory", [None, False, True])
+def test_prepare_xrf_data_shared_memory(shared_memory):
+    """
+    `prepare_xrf_map`: the map represented as numpy array is placed in shared memory. By default,
+    only large maps are placed in shared memory.
+    """
+    data_numpy = np.random.random((7, 12, 20))
+    data, file_obj = prepare_xrf_map(data_numpy, chunk_pixels=12, n_chunks_min=4, shared_memory=shared_memory)
+    assert data.chunksize[0] * data.chunksize[1] == 12
+    if shared_memory:
+        # The blocks are loaded from shared memory. The copy is removed when the object is closed.
+        assert isinstance(file_obj, SharedArray)
+        assert os.path.isfile(file_obj.fpath)
+    else:
+        assert file_obj is None
+
+    npt.assert_array_equal(data.compute(scheduler="processes"), data_numpy)
+
+    if file_obj:
+        file_obj.close()
+        assert not os.path.exists(file_obj.fpath)
+
+
 def test_prepare_xrf_data_fail():
     """Failing test for `_prepare_xrf_mask_fail`"""
     data = 50.0  # Just a number
@@ -611,6 +785,78 @@ class TestComputeTotalSpectrumAndCount:
             total_count, total_count_expected, err_msg="Total count (map) was computed incorrectly"
         )
 
+    # fmt: off
+    @pytest.mark.parametrize("data_representation", ["numpy_array", "dask_array", "hdf5_file_dset"])
+    # fmt: on
+    def test_TotalSpectrumIndex(self, data_representation, tmpdir):
+        """
+        The total spectrum and count computed using the index of partial sums for a sequence
+        of selections and masks (computed from block sums or as a difference with the last result).
+        """
+        data_shape = (20, 24, 16)
+        data_dask = da.random.random(data_shape, chunks=(2, 3, 4))
+        data_numpy = data_dask.compute(scheduler="synchronous")
+        data = _create_xrf_data(data_dask, data_representation, tmpdir)
+
+        index = TotalSpectrumIndex(
+            data, chunk_pixels=16, progress_bar=TerminalProgressBar("Monitoring progress: "), client=self.client
+        )
+        assert index.map_shape == data_shape[0:2]
+
+        mask = np.random.randint(0, 3, size=data_shape[0:2])
+        mask_edited = mask.copy()
+        mask_edited[5:7, 10:12] = 0
+        mask_edited[15, 3] = 1
+
+        # fmt: off
+        queries = [
+            (None, None), ((2, 3, 10, 15), None), ((2, 4, 10, 15), None), ((0, 0, 20, 24), mask),
+            ((0, 0, 20, 24), mask_edited), (None, mask), ((3, 5, 1, 1), mask_edited), (None, None),
+        ]
+        # fmt: on
+        for selection, mask in queries:
+            mask_expected = np.ones(shape=data_shape[0:2]) if mask is None else (mask > 0).astype(int)
+            if selection is not None:
+                y0, x0, ny, nx = selection
+                mask_sel = np.zeros(shape=data_shape[0:2])
+                mask_sel[y0 : y0 + ny, x0 : x0 + nx] = 1
+                mask_expected = mask_expected * mask_sel
+            data_tmp = data_numpy * np.expand_dims(mask_expected, axis=2)
+
+            total_spectrum, total_count = index.get_spectrum_and_count(
+                selection=selection, mask=mask, client=self.client
+            )
+            npt.assert_array_almost_equal(total_spectrum, np.sum(data_tmp, axis=(0, 1)), err_msg=f"{selection}")
+            npt.assert_array_almost_equal(total_count, np.sum(data_tmp, axis=2), err_msg=f"{selection}")
+
+        with pytest.raises(TypeError, match="does not match the shape of the map"):
+            index.get_spectrum_and_count(mask=np.ones(shape=(5, 5)))
+
+    def test_TotalSpectrumIndex_shared_memory(self, monkeypatch):
+        """
+        The map is copied to shared memory only when the index is built, not for each update.
+        """
+        monkeypatch.setattr(map_processing, "_SHARED_ARRAY_MIN_NBYTES", 0)
+        file_obj_types = []
+
+        def _prepare_xrf_map(*args, **kwargs):
+            data, file_obj = prepare_xrf_map(*args, **kwargs)
+            file_obj_types.append(type(file_obj))
+            return data, file_obj
+
+        monkeypatch.setattr(map_processing, "prepare_xrf_map", _prepare_xrf_map)
+
+        data = np.random.random((12, 10, 16))
+        index = TotalSpectrumIndex(data, chunk_pixels=16, client=self.client)
+        assert file_obj_types == [SharedArray]
+
+        for selection in [(2, 3, 5, 4), (2, 4, 5, 4), (3, 4, 5, 4)]:
+            total_spectrum, _ = index.get_spectrum_and_count(selection=selection, client=self.client)
+            y0, x0, ny, nx = selection
+            npt.assert_array_almost_equal(total_spectrum, np.sum(data[y0 : y0 + ny, x0 : x0 + nx], axis=(0, 1)))
+        assert len(file_obj_types) == 4
+        assert SharedArray not in file_obj_types[1:]
+
 
 def test_compute_total_spectrum_and_count2(tmpdir):
     """Create an instance of Dask client in the 'compute_total_spectrum' function to test if it works"""
@@ -835,8 +1081,9 @@ class _FitXRFMapTesting:
 ])
 @pytest.mark.parametrize("add_pts_before, add_pts_after", [(0, 0), (50, 100)])
 @pytest.mark.parametrize("use_snip", [False, True])
+@pytest.mark.parametrize("fitting_method", ["nnls", "nnls_gram"])
 # fmt: on
-def test_fit_xrf_block(dataset_params, add_pts_before, add_pts_after, use_snip):
+def test_fit_xrf_block(dataset_params, add_pts_before, add_pts_after, use_snip, fitting_method):
     ft = _FitXRFMapTesting(
         dataset_params=dataset_params,
         use_snip=use_snip,
@@ -850,6 +1097,7 @@ def test_fit_xrf_block(dataset_params, add_pts_before, add_pts_after, use_snip):
         matv=ft.spectra,
         snip_param=ft.snip_param,
         use_snip=use_snip,
+        fitting_method=fitting_method,
     )
 
     ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
@@ -909,7 +1157,8 @@ class TestFitXRFMap:
         ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
 
 
-def test_fit_xrf_map2():
+@pytest.mark.parametrize("fitting_method", ["nnls", "nnls_gram"])
+def test_fit_xrf_map2(fitting_method):
     """
     Basic functionality of `fit_xrf_map`.
     Tests are run using global Dask clients to inprove testing speed.
@@ -940,11 +1189,490 @@ def test_fit_xrf_map2():
         n_chunks_min=4,
         progress_bar=None,
         client=None,
+        fitting_method=fitting_method,
     )
 
     ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
 
 
+def test_fit_xrf_map_shared_memory(monkeypatch):
+    """
+    `fit_xrf_map`: the map is placed in shared memory. The model `matv` is sent to the workers
+    only once if the map is fitted repeatedly.
+    """
+    monkeypatch.setattr(map_processing, "_SHARED_ARRAY_MIN_NBYTES", 0)
+
+    ft = _FitXRFMapTesting(
+        dataset_params={"n_data_dimensions": (20, 20)}, use_snip=False, add_pts_before=15, add_pts_after=10
+    )
+
+    client = dask_client_create()
+    try:
+        futures = []
+        for _ in range(2):
+            data_out = fit_xrf_map(
+                ft.data_input,
+                data_sel_indices=ft.data_sel_indices,
+                matv=ft.spectra,
+                snip_param=ft.snip_param,
+                use_snip=False,
+                chunk_pixels=10,
+                n_chunks_min=4,
+                progress_bar=None,
+                client=client,
+            )
+            ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
+            futures.append(_scatter_cached(client, ft.spectra))
+
+        assert futures[0].key == futures[1].key
+        assert _scatter_cached(client, ft.spectra + 1).key != futures[0].key
+        npt.assert_array_equal(futures[0].result(), ft.spectra)
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize("func_name", ["fit", "roi", "total_spectrum", "total_spectrum_and_count"])
+def test_prepare_xrf_map_shared_memory_fail(func_name, monkeypatch):
+    """
+    The map placed in shared memory by `prepare_xrf_map` is released if processing fails.
+    """
+    monkeypatch.setattr(map_processing, "_SHARED_ARRAY_MIN_NBYTES", 0)
+
+    file_objs = []
+
+    def _prepare_xrf_map(*args, **kwargs):
+        data, file_obj = prepare_xrf_map(*args, **kwargs)
+        file_objs.append(file_obj)
+        return data, file_obj
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError("Processing failed")
+
+    monkeypatch.setattr(map_processing, "prepare_xrf_map", _prepare_xrf_map)
+    monkeypatch.setattr(map_processing, "wait_and_display_progress", _fail)
+
+    ft = _FitXRFMapTesting(
+        dataset_params={"n_data_dimensions": (20, 20)}, use_snip=False, add_pts_before=15, add_pts_after=10
+    )
+    kwargs = dict(chunk_pixels=10, n_chunks_min=4)
+    funcs = {
+        "fit": lambda: fit_xrf_map(
+            ft.data_input, data_sel_indices=ft.data_sel_indices, matv=ft.spectra, use_snip=False, **kwargs
+        ),
+        "roi": lambda: compute_selected_rois(
+            ft.data_input,
+            data_sel_indices=ft.data_sel_indices,
+            roi_dict={"roi-1": (3.5, 4.8)},
+            snip_param=ft.snip_param,
+            use_snip=False,
+            **kwargs,
+        ),
+        "total_spectrum": lambda: compute_total_spectrum(ft.data_input, **kwargs),
+        "total_spectrum_and_count": lambda: compute_total_spectrum_and_count(ft.data_input, **kwargs),
+    }
+
+    with pytest.raises(RuntimeError, match="Processing failed"):
+        funcs[func_name]()
+
+    assert len(file_objs) == 1
+    assert isinstance(file_objs[0], SharedArray)
+    assert file_objs[0].closed
+
+
+@pytest.mark.parametrize("use_snip", [False, True])
+def test_fit_xrf_map_batch(use_snip, tmpdir):
+    """
+    `fit_xrf_map_batch`: maps of different size represented as numpy arrays and HDF5 datasets
+    are fitted using different models. The same map may be included in the batch multiple times.
+    """
+    ft_list = [
+        _FitXRFMapTesting(
+            dataset_params={"n_data_dimensions": (ny, nx)},
+            use_snip=use_snip,
+            add_pts_before=n_before,
+            add_pts_after=n_after,
+        )
+        for ny, nx, n_before, n_after in ((8, 10, 15, 10), (5, 7, 0, 0), (12, 9, 20, 5))
+    ]
+    data_list = [
+        ft_list[0].data_input,
+        _create_xrf_data(_array_numpy_to_dask(ft_list[1].data_input, chunk_pixels=10), "hdf5_file_dset", tmpdir),
+        ft_list[2].data_input,
+    ]
+    # The last map is the same as the first map
+    ft_list.append(ft_list[0])
+    data_list.append(data_list[0])
+
+    progress = []
+    results = fit_xrf_map_batch(
+        [(data, ft.data_sel_indices, ft.spectra, ft.snip_param) for data, ft in zip(data_list, ft_list)],
+        use_snip=use_snip,
+        chunk_pixels=20,
+        n_chunks_min=2,
+        progress_bar=progress.append,
+    )
+
+    assert len(results) == len(ft_list)
+    for ft, data_out in zip(ft_list, results):
+        ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
+    npt.assert_array_equal(results[3], results[0])
+    assert progress[-1] == 100.0
+    assert len(progress) == len(ft_list) + 1
+
+    with pytest.raises(TypeError, match="Parameter 'matv' must be 2D ndarray"):
+        fit_xrf_map_batch([(data_list[0], ft_list[0].data_sel_indices, None, None)], use_snip=False)
+
+
+@pytest.mark.parametrize("save_to_file", [False, True])
+def test_fit_xrf_map_channels(save_to_file, tmpdir):
+    """
+    `fit_xrf_map_channels`: the maps of the same size are fitted in a single pass using different
+    models (the maps fitted using the same model are stacked). The results may be written to
+    the file that contains the raw data.
+    """
+    ny, nx = 9, 11
+    ft_list = [
+        _FitXRFMapTesting(
+            dataset_params={"n_data_dimensions": (ny, nx)},
+            use_snip=True,
+            add_pts_before=n_before,
+            add_pts_after=n_after,
+        )
+        for n_before, n_after in ((15, 10), (0, 0))
+    ]
+    # The last map is fitted using the same model as the first map
+    ft_list.append(ft_list[0])
+
+    os.chdir(tmpdir)
+    fln = "test-channels.h5"
+    with h5py.File(fln, "w") as f:
+        for n in (1, 2):
+            data = ft_list[n].data_input
+            f.create_dataset(f"xrfmap/det{n}/counts", data=data, chunks=(3, 4, data.shape[2]))
+    data_list = [ft_list[0].data_input] + [
+        RawHDF5Dataset(fln, f"xrfmap/det{n}/counts", shape=ft_list[n].data_input.shape) for n in (1, 2)
+    ]
+
+    outputs, weights_scales = None, None
+    if save_to_file:
+        outputs = [
+            RawHDF5Dataset(fln, f"xrfmap/det{n}/xrf_fit", shape=(ft.n_lines + 4, ny, nx))
+            for n, ft in enumerate(ft_list)
+        ]
+        weights_scales = [np.random.random(ft.n_lines) + 0.5 for ft in ft_list]
+
+    progress = []
+    results = fit_xrf_map_channels(
+        [(data, ft.data_sel_indices, ft.spectra, ft.snip_param) for data, ft in zip(data_list, ft_list)],
+        use_snip=True,
+        chunk_pixels=12,
+        n_chunks_min=4,
+        progress_bar=progress.append,
+        outputs=outputs,
+        output_weights_scales=weights_scales,
+    )
+    assert progress[-1] == 100.0
+
+    if save_to_file:
+        assert results is None
+        results = []
+        with h5py.File(fln, "r") as f:
+            # The raw data must remain in the file
+            npt.assert_array_equal(f["xrfmap/det1/counts"][()], ft_list[1].data_input)
+            for n, ft in enumerate(ft_list):
+                data_out = np.moveaxis(f[f"xrfmap/det{n}/xrf_fit"][()], 0, 2)
+                data_out[:, :, 0 : ft.n_lines] /= weights_scales[n]
+                results.append(data_out)
+        assert [_ for _ in os.listdir(tmpdir) if _.endswith(".h5")] == [fln], "Temporary file was not removed"
+
+    assert len(results) == len(ft_list)
+    for ft, data_out in zip(ft_list, results):
+        ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
+
+    data_fail = ft_list[0].data_input[:, 1:, :]
+    with pytest.raises(ValueError, match="XRF maps must have the same size"):
+        fit_xrf_map_channels(
+            [(data, ft_list[0].data_sel_indices, ft_list[0].spectra, None) for data in (data_list[0], data_fail)],
+            use_snip=False,
+        )
+    with pytest.raises(ValueError, match="Parameter 'outputs' must be None or a list of 1"):
+        fit_xrf_map_channels(
+            [(data_list[0], ft_list[0].data_sel_indices, ft_list[0].spectra, None)], use_snip=False, outputs=[]
+        )
+
+
+@pytest.mark.parametrize("method", ["nnls", "nnls_gram", "admm"])
+@pytest.mark.parametrize("axis", [0, 2])
+def test_fit_xanes_map(method, axis):
+    """
+    `fit_xanes_map`: the results are the same as the results produced by `fit_spectrum`
+    """
+    fitting_data = DataForFittingTest(n_data_dimensions=(9, 11), n_pts=51, axis=axis)
+    data, spectra = fitting_data.data_input, fitting_data.spectra
+
+    progress = []
+    weights, rfactor, results_dict = fit_xanes_map(
+        data, spectra, method=method, axis=axis, chunk_pixels=20, n_chunks_min=4, progress_bar=progress.append
+    )
+    weights_expected, rfactor_expected, _ = fit_spectrum(data, spectra, method=method, axis=axis)
+
+    fitting_data.validate_output_weights(weights, decimal=8)
+    npt.assert_array_almost_equal(weights, weights_expected)
+    npt.assert_array_almost_equal(rfactor, rfactor_expected)
+    assert progress[-1] == 100.0
+
+    assert results_dict["method"] == method
+    n_blocks = len(results_dict["blocks"])
+    assert n_blocks >= 4
+    assert sum([(y1 - y0) * (x1 - x0) for (y0, y1), (x0, x1) in results_dict["blocks"]]) == 9 * 11
+    if method == "admm":
+        assert len(results_dict["convergence"]) == len(results_dict["feasibility"]) == n_blocks
+        assert all([_[-1] < 1e-20 for _ in results_dict["convergence"]])
+    else:
+        assert results_dict["residual"].shape == (9, 11)
+
+    with pytest.raises(ValueError, match="Fitting method 'abc' is not supported"):
+        fit_xanes_map(data, spectra, method="abc", axis=axis)
+    with pytest.raises(ValueError, match="The number of spectrum points in data"):
+        fit_xanes_map(data, spectra[1:, :], method=method, axis=axis)
+
+
+# fmt: off
+@pytest.mark.parametrize("data_shape, pixel_bin, bin_energy", [
+    ((8, 12, 30), 1, 1),
+    ((8, 12, 30), 2, 1),
+    ((8, 12, 30), 1, 3),
+    ((9, 13, 31), 3, 2),
+    ((7, 11, 20), 4, 4),
+])
+# fmt: on
+def test_bin_xrf_map(data_shape, pixel_bin, bin_energy):
+    """
+    `bin_xrf_map`: the counts in the windows of `pixel_bin x pixel_bin` pixels and `bin_energy`
+    energy bins are summed. The pixels and bins that do not fill complete windows are discarded.
+    """
+    data = np.random.random(data_shape)
+    data_binned, file_obj = bin_xrf_map(
+        data, pixel_bin=pixel_bin, bin_energy=bin_energy, chunk_pixels=12, n_chunks_min=2
+    )
+    assert file_obj is None
+    assert isinstance(data_binned, da.core.Array)
+
+    ny, nx, ne = data_shape[0] // pixel_bin, data_shape[1] // pixel_bin, data_shape[2] // bin_energy
+    data_expected = data[: ny * pixel_bin, : nx * pixel_bin, : ne * bin_energy]
+    data_expected = np.sum(
+        np.reshape(data_expected, (ny, pixel_bin, nx, pixel_bin, ne, bin_energy)), axis=(1, 3, 5)
+    )
+    npt.assert_array_almost_equal(data_binned.compute(scheduler="synchronous"), data_expected)
+
+
+def test_bin_xrf_map_fail():
+    data = np.random.random((4, 6, 10))
+    for kwargs in ({"pixel_bin": 0}, {"pixel_bin": 1.5}, {"bin_energy": -1}):
+        with pytest.raises(ValueError, match="must be a positive integer"):
+            bin_xrf_map(data, **kwargs)
+    with pytest.raises(ValueError, match="too small"):
+        bin_xrf_map(data, pixel_bin=5)
+    with pytest.raises(ValueError, match="too small"):
+        bin_xrf_map(data, bin_energy=11)
+
+
+# fmt: off
+@pytest.mark.parametrize("data_representation, same_file", [
+    ("numpy_array", False),
+    ("hdf5_file_dset", False),
+    ("hdf5_file_dset", True),
+])
+# fmt: on
+def test_fit_xrf_map3(data_representation, same_file, tmpdir):
+    """
+    `fit_xrf_map`: the results are written directly to HDF5 file. If the output dataset
+    is located in the file with raw data, the results are saved to a temporary file and
+    then copied to the data file.
+    """
+    dataset_params = {"n_data_dimensions": (9, 11)}
+    add_pts_before, add_pts_after = 15, 10
+    use_snip = True
+    n_extra_maps = 2  # Additional maps that are filled with zeros
+
+    ft = _FitXRFMapTesting(
+        dataset_params=dataset_params,
+        use_snip=use_snip,
+        add_pts_before=add_pts_before,
+        add_pts_after=add_pts_after,
+    )
+
+    data_dask = _array_numpy_to_dask(ft.data_input, chunk_pixels=4, n_chunks_min=1)
+    data = _create_xrf_data(data_dask, data_representation, tmpdir)
+
+    os.chdir(tmpdir)
+    fln_out = data.abs_path if same_file else "test-output.h5"
+    dset_name = "xrfmap/detsum/xrf_fit"
+    n_maps = ft.n_lines + 4 + n_extra_maps
+    output = RawHDF5Dataset(fln_out, dset_name, shape=(n_maps, *ft.data_input.shape[0:2]))
+
+    weights_scale = np.random.random(ft.n_lines) + 0.5
+
+    client = dask_client_create()
+    try:
+        result = fit_xrf_map(
+            data,
+            data_sel_indices=ft.data_sel_indices,
+            matv=ft.spectra,
+            snip_param=ft.snip_param,
+            use_snip=use_snip,
+            chunk_pixels=10,
+            n_chunks_min=4,
+            progress_bar=None,
+            client=client,
+            output=output,
+            output_weights_scale=weights_scale,
+        )
+    finally:
+        client.close()
+
+    assert result is None, "The function is expected to return None if the output dataset is specified"
+
+    with h5py.File(fln_out, "r") as f:
+        data_saved = f[dset_name][()]
+        if same_file:
+            # The raw data must remain in the file
+            npt.assert_array_equal(f["level1/level2"][()], ft.data_input)
+
+    assert data_saved.shape == (n_maps, *ft.data_input.shape[0:2])
+    assert not np.any(data_saved[ft.n_lines + 4 :, :, :]), "Extra maps must be filled with zeros"
+
+    data_out = np.moveaxis(data_saved[0 : ft.n_lines + 4, :, :], 0, 2)
+    data_out[:, :, 0 : ft.n_lines] /= weights_scale
+    ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
+
+
+@pytest.mark.parametrize("fail_compute", [False, True])
+def test_fit_xrf_map3_fail(fail_compute, tmpdir, monkeypatch):
+    """
+    `fit_xrf_map`: the raw data file is closed and the temporary file is removed if processing fails,
+    so that the results can be written to the raw data file when processing is repeated.
+    """
+    ft = _FitXRFMapTesting(
+        dataset_params={"n_data_dimensions": (9, 11)}, use_snip=False, add_pts_before=0, add_pts_after=0
+    )
+    data_dask = _array_numpy_to_dask(ft.data_input, chunk_pixels=4, n_chunks_min=1)
+    data = _create_xrf_data(data_dask, "hdf5_file_dset", tmpdir)
+    ny, nx = ft.data_input.shape[0:2]
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError("Processing failed")
+
+    if fail_compute:
+        monkeypatch.setattr(map_processing, "_compute_and_save_blocks", _fail)
+        output_shape, except_type, err_msg = (ft.n_lines + 4, ny, nx), RuntimeError, "Processing failed"
+    else:
+        output_shape, except_type, err_msg = (ft.n_lines + 4, ny + 1, nx), ValueError, "does not match"
+    output = RawHDF5Dataset(data.abs_path, "xrfmap/detsum/xrf_fit", shape=output_shape)
+
+    files = set(os.listdir(tmpdir))
+    with pytest.raises(except_type, match=err_msg):
+        fit_xrf_map(
+            data,
+            data_sel_indices=ft.data_sel_indices,
+            matv=ft.spectra,
+            use_snip=False,
+            chunk_pixels=10,
+            n_chunks_min=4,
+            output=output,
+        )
+    assert set(os.listdir(tmpdir)) == files, "Temporary file was not removed"
+
+    # The raw data file must be closed
+    with h5py.File(data.abs_path, "a") as f:
+        f.create_dataset("test", data=[1, 2, 3])
+
+
+def test_fit_xrf_map4(tmpdir):
+    """
+    `fit_xrf_map` and `compute_selected_rois`: processed blocks are saved to the cache
+    and loaded from the cache when processing is repeated with the same data and parameters.
+    """
+    dataset_params = {"n_data_dimensions": (9, 11)}
+    ft = _FitXRFMapTesting(dataset_params=dataset_params, use_snip=True, add_pts_before=15, add_pts_after=10)
+    data = ft.data_input
+    cache = BlockResultCache(os.path.join(tmpdir, "cache"))
+
+    def _fit(matv):
+        return fit_xrf_map(
+            data,
+            data_sel_indices=ft.data_sel_indices,
+            matv=matv,
+            snip_param=ft.snip_param,
+            use_snip=True,
+            chunk_pixels=10,
+            n_chunks_min=4,
+            cache=cache,
+        )
+
+    data_out = _fit(ft.spectra)
+    ft.verify_fit_output(data_out=data_out, snip_param=ft.snip_param)
+    n_blocks = cache.n_entries
+    assert n_blocks >= 4
+
+    # Replace cached results with zeros: the results of the repeated call must be loaded from the cache
+    for fln in os.listdir(cache.cache_dir):
+        fpath = os.path.join(cache.cache_dir, fln)
+        np.save(fpath, np.zeros_like(np.load(fpath)))
+    data_out = _fit(ft.spectra)
+    assert data_out.shape == (*data.shape[0:2], ft.n_lines + 4)
+    assert not np.any(data_out), "The results were not loaded from the cache"
+    assert cache.n_entries == n_blocks
+
+    # Modified model: the cached results must not be used
+    data_out = _fit(ft.spectra * 2)
+    assert np.any(data_out)
+    assert cache.n_entries == 2 * n_blocks
+
+    # ROI computation with the same cache
+    roi_dict = {"roi-1": (3.5, 4.8), "roi-2": (5.2, 7.4)}
+    roi_kwargs = dict(data_sel_indices=ft.data_sel_indices, roi_dict=roi_dict, snip_param=ft.snip_param)
+    rois_1 = compute_selected_rois(data, chunk_pixels=10, n_chunks_min=4, cache=cache, **roi_kwargs)
+    assert cache.n_entries == 3 * n_blocks
+    rois_2 = compute_selected_rois(data, chunk_pixels=10, n_chunks_min=4, cache=cache, **roi_kwargs)
+    assert cache.n_entries == 3 * n_blocks
+    ft.verify_roi_output(data_out=rois_2, roi_dict=roi_dict, snip_param=ft.snip_param)
+    for k in roi_dict:
+        npt.assert_array_equal(rois_1[k], rois_2[k])
+
+    with pytest.raises(TypeError, match="Parameter 'cache' must be BlockResultCache or None"):
+        fit_xrf_map(data, data_sel_indices=ft.data_sel_indices, matv=ft.spectra, use_snip=False, cache={})
+
+
+# fmt: off
+@pytest.mark.parametrize("n_maps_delta, map_shape_delta, err_msg", [
+    (-1, (0, 0), "Output dataset must have the shape"),
+    (0, (1, 0), "The map size of the output dataset .* does not match"),
+])
+# fmt: on
+def test_fit_xrf_map_output_fail(n_maps_delta, map_shape_delta, err_msg, tmpdir):
+    """`fit_xrf_map`: shape of the output dataset is incorrect"""
+    ft = _FitXRFMapTesting(
+        dataset_params={"n_data_dimensions": (5, 5)},
+        use_snip=False,
+        add_pts_before=0,
+        add_pts_after=0,
+    )
+    ny, nx = ft.data_input.shape[0:2]
+    shape = (ft.n_lines + 4 + n_maps_delta, ny + map_shape_delta[0], nx + map_shape_delta[1])
+    output = RawHDF5Dataset(os.path.join(tmpdir, "test-output.h5"), "xrf_fit", shape=shape)
+
+    with pytest.raises(ValueError, match=err_msg):
+        fit_xrf_map(
+            ft.data_input,
+            data_sel_indices=ft.data_sel_indices,
+            matv=ft.spectra,
+            snip_param=ft.snip_param,
+            use_snip=False,
+            output=output,
+        )
+
+
 # fmt: off
 @pytest.mark.parametrize("params, except_type, err_msg", [
     ({"data_sel_indices": 50}, TypeError,
@@ -975,7 +1703,8 @@ def test_fit_xrf_map2():
     ({"data": np.zeros(shape=(10, 15, 100)), "matv": np.zeros(shape=(50, 3)),
       "data_sel_indices": (70, 70 + 50)}, ValueError,
      "Selection indices .* are outside the allowed range"),
-
+    ({"fitting_method": "admm"}, ValueError,
+     "Fitting method 'admm' is not supported"),
 ])
 # fmt: on
 def test_fit_xrf_map_fail(params, except_type, err_msg):
@@ -1279,6 +2008,98 @@ def test_compute_selected_rois_fail(params, except_type, err_msg):
         compute_selected_rois(**kwargs)
 
 
+# fmt: off
+@pytest.mark.parametrize("data_representation", ["numpy_array", "hdf5_file_dset"])
+@pytest.mark.parametrize("use_snip", [False, True])
+@pytest.mark.parametrize("mask_params", [(False, False), (True, True)])
+# fmt: on
+def test_process_xrf_map(data_representation, use_snip, mask_params, tmpdir):
+    """
+    `process_xrf_map`: the results of each stage are the same as the results produced
+    by `fit_xrf_map`, `compute_selected_rois` and `compute_total_spectrum_and_count`.
+    """
+    ft = _FitXRFMapTesting(
+        dataset_params={"n_data_dimensions": (9, 11)}, use_snip=use_snip, add_pts_before=20, add_pts_after=30
+    )
+    data_dask = _array_numpy_to_dask(ft.data_input, chunk_pixels=12, n_chunks_min=1)
+    data = _create_xrf_data(data_dask, data_representation, tmpdir)
+    mask, selection = _create_xrf_mask(ft.data_input.shape[0:2], *mask_params)
+
+    roi_dict = {"roi-1": (2.5, 3.5), "roi-2": (3.5, 4.8), "roi-3": (6.0, 6.0)}
+    kwargs = {"use_snip": use_snip, "chunk_pixels": 12, "n_chunks_min": 4}
+
+    results = process_xrf_map(
+        data,
+        ["fit", "roi", "total_count", "total_spectrum", "sel_count"],
+        data_sel_indices=ft.data_sel_indices,
+        snip_param=ft.snip_param,
+        matv=ft.spectra,
+        roi_dict=roi_dict,
+        mask=mask,
+        selection=selection,
+        **kwargs,
+    )
+
+    fit_expected = fit_xrf_map(
+        data, data_sel_indices=ft.data_sel_indices, matv=ft.spectra, snip_param=ft.snip_param, **kwargs
+    )
+    roi_expected = compute_selected_rois(
+        data, data_sel_indices=ft.data_sel_indices, roi_dict=roi_dict, snip_param=ft.snip_param, **kwargs
+    )
+    spectrum_expected, count_expected = compute_total_spectrum_and_count(
+        data, mask=mask, selection=selection, chunk_pixels=12, n_chunks_min=4
+    )
+
+    assert list(results.keys()) == ["fit", "roi", "total_count", "total_spectrum", "sel_count"]
+    npt.assert_array_almost_equal(results["fit"], fit_expected)
+    assert list(results["roi"].keys()) == list(roi_dict.keys())
+    for key, roi_map in roi_expected.items():
+        npt.assert_array_almost_equal(results["roi"][key], roi_map)
+    npt.assert_array_almost_equal(results["total_count"], count_expected)
+    npt.assert_array_almost_equal(results["total_spectrum"], spectrum_expected)
+    npt.assert_array_almost_equal(results["sel_count"], fit_expected[:, :, -2])
+
+    # Single stage
+    results = process_xrf_map(data, "total_spectrum", mask=mask, selection=selection, chunk_pixels=12)
+    assert list(results.keys()) == ["total_spectrum"]
+    npt.assert_array_almost_equal(results["total_spectrum"], spectrum_expected)
+
+
+# fmt: off
+@pytest.mark.parametrize("params, except_type, err_msg", [
+    ({"stages": []}, ValueError, "No processing stages are selected"),
+    ({"stages": ["fit", "background"]}, ValueError, r"Processing stages \['background'\] are not supported"),
+    ({"stages": "fit", "matv": None}, TypeError, "Parameter 'matv' must be 2D ndarray"),
+    ({"stages": "roi", "snip_param": None}, TypeError, "Parameter 'snip_param' must a dictionary with keys"),
+    ({"stages": "roi", "roi_dict": None}, TypeError, "Parameter 'roi_dict' must be a dictionary"),
+    ({"stages": "sel_count", "data_sel_indices": None}, TypeError,
+     "Parameter 'data_sel_indices' must be tuple or list"),
+    ({"stages": "total_count", "mask": [1, 0]}, TypeError, "Parameter 'mask' must be a numpy array or None"),
+    ({"stages": "sel_count", "data": np.zeros(shape=(10, 15, 100)), "data_sel_indices": (70, 70 + 50)},
+     ValueError,
+     "Selection indices .* are outside the allowed range"),
+])
+# fmt: on
+def test_process_xrf_map_fail(params, except_type, err_msg):
+    """Failing cases of `process_xrf_map` (wrong input parameters)"""
+    ft = _FitXRFMapTesting(
+        dataset_params={"n_data_dimensions": (5, 4)}, use_snip=True, add_pts_before=0, add_pts_after=0
+    )
+
+    kwargs = {
+        "data": ft.data_input,
+        "stages": ["fit", "roi"],
+        "data_sel_indices": ft.data_sel_indices,
+        "snip_param": ft.snip_param,
+        "matv": ft.spectra,
+        "roi_dict": {"roi-1": (2.5, 3.5)},
+    }
+    kwargs.update(params)
+
+    with pytest.raises(except_type, match=err_msg):
+        process_xrf_map(**kwargs)
+
+
 def test_snip_method_numba():
     """
     Compare the output of `snip_method_numba` with the output produced
@@ -1311,3 +2132,37 @@ def test_snip_method_numba():
             npt.assert_array_almost_equal(
                 bg, bg_expected, err_msg=f"Background estimates don't match for the pixel ({ny}, {nx})"
             )
+
+
+# fmt: off
+@pytest.mark.parametrize("data_dtype", [np.float64, np.float32, np.int32])
+@pytest.mark.parametrize("snip_kwargs", [
+    {"width": 0.5},
+    {"width": 1.5, "xmin": 20, "xmax": 300},
+    {"width": 0.5, "spectral_binning": 2},
+    {"width": 0.5, "con_val": 7, "iter_num": 2},
+])
+@pytest.mark.parametrize("parallel", [False, True])
+# fmt: on
+def test_snip_method_numba_block(data_dtype, snip_kwargs, parallel):
+    """
+    The output of `snip_method_numba_block` must be identical to the output
+    of `snip_method_numba` applied to each spectrum of the block.
+    """
+    data = np.random.random(size=(6, 7, 500)) * 1000
+    data = data.astype(data_dtype)
+    # Use truncated spectra: the function is typically applied to a non-contiguous view
+    spec_sel = data[:, :, 20:480]
+
+    bg_expected = np.apply_along_axis(snip_method_numba, 2, spec_sel, 0.1, 0.01, 1e-6, **snip_kwargs)
+    bg = snip_method_numba_block(spec_sel, 0.1, 0.01, 1e-6, parallel=parallel, **snip_kwargs)
+
+    assert bg.shape == bg_expected.shape
+    assert bg.dtype == bg_expected.dtype
+    npt.assert_array_equal(bg, bg_expected)
+
+
+def test_snip_method_numba_block_empty():
+    """Empty block is processed without errors"""
+    bg = snip_method_numba_block(np.zeros(shape=(0, 5, 100)), 0, 0.01, 0)
+    assert bg.shape == (0, 5, 100)
@@ -1123,4 +1123,28 @@ def test_ParamQuantitativeAnalysis(tmp_path):
     assert data_out is img_dict[eline], "Function output is not a reference to the input data"
     assert not is_applied, "Quantitative normalization was applied"
 
+    # Normalization of multiple maps produces the same results as normalization of each map
+    maps = {_: img_dict[_] for _ in elist}
+    maps.update({"Cu_K": img_dict[eline], scaler: scaler_dict[scaler]})
+    for ref_name, name_not_scalable in ((None, None), (elist[-1], [eline])):
+        maps_out = pqa.apply_quantitative_normalization_to_maps(
+            maps, scaler_dict=scaler_dict, ref_name=ref_name, name_not_scalable=name_not_scalable
+        )
+        names_expected = []
+        for data_name, data_in in maps.items():
+            data_out, is_applied = pqa.apply_quantitative_normalization(
+                data_in,
+                scaler_dict=scaler_dict,
+                scaler_name_default=None,
+                data_name=data_name,
+                ref_name=ref_name,
+                name_not_scalable=name_not_scalable,
+            )
+            if is_applied:
+                names_expected.append(data_name)
+                npt.assert_array_almost_equal(maps_out[data_name], data_out)
+        assert list(maps_out.keys()) == names_expected
+        assert names_expected and (scaler not in names_expected)
+        assert (eline in names_expected) == (name_not_scalable is None)
+
     # ----------------------------------------------------------------------
@@ -0,0 +1,68 @@
+import gc
+import os
+import pickle
+
+import dask.array as da
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from pyxrf.core.shared_array import SharedArray
+
+
+def test_SharedArray_1(tmp_path):
+    """
+    Basic operations: slicing, pickling, conversion to Dask array, closing
+    """
+    data = np.random.random((5, 6, 10))
+    shared = SharedArray(data, shared_dir=str(tmp_path))
+    assert os.path.isfile(shared.fpath)
+    assert os.path.dirname(shared.fpath) == str(tmp_path)
+    assert shared.shape == data.shape
+    assert shared.dtype == data.dtype
+    assert shared.ndim == 3
+    assert not shared.closed
+
+    npt.assert_array_equal(shared[:], data)
+    npt.assert_array_equal(shared[1:3, 2:5, :], data[1:3, 2:5, :])
+
+    # The copy does not contain the data and never removes the file
+    shared_copy = pickle.loads(pickle.dumps(shared))
+    assert len(pickle.dumps(shared)) < 1000
+    npt.assert_array_equal(shared_copy[2:4, :, 3:7], data[2:4, :, 3:7])
+    shared_copy.close()
+    assert os.path.isfile(shared.fpath)
+
+    data_dask = da.from_array(shared, chunks=(2, 3, 10))
+    npt.assert_array_equal(data_dask.compute(scheduler="processes"), data)
+
+    shared.close()
+    assert shared.closed
+    assert not os.path.exists(shared.fpath)
+    with pytest.raises(ValueError, match="The shared array is closed"):
+        shared[0, 0]
+    # Repeated call does nothing
+    shared.close()
+
+
+def test_SharedArray_2(tmp_path):
+    """
+    The file is removed when the object is garbage collected or the context is exited
+    """
+    data = np.random.randint(0, 100, (4, 3, 7))
+
+    with SharedArray(data, shared_dir=str(tmp_path)) as shared:
+        fpath = shared.fpath
+        npt.assert_array_equal(shared[:], data)
+    assert not os.path.exists(fpath)
+
+    shared = SharedArray(data, shared_dir=str(tmp_path))
+    fpath = shared.fpath
+    del shared
+    gc.collect()
+    assert not os.path.exists(fpath)
+
+    # Default directory
+    with SharedArray(data) as shared:
+        assert os.path.isfile(shared.fpath)
+        npt.assert_array_equal(shared[:], data)
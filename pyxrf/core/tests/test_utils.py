@@ -0,0 +1,71 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+import scipy.interpolate
+
+from pyxrf.core.utils import GridInterpolator, _get_grid_interpolator, grid_interpolate
+
+
+def _generate_coordinates(ny, nx):
+    """Coordinates of points of a scan with small random deviations from uniform grid"""
+    yy, xx = np.mgrid[0:ny, 0:nx].astype(float)
+    xx = 0.5 + xx * 0.2 + np.random.random(xx.shape) * 0.05
+    yy = 1.0 + yy * 0.3 + np.random.random(yy.shape) * 0.05
+    return xx, yy
+
+
+@pytest.mark.parametrize("n_maps", [None, 1, 4])
+def test_GridInterpolator_1(n_maps):
+    """
+    Results of interpolation are the same as the results of ``scipy.interpolate.griddata``
+    """
+    ny, nx = 15, 20
+    xx, yy = _generate_coordinates(ny, nx)
+    data = np.random.random((ny, nx) if n_maps is None else (n_maps, ny, nx))
+
+    interpolator = GridInterpolator(xx, yy)
+    data_uniform = interpolator.interpolate(data)
+    assert data_uniform.shape == data.shape
+
+    xx_uniform, yy_uniform = interpolator.xx_uniform, interpolator.yy_uniform
+    npt.assert_array_almost_equal(xx_uniform[0, :], np.linspace(np.median(xx[:, 0]), np.median(xx[:, -1]), nx))
+    npt.assert_array_almost_equal(yy_uniform[:, 0], np.linspace(np.median(yy[0, :]), np.median(yy[-1, :]), ny))
+
+    points = np.stack((xx.flatten(), yy.flatten())).T
+    for d, d_uniform in zip(np.reshape(data, (-1, ny, nx)), np.reshape(data_uniform, (-1, ny, nx))):
+        expected = scipy.interpolate.griddata(
+            points, d.flatten(), (xx_uniform, yy_uniform), method="linear", fill_value=0
+        )
+        npt.assert_array_almost_equal(d_uniform, expected)
+
+    # 'grid_interpolate' returns the same results and reuses the triangulation
+    data_uniform2, xx_uniform2, yy_uniform2 = grid_interpolate(data, xx, yy)
+    npt.assert_array_almost_equal(data_uniform2, data_uniform)
+    npt.assert_array_equal(xx_uniform2, xx_uniform)
+    npt.assert_array_equal(yy_uniform2, yy_uniform)
+    assert _get_grid_interpolator(xx, yy) is _get_grid_interpolator(xx.copy(), yy.copy())
+    assert _get_grid_interpolator(xx, yy) is not _get_grid_interpolator(xx + 0.01, yy)
+
+    # Only the uniform grid is generated
+    data_none, xx_uniform3, yy_uniform3 = grid_interpolate(None, xx, yy)
+    assert data_none is None
+    npt.assert_array_equal(xx_uniform3, xx_uniform)
+    npt.assert_array_equal(yy_uniform3, yy_uniform)
+
+
+def test_GridInterpolator_2():
+    """
+    Single row scan: interpolation is skipped. Shapes mismatch.
+    """
+    xx, yy = _generate_coordinates(1, 20)
+    data = np.random.random((3, 1, 20))
+    interpolator = GridInterpolator(xx, yy)
+    assert interpolator.interpolate(data) is data
+    assert interpolator.xx_uniform is xx
+
+    xx, yy = _generate_coordinates(15, 20)
+    interpolator = GridInterpolator(xx, yy)
+    with pytest.raises(ValueError, match="Shapes of data and coordinate arrays do not match"):
+        interpolator.interpolate(np.random.random((3, 20, 15)))
+    with pytest.raises(ValueError, match="Shapes of coordinate arrays 'xx' and 'yy' do not match"):
+        GridInterpolator(xx, yy.T)
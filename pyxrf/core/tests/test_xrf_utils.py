@@ -3,6 +3,7 @@ import re
 import numpy as np
 import numpy.testing as npt
 import pytest
+from skbeam.core.constants import XrfElement
 
 from pyxrf.core.xrf_utils import (
     check_if_eline_is_activated,
@@ -11,8 +12,11 @@ from pyxrf.core.xrf_utils import (
     compute_atomic_weight,
     compute_cs,
     compute_cs_ratio,
+    compute_eline_cs,
     generate_eline_list,
     get_element_atomic_number,
+    get_eline_energy,
+    get_eline_parameters,
     get_supported_eline_list,
     parse_compound_formula,
     split_compound_mass,
@@ -187,6 +191,72 @@ def test_check_if_eline_is_activated(eline, incident_energy, success):
     ), f"Activation status for the emission line {eline} at {incident_energy} keV is {success}"
 
 
+# fmt: off
+@pytest.mark.parametrize("eline, line, incident_energy", [
+    ("Fe_K", "ka1", 12.0),
+    ("Ca_kb2", "kb2", 12.0),
+    ("Fe_Kb", "kb1", 8.0),
+    ("W_L", "la1", 12.0),
+    ("W_lb3", "lb3", 12.0),
+    ("Pb_L", "la1", 12.0),
+    ("Ta_M", "ma1", 2.0),
+])
+# fmt: on
+def test_get_eline_parameters(eline, line, incident_energy):
+    """
+    ``get_eline_parameters`` and ``get_eline_energy``: the values are the same as the values
+    computed using ``scikit-beam``.
+    """
+    element = eline.split("_")[0]
+    e = XrfElement(element)
+    cs = e.cs(incident_energy)[line]
+    cs_1 = e.cs(incident_energy)[line[0] + "a1"]
+
+    params = get_eline_parameters(eline, incident_energy)
+    assert params["energy"] == pytest.approx(e.emission_line[line])
+    assert params["cs"] == pytest.approx(cs)
+    assert params["ratio"] == pytest.approx(cs / cs_1 if cs_1 else 0)
+    assert get_eline_energy(eline) == pytest.approx(e.emission_line[line])
+
+    # Non-existing lines
+    assert get_eline_parameters(f"{element}_kz", incident_energy) == {"energy": 0, "cs": 0, "ratio": 0}
+    assert get_eline_energy(f"{element}_kz") == 0
+
+    with pytest.raises(RuntimeError, match="improperly formatted"):
+        get_eline_parameters("Fe_K_", incident_energy)
+    with pytest.raises(RuntimeError, match="improperly formatted"):
+        get_eline_energy("Fe_K_")
+
+
+def test_compute_eline_cs():
+    """
+    ``compute_eline_cs``: cross sections of multiple lines for multiple energies are the same
+    as the values computed using ``scikit-beam``.
+    """
+    elines = ["Fe_K", "Ca_kb2", "W_L", "W_M", "Fe_kb1"]
+    lines = ["ka1", "kb2", "la1", "ma1", "kb1"]
+    energies = [6.0, 7.1, 7.2, 12.0, 7.1, 2.5]
+
+    cs = compute_eline_cs(elines, energies)
+    assert cs.shape == (len(elines), len(energies))
+    for n, (eline, line) in enumerate(zip(elines, lines)):
+        e = XrfElement(eline.split("_")[0])
+        cs_expected = [e.cs(_)[line] for _ in energies]
+        npt.assert_array_almost_equal(cs[n, :], cs_expected, err_msg=eline)
+
+    # Activation status is the same as computed by 'check_if_eline_is_activated'
+    is_activated = compute_eline_cs("Fe_K", energies)[0] != 0
+    assert list(is_activated) == [check_if_eline_is_activated("Fe_K", _) for _ in energies]
+    assert compute_eline_cs("Fe_K", 12.0).shape == (1, 1)
+
+    with pytest.raises(RuntimeError, match="improperly formatted"):
+        compute_eline_cs(["Fe_K", "Fe_K_"], energies)
+    with pytest.raises(ValueError, match="not supported"):
+        compute_eline_cs(["Fe_K", "Fe_kz"], energies)
+    with pytest.raises(ValueError, match="not supported"):
+        compute_eline_cs(["Ab_K"], energies)
+
+
 # fmt: off
 @pytest.mark.parametrize("elements, incident_energy, elines", [
     (["Fe", "W", "Ta"], 12.0, ['Fe_K', 'W_L', 'W_M', 'Ta_L', 'Ta_M']),
@@ -1,8 +1,13 @@
+import collections
+import hashlib
 import logging
+import threading
 import time as ttime
 
 import numpy as np
 import scipy
+import scipy.sparse
+import scipy.spatial
 
 logger = logging.getLogger(__name__)
 
@@ -12,16 +17,216 @@ logger = logging.getLogger(__name__)
 #  and prepared to be moved to scikit-beam (skbeam.core.fitting.xrf_model)
 
 
+def _get_uniform_grid(xx, yy):
+    """
+    Generate uniform grid that has the same dimensions as the arrays of coordinates
+    and covers the full range of the coordinates along X and Y axes.
+
+    Parameters
+    ----------
+    xx : ndarray
+        2D array with measured values of X coordinates of data points
+    yy : ndarray
+        2D array with measured values of Y coordinates of data points
+
+    Returns
+    -------
+    xx_uniform : ndarray
+        2D array with evenly spaced X axis values
+    yy_uniform : ndarray
+        2D array with evenly spaced Y axis values
+    """
+
+    def _get_range(vv):
+        """
+        Returns the range of the data coordinates along X or Y axis. Coordinate
+        data for a single axis is represented as a 2D array ``vv``. The array
+        will have all rows or all columns identical or almost identical.
+        The range is returned as ``vv_min`` (leftmost or topmost value)
+        and ``vv_max`` (rightmost or bottommost value). Note, that ``vv_min`` may
+        be greater than ``vv_max``
+
+        Parameters
+        ----------
+        vv : ndarray
+            2-d array of coordinates
+
+        Returns
+        -------
+        vv_min : float
+            starting point of the range
+        vv_max : float
+            end of the range
+        """
+        # The assumption is that X values are mostly changing along the dimension 1 and
+        #   Y values change along the dimension 0 of the 2D array and only slightly change
+        #   along the alternative dimension. Determine, if the range is for X or Y
+        #   axis based on the dimension in which value change is the largest.
+        if abs(vv[0, 0] - vv[0, -1]) > abs(vv[0, 0] - vv[-1, 0]):
+            vv_min = np.median(vv[:, 0])
+            vv_max = np.median(vv[:, -1])
+        else:
+            vv_min = np.median(vv[0, :])
+            vv_max = np.median(vv[-1, :])
+
+        return vv_min, vv_max
+
+    ny, nx = xx.shape
+    # Find the range of axes
+    x_min, x_max = _get_range(xx)
+    y_min, y_max = _get_range(yy)
+    yy_uniform, xx_uniform = np.mgrid[y_min : y_max : ny * 1j, x_min : x_max : nx * 1j]
+    return xx_uniform, yy_uniform
+
+
+class GridInterpolator:
+    """
+    Linear interpolation of unevenly sampled maps to even grid (the same interpolation as
+    ``scipy.interpolate.griddata(..., method="linear", fill_value=0)``). The triangulation
+    of the set of data points is computed once when the object is created. The indices of
+    the vertices and the barycentric weights for each point of the uniform grid are stored
+    as a sparse matrix, so any number of maps with the same coordinates are interpolated
+    using a single sparse matrix product.
+
+    Examples
+    --------
+    .. code-block:: python
+
+        interpolator = GridInterpolator(x_pos, y_pos)
+        maps_uniform = interpolator.interpolate(maps)  # maps.shape = (n_maps, ny, nx)
+        xx_uniform, yy_uniform = interpolator.xx_uniform, interpolator.yy_uniform
+
+    Parameters
+    ----------
+    xx : ndarray
+        2D array with measured values of X coordinates of data points (the values may be unevenly spaced)
+    yy : ndarray
+        2D array with measured values of Y coordinates of data points (the values may be unevenly spaced)
+    xx_uniform : ndarray
+        2D array with evenly spaced X axis values (same shape as `xx`). If not provided, then
+        generated automatically.
+    yy_uniform : ndarray
+        2D array with evenly spaced Y axis values (same shape as `yy`). If not provided, then
+        generated automatically.
+    """
+
+    def __init__(self, xx, yy, xx_uniform=None, yy_uniform=None):
+        if xx.shape != yy.shape:
+            raise ValueError("Shapes of coordinate arrays 'xx' and 'yy' do not match.")
+        for v, name in ((xx_uniform, "xx_uniform"), (yy_uniform, "yy_uniform")):
+            if (v is not None) and (v.shape != xx.shape):
+                raise ValueError(f"Shapes of coordinate arrays and uniform coordinates {name!r} do not match.")
+
+        self.shape = xx.shape
+        self._weights = None
+
+        ny, nx = xx.shape
+        # Data must be 2-dimensional to use the following interpolation procedure.
+        if (nx <= 1) or (ny <= 1):
+            logger.debug("GridInterpolator: single row or column scan. Grid interpolation is skipped")
+            self.xx_uniform, self.yy_uniform = xx, yy
+            return
+
+        if xx_uniform is None or yy_uniform is None:
+            _xx_uniform, _yy_uniform = _get_uniform_grid(xx, yy)
+            xx_uniform = _xx_uniform if xx_uniform is None else xx_uniform
+            yy_uniform = _yy_uniform if yy_uniform is None else yy_uniform
+        self.xx_uniform, self.yy_uniform = xx_uniform, yy_uniform
+
+        points = np.stack((xx.flatten(), yy.flatten())).T
+        xi = np.stack((xx_uniform.flatten(), yy_uniform.flatten())).T
+
+        tri = scipy.spatial.Delaunay(points)
+        simplex = tri.find_simplex(xi)
+        # The points outside the convex hull are filled with zeros
+        n_inside = np.nonzero(simplex >= 0)[0]
+        simplex = simplex[n_inside]
+
+        # Barycentric coordinates of the points of the uniform grid
+        transform = tri.transform[simplex]
+        b = np.einsum("ijk,ik->ij", transform[:, :2, :], xi[n_inside] - transform[:, 2, :])
+        weights = np.concatenate([b, 1 - np.sum(b, axis=1, keepdims=True)], axis=1)
+
+        rows = np.repeat(n_inside, 3)
+        cols = tri.simplices[simplex].flatten()
+        self._weights = scipy.sparse.csr_matrix((weights.flatten(), (rows, cols)), shape=(xi.shape[0], xx.size))
+
+    def interpolate(self, data):
+        """
+        Interpolate the map or the stack of maps to the uniform grid.
+
+        Parameters
+        ----------
+        data : ndarray
+            2D array with the shape `(ny, nx)` or 3D array with the shape `(n_maps, ny, nx)`,
+            where `(ny, nx)` is the shape of the arrays of coordinates.
+
+        Returns
+        -------
+        ndarray
+            interpolated map(s), same shape as `data`. The reference to `data` is returned
+            if interpolation is skipped (single row or column scan).
+        """
+        if data.shape[-2:] != self.shape:
+            raise ValueError("Shapes of data and coordinate arrays do not match.")
+        if self._weights is None:
+            return data
+
+        data_flat = np.reshape(data, (-1, self._weights.shape[1]))
+        data_uniform = (self._weights @ data_flat.T).T
+        return np.reshape(data_uniform, data.shape)
+
+
+# Interpolators for the recently used sets of coordinates
+_grid_interpolator_cache = collections.OrderedDict()
+_grid_interpolator_cache_lock = threading.Lock()
+_GRID_INTERPOLATOR_CACHE_SIZE = 8
+
+
+def _get_grid_interpolator(xx, yy, xx_uniform=None, yy_uniform=None):
+    """
+    Returns the interpolator for the set of coordinates. The interpolators for the recently
+    used sets of coordinates are cached, so repeated interpolation of maps with the same
+    coordinates (e.g. when the maps are redrawn or exported) does not repeat the triangulation.
+    """
+    h = hashlib.sha1()
+    for v in (xx, yy, xx_uniform, yy_uniform):
+        if v is None:
+            h.update(b"None")
+        else:
+            v = np.ascontiguousarray(v)
+            h.update(f"{v.shape}{v.dtype.str}".encode())
+            h.update(memoryview(v).cast("B"))
+    key = h.hexdigest()
+
+    with _grid_interpolator_cache_lock:
+        interpolator = _grid_interpolator_cache.get(key, None)
+        if interpolator is not None:
+            _grid_interpolator_cache.move_to_end(key)
+            return interpolator
+
+    interpolator = GridInterpolator(xx, yy, xx_uniform, yy_uniform)
+
+    with _grid_interpolator_cache_lock:
+        _grid_interpolator_cache[key] = interpolator
+        while len(_grid_interpolator_cache) > _GRID_INTERPOLATOR_CACHE_SIZE:
+            _grid_interpolator_cache.popitem(last=False)
+    return interpolator
+
+
 def grid_interpolate(data, xx, yy, xx_uniform=None, yy_uniform=None):
     """
     Interpolate unevenly sampled data to even grid. The new even grid has the same
     dimensions as the original data and covers full range of original X and Y axes.
+    The triangulation is computed once for each set of coordinates (see ``GridInterpolator``)
+    and reused for the following calls with the same coordinates.
 
     Parameters
     ----------
 
     data : ndarray
         2D array with data values (`xx`, `yy` and `data` must have the same shape)
+        or 3D array with the stack of maps (dimensions 1 and 2 must match the shape of `xx` and `yy`).
         ``data`` may be None. In this case interpolation will not be performed, but uniform
         grid will be generated. Use this feature to generate uniform grid.
     xx : ndarray
@@ -47,7 +252,7 @@ def grid_interpolate(data, xx, yy, xx_uniform=None, yy_uniform=None):
 
     # Check if data shape and shape of coordinate arrays match
     if data is not None:
-        if data.shape != xx.shape:
+        if data.shape[-2:] != xx.shape or data.ndim not in (2, 3):
             msg = "Shapes of data and coordinate arrays do not match. (function 'grid_interpolate')"
             raise ValueError(msg)
     if xx.shape != yy.shape:
@@ -72,66 +277,18 @@ def grid_interpolate(data, xx, yy, xx_uniform=None, yy_uniform=None):
         logger.debug("Function utils.grid_interpolate: single row or column scan. Grid interpolation is skipped")
         return data, xx, yy
 
-    def _get_range(vv):
-        """
-        Returns the range of the data coordinates along X or Y axis. Coordinate
-        data for a single axis is represented as a 2D array ``vv``. The array
-        will have all rows or all columns identical or almost identical.
-        The range is returned as ``vv_min`` (leftmost or topmost value)
-        and ``vv_max`` (rightmost or bottommost value). Note, that ``vv_min`` may
-        be greater than ``vv_max``
-
-        Parameters
-        ----------
-        vv : ndarray
-            2-d array of coordinates
+    if data is None:
+        # Generate uniform grid without interpolation
+        if xx_uniform is None or yy_uniform is None:
+            _xx_uniform, _yy_uniform = _get_uniform_grid(xx, yy)
+            xx_uniform = _xx_uniform if xx_uniform is None else xx_uniform
+            yy_uniform = _yy_uniform if yy_uniform is None else yy_uniform
+        return None, xx_uniform, yy_uniform
 
-        Returns
-        -------
-        vv_min : float
-            starting point of the range
-        vv_max : float
-            end of the range
-        """
-        # The assumption is that X values are mostly changing along the dimension 1 and
-        #   Y values change along the dimension 0 of the 2D array and only slightly change
-        #   along the alternative dimension. Determine, if the range is for X or Y
-        #   axis based on the dimension in which value change is the largest.
-        if abs(vv[0, 0] - vv[0, -1]) > abs(vv[0, 0] - vv[-1, 0]):
-            vv_min = np.median(vv[:, 0])
-            vv_max = np.median(vv[:, -1])
-        else:
-            vv_min = np.median(vv[0, :])
-            vv_max = np.median(vv[-1, :])
-
-        return vv_min, vv_max
-
-    if xx_uniform is None or yy_uniform is None:
-        # Find the range of axes
-        x_min, x_max = _get_range(xx)
-        y_min, y_max = _get_range(yy)
-        _yy_uniform, _xx_uniform = np.mgrid[y_min : y_max : ny * 1j, x_min : x_max : nx * 1j]
-
-    if xx_uniform is None:
-        xx_uniform = _xx_uniform
-    if yy_uniform is None:
-        yy_uniform = _yy_uniform
-
-    xx = xx.flatten()
-    yy = yy.flatten()
-    xxyy = np.stack((xx, yy)).T
-
-    if data is not None:
-        # Do the interpolation only if data is provided
-        data = data.flatten()
-        # Do the interpolation
-        data_uniform = scipy.interpolate.griddata(
-            xxyy, data, (xx_uniform, yy_uniform), method="linear", fill_value=0
-        )
-    else:
-        data_uniform = None
+    interpolator = _get_grid_interpolator(xx, yy, xx_uniform, yy_uniform)
+    data_uniform = interpolator.interpolate(data)
 
-    return data_uniform, xx_uniform, yy_uniform
+    return data_uniform, interpolator.xx_uniform, interpolator.yy_uniform
 
 
 def normalize_data_by_scaler(data_in, scaler, *, data_name=None, name_not_scalable=None):
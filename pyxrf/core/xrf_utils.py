@@ -1,10 +1,18 @@
+import functools
 import re
 from distutils.version import LooseVersion
 
+import numpy as np
 import xraylib
 from skbeam.core.constants import XrfElement as Element
+from skbeam.core.constants.xrf import XRAYLIB_MAP
 from skbeam.core.fitting.xrf_model import K_LINE, L_LINE, M_LINE
 
+# The maximum atomic number of the elements included in the table of emission lines
+_ELINE_TABLE_Z_MAX = 103
+# The maximum number of (element, incident energy) pairs for which cross sections are cached
+_CS_CACHE_SIZE = 4096
+
 
 def get_element_atomic_number(element_str):
     r"""
@@ -144,6 +152,77 @@ def split_compound_mass(compound_formula, compound_mass):
     return element_dict
 
 
+def _xraylib_value(func, *args):
+    """
+    Call ``xraylib`` function. Returns 0 for non-existing lines and shells
+    (the same as ``scikit-beam``, which imitates the behavior of ``xraylib`` < 4.0).
+    """
+    try:
+        return func(*args)
+    except ValueError:
+        return 0
+
+
+class _ElineTable:
+    """
+    Table of energies of emission lines of the elements supported by ``xraylib``. The values
+    are the same as the values provided by ``scikit-beam`` (``XrfElement``), but they are
+    computed only once (see ``_get_eline_table``). Row ``Z`` of the array ``line_energies``
+    contains the values for the element with atomic number ``Z``.
+    """
+
+    def __init__(self, z_max=_ELINE_TABLE_Z_MAX):
+        line_map, line_func = XRAYLIB_MAP["lines"]
+
+        # Lower case line names, e.g. 'ka1' or 'lb2'
+        self.line_names = tuple(sorted(line_map))
+        self.line_index = {_: n for n, _ in enumerate(self.line_names)}
+
+        self.element_index = {}
+        self.line_energies = np.zeros(shape=(z_max + 1, len(self.line_names)))
+        for z in range(1, z_max + 1):
+            self.element_index[xraylib.AtomicNumberToSymbol(z)] = z
+            for n, name in enumerate(self.line_names):
+                self.line_energies[z, n] = _xraylib_value(line_func, z, line_map[name])
+
+        self.line_energies.flags.writeable = False
+
+
+@functools.lru_cache(maxsize=None)
+def _get_eline_table():
+    """
+    Returns the table of emission lines. The table is created on the first call.
+    """
+    return _ElineTable()
+
+
+@functools.lru_cache(maxsize=_CS_CACHE_SIZE)
+def _get_eline_cs(z, incident_energy):
+    """
+    Returns the array of fluorescence cross sections (cm2/g) of the emission lines
+    ``_ElineTable.line_names`` of the element with atomic number ``z`` excited by the beam
+    with given incident energy (keV). The arrays are cached and must not be modified.
+    """
+    cs_map, cs_func = XRAYLIB_MAP["cs"]
+    table = _get_eline_table()
+    cs = np.array([_xraylib_value(cs_func, z, cs_map[_], incident_energy) for _ in table.line_names])
+    cs.flags.writeable = False
+    return cs
+
+
+def _normalize_line_name(line):
+    """
+    Convert line name from 'K', 'Ka', 'Kb2' etc. to the name used in the table of emission lines
+    ('ka1', 'ka1', 'kb2' etc.)
+    """
+    line = line.lower()
+    if len(line) == 1:
+        line += "a1"
+    elif len(line) == 2:
+        line += "1"
+    return line
+
+
 def get_supported_eline_list(*, lines=None):
     """
     Returns the list of the emission lines supported by ``scikit-beam``
@@ -164,6 +243,15 @@ def get_supported_eline_list(*, lines=None):
     if lines is None:
         lines = ("K", "L", "M")
 
+    return list(_get_supported_elines(tuple(lines))[0])
+
+
+@functools.lru_cache(maxsize=None)
+def _get_supported_elines(lines):
+    """
+    Returns the tuple of supported emission lines and the set of the same lines
+    for fast lookups. ``lines`` must be a tuple.
+    """
     eline_list = []
     if "K" in lines:
         eline_list += K_LINE
@@ -172,7 +260,7 @@ def get_supported_eline_list(*, lines=None):
     if "M" in lines:
         eline_list += M_LINE
 
-    return eline_list
+    return tuple(eline_list), frozenset(eline_list)
 
 
 def check_if_eline_supported(eline_name, *, lines=None):
@@ -200,10 +288,10 @@ def check_if_eline_supported(eline_name, *, lines=None):
     if not eline_name or not isinstance(eline_name, str):
         return False
 
-    if eline_name in get_supported_eline_list(lines=lines):
-        return True
-    else:
-        return False
+    if lines is None:
+        lines = ("K", "L", "M")
+
+    return eline_name in _get_supported_elines(tuple(lines))[1]
 
 
 def check_if_eline_is_activated(elemental_line, incident_energy):
@@ -230,17 +318,16 @@ def check_if_eline_is_activated(elemental_line, incident_energy):
     # The validation of 'elemental_line' is strict enough to do the rest of the processing
     #   without further checks.
     [element, line] = elemental_line.split("_")
-    line = line.lower()
-    if len(line) == 1:
-        line += "a1"
-    elif len(line) == 2:
-        line += "1"
+    line = _normalize_line_name(line)
 
-    e = Element(element)
-    if e.cs(incident_energy)[line] == 0:
-        return False
-    else:
-        return True
+    table = _get_eline_table()
+    z = table.element_index.get(element, None)
+    if z is None:
+        # Let 'scikit-beam' process the elements that are not in the table
+        e = Element(element)
+        return e.cs(incident_energy)[line] != 0
+
+    return bool(_get_eline_cs(z, incident_energy)[table.line_index[line]] != 0)
 
 
 def generate_eline_list(element_list, *, incident_energy, lines=None):
@@ -328,20 +415,18 @@ def get_eline_parameters(elemental_line, incident_energy):
     # The validation of 'elemental_line' is strict enough to do the rest of the processing
     #   without further checks.
     [element, line] = elemental_line.split("_")
-    line = line.lower()
-    if len(line) == 1:
-        line += "a1"
-    elif len(line) == 2:
-        line += "1"
+    line = _normalize_line_name(line)
 
     # This is the name of line #1 (ka1, la1 etc.)
     line_1 = line[0] + "a1"
 
     try:
-        e = Element(element)
-        energy = e.emission_line[line]
-        cs = e.cs(incident_energy)[line]
-        cs_1 = e.cs(incident_energy)[line_1]
+        table = _get_eline_table()
+        z = table.element_index[element]
+        n_line, n_line_1 = table.line_index[line], table.line_index[line_1]
+        cs_all = _get_eline_cs(z, incident_energy)
+        energy = float(table.line_energies[z, n_line])
+        cs, cs_1 = float(cs_all[n_line]), float(cs_all[n_line_1])
         ratio = cs / cs_1 if cs_1 else 0
     except Exception:
         energy, cs, ratio = 0, 0, 0
@@ -374,21 +459,73 @@ def get_eline_energy(elemental_line):
     # The validation of 'elemental_line' is strict enough to do the rest of the processing
     #   without further checks.
     [element, line] = elemental_line.split("_")
-    line = line.lower()
-    if len(line) == 1:
-        line += "a1"
-    elif len(line) == 2:
-        line += "1"
+    line = _normalize_line_name(line)
 
     try:
-        e = Element(element)
-        energy = e.emission_line[line]
+        table = _get_eline_table()
+        energy = float(table.line_energies[table.element_index[element], table.line_index[line]])
     except Exception:
         energy = 0
 
     return energy
 
 
+def compute_eline_cs(elemental_lines, incident_energies):
+    """
+    Compute fluorescence cross sections of multiple emission lines at multiple incident
+    energies, e.g. the energies of XANES scan. The values are the same as the cross sections
+    used by ``check_if_eline_is_activated`` and ``get_eline_parameters``. The emission line
+    is activated at the incident energy if the respective cross section is not zero.
+
+    Parameters
+    ----------
+    elemental_lines : str or list(str)
+        emission line or the list of emission lines in the format K_K, Fe_K, Ca_k, Ca_ka, Ca_kb2 etc.
+    incident_energies : float or array-like
+        incident energy or 1D array of incident energies in keV
+
+    Returns
+    -------
+    ndarray
+        2D array of cross sections (cm2/g) of the shape ``(n_lines, n_energies)``
+
+    Raises
+    ------
+    RuntimeError
+        emission line is improperly formatted
+    ValueError
+        the element or the line is not supported
+    """
+    if isinstance(elemental_lines, str):
+        elemental_lines = [elemental_lines]
+    incident_energies = np.atleast_1d(np.asarray(incident_energies, dtype=float))
+    if incident_energies.ndim != 1:
+        raise ValueError(f"Incident energies must be a scalar or 1D array: shape {incident_energies.shape}")
+
+    table = _get_eline_table()
+    z_list, n_line_list = [], []
+    for eline in elemental_lines:
+        if not re.search(r"^[A-Z][a-z]?_[KLMklm]([a-z]\d?)?$", eline):
+            raise RuntimeError(f"Elemental line {eline} is improperly formatted")
+        element, line = eline.split("_")
+        line = _normalize_line_name(line)
+        if (element not in table.element_index) or (line not in table.line_index):
+            raise ValueError(f"Emission line {eline!r} is not supported")
+        z_list.append(table.element_index[element])
+        n_line_list.append(table.line_index[line])
+
+    # The cross sections for all lines of an element are computed once for each unique energy
+    energies_unique, energies_inverse = np.unique(incident_energies, return_inverse=True)
+    z_array, n_line_array = np.array(z_list, dtype=int), np.array(n_line_list, dtype=int)
+    cs = np.zeros(shape=(len(elemental_lines), len(incident_energies)))
+    for z in np.unique(z_array):
+        cs_z = np.stack([_get_eline_cs(int(z), float(_)) for _ in energies_unique])
+        rows = z_array == z
+        cs[rows, :] = cs_z[energies_inverse][:, n_line_array[rows]].T
+
+    return cs
+
+
 def compute_cs(Z, e, *, line=None):
     """
     Calculate full fluorescence cross section of for a specified emission line using Kissel method (in Barns).
@@ -408,8 +545,14 @@ def compute_cs(Z, e, *, line=None):
     if line not in ("K", "L", "M", "k", "l", "m"):
         raise ValueError(f"Unrecognized emission line: {line!r}. Supported values: 'K', 'L', 'M'")
 
-    line = line.upper()
+    return _compute_cs_cached(Z, e, line.upper())
+
 
+@functools.lru_cache(maxsize=_CS_CACHE_SIZE)
+def _compute_cs_cached(Z, e, line):
+    """
+    Computes the cross section for ``compute_cs``. The results are cached.
+    """
     if line == "K":
         shells = [xraylib.K_SHELL]
     elif line == "L":
@@ -1720,9 +1720,9 @@ class GlobalProcessingClasses:
 
         self.fit_model.fit_single_pixel()
 
-        # add scalers to fit dict
+        # add scalers to fit dict (the maps of binned data are not added to the dict)
         scaler_keys = [v for v in self.io_model.img_dict.keys() if "scaler" in v]
-        if len(scaler_keys) > 0:
+        if len(scaler_keys) > 0 and self.fit_model.fit_img:
             self.fit_model.fit_img[list(self.fit_model.fit_img.keys())[0]].update(
                 self.io_model.img_dict[scaler_keys[0]]
             )
@@ -16,14 +16,54 @@ import h5py
 import numpy as np
 from skbeam.core.fitting.xrf_model import define_range, linear_spectrum_fitting
 
-from ..core.map_processing import dask_client_create
+from ..core.map_processing import TerminalProgressBar, bin_map, dask_cluster_manager, fit_xrf_map_batch
 from ..core.quant_analysis import ParamQuantitativeAnalysis
-from .fileio import output_data, read_hdf_APS, read_MAPS, sep_v
-from .fit_spectrum import save_fitdata_to_hdf, single_pixel_fitting_controller
+from .fileio import (
+    get_fit_data,
+    output_data,
+    read_hdf_APS,
+    read_MAPS,
+    save_scalers_and_positions_to_hdf,
+    sep_v,
+)
+from .fit_spectrum import (
+    _build_linear_model,
+    _get_snip_param,
+    calculate_area,
+    multi_channel_fitting_controller,
+    save_fitdata_to_hdf,
+    single_pixel_fitting_controller,
+)
 
 logger = logging.getLogger(__name__)
 
 
+def _set_incident_energy(param, *, incident_energy, mdata, ignore_datafile_metadata, file_name, param_path):
+    """
+    Set incident energy in the dictionary of fitting parameters ``param`` (in place). The energy
+    passed as ``incident_energy`` has the highest priority, then the energy from the metadata
+    of the data file (unless ``ignore_datafile_metadata`` is True). The value from the parameter
+    file is used if no other value is available. Returns the value of incident energy.
+    """
+    if incident_energy is not None:
+        param["coherent_sct_energy"]["value"] = incident_energy
+        print("Using incident beam energy passed as the function parameter.")
+    elif (
+        mdata.is_metadata_available()
+        and "instrument_mono_incident_energy" in mdata
+        and not ignore_datafile_metadata
+    ):
+        param["coherent_sct_energy"]["value"] = mdata["instrument_mono_incident_energy"]
+        print(f"Using incident beam energy from the data file '{file_name}'.")
+    else:
+        print(f"Using incident beam energy from the parameter file '{param_path}'.")
+
+    # The value of incident energy that is used for processing
+    incident_energy_used = param["coherent_sct_energy"]["value"]
+    print(f"Incident beam energy: {incident_energy_used}.")
+    return incident_energy_used
+
+
 def fit_pixel_data_and_save(
     working_directory,
     file_name,
@@ -46,11 +86,15 @@ def fit_pixel_data_and_save(
     bin_energy=0,
     save_txt=False,
     save_tiff=True,
+    save_stack_formats=None,
     scaler_name=None,
     use_average=False,
     interpolate_to_uniform_grid=False,
     data_from="NSLS-II",
     dask_client=None,
+    stream_results_to_file=False,
+    result_cache=None,
+    fit_channels_single_pass=False,
 ):
     """
     Do fitting for signle data set, and save data accordingly. Fitting can be performed on
@@ -92,7 +136,11 @@ def fit_pixel_data_and_save(
     method : str, optional
         fitting method, default as nnls
     pixel_bin : int, optional
-        bin pixel as 2by2, or 3by3
+        bin pixels before fitting (2 - 2x2 pixels, N - NxN pixels). Binning is useful for quick
+        evaluation of large maps. The maps of binned data are saved to the group ``xrfmap/bin<N>``
+        (e.g. ``xrfmap/bin2/detsum/xrf_fit``) together with binned scalers (summed) and positions
+        (averaged), so the results of fitting of the full-resolution data are not overwritten.
+        Exported scalers and positions are binned in the same way.
     raise_bg : int, optional
         add a constant value to each spectrum, better for fitting
     comp_elastic_combine : bool, optional
@@ -102,11 +150,15 @@ def fit_pixel_data_and_save(
     use_snip : bool, optional
         use snip method to remove background
     bin_energy : int, optional
-        bin spectrum with given value
+        the number of adjacent energy bins summed before fitting
     save_txt : bool, optional
         save data to txt or not
     save_tiff : bool, optional
         save data to tiff or not
+    save_stack_formats : list(str) or None, optional
+        the list of formats used to save all maps in a single file with the list of map names:
+        ``"tiff_stack"`` (multipage TIFF), ``"npz"`` or ``"h5"``. The files are saved to
+        the directory ``output_stack_<file name>``. Stacked files are not saved if None (default).
     scaler_name : str, optional
         name of the field representing the scaler (for example 'i0'), which must be present
         in the data files. If given, normalization will be performed before saving data
@@ -124,9 +176,95 @@ def fit_pixel_data_and_save(
         If a batch of files is processed, then creating Dask client and
         passing the reference to it to the processing functions will save
         execution time: `client = Client(processes=True, silence_logs=logging.ERROR)`
+    stream_results_to_file : bool, optional
+        write the results of fitting directly to the data file as processing of each block
+        of data is completed. The fitted maps are not assembled in memory, which is
+        useful for processing of very large maps. The maps are loaded from the file only
+        if they are exported to TXT or TIFF files.
+    result_cache : BlockResultCache or None, optional
+        on-disk cache of fitted blocks of data. Blocks that were already fitted with the same data
+        and parameters are loaded from the cache instead of being refitted. The cache is not used
+        if `None`.
+    fit_channels_single_pass : bool, optional
+        if ``fit_channel_each`` is True, fit the sum and all detector channels in a single pass over
+        the data: co-located blocks of all channels are loaded and fitted by the same task and the results
+        are written to the datasets of the respective channels. The raw data is read and the blocks are
+        scheduled once instead of once per channel. The results are the same.
     """
     fpath = os.path.join(working_directory, file_name)
 
+    # The list of formats of the exported maps
+    save_stack_formats = [_.lower() for _ in (save_stack_formats or [])]
+    supported_stack_formats = ("tiff_stack", "npz", "h5")
+    for fmt in save_stack_formats:
+        if fmt not in supported_stack_formats:
+            raise ValueError(
+                f"Unsupported format of stacked maps {fmt!r}. Supported formats: {supported_stack_formats}"
+            )
+    output_formats = (["txt"] if save_txt else []) + (["tiff"] if save_tiff else []) + save_stack_formats
+
+    def _output_folder(file_format, prefix_fname):
+        # Maps in stacked formats are saved in the same folder
+        folder_format = file_format if file_format in ("txt", "tiff") else "stack"
+        return os.path.join(working_directory, f"output_{folder_format}_{prefix_fname}")
+
+    def _fit_and_save(data, param, inner_path):
+        # Fit the data and save the results to the file 'fpath'. Returns the dictionary of maps
+        #   only if it is needed for exporting the data.
+        result_map, _ = single_pixel_fitting_controller(
+            data,
+            param,
+            incident_energy=incident_energy,
+            method=method,
+            pixel_bin=pixel_bin,
+            raise_bg=raise_bg,
+            comp_elastic_combine=comp_elastic_combine,
+            linear_bg=linear_bg,
+            use_snip=use_snip,
+            bin_energy=bin_energy,
+            dask_client=dask_client,
+            output_fpath=fpath if stream_results_to_file else None,
+            output_datapath=inner_path,
+            result_cache=result_cache,
+        )
+        return _save_result_map(result_map, inner_path)
+
+    def _fit_and_save_channels(fit_maps):
+        # Fit the maps (the sum and/or the channels of the detector) in a single pass over
+        #   the data and save the results to the file 'fpath' (same as '_fit_and_save')
+        results = multi_channel_fitting_controller(
+            [(_["data"], _["param"]) for _ in fit_maps],
+            incident_energy=incident_energy,
+            method=method,
+            pixel_bin=pixel_bin,
+            raise_bg=raise_bg,
+            comp_elastic_combine=comp_elastic_combine,
+            linear_bg=linear_bg,
+            use_snip=use_snip,
+            bin_energy=bin_energy,
+            dask_client=dask_client,
+            output_fpath=fpath if stream_results_to_file else None,
+            output_datapaths=[_["inner_path"] for _ in fit_maps],
+            result_cache=result_cache,
+        )
+        return [
+            _save_result_map(result_map, fit_map["inner_path"])
+            for (result_map, _), fit_map in zip(results, fit_maps)
+        ]
+
+    def _save_result_map(result_map, inner_path):
+        if not stream_results_to_file:
+            # output to .h5 file
+            save_fitdata_to_hdf(fpath, result_map, datapath=inner_path)
+        elif output_formats:
+            with h5py.File(fpath, "r") as f:
+                result_map = get_fit_data(f[inner_path]["xrf_fit_name"][()], f[inner_path]["xrf_fit"][()])
+        else:
+            # The maps are not needed, so they are not loaded from the file
+            result_map = {}
+
+        return result_map
+
     # Load quantitative calibration files (if necessary)
     quant_norm = False  # Indicates if at least one calibration file is loaded
     param_quant_analysis = ParamQuantitativeAnalysis()
@@ -145,10 +283,46 @@ def fit_pixel_data_and_save(
             except Exception as ex:
                 logger.error(f"Error occurred while loading quantitative calibration from file '{f}': {ex}")
 
+    def get_scaler_set(img_dict):
+        sc_set_names = [_ for _ in img_dict if _.endswith("_scaler")]
+        if sc_set_names:
+            return img_dict[sc_set_names[0]]
+        else:
+            return {}
+
+    def get_positions_set(img_dict):
+        if "positions" in img_dict:
+            return img_dict["positions"]
+        else:
+            return {}
+
+    params_loaded = {}  # Each parameter file is loaded once
+
+    def _load_param(param_file_name):
+        if not os.path.isabs(param_file_name):
+            param_path = os.path.join(working_directory, param_file_name)
+        else:
+            param_path = param_file_name
+        if param_path not in params_loaded:
+            with open(param_path, "r") as json_data:
+                params_loaded[param_path] = json.load(json_data)
+        return copy.deepcopy(params_loaded[param_path]), param_path
+
     t0 = time.time()
     prefix_fname = file_name.split(".")[0]
+
+    # The maps of binned data have different shape, so they are saved to a separate group
+    #   (the name of the group must not contain 'det', see 'read_hdf_APS')
+    fit_group = f"xrfmap/bin{pixel_bin}" if pixel_bin > 1 else "xrfmap"
+
+    # The list of maps to fit: the sum of all detector channels and/or each detector channel
+    fit_maps = []
+
     if fit_channel_sum is True:
-        if data_from == "NSLS-II":
+        if fit_channel_each and fit_channels_single_pass and data_from == "NSLS-II":
+            # The sum and the channels are loaded from the file once
+            img_dict, data_sets, mdata = read_hdf_APS(working_directory, file_name, load_each_channel=True)
+        elif data_from == "NSLS-II":
             img_dict, data_sets, mdata = read_hdf_APS(working_directory, file_name, load_each_channel=False)
         elif data_from == "2IDE-APS":
             img_dict, data_sets, mdata = read_MAPS(working_directory, file_name, channel_num=1)
@@ -161,113 +335,33 @@ def fit_pixel_data_and_save(
             data_all_sum = data_sets[prefix_fname].raw_data
 
         # load param file
-        if not os.path.isabs(param_file_name):
-            param_path = os.path.join(working_directory, param_file_name)
-        else:
-            param_path = param_file_name
-        with open(param_path, "r") as json_data:
-            param_sum = json.load(json_data)
+        param_sum, param_path = _load_param(param_file_name)
 
         # update incident energy, required for XANES
-        if incident_energy is not None:
-            param_sum["coherent_sct_energy"]["value"] = incident_energy
-            print("Using incident beam energy passed as the function parameter.")
-        elif (
-            mdata.is_metadata_available()
-            and "instrument_mono_incident_energy" in mdata
-            and not ignore_datafile_metadata
-        ):
-            param_sum["coherent_sct_energy"]["value"] = mdata["instrument_mono_incident_energy"]
-            print(f"Using incident beam energy from the data file '{file_name}'.")
-        else:
-            print(f"Using incident beam energy from the parameter file '{param_path}'.")
-
-        # The value of incident energy that is used for processing
-        incident_energy_used = param_sum["coherent_sct_energy"]["value"]
-        print(f"Incident beam energy: {incident_energy_used}.")
-
-        result_map_sum, calculation_info = single_pixel_fitting_controller(
-            data_all_sum,
+        incident_energy_used = _set_incident_energy(
             param_sum,
             incident_energy=incident_energy,
-            method=method,
-            pixel_bin=pixel_bin,
-            raise_bg=raise_bg,
-            comp_elastic_combine=comp_elastic_combine,
-            linear_bg=linear_bg,
-            use_snip=use_snip,
-            bin_energy=bin_energy,
-            dask_client=dask_client,
+            mdata=mdata,
+            ignore_datafile_metadata=ignore_datafile_metadata,
+            file_name=file_name,
+            param_path=param_path,
         )
 
-        # output to .h5 file
-        inner_path = "xrfmap/detsum"
-        # fit_name = prefix_fname+'_fit'
-        save_fitdata_to_hdf(fpath, result_map_sum, datapath=inner_path)
-
-        def get_scaler_set(img_dict):
-            sc_set_names = [_ for _ in img_dict if _.endswith("_scaler")]
-            if sc_set_names:
-                return img_dict[sc_set_names[0]]
-            else:
-                return {}
-
-        def get_positions_set(img_dict):
-            if "positions" in img_dict:
-                return img_dict["positions"]
-            else:
-                return {}
-
-        scaler_dict = get_scaler_set(img_dict)
-        scaler_name_list = list(scaler_dict.keys())
-        positions_dict = get_positions_set(img_dict)
-        # Generate dataset
-        dataset = copy.deepcopy(scaler_dict)
-        dataset.update(result_map_sum)
-
-        # Set parameters for quantitative normalization
-        param_quant_analysis.experiment_incident_energy = incident_energy_used
-        param_quant_analysis.experiment_distance_to_sample = quant_distance_to_sample
-        param_quant_analysis.experiment_detector_channel = "sum"
-
-        if save_txt is True:
-            output_folder = "output_txt_" + prefix_fname
-            output_path = os.path.join(working_directory, output_folder)
-            output_data(
-                output_dir=output_path,
-                interpolate_to_uniform_grid=interpolate_to_uniform_grid,
-                dataset_name="dataset_fit",  # Sum of all detectors: should end with '_fit'
-                quant_norm=quant_norm,
-                quant_ref_eline=quant_ref_eline,
-                param_quant_analysis=param_quant_analysis,
-                dataset_dict=dataset,
-                positions_dict=positions_dict,
-                file_format="txt",
-                scaler_name=scaler_name,
-                scaler_name_list=scaler_name_list,
-                use_average=use_average,
-            )
-
-        if save_tiff is True:
-            output_folder = "output_tiff_" + prefix_fname
-            output_path = os.path.join(working_directory, output_folder)
-            output_data(
-                output_dir=output_path,
-                interpolate_to_uniform_grid=interpolate_to_uniform_grid,
-                dataset_name="dataset_fit",  # Sum of all detectors: should end with '_fit'
-                quant_norm=quant_norm,
-                quant_ref_eline=quant_ref_eline,
-                param_quant_analysis=param_quant_analysis,
-                dataset_dict=dataset,
-                positions_dict=positions_dict,
-                file_format="tiff",
-                scaler_name=scaler_name,
-                scaler_name_list=scaler_name_list,
-                use_average=use_average,
-            )
+        fit_maps.append(
+            {
+                "data": data_all_sum,
+                "param": param_sum,
+                "inner_path": f"{fit_group}/detsum",  # output to .h5 file
+                "dataset_name": "dataset_fit",  # Sum of all detectors: should end with '_fit'
+                "detector_channel": "sum",
+                "incident_energy": incident_energy_used,
+                "img_dict": img_dict,
+            }
+        )
 
     if fit_channel_each:
-        img_dict, data_sets, mdata = read_hdf_APS(working_directory, file_name, load_each_channel=True)
+        if not fit_maps or not fit_channels_single_pass or data_from != "NSLS-II":
+            img_dict, data_sets, mdata = read_hdf_APS(working_directory, file_name, load_each_channel=True)
 
         # Find the detector channels and the names of the channels
         det_channels = [_ for _ in data_sets.keys() if re.search(r"_det\d+$", _)]
@@ -284,117 +378,85 @@ def fit_pixel_data_and_save(
 
         channel_num = len(param_channel_list)
         for i in range(channel_num):
-            inner_path = "xrfmap/" + det_channel_names[i]
-            print(f"Processing data from detector channel {det_channel_names[i]} (#{i + 1}) ...")
-
             # load param file
-            param_file_name = param_channel_list[i]
-
-            # load param file
-            if not os.path.isabs(param_file_name):
-                param_path = os.path.join(working_directory, param_file_name)
-            else:
-                param_path = param_file_name
-            with open(param_path, "r") as json_data:
-                param_det = json.load(json_data)
+            param_det, param_path = _load_param(param_channel_list[i])
 
             # update incident energy, required for XANES
-            if incident_energy is not None:
-                param_det["coherent_sct_energy"]["value"] = incident_energy
-                print("Using incident beam energy passed as the function parameter.")
-            elif (
-                mdata.is_metadata_available()
-                and "instrument_mono_incident_energy" in mdata
-                and not ignore_datafile_metadata
-            ):
-                param_det["coherent_sct_energy"]["value"] = mdata["instrument_mono_incident_energy"]
-                print(f"Using incident beam energy from the data file '{file_name}'.")
-            else:
-                print(f"Using incident beam energy from the parameter file '{param_path}'.")
-
-            # The value of incident energy that is used for processing
-            incident_energy_used = param_det["coherent_sct_energy"]["value"]
-            print(f"Incident beam energy: {incident_energy_used}.")
-
-            data_all_det = data_sets[det_channels[i]].raw_data
-
-            result_map_det, calculation_info = single_pixel_fitting_controller(
-                data_all_det,
+            incident_energy_used = _set_incident_energy(
                 param_det,
                 incident_energy=incident_energy,
-                method=method,
-                pixel_bin=pixel_bin,
-                raise_bg=raise_bg,
-                comp_elastic_combine=comp_elastic_combine,
-                linear_bg=linear_bg,
-                use_snip=use_snip,
-                bin_energy=bin_energy,
-                dask_client=dask_client,
+                mdata=mdata,
+                ignore_datafile_metadata=ignore_datafile_metadata,
+                file_name=file_name,
+                param_path=param_path,
             )
 
-            # output to .h5 file
-            save_fitdata_to_hdf(fpath, result_map_det, datapath=inner_path)
+            fit_maps.append(
+                {
+                    "data": data_sets[det_channels[i]].raw_data,
+                    "param": param_det,
+                    "inner_path": f"{fit_group}/{det_channel_names[i]}",  # output to .h5 file
+                    "dataset_name": f"dataset_{det_channel_names[i]}_fit",  # ..._det1_fit, etc.
+                    "detector_channel": det_channel_names[i],
+                    "incident_energy": incident_energy_used,
+                    "img_dict": img_dict,
+                }
+            )
 
-            def get_scaler_set(img_dict):
-                sc_set_names = [_ for _ in img_dict if _.endswith("_scaler")]
-                if sc_set_names:
-                    return img_dict[sc_set_names[0]]
-                else:
-                    return {}
+    def _get_scalers_and_positions(img_dict):
+        # The scalers and positions must match the maps of binned data
+        scaler_dict = {k: bin_map(v, pixel_bin=pixel_bin) for k, v in get_scaler_set(img_dict).items()}
+        positions_dict = {
+            k: bin_map(v, pixel_bin=pixel_bin, average=True) for k, v in get_positions_set(img_dict).items()
+        }
+        return scaler_dict, positions_dict
 
-            def get_positions_set(img_dict):
-                if "positions" in img_dict:
-                    return img_dict["positions"]
-                else:
-                    return {}
-
-            scaler_dict = get_scaler_set(img_dict)
-            scaler_name_list = list(scaler_dict.keys())
-            positions_dict = get_positions_set(img_dict)
-            # Generate dataset
-            dataset = copy.deepcopy(scaler_dict)
-            dataset.update(result_map_det)
-
-            # Set parameters for quantitative normalization
-            param_quant_analysis.experiment_incident_energy = incident_energy_used
-            param_quant_analysis.experiment_distance_to_sample = quant_distance_to_sample
-            param_quant_analysis.experiment_detector_channel = det_channel_names[i]
-
-            if save_txt is True:
-                output_folder = "output_txt_" + prefix_fname
-                output_path = os.path.join(working_directory, output_folder)
-                output_data(
-                    output_dir=output_path,
-                    interpolate_to_uniform_grid=interpolate_to_uniform_grid,
-                    dataset_name=f"dataset_{det_channel_names[i]}_fit",  # ..._det1_fit, etc.
-                    quant_norm=quant_norm,
-                    quant_ref_eline=quant_ref_eline,
-                    param_quant_analysis=param_quant_analysis,
-                    dataset_dict=dataset,
-                    positions_dict=positions_dict,
-                    file_format="txt",
-                    scaler_name=scaler_name,
-                    scaler_name_list=scaler_name_list,
-                    use_average=use_average,
-                )
+    def _export_result_map(fit_map, result_map):
+        scaler_dict, positions_dict = _get_scalers_and_positions(fit_map["img_dict"])
+        scaler_name_list = list(scaler_dict.keys())
+        # Generate dataset. The maps are not modified, so the arrays are not copied.
+        dataset = dict(scaler_dict)
+        dataset.update(result_map)
 
-            if save_tiff is True:
-                output_folder = "output_tiff_" + prefix_fname
-                output_path = os.path.join(working_directory, output_folder)
-                output_data(
-                    output_dir=output_path,
-                    interpolate_to_uniform_grid=interpolate_to_uniform_grid,
-                    dataset_name=f"dataset_{det_channel_names[i]}_fit",  # ..._det1_fit, etc.
-                    quant_norm=quant_norm,
-                    quant_ref_eline=quant_ref_eline,
-                    param_quant_analysis=param_quant_analysis,
-                    dataset_dict=dataset,
-                    positions_dict=positions_dict,
-                    file_format="tiff",
-                    scaler_name=scaler_name,
-                    scaler_name_list=scaler_name_list,
-                    use_average=use_average,
-                )
+        # Set parameters for quantitative normalization
+        param_quant_analysis.experiment_incident_energy = fit_map["incident_energy"]
+        param_quant_analysis.experiment_distance_to_sample = quant_distance_to_sample
+        param_quant_analysis.experiment_detector_channel = fit_map["detector_channel"]
+
+        for file_format in output_formats:
+            output_data(
+                output_dir=_output_folder(file_format, prefix_fname),
+                interpolate_to_uniform_grid=interpolate_to_uniform_grid,
+                dataset_name=fit_map["dataset_name"],
+                quant_norm=quant_norm,
+                quant_ref_eline=quant_ref_eline,
+                param_quant_analysis=param_quant_analysis,
+                dataset_dict=dataset,
+                positions_dict=positions_dict,
+                file_format=file_format,
+                scaler_name=scaler_name,
+                scaler_name_list=scaler_name_list,
+                use_average=use_average,
+            )
+
+    if fit_maps and (fit_group != "xrfmap"):
+        save_scalers_and_positions_to_hdf(
+            fpath, *_get_scalers_and_positions(fit_maps[0]["img_dict"]), datapath=fit_group
+        )
+
+    if fit_channels_single_pass and (len(fit_maps) > 1):
+        print(f"Processing data from {len(fit_maps)} detector channels in a single pass ...")
+        result_maps = _fit_and_save_channels(fit_maps)
+        for fit_map, result_map in zip(fit_maps, result_maps):
+            _export_result_map(fit_map, result_map)
+    else:
+        # Each map is exported as soon as it is fitted, so only one set of maps is held in memory
+        for n, fit_map in enumerate(fit_maps):
+            if fit_map["detector_channel"] != "sum":
+                print(f"Processing data from detector channel {fit_map['detector_channel']} (#{n + 1}) ...")
+            result_map = _fit_and_save(fit_map["data"], fit_map["param"], fit_map["inner_path"])
+            _export_result_map(fit_map, result_map)
+            del result_map
 
     t1 = time.time()
     print(f"Processing time: {t1 - t0}")
@@ -416,12 +478,18 @@ def pyxrf_batch(
     quant_distance_to_sample=0,
     quant_ref_eline="",
     use_snip=True,
+    pixel_bin=0,
+    bin_energy=0,
     save_txt=False,
     save_tiff=True,
+    save_stack_formats=None,
     scaler_name=None,
     use_average=False,
     interpolate_to_uniform_grid=False,
     dask_client=None,
+    stream_results_to_file=False,
+    result_cache=None,
+    fit_channels_single_pass=False,
 ):
     """
     Perform fitting on a batch of data files. The results are saved as new datasets
@@ -478,10 +546,19 @@ def pyxrf_batch(
     use_snip : bool, optional
         use snip method to remove background (`True`). If `False`, then do fitting
         without removing the background (runs faster)
+    pixel_bin : int, optional
+        bin pixels before fitting (2 - 2x2 pixels, N - NxN pixels). The saved and exported maps,
+        scalers and positions have the shape of the binned data. The binned maps are saved to
+        the group ``xrfmap/bin<N>`` of the data file. No binning if 0 or 1 (default).
+    bin_energy : int, optional
+        the number of adjacent energy bins summed before fitting. No binning if 0 or 1 (default).
     save_txt : bool, optional
         save data to txt or not
     save_tiff : bool, optional
         save data to tiff or not
+    save_stack_formats : list(str) or None, optional
+        the list of formats used to save all maps in a single file: ``"tiff_stack"`` (multipage TIFF),
+        ``"npz"`` or ``"h5"``. Stacked files are not saved if None (default).
     scaler_name : str, optional
         if given, normalization will be performed
     use_average : bool, optional
@@ -491,17 +568,34 @@ def pyxrf_batch(
         The grid dimensions match the dimensions of positional data for X and Y axes.
         The range of axes is chosen to fit the values of X and Y.
     dask_client: dask.distributed.Client
-        Dask client object. If None, then Dask client is created automatically.
-        If a batch of files is processed, then creating Dask client and
-        passing the reference to it to the processing functions will save
-        execution time:
+        Dask client object. If None, then the shared local Dask cluster is used. The cluster
+        is created on the first call and reused by the following calls, so the start-up cost
+        is paid only once per process. The cluster may be configured before processing:
 
         .. code:: python
 
-            from pyxrf.api import dask_client_create
-            client = dask_client_create()  # Create Dask client
-            # <-- code that runs computations -->
-            client.close()  # Close Dask client
+            from pyxrf.api import dask_cluster_manager
+            dask_cluster_manager.configure(n_workers=4, memory_limit="4GB")
+
+    stream_results_to_file : bool, optional
+        write the results of fitting directly to the data file as processing of each block
+        of data is completed instead of assembling the maps in memory. Recommended for
+        processing of very large maps.
+    result_cache : BlockResultCache or None, optional
+        on-disk cache of fitted blocks of data. Repeated processing of unchanged files with
+        the same parameters (e.g. in order to change output options) loads the results from
+        the cache instead of refitting the data. The size of the cache is limited, the least
+        recently used blocks are removed first:
+
+        .. code:: python
+
+            from pyxrf.api import BlockResultCache
+            cache = BlockResultCache(max_size=4 * 1024**3)
+            pyxrf_batch(..., result_cache=cache)
+
+    fit_channels_single_pass : bool, optional
+        if ``fit_channel_each`` is True, fit the sum and all detector channels of each file
+        in a single pass over the data (see ``fit_pixel_data_and_save``).
 
     Returns
     -------
@@ -697,19 +791,10 @@ def pyxrf_batch(
         print(f"Processing parameter file: '{pname}'")
 
     if len(flist) > 0:
-        client_is_local = False
-        # If no external Dask client is provided and we are processing a batch
-        #   then create a local client that will be used to process the whole batch
-        if (len(flist) > 1) and (dask_client is None):
-            logger.info("Creating local Dask client for processing the batch of files ...")
-            dask_client = dask_client_create()
-            client_is_local = True
-
-        def _dask_client_close(is_local):
-            # We don't want to close an externally provided client
-            if is_local:
-                logger.info("Closing the local Dask client ...")
-                dask_client.close()
+        # If no external Dask client is provided, then the shared local cluster
+        #   is used to process the whole batch (it is created only once per process)
+        if dask_client is None:
+            dask_client = dask_cluster_manager.get_client()
 
         print("The following files are scheduled for processing:")
         for fln in flist:
@@ -734,16 +819,21 @@ def pyxrf_batch(
                     quant_distance_to_sample=quant_distance_to_sample,
                     quant_ref_eline=quant_ref_eline,
                     use_snip=use_snip,
+                    pixel_bin=pixel_bin,
+                    bin_energy=bin_energy,
                     save_txt=save_txt,
                     save_tiff=save_tiff,
+                    save_stack_formats=save_stack_formats,
                     scaler_name=scaler_name,
                     use_average=use_average,
                     interpolate_to_uniform_grid=interpolate_to_uniform_grid,
                     dask_client=dask_client,
+                    stream_results_to_file=stream_results_to_file,
+                    result_cache=result_cache,
+                    fit_channels_single_pass=fit_channels_single_pass,
                 )
             except Exception as ex:
                 if allow_raising_exceptions:
-                    _dask_client_close(client_is_local)
                     raise Exception from ex
                 else:
                     print(f"ERROR: could not process the file '{fname}'. No results are saved.")
@@ -752,14 +842,145 @@ def pyxrf_batch(
 
         print("\nAll selected files were processed.")
 
-        _dask_client_close(client_is_local)
-
     else:
         print("No files were selected for processing.")
 
     return flist
 
 
+def fit_pixel_data_batch(
+    file_paths,
+    *,
+    param_file_name,
+    incident_energy=None,
+    ignore_datafile_metadata=False,
+    use_snip=True,
+    n_files_in_batch=16,
+    dask_client=None,
+):
+    """
+    Fit summed detector data from multiple files and save the results to the respective files
+    (the results are the same as the results produced by ``fit_pixel_data_and_save`` with
+    the default options). The function is intended for processing of long series of small
+    maps, e.g. XANES scans: the files are processed in batches and the fitting graphs for all
+    files in a batch are submitted to Dask client at once, so the processing is not limited
+    by latency of processing of each file. The parameter file is loaded once and the linear model
+    is computed once for each distinct value of incident energy.
+
+    Parameters
+    ----------
+    file_paths : list(str)
+        list of paths to the data files
+    param_file_name : str
+        full path to the JSON parameter file
+    incident_energy : float, list(float) or None
+        incident energy used for processing of the files. A single value is used for all files,
+        a list must contain one value for each file. The value ``None`` means that the energy
+        from metadata or from the parameter file is used (see ``fit_pixel_data_and_save``).
+    ignore_datafile_metadata : bool
+        tells whether to ignore metadata from the data files (see ``fit_pixel_data_and_save``).
+    use_snip : bool
+        use snip method to remove background
+    n_files_in_batch : int
+        the number of files that are fitted concurrently. The results are saved once
+        the processing of the batch is completed.
+    dask_client : dask.distributed.Client or None
+        Dask client object. If None, then the shared local cluster is used.
+
+    Returns
+    -------
+    list(str)
+        list of paths of the files that were successfully processed
+    """
+    if not isinstance(n_files_in_batch, int) or n_files_in_batch <= 0:
+        raise ValueError(
+            f"Parameter 'n_files_in_batch' must be a positive integer: n_files_in_batch = {n_files_in_batch!r}"
+        )
+
+    if not isinstance(incident_energy, (list, tuple)):
+        incident_energy = [incident_energy] * len(file_paths)
+    if len(incident_energy) != len(file_paths):
+        raise ValueError(
+            f"The number of values of incident energy ({len(incident_energy)}) is not equal "
+            f"to the number of files ({len(file_paths)})"
+        )
+
+    with open(param_file_name, "r") as json_data:
+        param_json = json.load(json_data)
+
+    if dask_client is None:
+        dask_client = dask_cluster_manager.get_client()
+
+    # Linear models are cached for each pair (incident_energy, num_energy_bins)
+    models = {}
+
+    def load_file(fpath, energy):
+        working_directory, file_name = os.path.split(fpath)
+        _, data_sets, mdata = read_hdf_APS(
+            working_directory, file_name, load_each_channel=False, load_fit_results=False, load_roi_results=False
+        )
+        prefix_fname = file_name.split(".")[0]
+        try:
+            data = data_sets[prefix_fname + "_sum"].raw_data
+        except KeyError:
+            data = data_sets[prefix_fname].raw_data
+
+        param = copy.deepcopy(param_json)
+        energy = _set_incident_energy(
+            param,
+            incident_energy=energy,
+            mdata=mdata,
+            ignore_datafile_metadata=ignore_datafile_metadata,
+            file_name=file_name,
+            param_path=param_file_name,
+        )
+
+        key = (energy, data.shape[2])
+        if key not in models:
+            models[key] = _build_linear_model(param, num_energy_bins=data.shape[2])
+        param, data_sel_indices, matv, e_select, elist_non_activated = models[key]
+        # Make matrix smaller for single pixel fitting (same as in 'single_pixel_fitting_controller')
+        matv = matv / (data.shape[0] * data.shape[1])
+        return data, param, data_sel_indices, matv, e_select, elist_non_activated
+
+    files_processed = []
+    for n_start in range(0, len(file_paths), n_files_in_batch):
+        batch = list(zip(file_paths, incident_energy))[n_start : n_start + n_files_in_batch]
+
+        files_loaded, file_params = [], []
+        for fpath, energy in batch:
+            print(f"Processing file '{fpath}' ...")
+            try:
+                file_params.append(load_file(fpath, energy))
+                files_loaded.append(fpath)
+            except Exception as ex:
+                logger.error(f"Could not load the file '{fpath}'. No results are saved. Exception: {ex}")
+        if not file_params:
+            continue
+
+        try:
+            results = fit_xrf_map_batch(
+                [(_[0], _[2], _[3], _get_snip_param(_[1])) for _ in file_params],
+                use_snip=use_snip,
+                progress_bar=TerminalProgressBar("NNLS fitting"),
+                client=dask_client,
+            )
+        except Exception as ex:
+            logger.error(f"Failed to fit the batch of files {files_loaded}. No results are saved. Exception: {ex}")
+            continue
+
+        # The data files are closed at this point, so the results can be saved
+        for fpath, (_, param, _, matv, e_select, elist_non_activated), result in zip(
+            files_loaded, file_params, results
+        ):
+            result_map = calculate_area(e_select, matv, result, param, first_peak_area=False)
+            result_map.add_maps([_ for _ in elist_non_activated if _ not in result_map])
+            save_fitdata_to_hdf(fpath, result_map, datapath="xrfmap/detsum")
+            files_processed.append(fpath)
+
+    return files_processed
+
+
 def fit_each_pixel_with_nnls(data, params, elemental_lines=None, incident_energy=None, weights=None):
     """
     Fit a spectrum with a linear model.
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import ast
+import concurrent.futures
 import copy
+import functools
 import glob
 import json
 import logging
@@ -14,27 +16,28 @@ from collections.abc import Iterable
 from distutils.version import LooseVersion
 
 import h5py
-import matplotlib.animation as animation
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import requests
 import skimage.io as sio
+import tifffile
 from atom.api import Atom, Bool, Dict, Enum, Float, Int, List, Str, Typed, observe
 from PIL import Image
 
 import pyxrf
 
+from ..core.map_cube import MapCube
 from ..core.map_processing import (
     RawHDF5Dataset,
     TerminalProgressBar,
+    TotalSpectrumIndex,
     compute_total_spectrum_and_count,
-    dask_client_create,
+    dask_cluster_manager,
     prepare_xrf_map,
 )
-from ..core.utils import grid_interpolate, normalize_data_by_scaler
+from ..core.utils import GridInterpolator
 from .load_data_from_db import (
-    db,
+    _get_db,
     fetch_data_from_db,
     fetch_run_info,
     flip_data,
@@ -233,7 +236,7 @@ class FileIOModel(Atom):
         bool
             True - Databroker is available, False otherwise.
         """
-        return db is not None
+        return _get_db() is not None
 
     def _metadata_update_program_state(self):
         """
@@ -488,7 +491,7 @@ class FileIOModel(Atom):
         self.file_channel_list = []
         self.clear()
 
-        if db is None:
+        if _get_db() is None:
             raise RuntimeError("Databroker is not installed. The scan cannot be loaded.")
 
         s = f"ID {run_id_uid}" if isinstance(run_id_uid, int) else f"UID '{run_id_uid}'"
@@ -661,8 +664,8 @@ class FileIOModel(Atom):
         # Select raw data to for single pixel fitting.
         self.data_all = self.data_sets[self.selected_file_name].raw_data
 
-        # Create Dask client to speed up processing of multiple datasets
-        client = dask_client_create()
+        # Use the shared Dask client to speed up processing of multiple datasets
+        client = dask_cluster_manager.get_client()
         # Run computations with the new selection and mask
         #    ... for the dataset selected for processing
         self.data, self.data_total_count = self.data_sets[self.selected_file_name].get_total_spectrum_and_count(
@@ -672,7 +675,6 @@ class FileIOModel(Atom):
         for key in self.data_sets.keys():
             if (key != self.selected_file_name) and self.data_sets[key].selected_for_preview:
                 self.data_sets[key].update_buffers(client=client)
-        client.close()
 
 
 plot_as = ["Sum", "Point", "Roi"]
@@ -735,6 +737,8 @@ class DataSelection(Atom):
     fit_data = Typed(np.ndarray)
 
     _cached_spectrum = Dict()
+    # Partial sums used to recompute the total spectrum when the selection or the mask is changed
+    _spectrum_index = Typed(object)
 
     def get_total_spectrum(self, *, client=None):
         total_spectrum, _ = self._get_sum(client=client)
@@ -764,6 +768,11 @@ class DataSelection(Atom):
         total_count = self.get_total_count()
         return total_count.min(), total_count.max()
 
+    @observe(str("raw_data"))
+    def _reset_cached_data(self, change):
+        self._cached_spectrum = {}
+        self._spectrum_index = None
+
     @observe(str("selected_for_preview"))
     def _update_roi(self, change):
         if self.selected_for_preview:
@@ -912,8 +921,14 @@ class DataSelection(Atom):
                 f"Dataset '{self.filename}': computing the total spectrum and total count map from raw data ..."
             )
 
+            if self._spectrum_index is None:
+                # The whole map is processed only once
+                self._spectrum_index = TotalSpectrumIndex(
+                    self.raw_data, progress_bar=TerminalProgressBar("Computing total spectrum: "), client=client
+                )
+
             SC = SpectrumCalculator(pt_start=pt_start, pt_end=pt_end, mask=mask)
-            spec, count = SC.get_spectrum(self.raw_data, client=client)
+            spec, count = SC.get_spectrum(self.raw_data, client=client, spectrum_index=self._spectrum_index)
 
             # Save cache the computed spectrum (with all settings)
             self._cached_spectrum["pt_start"] = pt_start.copy() if pt_start is not None else None
@@ -988,7 +1003,7 @@ class SpectrumCalculator(object):
                 mask = None
         self.mask = mask
 
-    def get_spectrum(self, data, *, client=None):
+    def get_spectrum(self, data, *, client=None, spectrum_index=None):
         """
         Run computation of the total spectrum and total count. Use the selected
         spatial ROI and/or mask
@@ -999,6 +1014,9 @@ class SpectrumCalculator(object):
             raw data array, shape (n_rows, n_cols, n_energy_bins)
         client: dask.distributed.Client or None
             Dask client. If None, then local client will be created
+        spectrum_index: TotalSpectrumIndex or None
+            index of partial sums computed for `data`. If the index is specified, then only
+            the blocks of data affected by the selection and the mask are processed.
         """
         selection = None
         if self._pt_start:
@@ -1015,15 +1033,18 @@ class SpectrumCalculator(object):
                 selection = (self._pt_start[0], self._pt_start[1], 1, 1)
 
         progress_bar = TerminalProgressBar("Computing total spectrum: ")
-        total_spectrum, total_count = compute_total_spectrum_and_count(
-            data,
-            selection=selection,
-            mask=self.mask,
-            chunk_pixels=5000,
-            n_chunks_min=4,
-            progress_bar=progress_bar,
-            client=client,
-        )
+        if spectrum_index is not None:
+            total_spectrum, total_count = spectrum_index.get_spectrum_and_count(
+                selection=selection, mask=self.mask, progress_bar=progress_bar, client=client
+            )
+        else:
+            total_spectrum, total_count = compute_total_spectrum_and_count(
+                data,
+                selection=selection,
+                mask=self.mask,
+                progress_bar=progress_bar,
+                client=client,
+            )
 
         return total_spectrum, total_count
 
@@ -1091,7 +1112,7 @@ def read_data_from_hdf5(fpath, *, representation="numpy_array", load_each_channe
             data[f"det{n}"] = data_sets[k]
     # Represent datasets as dask or numpy arrays
     for k in data:
-        data_dask, _ = prepare_xrf_map(data[k].raw_data)
+        data_dask, _ = prepare_xrf_map(data[k].raw_data, shared_memory=False)
         if representation == "numpy_array":
             data[k] = data_dask[:, :, :].compute()
         else:
@@ -1190,7 +1211,8 @@ def output_data(
     output_dir : str
         which folder to save those txt file
     file_format : str, optional
-        tiff or txt
+        tiff or txt (each map is saved in a separate file), tiff_stack, npz or h5 (all maps are
+        saved in a single file, see ``output_data_to_tiff``)
     scaler_name : str, optional
         if given, normalization will be performed.
     use_average : Bool, optional
@@ -1262,15 +1284,17 @@ def output_data(
     if interpolate_to_uniform_grid:
         if ("x_pos" in fit_output) and ("y_pos" in fit_output):
             logger.info("Data is INTERPOLATED to uniform grid.")
+            # The triangulation is computed once and reused for all maps
+            interpolator = GridInterpolator(fit_output["x_pos"], fit_output["y_pos"])
             for k, v in fit_output.items():
                 # Do not interpolation positions
                 if "pos" in k:
                     continue
 
-                fit_output[k], xx, yy = grid_interpolate(v, fit_output["x_pos"], fit_output["y_pos"])
+                fit_output[k] = interpolator.interpolate(v)
 
-            fit_output["x_pos"] = xx
-            fit_output["y_pos"] = yy
+            fit_output["x_pos"] = interpolator.xx_uniform
+            fit_output["y_pos"] = interpolator.yy_uniform
         else:
             logger.error(
                 "Positional data 'x_pos' and 'y_pos' is not found in the dataset.\n"
@@ -1293,6 +1317,42 @@ def output_data(
     )
 
 
+def _savetxt(fname, data):
+    """
+    Save 2D array to text file. The output is identical to the output of ``np.savetxt(fname, data)``,
+    but the whole array is formatted with a single operation instead of formatting each row separately.
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        # 1D array is saved as a column (the same as 'np.savetxt')
+        data = np.expand_dims(data, axis=1)
+    elif data.ndim != 2:
+        raise ValueError(f"Only 1D or 2D arrays may be saved to text files: data.shape = {data.shape}")
+    n_rows, n_cols = data.shape
+    fmt_row = " ".join(["%.18e"] * n_cols) + "\n"
+    with open(fname, "w") as f:
+        f.write((fmt_row * n_rows) % tuple(data.ravel().tolist()))
+
+
+def _save_map_stack(fname, data, *, names, file_format):
+    """
+    Save the stack of maps (3D array, shape ``(n_maps, ny, nx)``) and the list of map names
+    to a single file. Supported formats: ``tiff_stack`` (multipage TIFF, the names are saved
+    in the image description), ``npz`` (arrays ``data`` and ``names``) and ``h5``
+    (datasets ``maps`` and ``map_names``, may be loaded using ``MapCube.from_hdf5``).
+    """
+    if file_format == "tiff_stack":
+        tifffile.imwrite(fname, data, metadata={"names": names})
+    elif file_format == "npz":
+        np.savez(fname, data=data, names=np.array(names))
+    elif file_format == "h5":
+        with h5py.File(fname, "w") as f:
+            f.create_dataset("maps", data=data, chunks=(1, *data.shape[1:]) if data.size else None)
+            f.create_dataset("map_names", data=[_.encode() for _ in names])
+    else:
+        raise ValueError(f"Function is called with invalid file format '{file_format}'.")
+
+
 def output_data_to_tiff(
     fit_output,
     output_dir=None,
@@ -1305,6 +1365,7 @@ def output_data_to_tiff(
     quant_ref_eline="",
     param_quant_analysis=None,
     use_average=False,
+    n_threads=None,
 ):
     """
     Read data in memory and save them into tiff to txt.
@@ -1316,7 +1377,9 @@ def output_data_to_tiff(
     output_dir : str, optional
         which folder to save those txt file
     file_format : str, optional
-        tiff or txt
+        tiff or txt - each map is saved to a separate file; tiff_stack (multipage TIFF), npz or h5 -
+        all maps are saved to a single file together with the list of map names. Raw, normalized
+        and quantitatively normalized maps are saved to separate files.
     name_prefix_detector : str
         prefix appended to file name except for the files that contain positional data and scalers
     name_append: str, optional
@@ -1337,6 +1400,9 @@ def output_data_to_tiff(
     use_average : Bool, optional
         when normalization, multiply by the mean value of scaler,
         i.e., norm_data = data/scaler * np.mean(scaler)
+    n_threads : int or None, optional
+        the number of threads used to write the files. If None, then the number is selected
+        automatically.
     """
 
     if output_dir is None:
@@ -1350,58 +1416,27 @@ def output_data_to_tiff(
 
     file_format = file_format.lower()
 
-    allowed_formats = ("txt", "tiff")
+    allowed_formats = ("txt", "tiff", "tiff_stack", "npz", "h5")
     if file_format not in allowed_formats:
         raise RuntimeError(f"The specified format '{file_format}' not in {allowed_formats}")
 
+    if scaler_name_list is None:
+        scaler_name_list = []
+
     # Create the output directory if it does not exist
     os.makedirs(output_dir, exist_ok=True)
 
-    def _save_data(
-        data, *, output_dir, file_name, name_prefix_detector, name_append, file_format, scaler_name_list
-    ):
-        # The 'file_format' is specified as file extension
-        file_extension = file_format.lower()
-
-        # If data is scalar or position, then don't attach the prefix
-        fname = (
-            f"{name_prefix_detector}_{file_name}"
-            if (file_name not in scaler_name_list) and ("pos" not in file_name)
-            else file_name
-        )
-
-        fname = f"{fname}{name_append}.{file_extension}"
-        fname = os.path.join(output_dir, fname)
-        if file_format.lower() == "tiff":
-            sio.imsave(fname, data.astype(np.float32))
-        elif file_format.lower() == "txt":
-            np.savetxt(fname, data.astype(np.float32))
-        else:
-            raise ValueError(f"Function is called with invalid file format '{file_format}'.")
+    # The list of sets of maps: (dictionary of maps, string appended to file names)
+    map_sets = []
 
     if quant_norm:
         if param_quant_analysis:
-            for data_name, data in fit_output.items():
-                # Quantitative normalization
-                data_normalized, quant_norm_applied = param_quant_analysis.apply_quantitative_normalization(
-                    data_in=data,
-                    scaler_dict=fit_output,
-                    scaler_name_default=None,  # We don't want data to be scaled
-                    data_name=data_name,
-                    ref_name=quant_ref_eline,
-                    name_not_scalable=None,
-                )  # For simplicity, all saved maps are normalized
-                if quant_norm_applied:
-                    # Save data only if quantitative normalization was performed.
-                    _save_data(
-                        data_normalized,
-                        output_dir=output_dir,
-                        file_name=data_name,
-                        name_prefix_detector=name_prefix_detector,
-                        name_append=f"{name_append}_quantitative",
-                        file_format=file_format,
-                        scaler_name_list=scaler_name_list,
-                    )
+            # Quantitative normalization is applied to all maps at once. The dictionary contains
+            #   only the maps for which quantitative normalization was performed.
+            maps_quant = param_quant_analysis.apply_quantitative_normalization_to_maps(
+                fit_output, scaler_dict=fit_output, ref_name=quant_ref_eline
+            )
+            map_sets.append((maps_quant, f"{name_append}_quantitative"))
         else:
             logger.error(
                 "Quantitative analysis parameters are not provided. "
@@ -1412,23 +1447,27 @@ def output_data_to_tiff(
     if scaler_name is not None:
         if scaler_name in fit_output:
             scaler_data = fit_output[scaler_name]
-            for data_name, data in fit_output.items():
-                if "pos" in data_name or "r2" in data_name:
-                    continue
-                # Normalization of data
-                data_normalized = normalize_data_by_scaler(data, scaler_data)
-                if use_average is True:
-                    data_normalized *= np.mean(scaler_data)
-
-                _save_data(
-                    data_normalized,
-                    output_dir=output_dir,
-                    file_name=data_name,
-                    name_prefix_detector=name_prefix_detector,
-                    name_append=f"{name_append}_norm",
-                    file_format=file_format,
-                    scaler_name_list=scaler_name_list,
+            data_names = [_ for _ in fit_output.keys() if "pos" not in _ and "r2" not in _]
+            # The maps that have the same shape as the scaler are normalized all at once
+            names_scalable = [_ for _ in data_names if np.shape(fit_output[_]) == np.shape(scaler_data)]
+            maps_normalized = (
+                MapCube.from_dict({_: fit_output[_] for _ in names_scalable}).normalize_by_scaler(
+                    scaler_data, use_average=use_average
                 )
+                if names_scalable
+                else {}
+            )
+            maps_norm = {}
+            for data_name in data_names:
+                if data_name in maps_normalized:
+                    maps_norm[data_name] = maps_normalized[data_name]
+                else:
+                    # Normalization by scaler is not applicable
+                    data_normalized = fit_output[data_name]
+                    if use_average is True:
+                        data_normalized = data_normalized * np.mean(scaler_data)
+                    maps_norm[data_name] = data_normalized
+            map_sets.append((maps_norm, f"{name_append}_norm"))
         else:
             logger.warning(
                 f"The scaler '{scaler_name}' was not found. Data normalization "
@@ -1436,16 +1475,50 @@ def output_data_to_tiff(
             )
 
     # Always save not normalized data
-    for data_name, data in fit_output.items():
-        _save_data(
-            data,
-            output_dir=output_dir,
-            file_name=data_name,
-            name_prefix_detector=name_prefix_detector,
-            name_append=name_append,
-            file_format=file_format,
-            scaler_name_list=scaler_name_list,
-        )
+    map_sets.append((fit_output, name_append))
+
+    def _save_map(fname, data):
+        if file_format == "tiff":
+            sio.imsave(fname, data.astype(np.float32))
+        else:
+            _savetxt(fname, data.astype(np.float32))
+
+    if file_format in ("txt", "tiff"):
+        # Each map is saved in a separate file
+        jobs = []
+        for maps, set_name_append in map_sets:
+            for data_name, data in maps.items():
+                # If data is scalar or position, then don't attach the prefix
+                fname = (
+                    f"{name_prefix_detector}_{data_name}"
+                    if (data_name not in scaler_name_list) and ("pos" not in data_name)
+                    else data_name
+                )
+                fname = os.path.join(output_dir, f"{fname}{set_name_append}.{file_format}")
+                jobs.append((_save_map, fname, data))
+    else:
+        # All maps from the set are saved in a single file. Only the maps that have the same
+        #   shape as the most of the maps can be stacked.
+        file_extension = "tiff" if file_format == "tiff_stack" else file_format
+        jobs = []
+        for maps, set_name_append in map_sets:
+            if not maps:
+                continue
+            shapes = [np.shape(_) for _ in maps.values()]
+            map_shape = max(set(shapes), key=shapes.count)
+            names = [_ for _, shape in zip(maps.keys(), shapes) if shape == map_shape]
+            names_skipped = [_ for _ in maps.keys() if _ not in names]
+            if names_skipped:
+                logger.warning(f"The following maps have different shape and are not saved: {names_skipped}")
+            data = np.asarray([maps[_] for _ in names], dtype=np.float32)
+            fname = os.path.join(output_dir, f"{name_prefix_detector}_maps{set_name_append}.{file_extension}")
+            jobs.append((functools.partial(_save_map_stack, names=names, file_format=file_format), fname, data))
+
+    # Formatting and writing of the files is performed in parallel threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = [executor.submit(func, fname, data) for func, fname, data in jobs]
+        for fut in futures:
+            fut.result()
 
 
 def read_hdf_APS(
@@ -1498,13 +1571,14 @@ def read_hdf_APS(
 
     file_path = os.path.join(working_directory, file_name)
 
-    # defined in other_list in config file
-    try:
-        dict_sc = retrieve_data_from_hdf_suitcase(file_path)
-    except Exception:
-        dict_sc = {}
+    # The file is opened only for reading, so it may be read by other processes concurrently
+    with h5py.File(file_path, "r") as f:
+        # defined in other_list in config file
+        try:
+            dict_sc = _retrieve_data_from_hdf_suitcase(f)
+        except Exception:
+            dict_sc = {}
 
-    with h5py.File(file_path, "r+") as f:
         # Retrieve metadata if it exists
         if "xrfmap/scan_metadata" in f:  # Metadata is always loaded
             metadata = f["xrfmap/scan_metadata"]
@@ -1536,24 +1610,27 @@ def read_hdf_APS(
                 print("No data is loaded for detector sum.")
 
         if "scalers" in data:  # Scalers are always loaded if data is available
-            det_name = data["scalers/name"]
+            det_name = data["scalers/name"][()]
+            # Read all scalers at once. Scaler maps are contiguous views of the array.
+            scaler_val = np.ascontiguousarray(np.moveaxis(data["scalers/val"][()], 2, 0))
             temp = {}
             for i, n in enumerate(det_name):
                 if not isinstance(n, str):
                     n = n.decode()
-                temp[n] = data["scalers/val"][:, :, i]
+                temp[n] = scaler_val[i]
             img_dict[f"{fname}_scaler"] = temp
             # also dump other data from suitcase if required
             if len(dict_sc) != 0:
                 img_dict[f"{fname}_scaler"].update(dict_sc)
 
         if "positions" in data:  # Positions are always loaded if data is available
-            pos_name = data["positions/name"]
+            pos_name = data["positions/name"][()]
+            pos_val = data["positions/pos"][()]
             temp = {}
             for i, n in enumerate(pos_name):
                 if not isinstance(n, str):
                     n = n.decode()
-                temp[n] = data["positions/pos"][i, :]
+                temp[n] = pos_val[i]
             img_dict["positions"] = temp
 
         # TODO: rewrite the algorithm for finding the detector channels (not robust)
@@ -1761,44 +1838,51 @@ def retrieve_data_from_hdf_suitcase(fpath):
     Retrieve data from suitcase part in hdf file.
     Data name is defined in config file.
     """
+    with h5py.File(fpath, "r") as f:
+        return _retrieve_data_from_hdf_suitcase(f)
+
+
+def _retrieve_data_from_hdf_suitcase(f):
+    """
+    Retrieve data from suitcase part of the open hdf file ``f``.
+    """
     data_dict = {}
-    with h5py.File(fpath, "r+") as f:
-        other_data_list = [v for v in f.keys() if v != "xrfmap"]
-        if len(other_data_list) > 0:
-            f_hdr = f[other_data_list[0]].attrs["start"]
-            if not isinstance(f_hdr, str):
-                f_hdr = f_hdr.decode("utf-8")
-            start_doc = ast.literal_eval(f_hdr)
-            other_data = f[other_data_list[0] + "/primary/data"]
-
-            if start_doc["beamline_id"] == "HXN":
-                current_dir = os.path.dirname(os.path.realpath(__file__))
-                config_file = "hxn_pv_config.json"
-                config_path = sep_v.join(current_dir.split(sep_v)[:-2] + ["configs", config_file])
-                with open(config_path, "r") as json_data:
-                    config_data = json.load(json_data)
-                extra_list = config_data["other_list"]
-                fly_type = start_doc.get("fly_type", None)
-                subscan_dims = start_doc.get("subscan_dims", None)
-
-                if "dimensions" in start_doc:
-                    datashape = start_doc["dimensions"]
-                elif "shape" in start_doc:
-                    datashape = start_doc["shape"]
-                else:
-                    logger.error("No dimension/shape is defined in hdr.start.")
-
-                datashape = [datashape[1], datashape[0]]  # vertical first, then horizontal
-                for k in extra_list:
-                    # k = k.encode('utf-8')
-                    if k not in other_data.keys():
-                        continue
-                    _v = np.array(other_data[k])
-                    v = _v.reshape(datashape)
-                    if fly_type in ("pyramid",):
-                        # flip position the same as data flip on det counts
-                        v = flip_data(v, subscan_dims=subscan_dims)
-                    data_dict[k] = v
+    other_data_list = [v for v in f.keys() if v != "xrfmap"]
+    if len(other_data_list) > 0:
+        f_hdr = f[other_data_list[0]].attrs["start"]
+        if not isinstance(f_hdr, str):
+            f_hdr = f_hdr.decode("utf-8")
+        start_doc = ast.literal_eval(f_hdr)
+        other_data = f[other_data_list[0] + "/primary/data"]
+
+        if start_doc["beamline_id"] == "HXN":
+            current_dir = os.path.dirname(os.path.realpath(__file__))
+            config_file = "hxn_pv_config.json"
+            config_path = sep_v.join(current_dir.split(sep_v)[:-2] + ["configs", config_file])
+            with open(config_path, "r") as json_data:
+                config_data = json.load(json_data)
+            extra_list = config_data["other_list"]
+            fly_type = start_doc.get("fly_type", None)
+            subscan_dims = start_doc.get("subscan_dims", None)
+
+            if "dimensions" in start_doc:
+                datashape = start_doc["dimensions"]
+            elif "shape" in start_doc:
+                datashape = start_doc["shape"]
+            else:
+                logger.error("No dimension/shape is defined in hdr.start.")
+
+            datashape = [datashape[1], datashape[0]]  # vertical first, then horizontal
+            for k in extra_list:
+                # k = k.encode('utf-8')
+                if k not in other_data.keys():
+                    continue
+                _v = np.array(other_data[k])
+                v = _v.reshape(datashape)
+                if fly_type in ("pyramid",):
+                    # flip position the same as data flip on det counts
+                    v = flip_data(v, subscan_dims=subscan_dims)
+                data_dict[k] = v
     return data_dict
 
 
@@ -1819,7 +1903,7 @@ def read_MAPS(working_directory, file_name, channel_num=1):
     file_path = os.path.join(working_directory, file_name)
     print("file path is {}".format(file_path))
 
-    with h5py.File(file_path, "r+") as f:
+    with h5py.File(file_path, "r") as f:
         data = f["MAPS"]
         fname = file_name.split(".")[0]
 
@@ -1908,13 +1992,13 @@ def get_fit_data(namelist, data):
         list of str for element lines
     data : array
         3D array of fitting results
+
+    Returns
+    -------
+    MapCube
+        dictionary of maps, the maps are views of the array ``data`` (no data is copied)
     """
-    data_temp = dict()
-    for i, v in enumerate(namelist):
-        if not isinstance(v, str):
-            v = v.decode()
-        data_temp.update({v: data[i, :, :]})
-    return data_temp
+    return MapCube(namelist, data)
 
 
 def read_hdf_to_stitch(working_directory, filelist, shape, ignore_file=None):
@@ -2096,7 +2180,7 @@ def save_fitdata_to_hdf(
     ----------
     fpath : str
         path of the hdf5 file
-    data_dict : dict
+    data_dict : dict or MapCube
         dict of array
     datapath : str
         path inside h5py file
@@ -2111,21 +2195,76 @@ def save_fitdata_to_hdf(
     except ValueError:
         dataGrp = f[datapath]
 
-    data = []
-    namelist = []
-    for k, v in data_dict.items():
-        if not isinstance(k, str):
-            k = k.decode()
-        namelist.append(k)
-        data.append(v)
+    # The maps are written with a single write operation. 'MapCube' already holds the maps in one array.
+    if not isinstance(data_dict, MapCube):
+        data_dict = MapCube(data_dict.keys(), np.asarray(list(data_dict.values())))
+    data, namelist = data_dict.data, data_dict.names
 
     if data_saveas in dataGrp:
         del dataGrp[data_saveas]
 
-    data = np.asarray(data)
     ds_data = dataGrp.create_dataset(data_saveas, data=data)
     ds_data.attrs["comments"] = " "
 
+    _save_fitdata_names(dataGrp, namelist, dataname_saveas)
+
+    f.close()
+
+
+def save_fitdata_names_to_hdf(fpath, namelist, datapath="xrfmap/detsum", dataname_saveas="xrf_fit_name"):
+    """
+    Save the list of names of fitted maps to existing h5 file. The function is used
+    if the maps are written to the file directly by the processing code.
+
+    Parameters
+    ----------
+    fpath : str
+        path of the hdf5 file
+    namelist : list(str)
+        list of names of the maps
+    datapath : str
+        path inside h5py file
+    dataname_saveas : str, optional
+        name of the dataset in hdf file
+    """
+    with h5py.File(fpath, "a") as f:
+        dataGrp = f.require_group(datapath)
+        _save_fitdata_names(dataGrp, namelist, dataname_saveas)
+
+
+def save_scalers_and_positions_to_hdf(fpath, scaler_dict, positions_dict, datapath="xrfmap"):
+    """
+    Save scalers and positional data to existing h5 file using the same layout as in
+    the group ``xrfmap`` (datasets ``scalers/name``, ``scalers/val``, ``positions/name``
+    and ``positions/pos``). The function is used to save scalers and positions that match
+    the shape of binned maps saved to a separate group. The existing datasets are replaced.
+
+    Parameters
+    ----------
+    fpath : str
+        path of the hdf5 file
+    scaler_dict : dict(str, ndarray)
+        scaler maps, all maps must have the same shape. Not saved if empty.
+    positions_dict : dict(str, ndarray)
+        positional data (e.g. ``x_pos`` and ``y_pos``). Not saved if empty.
+    datapath : str
+        path inside h5py file
+    """
+    with h5py.File(fpath, "a") as f:
+        dataGrp = f.require_group(datapath)
+        for grp_name, ds_name, d, axis in (
+            ("scalers", "val", scaler_dict, 2),
+            ("positions", "pos", positions_dict, 0),
+        ):
+            if grp_name in dataGrp:
+                del dataGrp[grp_name]
+            if d:
+                grp = dataGrp.create_group(grp_name)
+                grp.create_dataset("name", data=helper_encode_list(list(d.keys())))
+                grp.create_dataset(ds_name, data=np.stack(list(d.values()), axis=axis))
+
+
+def _save_fitdata_names(dataGrp, namelist, dataname_saveas):
     if dataname_saveas in dataGrp:
         del dataGrp[dataname_saveas]
 
@@ -2135,8 +2274,6 @@ def save_fitdata_to_hdf(
     name_data = dataGrp.create_dataset(dataname_saveas, data=namelist)
     name_data.attrs["comments"] = " "
 
-    f.close()
-
 
 def export_to_view(fpath, output_name=None, output_folder="", namelist=None):
     """
@@ -2359,6 +2496,9 @@ def create_movie(
     fps : int, optional
         frame per second
     """
+    import matplotlib.animation as animation
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.set_aspect("equal")
     ax.get_xaxis().set_visible(False)
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import copy
+import json
 import logging
 import math
 import multiprocessing
@@ -8,6 +9,8 @@ import multiprocessing.pool
 import os
 import platform
 import re
+import tempfile
+import threading
 import time
 from collections import OrderedDict
 from distutils.version import LooseVersion
@@ -15,17 +18,15 @@ from distutils.version import LooseVersion
 import dask.array as da
 import h5py
 import lmfit
-import matplotlib.animation as animation
-import matplotlib.pyplot as plt
 import numpy as np
 from atom.api import Atom, Bool, Dict, Float, Int, List, Str, Typed, observe
+from skbeam import __version__ as skbeam_version
 from skbeam.core.fitting.xrf_model import (  # sum_area,; ParamController,; linear_spectrum_fitting,
     K_LINE,
     L_LINE,
     M_LINE,
     TRANSITIONS_LOOKUP,
     ModelSpectrum,
-    construct_linear_model,
     nnls_fit,
     register_strategy,
     set_parameter_bound,
@@ -33,10 +34,29 @@ from skbeam.core.fitting.xrf_model import (  # sum_area,; ParamController,; line
 )
 from skbeam.fluorescence import XrfElement as Element
 
+from ..core.block_cache import BlockResultCache
 from ..core.fitting import rfactor
-from ..core.map_processing import TerminalProgressBar, fit_xrf_map, prepare_xrf_map, snip_method_numba
+from ..core.map_cube import MapCube
+from ..core.map_processing import (
+    RawHDF5Dataset,
+    TerminalProgressBar,
+    _copy_hdf5_dataset,
+    _fit_xrf_block,
+    bin_map,
+    bin_xrf_map,
+    fit_xrf_map,
+    fit_xrf_map_channels,
+    prepare_xrf_map,
+    snip_method_numba,
+)
 from ..core.quant_analysis import ParamQuantEstimation
-from .fileio import output_data, save_fitdata_to_hdf
+from ..core.xrf_utils import _get_eline_cs, _get_eline_table
+from .fileio import (
+    output_data,
+    save_fitdata_names_to_hdf,
+    save_fitdata_to_hdf,
+    save_scalers_and_positions_to_hdf,
+)
 from .parameters import calculate_profile, define_range, fit_strategy_list, trim_escape_peak
 
 logger = logging.getLogger(__name__)
@@ -722,6 +742,8 @@ class Fit1D(Atom):
                     self.param_model.param_new,
                     output_folder,
                     use_snip=use_snip,
+                    pixel_bin=calculation_info["pixel_bin"],
+                    bin_energy=calculation_info["bin_energy"],
                 )
 
             # the output movie are saved as the same name
@@ -755,12 +777,16 @@ class Fit1D(Atom):
         """
         Save fitted 2D map of elements into hdf file after fitting is done. User
         can choose to interpolate the image based on x,y position or not.
+        The maps of binned data are saved to the group ``xrfmap/bin<N>`` together with
+        binned scalers and positions (see `fit_pixel_data_and_save`). They are not added
+        to the datasets displayed in GUI, which contain full-resolution scalers and positions.
 
         Parameters
         ----------
         pixel_fit : str
             If nonlinear is chosen, more information needs to be saved.
         """
+        pixel_bin = calculation_info["pixel_bin"] if calculation_info else 1
 
         prefix_fname = os.path.basename(self.hdf_path).split(".")[0]
         if len(prefix_fname) == 0:
@@ -778,16 +804,33 @@ class Fit1D(Atom):
         if srch:
             det_name = srch.group(0)
             fit_name = f"{prefix_fname}_{det_name}_fit"
-        inner_path = f"xrfmap/{det_name}"
+        # The maps of binned data have different shape, so they are saved to a separate group
+        fit_group = f"xrfmap/bin{pixel_bin}" if pixel_bin > 1 else "xrfmap"
+        inner_path = f"{fit_group}/{det_name}"
 
-        # Update GUI so that results can be seen immediately
-        self.fit_img[fit_name] = self.result_map
+        if pixel_bin == 1:
+            # Update GUI so that results can be seen immediately
+            self.fit_img[fit_name] = self.result_map
+        else:
+            logger.info(f"The maps of binned data are not displayed. The maps are saved to '{inner_path}'.")
 
         if not os.path.isfile(self.hdf_path):
             raise IOError(f"File '{self.hdf_path}' does not exist. Data is not saved to HDF5 file.")
 
         save_fitdata_to_hdf(self.hdf_path, self.result_map, datapath=inner_path)
 
+        if pixel_bin > 1:
+            img_dict = self.io_model.img_dict
+            scaler_dsets = [_ for _ in img_dict.keys() if re.search(r"_scaler$", _)]
+            scaler_dict = img_dict[scaler_dsets[0]] if scaler_dsets else {}
+            positions_dict = img_dict.get("positions", {})
+            save_scalers_and_positions_to_hdf(
+                self.hdf_path,
+                {k: bin_map(v, pixel_bin=pixel_bin) for k, v in scaler_dict.items()},
+                {k: bin_map(v, pixel_bin=pixel_bin, average=True) for k, v in positions_dict.items()},
+                datapath=fit_group,
+            )
+
         # output error
         if pixel_fit == "nonlinear":
             error_map = calculation_info["error_map"]
@@ -1109,27 +1152,20 @@ def bin_data_pixel(data, nearest_n=4):
     nearest_n : int, optional
         define how many pixels to be considered.
     """
+    data = np.asarray(data)
     new_data = np.array(data)
-    d_shape = data.shape
-
-    # if nearest_n == 4:
-    #     for i in [-1, 1]:
-    #         new_data[1:-1, 1:-1, :] += data[1+i:d_shape[0]-1+i, 1:d_shape[1]-1, :]
-    #     for j in [-1, 1]:
-    #         new_data[1:-1, 1:-1, :] += data[1:d_shape[0]-1, 1+j:d_shape[1]-1+j, :]
 
     if nearest_n == 4:
-        for i in np.arange(d_shape[0] - 1):
-            for j in np.arange(d_shape[1] - 1):
-                new_data[i, j, :] += new_data[i + 1, j, :] + new_data[i, j + 1, :] + new_data[i + 1, j + 1, :]
-        new_data[:-1, :-1, :] /= nearest_n
+        # Each pixel (except the last row and column) is averaged with its neighbors on the right and below
+        new_data[:-1, :-1, :] = (data[:-1, :-1, :] + data[1:, :-1, :] + data[:-1, 1:, :] + data[1:, 1:, :]) / 4
 
     if nearest_n == 9:
-        for i in [-1, 0, 1]:
-            for j in [-1, 0, 1]:
-                new_data[1:-1, 1:-1, :] += data[1 + i : d_shape[0] - 1 + i, 1 + j : d_shape[1] - 1 + j, :]
-
-        new_data[1:-1, 1:-1, :] /= nearest_n
+        # Each pixel (except the edges) is averaged with its 8 neighbors
+        ny, nx = data.shape[0:2]
+        new_data[1:-1, 1:-1, :] = (
+            sum([data[1 + i : ny - 1 + i, 1 + j : nx - 1 + j, :] for i in (-1, 0, 1) for j in (-1, 0, 1)])
+            + data[1:-1, 1:-1, :]
+        ) / nearest_n
 
     return new_data
 
@@ -1137,6 +1173,8 @@ def bin_data_pixel(data, nearest_n=4):
 def bin_data_spacial(data, bin_size=4):
     """
     Bin 2D/3D data based on first and second dim, i.e., 2 by 2 window, or 4 by 4.
+    The values in each window are summed. The rows and columns that do not fit
+    into whole windows are discarded.
 
     Parameters
     ----------
@@ -1149,31 +1187,20 @@ def bin_data_spacial(data, bin_size=4):
         return data
 
     data = np.asarray(data)
-    if data.ndim == 2:
-        d_shape = np.array([data.shape[0], data.shape[1]]) / bin_size
-
-        data_new = np.zeros([d_shape[0], d_shape[1]])
-        for i in np.arange(d_shape[0]):
-            for j in np.arange(d_shape[1]):
-                data_new[i, j] = np.sum(
-                    data[i * bin_size : i * bin_size + bin_size, j * bin_size : j * bin_size + bin_size]
-                )
-    elif data.ndim == 3:
-        d_shape = np.array([data.shape[0], data.shape[1]]) / bin_size
-
-        data_new = np.zeros([d_shape[0], d_shape[1], data.shape[2]])
-        for i in np.arange(d_shape[0]):
-            for j in np.arange(d_shape[1]):
-                data_new[i, j, :] = np.sum(
-                    data[i * bin_size : i * bin_size + bin_size, j * bin_size : j * bin_size + bin_size, :],
-                    axis=(0, 1),
-                )
-    return data_new
+    if data.ndim not in (2, 3):
+        raise ValueError(f"Only 2D and 3D arrays can be binned: data.shape = {data.shape}")
+
+    ny, nx = data.shape[0] // bin_size, data.shape[1] // bin_size
+    data = data[: ny * bin_size, : nx * bin_size]
+    return np.sum(np.reshape(data, (ny, bin_size, nx, bin_size) + data.shape[2:]), axis=(1, 3))
 
 
 def conv_expdata_energy(data, width=2):
     """
     Do convolution on the 3rd axis, energy axis.
+    The result is the same as applying ``np.convolve(spectrum, [1 / width] * width, mode="same")``
+    to the spectrum in each pixel.
+
     Paremeters
     ----------
     data : 3D array
@@ -1185,16 +1212,14 @@ def conv_expdata_energy(data, width=2):
     array :
         after convolution
     """
-    data_new = np.array(data)
-    if width == 2:
-        conv_f = [1.0 / 2, 1.0 / 2]
-    if width == 3:
-        conv_f = [1.0 / 3, 1.0 / 3, 1.0 / 3]
-    for i in np.arange(data.shape[0]):
-        for j in np.arange(data.shape[1]):
-            data_new[i, j, :] = np.convolve(data_new[i, j, :], conv_f, mode="same")
-
-    return data_new
+    data = np.asarray(data, dtype=float)
+    n_pts = data.shape[2]
+    # Moving sum computed using cumulative sum of the spectra padded with zeros
+    data_padded = np.pad(data, ((0, 0), (0, 0), (width, width - 1)))
+    cumsum = np.cumsum(data_padded, axis=2)
+    data_full = (cumsum[:, :, width:] - cumsum[:, :, :-width]) / width
+    n_start = (width - 1) // 2
+    return data_full[:, :, n_start : n_start + n_pts]
 
 
 def bin_data_energy2D(data, bin_step=2, axis_v=0, sum_data=False):
@@ -1221,34 +1246,15 @@ def bin_data_energy2D(data, bin_step=2, axis_v=0, sum_data=False):
         return data
 
     data = np.array(data)
-    if axis_v == 0:
-        if bin_step == 2:
-            new_len = data.shape[0] / bin_step
-            m1 = data[::2, :]
-            m2 = data[1::2, :]
-            if sum_data is True:
-                return (m1[:new_len, :] + m2[:new_len, :]) / bin_step
-            else:
-                return m1[:new_len, :]
-        elif bin_step == 3:
-            new_len = data.shape[0] / bin_step
-            m1 = data[::3, :]
-            m2 = data[1::3, :]
-            m3 = data[2::3, :]
-            if sum_data is True:
-                return (m1[:new_len, :] + m2[:new_len, :] + m3[:new_len, :]) / bin_step
-            else:
-                return m1[:new_len, :]
-        elif bin_step == 4:
-            new_len = data.shape[0] / bin_step
-            m1 = data[::4, :]
-            m2 = data[1::4, :]
-            m3 = data[2::4, :]
-            m4 = data[3::4, :]
-            if sum_data is True:
-                return (m1[:new_len, :] + m2[:new_len, :] + m3[:new_len, :] + m4[:new_len, :]) / bin_step
-            else:
-                return m1[:new_len, :]
+    if axis_v != 0:
+        raise ValueError(f"Binning is supported only along axis 0: axis_v = {axis_v}")
+
+    new_len = data.shape[0] // bin_step
+    if sum_data is True:
+        data = data[: new_len * bin_step]
+        return np.sum(np.reshape(data, (new_len, bin_step) + data.shape[1:]), axis=1) / bin_step
+    else:
+        return data[: new_len * bin_step : bin_step]
 
 
 def bin_data_energy3D(data, bin_step=2, sum_data=False):
@@ -1338,8 +1344,8 @@ def calculate_area(e_select, matv, results, param, first_peak_area=False):
 
     Returns
     -------
-    dict :
-        dict of each 2D elemental distribution
+    MapCube :
+        dict of each 2D elemental distribution (the maps are views of a single 3D array)
     """
     total_list = e_select + ["snip_bkg", "r_factor", "sel_cnt", "total_cnt"]
     mat_sum = np.sum(matv, axis=0)
@@ -1352,95 +1358,123 @@ def calculate_area(e_select, matv, results, param, first_peak_area=False):
             f"since some of the generated XRF maps may be invalid."
         )
 
-    result_map = dict()
-    for i, eline in enumerate(total_list):
-        if i < len(e_select):
-            # We are processing the component due to emission line (and may be
-            #   additional constant spectrum representing background)
-            if first_peak_area is not True:
-                result_map.update({total_list[i]: results[:, :, i] * mat_sum[i]})
-            else:
-                if total_list[i] not in K_LINE + L_LINE + M_LINE:
-                    ratio_v = 1
-                else:
-                    ratio_v = get_branching_ratio(total_list[i], param["coherent_sct_energy"]["value"])
-                result_map.update({total_list[i]: results[:, :, i] * mat_sum[i] * ratio_v})
-        else:
-            # We are just copying additional computed data
-            result_map.update({eline: results[:, :, i]})
+    # Scaling coefficients for each map: the weights of emission lines (and possibly additional
+    #   constant spectrum representing background) are converted to areas, additional computed
+    #   data is copied without change
+    n_maps = min(len(total_list), results.shape[2])
+    scale = np.ones(shape=n_maps)
+    for i, eline in enumerate(e_select[:n_maps]):
+        ratio_v = 1
+        if first_peak_area and (eline in K_LINE + L_LINE + M_LINE):
+            ratio_v = get_branching_ratio(eline, param["coherent_sct_energy"]["value"])
+        scale[i] = mat_sum[i] * ratio_v
 
-    return result_map
+    # All maps are scaled at once and placed in a single contiguous array
+    data = np.moveaxis(results[:, :, :n_maps], 2, 0) * scale[:, np.newaxis, np.newaxis]
+    return MapCube(total_list[:n_maps], data)
 
 
 def save_fitted_fig(
-    x_v, matv, results, p1, p2, data_all, data_sel_indices, param_dict, result_folder, use_snip=False
+    x_v,
+    matv,
+    results,
+    p1,
+    p2,
+    data_all,
+    data_sel_indices,
+    param_dict,
+    result_folder,
+    use_snip=False,
+    pixel_bin=1,
+    bin_energy=1,
 ):
     """
     Save single pixel fitting results to figs.
     `data_all` can be numpy array, Dask array or RawHDF5Dataset.
+    If the data was binned before fitting (`pixel_bin` or `bin_energy` > 1), then `data_all`
+    is the original (not binned) map, `p1` and `p2` are the pixel coordinates in the original map,
+    and `param_dict` contains the energy calibration of the original spectra. `results` and
+    `data_sel_indices` refer to the binned data.
     """
+    import matplotlib.pyplot as plt
+
+    pixel_bin, bin_energy = max(int(pixel_bin), 1), max(int(bin_energy), 1)
+    if (pixel_bin > 1) or (bin_energy > 1):
+        # The selected area of the binned map contains all binned pixels overlapping the selection
+        p1 = [_ // pixel_bin for _ in p1]
+        p2 = [min(-(-p // pixel_bin), n) for p, n in zip(p2, results.shape[0:2])]
+        param_dict = _bin_energy_calibration(param_dict, bin_energy)
+
     logger.info(f"Saving plots of the fitted data to file. Selection: {tuple(p1)} .. {tuple(p2)}")
 
     # Convert the 'data_all', which can be numpy array, Dask array or
     #   RawHDF5Dataset into Dask array, so that it could be treated uniformly
-    data_all_dask, file_obj = prepare_xrf_map(data_all)
+    if (pixel_bin > 1) or (bin_energy > 1):
+        data_all_dask, file_obj = bin_xrf_map(
+            data_all, pixel_bin=pixel_bin, bin_energy=bin_energy, shared_memory=False
+        )
+    else:
+        data_all_dask, file_obj = prepare_xrf_map(data_all, shared_memory=False)
     # Selection (indices of the processed interval) of `data_all` along axis 2
     d_start, d_stop = data_sel_indices
-    # 'file_obj' must remain alive until the function exits
-
-    low_limit_v = 0.5
-
-    fig, ax = plt.subplots(nrows=1, ncols=1)
-    ax.set_xlabel("Energy [keV]")
-    ax.set_ylabel("Counts")
-    max_v = da.max(data_all_dask[p1[0] : p2[0], p1[1] : p2[1], d_start:d_stop]).compute()
-
-    fitted_sum = None
-    for m in range(p1[0], p2[0]):
-        for n in range(p1[1], p2[1]):
-            data_y = data_all_dask[m, n, d_start:d_stop].compute()
-
-            fitted_y = np.sum(matv * results[m, n, :], axis=1)
-            if use_snip is True:
-                bg = snip_method_numba(
-                    data_y,
-                    param_dict["e_offset"]["value"],
-                    param_dict["e_linear"]["value"],
-                    param_dict["e_quadratic"]["value"],
-                    width=param_dict["non_fitting_values"]["background_width"],
-                )
-                fitted_y += bg
-
-            if fitted_sum is None:
-                fitted_sum = fitted_y
-            else:
-                fitted_sum += fitted_y
-            ax.cla()
-            ax.set_title("Single pixel fitting for point ({}, {})".format(m, n))
-            ax.set_xlabel("Energy [keV]")
-            ax.set_ylabel("Counts")
-            ax.set_ylim(low_limit_v, max_v * 2)
-
-            ax.semilogy(x_v, data_y, label="exp", linestyle="", marker=".")
-            ax.semilogy(x_v, fitted_y, label="fit")
-
-            ax.legend()
-            output_path = os.path.join(result_folder, "data_out_" + str(m) + "_" + str(n) + ".png")
-            plt.savefig(output_path)
-
-    ax.cla()
-    sum_y = da.sum(data_all_dask[p1[0] : p2[0], p1[1] : p2[1], d_start:d_stop], axis=(0, 1)).compute()
-    ax.set_title("Summed spectrum from point ({},{}) to ({},{})".format(p1[0], p1[1], p2[0], p2[1]))
-    ax.set_xlabel("Energy [keV]")
-    ax.set_ylabel("Counts")
-    ax.set_ylim(low_limit_v, np.max(sum_y) * 2)
-    ax.semilogy(x_v, sum_y, label="exp", linestyle="", marker=".")
-    ax.semilogy(x_v, fitted_sum, label="fit", color="red")
-
-    ax.legend()
-    fit_sum_name = "pixel_sum_" + str(p1[0]) + "-" + str(p1[1]) + "_" + str(p2[0]) + "-" + str(p2[1]) + ".png"
-    output_path = os.path.join(result_folder, fit_sum_name)
-    plt.savefig(output_path)
+    # 'file_obj' must remain open until the plots are saved
+    try:
+        low_limit_v = 0.5
+
+        fig, ax = plt.subplots(nrows=1, ncols=1)
+        ax.set_xlabel("Energy [keV]")
+        ax.set_ylabel("Counts")
+        max_v = da.max(data_all_dask[p1[0] : p2[0], p1[1] : p2[1], d_start:d_stop]).compute()
+
+        fitted_sum = None
+        for m in range(p1[0], p2[0]):
+            for n in range(p1[1], p2[1]):
+                data_y = data_all_dask[m, n, d_start:d_stop].compute()
+
+                fitted_y = np.sum(matv * results[m, n, :], axis=1)
+                if use_snip is True:
+                    bg = snip_method_numba(
+                        data_y,
+                        param_dict["e_offset"]["value"],
+                        param_dict["e_linear"]["value"],
+                        param_dict["e_quadratic"]["value"],
+                        width=param_dict["non_fitting_values"]["background_width"],
+                    )
+                    fitted_y += bg
+
+                if fitted_sum is None:
+                    fitted_sum = fitted_y
+                else:
+                    fitted_sum += fitted_y
+                ax.cla()
+                ax.set_title("Single pixel fitting for point ({}, {})".format(m, n))
+                ax.set_xlabel("Energy [keV]")
+                ax.set_ylabel("Counts")
+                ax.set_ylim(low_limit_v, max_v * 2)
+
+                ax.semilogy(x_v, data_y, label="exp", linestyle="", marker=".")
+                ax.semilogy(x_v, fitted_y, label="fit")
+
+                ax.legend()
+                output_path = os.path.join(result_folder, "data_out_" + str(m) + "_" + str(n) + ".png")
+                plt.savefig(output_path)
+
+        ax.cla()
+        sum_y = da.sum(data_all_dask[p1[0] : p2[0], p1[1] : p2[1], d_start:d_stop], axis=(0, 1)).compute()
+        ax.set_title("Summed spectrum from point ({},{}) to ({},{})".format(p1[0], p1[1], p2[0], p2[1]))
+        ax.set_xlabel("Energy [keV]")
+        ax.set_ylabel("Counts")
+        ax.set_ylim(low_limit_v, np.max(sum_y) * 2)
+        ax.semilogy(x_v, sum_y, label="exp", linestyle="", marker=".")
+        ax.semilogy(x_v, fitted_sum, label="fit", color="red")
+
+        ax.legend()
+        fit_sum_name = "pixel_sum_" + str(p1[0]) + "-" + str(p1[1]) + "_" + str(p2[0]) + "-" + str(p2[1]) + ".png"
+        output_path = os.path.join(result_folder, fit_sum_name)
+        plt.savefig(output_path)
+    finally:
+        if file_obj:
+            file_obj.close()
 
     logger.info(f"Fitted data is saved to the directory '{result_folder}'")
 
@@ -1451,6 +1485,9 @@ def save_fitted_as_movie(
     """
     Create movie to save single pixel fitting resutls.
     """
+    import matplotlib.animation as animation
+    import matplotlib.pyplot as plt
+
     total_n = data_all.shape[1] * p2[0]
 
     fig, ax = plt.subplots(nrows=1, ncols=1)
@@ -1772,61 +1809,191 @@ def get_area_and_error_nonlinear_fit(elist, fit_results, reg_mat):
     return area_dict, error_dict, weights_mat
 
 
-def single_pixel_fitting_controller(
-    input_data,
+# The maximum number of columns of linear models kept in memory
+_LINEAR_MODEL_CACHE_SIZE = 512
+# The columns computed by different versions of scikit-beam are not reused
+_LINEAR_MODEL_VERSION = f"linear_model:scikit-beam-{skbeam_version}"
+
+
+class _LinearModelColumnCache:
+    """
+    In-memory LRU cache of the columns of linear models (see `_construct_linear_model`).
+    The cached arrays are read-only. The cache is shared by all threads of the process.
+    """
+
+    def __init__(self, max_entries=_LINEAR_MODEL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            column = self._entries.get(key, None)
+            if column is not None:
+                self._entries.move_to_end(key)
+        return column
+
+    def put(self, key, column):
+        column = np.array(column)
+        column.flags.writeable = False
+        with self._lock:
+            self._entries[key] = column
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_linear_model_cache = _LinearModelColumnCache()
+
+
+def _eline_ratio_signature(elemental_line, incident_energy):
+    """
+    Returns the values that determine the dependence of the spectrum of the emission line on
+    the incident energy: branching ratios of the lines of K, L or M family (rounded to 12 significant
+    digits) or empty tuple for user and pileup peaks, which do not depend on the incident energy.
+    Returns `None` if the line is not activated at the incident energy.
+    """
+    if (elemental_line not in K_LINE) and (elemental_line not in L_LINE) and (elemental_line not in M_LINE):
+        return ()
+    element, family = elemental_line.split("_")
+    family = family.lower()
+    table = _get_eline_table()
+    cs = _get_eline_cs(table.element_index[element], float(incident_energy))
+    cs_ref = cs[table.line_index[f"{family}a1"]]
+    if cs_ref == 0:
+        return None
+    return tuple(float(f"{cs[n] / cs_ref:.12g}") for n, name in enumerate(table.line_names) if family in name)
+
+
+def _construct_linear_model(n_bin, param, elist, *, result_cache=None):
+    """
+    Same as `construct_linear_model` from scikit-beam with the default area, but the columns of
+    the model are cached. The spectra of the emission lines depend on the incident energy only
+    through the branching ratios, which remain constant (e.g. for K lines) once the line is
+    activated, so the cached spectra are reused when the XRF maps acquired at different incident
+    energies (e.g. XANES scans) are fitted. The Compton and elastic peaks are recomputed
+    for each incident energy.
+
+    Parameters
+    ----------
+    n_bin: ndarray
+        indices of the energy bins used for fitting
+    param: dict
+        fitting parameters
+    elist: list(str)
+        the list of emission lines, user and pileup peaks
+    result_cache: BlockResultCache or None
+        on-disk cache, where the computed columns are saved in addition to the in-memory cache.
+        The columns are reused by other processes (e.g. repeated batch processing).
+
+    Returns
+    -------
+    e_select: list(str)
+        the names of activated lines followed by `compton` and `elastic`
+    matv: ndarray
+        matrix for linear fitting, the columns correspond to `e_select`
+    """
+    incident_energy = param["coherent_sct_energy"]["value"]
+    param_elines = {k: v for k, v in param.items() if k != "coherent_sct_energy"}
+    n_bin_range = (int(n_bin[0]), int(n_bin[-1]), len(n_bin))
+    digest_elines = BlockResultCache.params_digest(_LINEAR_MODEL_VERSION, param_elines, n_bin_range)
+    digest_scatter = BlockResultCache.params_digest(_LINEAR_MODEL_VERSION, param, n_bin_range)
+
+    model_spectrum = None
+
+    def _get_column(key, model_name):
+        nonlocal model_spectrum
+        column = _linear_model_cache.get(key)
+        if column is None and result_cache is not None:
+            column = result_cache.get(key)
+            if column is not None:
+                _linear_model_cache.put(key, column)
+        if column is None:
+            if model_spectrum is None:
+                model_spectrum = ModelSpectrum(param, elist)
+            if model_name in ("compton", "elastic"):
+                model = getattr(model_spectrum, model_name)
+            else:
+                model = model_spectrum.setup_element_model(model_name, default_area=100)
+            # Empty array represents the line that is not activated
+            column = model.eval(x=n_bin, params=model.make_params()) if model else np.zeros(0)
+            _linear_model_cache.put(key, column)
+            if result_cache is not None:
+                result_cache.put(key, column)
+        return column
+
+    e_select, columns = [], []
+    for eline in elist:
+        signature = _eline_ratio_signature(eline, incident_energy)
+        if signature is None:
+            continue
+        column = _get_column(BlockResultCache.params_digest(digest_elines, eline, signature), eline)
+        if column.size:
+            e_select.append(eline)
+            columns.append(column)
+
+    for name in ("compton", "elastic"):
+        e_select.append(name)
+        columns.append(_get_column(BlockResultCache.params_digest(digest_scatter, name), name))
+
+    return e_select, np.stack(columns, axis=1)
+
+
+def _build_linear_model(
     parameter,
+    *,
+    num_energy_bins,
     incident_energy=None,
-    method="nnls",
-    pixel_bin=0,
-    raise_bg=0,
     comp_elastic_combine=False,
     linear_bg=False,
-    use_snip=True,
-    bin_energy=1,
-    dask_client=None,
+    result_cache=None,
 ):
     """
+    Build the linear model (the matrix of spectra of the selected emission lines) used for
+    fitting of XRF spectra pixel by pixel.
+
     Parameters
     ----------
-    input_data: array
-        3D array of spectrum
     parameter: dict
-        parameter for fitting
-    incident_energy: float, optional
-        incident beam energy in KeV
-    method: str, optional
-        fitting method, default as nnls
-    pixel_bin: int, optional
-        bin pixel as 2by2, or 3by3
-    raise_bg: int, optional
-        add a constant value to each spectrum, better for fitting
-    comp_elastic_combine: bool, optional
+        fitting parameters
+    num_energy_bins: int
+        the number of energy bins in the experimental spectra
+    incident_energy: float or None
+        incident beam energy in keV. The value from `parameter` is used if `None`.
+    comp_elastic_combine: bool
         combine elastic and compton as one component for fitting
-    linear_bg: bool, optional
-        use linear background instead of snip
-    use_snip: bool, optional
-        use snip method to remove background
-    bin_energy: int, optional
-        bin spectrum with given value
-    dask_client: dask.distributed.Client
-        Dask client object. If None, then Dask client is created automatically.
-        If a batch of files is processed, then creating Dask client and
-        passing the reference to it to the processing functions will save
-        execution time: `client = Client(processes=True, silence_logs=logging.ERROR)`
+    linear_bg: bool
+        add constant background component to the model
+    result_cache: BlockResultCache or None
+        on-disk cache for the columns of the model. The columns are always cached in memory
+        (see `_construct_linear_model`).
 
     Returns
     -------
-    result_map : dict
-        of elemental map for given elements
-    calculation_info : dict
-        dict of fitting information
+    param: dict
+        copy of the fitting parameters with the updated incident energy
+    data_sel_indices: tuple(int)
+        tuple `(n_bin_low, n_bin_high)` - the range of energy bins used for fitting
+    matv: ndarray
+        matrix of spectra of the selected components, shape `(n_bin_high - n_bin_low, n_components)`
+    e_select: list(str)
+        names of the components in the order of the columns of `matv`
+    elist_non_activated: list(str)
+        emission lines from the element list, which are not activated at the incident energy
     """
     param = copy.deepcopy(parameter)
     if incident_energy is not None:
         param["coherent_sct_energy"]["value"] = incident_energy
 
     n_bin_low, n_bin_high = get_energy_bin_range(
-        num_energy_bins=input_data.shape[2],
+        num_energy_bins=num_energy_bins,
         low_e=param["non_fitting_values"]["energy_bound_low"]["value"],
         high_e=param["non_fitting_values"]["energy_bound_high"]["value"],
         e_offset=param["e_offset"]["value"],
@@ -1838,7 +2005,7 @@ def single_pixel_fitting_controller(
     # calculate matrix for regression analysis
     elist = param["non_fitting_values"]["element_list"].split(", ")
     elist = [e.strip(" ") for e in elist]
-    e_select, matv, e_area = construct_linear_model(n_bin, param, elist)
+    e_select, matv = _construct_linear_model(n_bin, param, elist, result_cache=result_cache)
 
     # The initial list of elines may contain lines that are not activated for the incident beam
     #   energy. This always happens for at least one line when batches of XRF scans obtained for
@@ -1871,6 +2038,117 @@ def single_pixel_fitting_controller(
 
     logger.info("Matrix used for linear fitting has components: {}".format(e_select))
 
+    return param, (n_bin_low, n_bin_high), matv, e_select, elist_non_activated
+
+
+def _bin_linear_model(param, data_sel_indices, matv, bin_energy):
+    """
+    Rebin the linear model built by `_build_linear_model` so that it matches the spectra
+    binned along the energy axis (`bin_energy` adjacent bins are summed, see `bin_xrf_map`).
+    The rows of `matv` are summed in the same way as the bins of the spectra, so the binned
+    model is exact. The range of selected bins is reduced to the bins that are completely
+    within the original range.
+
+    Parameters
+    ----------
+    param: dict
+        fitting parameters returned by `_build_linear_model`
+    data_sel_indices: tuple(int)
+        tuple `(n_bin_low, n_bin_high)` - the range of (original) energy bins used for fitting
+    matv: ndarray
+        matrix of spectra of the selected components, shape `(n_bin_high - n_bin_low, n_components)`
+    bin_energy: int
+        the number of binned energy bins
+
+    Returns
+    -------
+    param: dict
+        copy of the fitting parameters with energy axis calibration (`e_offset`, `e_linear` and
+        `e_quadratic`) computed for the binned spectra
+    data_sel_indices: tuple(int)
+        the range of binned energy bins used for fitting
+    matv: ndarray
+        binned matrix of spectra of the selected components
+    """
+    n_bin_low, n_bin_high = data_sel_indices
+    n_low, n_high = -(-n_bin_low // bin_energy), n_bin_high // bin_energy
+    if n_high <= n_low:
+        raise ValueError(
+            f"The range of energy bins {data_sel_indices} is too small for binning: bin_energy = {bin_energy}"
+        )
+
+    rows = matv[n_low * bin_energy - n_bin_low : n_high * bin_energy - n_bin_low, :]
+    matv = np.sum(np.reshape(rows, (n_high - n_low, bin_energy, rows.shape[1])), axis=1)
+
+    return _bin_energy_calibration(param, bin_energy), (n_low, n_high), matv
+
+
+def _bin_energy_calibration(param, bin_energy):
+    """
+    Returns the copy of fitting parameters with energy axis calibration (`e_offset`, `e_linear`
+    and `e_quadratic`) computed for the spectra binned along the energy axis (see `bin_xrf_map`).
+    """
+    # The binned bin 'k' is centered at the original bin 'k * bin_energy + (bin_energy - 1) / 2'
+    param = copy.deepcopy(param)
+    a0, a1, a2 = [param[_]["value"] for _ in ("e_offset", "e_linear", "e_quadratic")]
+    c = (bin_energy - 1) / 2
+    param["e_offset"]["value"] = a0 + a1 * c + a2 * c**2
+    param["e_linear"]["value"] = (a1 + 2 * a2 * c) * bin_energy
+    param["e_quadratic"]["value"] = a2 * bin_energy**2
+    return param
+
+
+def _get_snip_param(param):
+    """
+    Returns the dictionary of parameters for background removal using SNIP method
+    (see `_fit_xrf_block`).
+    """
+    return {
+        "e_offset": param["e_offset"]["value"],
+        "e_linear": param["e_linear"]["value"],
+        "e_quadratic": param["e_quadratic"]["value"],
+        "b_width": param["non_fitting_values"]["background_width"],
+    }
+
+
+def _prepare_pixel_fitting(
+    input_data,
+    parameter,
+    *,
+    incident_energy,
+    method,
+    pixel_bin,
+    raise_bg,
+    comp_elastic_combine,
+    linear_bg,
+    bin_energy,
+    dask_client,
+    output_fpath,
+    output_datapath,
+    result_cache,
+):
+    """
+    Build the linear model and prepare the (binned) XRF map for pixel fitting. The parameters
+    are the same as the parameters of `single_pixel_fitting_controller`.
+
+    Returns
+    -------
+    dict
+        parameters of fitting: `param`, `matv`, `e_select`, `elist_non_activated`, `data_sel_indices`,
+        `energy_axis`, `snip_param`, `input_data` (the map passed to `fit_xrf_map`), `raw_data`
+        (the original map before binning), `pixel_bin`, `bin_energy`, `file_obj` (must be closed
+        after fitting), `output` (`RawHDF5Dataset` or `None`), `output_final`
+        (see `_move_pixel_fitting_output`) and `map_names`.
+    """
+    param, (n_bin_low, n_bin_high), matv, e_select, elist_non_activated = _build_linear_model(
+        parameter,
+        num_energy_bins=input_data.shape[2],
+        incident_energy=incident_energy,
+        comp_elastic_combine=comp_elastic_combine,
+        linear_bg=linear_bg,
+        result_cache=result_cache,
+    )
+
     def _log_unsupported_option(option):
         logger.warning(
             f"Option '{option}' is enabled. This option is not supported "
@@ -1884,52 +2162,104 @@ def single_pixel_fitting_controller(
     # if raise_bg > 0:
     #     exp_data += raise_bg
 
-    if pixel_bin > 1:
-        _log_unsupported_option(f"pixel_bin == {pixel_bin}")
-
-    # bin data based on nearest pixels, only two options
-    # if pixel_bin in [4, 9]:
-    #     logger.info('Bin pixel data with parameter: {}'.format(pixel_bin))
-    #     exp_data = bin_data_spacial(exp_data, bin_size=int(np.sqrt(pixel_bin)))
-    #     # exp_data = bin_data_pixel(exp_data, nearest_n=pixel_bin)  # return a copy of data
-
+    # Spatial and energy binning are applied lazily to the data before fitting. The model is binned
+    #   to match the binned spectra. The parameters in 'param_fit' define the energy axis of binned spectra.
+    pixel_bin, bin_energy = max(int(pixel_bin), 1), max(int(bin_energy), 1)
+    param_fit = param
     if bin_energy > 1:
-        _log_unsupported_option(f"pixel_bin == {pixel_bin}")
-    # bin data based on energy spectrum
-    # if bin_energy in [2, 3]:
-    #     exp_data = conv_expdata_energy(exp_data, width=bin_energy)
+        param_fit, (n_bin_low, n_bin_high), matv = _bin_linear_model(
+            param, (n_bin_low, n_bin_high), matv, bin_energy
+        )
+    # Energy axis: the positions of the centers of the (binned) energy bins in original bin units
+    n_bin = np.arange(n_bin_low, n_bin_high) * bin_energy + (bin_energy - 1) / 2
+
+    file_obj, raw_data = None, input_data
+    if (pixel_bin > 1) or (bin_energy > 1):
+        logger.info(f"Binning XRF data: pixels - {pixel_bin}x{pixel_bin}, energy bins - {bin_energy}")
+        input_data, file_obj = bin_xrf_map(
+            input_data, pixel_bin=pixel_bin, bin_energy=bin_energy, client=dask_client
+        )
 
     # make matrix smaller for single pixel fitting
     matv /= input_data.shape[0] * input_data.shape[1]
     # save matrix to analyze collinearity
     # np.save('mat.npy', matv)
-    error_map = None
 
     if method != "nnls":
         logger.warning(f"Fitting using '{method}' is not supported: 'nnls' method will be used instead.")
 
     logger.info("Fitting method: non-negative least squares")
 
-    snip_param = {
-        "e_offset": param["e_offset"]["value"],
-        "e_linear": param["e_linear"]["value"],
-        "e_quadratic": param["e_quadratic"]["value"],
-        "b_width": param["non_fitting_values"]["background_width"],
+    # The names of the maps are in the same order as in the dictionary returned by 'calculate_area'
+    map_names = e_select + ["snip_bkg", "r_factor", "sel_cnt", "total_cnt"] + elist_non_activated
+    output, output_final = None, None
+    if output_fpath is not None:
+        try:
+            output = RawHDF5Dataset(
+                output_fpath, f"{output_datapath}/xrf_fit", shape=(len(map_names), *input_data.shape[0:2])
+            )
+            # Binned data is read from the raw data file, which remains open during fitting, so the file
+            #   can not be opened for writing. The results are saved to a temporary file and copied later.
+            if isinstance(file_obj, h5py.File) and (os.path.abspath(file_obj.filename) == output.abs_path):
+                fd, tmp_path = tempfile.mkstemp(suffix=".h5", dir=os.path.dirname(output.abs_path))
+                os.close(fd)
+                output_final, output = output, RawHDF5Dataset(tmp_path, "xrf_fit", shape=output.shape)
+        except Exception:
+            if file_obj:
+                file_obj.close()
+            raise
+
+    return {
+        "param": param,
+        "matv": matv,
+        "e_select": e_select,
+        "elist_non_activated": elist_non_activated,
+        "data_sel_indices": (n_bin_low, n_bin_high),
+        "energy_axis": n_bin,
+        "snip_param": _get_snip_param(param_fit),
+        "input_data": input_data,
+        "raw_data": raw_data,
+        "pixel_bin": pixel_bin,
+        "bin_energy": bin_energy,
+        "file_obj": file_obj,
+        "output": output,
+        "output_final": output_final,
+        "map_names": map_names,
     }
-    results = fit_xrf_map(
-        data=input_data,
-        data_sel_indices=(n_bin_low, n_bin_high),
-        matv=matv,
-        snip_param=snip_param,
-        use_snip=use_snip,
-        chunk_pixels=5000,
-        n_chunks_min=4,
-        progress_bar=TerminalProgressBar("NNLS fitting"),
-        client=dask_client,
-    )
 
-    # output area of dict
-    result_map = calculate_area(e_select, matv, results, param, first_peak_area=False)
+
+def _move_pixel_fitting_output(job, *, copy_results=True):
+    """
+    Copy the results of fitting from the temporary file to the output file and delete the temporary
+    file if the results were redirected by `_prepare_pixel_fitting`. Must be called after
+    the raw data file (`job["file_obj"]`) is closed. The results are not copied if
+    `copy_results` is `False` (fitting failed).
+    """
+    if job["output_final"] is None:
+        return
+    try:
+        if copy_results:
+            _copy_hdf5_dataset(job["output"], job["output_final"])
+    finally:
+        os.remove(job["output"].abs_path)
+
+
+def _complete_pixel_fitting(job, results, *, output_fpath, output_datapath):
+    """
+    Generate the maps and fitting information from the results returned by `fit_xrf_map`.
+    `job` is the dictionary returned by `_prepare_pixel_fitting`. Returns the tuple
+    `(result_map, calculation_info)` (see `single_pixel_fitting_controller`).
+    """
+    e_select, matv, param = job["e_select"], job["matv"], job["param"]
+    error_map = None
+
+    if job["output"] is not None:
+        # The maps for non-activated lines are filled with zeros when the dataset is created
+        save_fitdata_names_to_hdf(output_fpath, job["map_names"], datapath=output_datapath)
+        result_map = None
+    else:
+        # output area of dict
+        result_map = calculate_area(e_select, matv, results, param, first_peak_area=False)
 
     # Alternative fitting method (nonlinear fit). Very slow and nobody seems to be using it
     # logger.info('Fitting method: nonlinear least squares')
@@ -1941,8 +2271,8 @@ def single_pixel_fitting_controller(
     #                                                                  matv/matrix_norm)
 
     # Generate 'zero' maps for the emission lines that were not activated
-    for eline in elist_non_activated:
-        result_map[eline] = np.zeros(shape=input_data.shape[0:2])
+    if result_map is not None:
+        result_map.add_maps([_ for _ in job["elist_non_activated"] if _ not in result_map])
 
     calculation_info = dict()
     if error_map is not None:
@@ -1951,18 +2281,364 @@ def single_pixel_fitting_controller(
     calculation_info["fit_name"] = e_select
     calculation_info["regression_mat"] = matv
     calculation_info["results"] = results
-    calculation_info["fit_range"] = (n_bin_low, n_bin_high)
-    calculation_info["energy_axis"] = n_bin
+    calculation_info["fit_range"] = job["data_sel_indices"]
+    calculation_info["energy_axis"] = job["energy_axis"]
     # Used to be 'exp_data'(selected data), now it is the full dataset,
     #   which can be ndarray, Dask array or RawHDF5Dataset. In order
     #   to get the selected set, 'input_data' must be sliced along axis2
-    #   using 'fit_range' values.
-    calculation_info["input_data"] = input_data
-    calculation_info["data_sel_indices"] = (n_bin_low, n_bin_high)
+    #   using 'fit_range' values. 'input_data' is the original (not binned) dataset:
+    #   the binned map references the raw data file, which is closed after fitting.
+    #   If binning is enabled ('pixel_bin' or 'bin_energy' > 1), 'fit_range' and
+    #   the maps refer to the binned data (see 'bin_xrf_map').
+    calculation_info["input_data"] = job["raw_data"]
+    calculation_info["data_sel_indices"] = job["data_sel_indices"]
+    calculation_info["pixel_bin"] = job["pixel_bin"]
+    calculation_info["bin_energy"] = job["bin_energy"]
 
     return result_map, calculation_info
 
 
+def single_pixel_fitting_controller(
+    input_data,
+    parameter,
+    incident_energy=None,
+    method="nnls",
+    pixel_bin=0,
+    raise_bg=0,
+    comp_elastic_combine=False,
+    linear_bg=False,
+    use_snip=True,
+    bin_energy=1,
+    dask_client=None,
+    output_fpath=None,
+    output_datapath="xrfmap/detsum",
+    result_cache=None,
+):
+    """
+    Parameters
+    ----------
+    input_data: array
+        3D array of spectrum
+    parameter: dict
+        parameter for fitting
+    incident_energy: float, optional
+        incident beam energy in KeV
+    method: str, optional
+        fitting method, default as nnls
+    pixel_bin: int, optional
+        bin pixels before fitting: 2 - 2x2 pixels, 3 - 3x3 pixels, N - NxN pixels. The counts in
+        the binned pixels are summed. The maps are not binned if the value is 0 or 1.
+    raise_bg: int, optional
+        add a constant value to each spectrum, better for fitting
+    comp_elastic_combine: bool, optional
+        combine elastic and compton as one component for fitting
+    linear_bg: bool, optional
+        use linear background instead of snip
+    use_snip: bool, optional
+        use snip method to remove background
+    bin_energy: int, optional
+        the number of adjacent energy bins summed before fitting. The spectra are not
+        binned if the value is 0 or 1.
+    dask_client: dask.distributed.Client
+        Dask client object. If None, then Dask client is created automatically.
+        If a batch of files is processed, then creating Dask client and
+        passing the reference to it to the processing functions will save
+        execution time: `client = Client(processes=True, silence_logs=logging.ERROR)`
+    output_fpath: str or None
+        path to HDF5 file. If specified, then the results of fitting are written directly
+        to the datasets `xrf_fit` and `xrf_fit_name` in the group `output_datapath` as processing
+        of each block of data is completed. The maps are not assembled in memory.
+    output_datapath: str
+        the group in HDF5 file, where the results are saved if `output_fpath` is specified.
+    result_cache: BlockResultCache or None
+        on-disk cache of fitted blocks of data. The blocks fitted previously with the same
+        data and parameters are loaded from the cache. The cache is not used if `None`.
+
+    Returns
+    -------
+    result_map : dict or None
+        of elemental map for given elements. `None` if the results are saved to file.
+        If pixels are binned, then the maps have the shape of the binned data.
+    calculation_info : dict
+        dict of fitting information
+    """
+    job = _prepare_pixel_fitting(
+        input_data,
+        parameter,
+        incident_energy=incident_energy,
+        method=method,
+        pixel_bin=pixel_bin,
+        raise_bg=raise_bg,
+        comp_elastic_combine=comp_elastic_combine,
+        linear_bg=linear_bg,
+        bin_energy=bin_energy,
+        dask_client=dask_client,
+        output_fpath=output_fpath,
+        output_datapath=output_datapath,
+        result_cache=result_cache,
+    )
+
+    completed = False
+    try:
+        results = fit_xrf_map(
+            data=job["input_data"],
+            data_sel_indices=job["data_sel_indices"],
+            matv=job["matv"],
+            snip_param=job["snip_param"],
+            use_snip=use_snip,
+            progress_bar=TerminalProgressBar("NNLS fitting"),
+            client=dask_client,
+            output=job["output"],
+            cache=result_cache,
+            # Save areas under the spectra of emission lines (same as 'calculate_area')
+            output_weights_scale=np.sum(job["matv"], axis=0),
+        )
+        completed = True
+    finally:
+        if job["file_obj"]:
+            job["file_obj"].close()
+        _move_pixel_fitting_output(job, copy_results=completed)
+
+    return _complete_pixel_fitting(job, results, output_fpath=output_fpath, output_datapath=output_datapath)
+
+
+def multi_channel_fitting_controller(
+    datasets,
+    *,
+    incident_energy=None,
+    method="nnls",
+    pixel_bin=0,
+    raise_bg=0,
+    comp_elastic_combine=False,
+    linear_bg=False,
+    use_snip=True,
+    bin_energy=1,
+    dask_client=None,
+    output_fpath=None,
+    output_datapaths=None,
+    result_cache=None,
+):
+    """
+    Fit several XRF maps of the same size (e.g. the sum and the channels of a multi-channel detector)
+    in a single pass over the data (see `fit_xrf_map_channels`). The raw data of all maps is read and
+    the blocks are scheduled once instead of once per map. The results are the same as the results
+    of calling `single_pixel_fitting_controller` for each map.
+
+    Parameters
+    ----------
+    datasets: list(tuple)
+        list of tuples `(input_data, parameter)`: the XRF map and the fitting parameters
+        (see `single_pixel_fitting_controller`)
+    output_datapaths: list(str) or None
+        the groups in HDF5 file, where the results are saved if `output_fpath` is specified,
+        one group per map, e.g. `["xrfmap/detsum", "xrfmap/det1", "xrfmap/det2"]`.
+    incident_energy, method, pixel_bin, raise_bg, comp_elastic_combine, linear_bg, use_snip,
+    bin_energy, dask_client, output_fpath, result_cache:
+        the parameters are applied to all maps (see `single_pixel_fitting_controller`)
+
+    Returns
+    -------
+    list(tuple)
+        list of tuples `(result_map, calculation_info)` in the order of the maps
+        (see `single_pixel_fitting_controller`)
+    """
+    if output_datapaths is None:
+        if output_fpath is not None:
+            raise ValueError("Parameter 'output_datapaths' must be specified if 'output_fpath' is specified")
+        output_datapaths = [None] * len(datasets)
+    if len(output_datapaths) != len(datasets):
+        raise ValueError(
+            f"The number of output data paths ({len(output_datapaths)}) is not equal to "
+            f"the number of datasets ({len(datasets)})"
+        )
+
+    jobs, completed = [], False
+    try:
+        for (input_data, parameter), output_datapath in zip(datasets, output_datapaths):
+            jobs.append(
+                _prepare_pixel_fitting(
+                    input_data,
+                    parameter,
+                    incident_energy=incident_energy,
+                    method=method,
+                    pixel_bin=pixel_bin,
+                    raise_bg=raise_bg,
+                    comp_elastic_combine=comp_elastic_combine,
+                    linear_bg=linear_bg,
+                    bin_energy=bin_energy,
+                    dask_client=dask_client,
+                    output_fpath=output_fpath,
+                    output_datapath=output_datapath,
+                    result_cache=result_cache,
+                )
+            )
+
+        outputs = [_["output"] for _ in jobs] if output_fpath is not None else None
+        results = fit_xrf_map_channels(
+            [(_["input_data"], _["data_sel_indices"], _["matv"], _["snip_param"]) for _ in jobs],
+            use_snip=use_snip,
+            progress_bar=TerminalProgressBar("NNLS fitting"),
+            client=dask_client,
+            outputs=outputs,
+            # Save areas under the spectra of emission lines (same as 'calculate_area')
+            output_weights_scales=[np.sum(_["matv"], axis=0) for _ in jobs],
+            cache=result_cache,
+        )
+        completed = True
+    finally:
+        for job in jobs:
+            if job["file_obj"]:
+                job["file_obj"].close()
+        for job in jobs:
+            _move_pixel_fitting_output(job, copy_results=completed)
+
+    if results is None:
+        results = [None] * len(jobs)
+    return [
+        _complete_pixel_fitting(job, res, output_fpath=output_fpath, output_datapath=output_datapath)
+        for job, res, output_datapath in zip(jobs, results, output_datapaths)
+    ]
+
+
+class LiveMapFitter:
+    """
+    Fitting of XRF maps row by row as the data is acquired ("processing while acquiring" mode).
+    The linear model is computed once (when the first block of rows is received) and the same
+    model is used to fit all rows of the map. The results are identical to the results produced
+    by ``single_pixel_fitting_controller`` with the same parameters, but partial maps of emission
+    lines become available before the scan is completed.
+
+    The object is passed to the loaders working in streaming mode (see ``make_hdf``, parameter
+    ``live_fitter``). The loaders fit the sum of detector channels in blocks of ``rows_per_block``
+    rows as the rows are written to the file and append the results to the dataset ``xrf_fit``
+    of the output file. While the scan is loaded, the partial maps can be read from the file
+    with the suffix ``_live`` opened in SWMR mode (see ``make_hdf``). The models are computed
+    separately for each number of energy bins, so the same object may be used for multiple detectors.
+
+    Examples
+    --------
+    .. code-block:: python
+
+        live_fitter = LiveMapFitter(param, rows_per_block=4)
+        make_hdf(run_id, stream_to_file=True, live_fitter=live_fitter)
+
+        # Fitting the block of data directly
+        maps = live_fitter.fit_rows(data)  # data.shape = (n_rows, n_cols, n_bins)
+        map_names = live_fitter.get_map_names(data.shape[2])
+
+    Parameters
+    ----------
+    parameter: dict or str
+        fitting parameters or the path to JSON file with fitting parameters
+    incident_energy: float or None
+        incident beam energy in keV. The value from the fitting parameters is used if `None`.
+    use_snip: bool
+        use SNIP method to remove background
+    comp_elastic_combine: bool
+        combine elastic and compton as one component for fitting
+    linear_bg: bool
+        add constant background component to the model
+    rows_per_block: int
+        the number of rows fitted at once by the loaders
+    """
+
+    def __init__(
+        self,
+        parameter,
+        *,
+        incident_energy=None,
+        use_snip=True,
+        comp_elastic_combine=False,
+        linear_bg=False,
+        rows_per_block=1,
+    ):
+        if not isinstance(rows_per_block, int) or rows_per_block < 1:
+            raise ValueError(
+                f"Parameter 'rows_per_block' must be a positive integer: rows_per_block = {rows_per_block!r}"
+            )
+        if isinstance(parameter, str):
+            with open(parameter, "r") as f:
+                parameter = json.load(f)
+        self._parameter = copy.deepcopy(parameter)
+        self.incident_energy = incident_energy
+        self.use_snip = use_snip
+        self.comp_elastic_combine = comp_elastic_combine
+        self.linear_bg = linear_bg
+        self.rows_per_block = rows_per_block
+        self._models = {}  # The number of energy bins: model
+
+    def _get_model(self, num_energy_bins):
+        if num_energy_bins not in self._models:
+            param, data_sel_indices, matv, e_select, elist_non_activated = _build_linear_model(
+                self._parameter,
+                num_energy_bins=num_energy_bins,
+                incident_energy=self.incident_energy,
+                comp_elastic_combine=self.comp_elastic_combine,
+                linear_bg=self.linear_bg,
+            )
+            self._models[num_energy_bins] = {
+                "data_sel_indices": data_sel_indices,
+                "matv": matv,
+                "weights_scale": np.sum(matv, axis=0),
+                "snip_param": _get_snip_param(param),
+                # Same order as in the dictionary returned by 'calculate_area'
+                "map_names": e_select + ["snip_bkg", "r_factor", "sel_cnt", "total_cnt"] + elist_non_activated,
+            }
+        return self._models[num_energy_bins]
+
+    def get_map_names(self, num_energy_bins):
+        """
+        Returns the names of the maps in the order of the maps in the array returned by ``fit_rows``.
+
+        Parameters
+        ----------
+        num_energy_bins: int
+            the number of energy bins in the experimental spectra
+
+        Returns
+        -------
+        list(str)
+            list of map names
+        """
+        return list(self._get_model(num_energy_bins)["map_names"])
+
+    def fit_rows(self, data):
+        """
+        Fit the block of rows of XRF map.
+
+        Parameters
+        ----------
+        data: ndarray
+            block of XRF data, shape `(n_rows, n_cols, n_bins)`
+
+        Returns
+        -------
+        ndarray
+            fitted maps, shape `(n_maps, n_rows, n_cols)`. The names of the maps are
+            returned by ``get_map_names``. The maps for non-activated emission lines are
+            filled with zeros.
+        """
+        data = np.asarray(data)
+        if data.ndim != 3:
+            raise ValueError(f"The block of XRF data must be 3D array: data.shape = {data.shape}")
+        model = self._get_model(data.shape[2])
+
+        results = _fit_xrf_block(
+            data,
+            data_sel_indices=model["data_sel_indices"],
+            matv=model["matv"],
+            snip_param=model["snip_param"],
+            use_snip=self.use_snip,
+        )
+        # Areas under the spectra of emission lines (same as 'calculate_area')
+        weights_scale = model["weights_scale"]
+        results[:, :, : len(weights_scale)] *= weights_scale
+
+        maps = np.zeros(shape=(len(model["map_names"]), *data.shape[0:2]))
+        maps[0 : results.shape[2]] = np.moveaxis(results, 2, 0)
+        return maps
+
+
 def get_energy_bin_range(num_energy_bins, low_e, high_e, e_offset, e_linear):
     """
     Find the bin numbers in the range `0 .. num_energy_bins-1` that correspond
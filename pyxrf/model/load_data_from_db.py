@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import concurrent.futures
 import copy
 import json
 import logging
@@ -9,6 +10,7 @@ import os
 import platform
 import pprint
 import re
+import threading
 import time as ttime
 import warnings
 from distutils.version import LooseVersion
@@ -17,7 +19,6 @@ import dask.array as da
 import h5py
 import numpy as np
 import pandas as pd
-from event_model import Filler
 
 try:
     import databroker
@@ -26,6 +27,7 @@ except ImportError:
 
 import pyxrf
 
+from ..core.map_processing import compute_optimal_chunk_size
 from ..core.utils import convert_time_to_nexus_string
 from .catalog_management import catalog_info, get_catalog
 from .scan_metadata import ScanMetadataXRF
@@ -37,68 +39,103 @@ warnings.filterwarnings("ignore")
 
 sep_v = os.sep
 
-try:
-    logger.info(f"Opening catalog: {catalog_info.name!r}")
-    if not catalog_info.name:
-        # Attempt to find the configuration file first
-        config_path = "/etc/pyxrf/pyxrf.json"
-        if os.path.isfile(config_path):
+# The catalog (Databroker or Tiled) is opened on first use (see '_get_db'), so that importing
+#   the module does not require connection to the database.
+_db = None
+_db_opened = False
+_db_lock = threading.Lock()
+
+
+def _open_db():
+    """
+    Open the catalog for the beamline. The beamline is determined based on the configuration
+    file ``/etc/pyxrf/pyxrf.json`` or the host name. Returns ``None`` if the beamline
+    is not identified or the catalog can not be opened.
+    """
+    db = None
+    try:
+        logger.info(f"Opening catalog: {catalog_info.name!r}")
+        if not catalog_info.name:
+            # Attempt to find the configuration file first
+            config_path = "/etc/pyxrf/pyxrf.json"
+            if os.path.isfile(config_path):
+                try:
+                    with open(config_path, "r") as beamline_pyxrf:
+                        beamline_config_pyxrf = json.load(beamline_pyxrf)
+                        catalog_info.set_name(beamline_config_pyxrf["beamline_name"])
+                except Exception as ex:
+                    raise IOError(f"Error while opening configuration file {config_path!r}") from ex
+
+            else:
+                # Otherwise try to identify the beamline using host name
+                hostname = platform.node()
+                catalog_names = {
+                    "xf03id": "HXN",
+                    "xf05id": "SRX",
+                    "xf08bm": "TES",
+                    "xf04bm": "XFM",
+                }
+
+                for k, v in catalog_names.items():
+                    if hostname.startswith(k):
+                        catalog_info.set_name(v)
+
+        if not catalog_info.name:
+            raise Exception("Beamline is not identified")
+
+        if catalog_info.name.upper() == "HXN":
+            from pyxrf.db_config.hxn_db_config import db
+        elif catalog_info.name.upper() == "SRX":
+            _failed = False
             try:
-                with open(config_path, "r") as beamline_pyxrf:
-                    beamline_config_pyxrf = json.load(beamline_pyxrf)
-                    catalog_info.set_name(beamline_config_pyxrf["beamline_name"])
+                db = get_catalog("srx")
             except Exception as ex:
-                raise IOError(f"Error while opening configuration file {config_path!r}") from ex
-
+                logger.error("Failed to load Tiled catalog: %s", str(ex))
+                _failed = True
+            if _failed:
+                logger.info("Attempting to open databroker ...")
+                from pyxrf.db_config.srx_db_config import db
+        elif catalog_info.name.upper() == "XFM":
+            from pyxrf.db_config.xfm_db_config import db
+        elif catalog_info.name.upper() == "TES":
+            _failed = False
+            try:
+                db = get_catalog("tes")
+            except Exception as ex:
+                logger.error("Failed to load Tiled catalog: %s", str(ex))
+                _failed = True
+            if _failed:
+                logger.info("Attempting to open databroker ...")
+                from pyxrf.db_config.tes_db_config import db
         else:
-            # Otherwise try to identify the beamline using host name
-            hostname = platform.node()
-            catalog_names = {
-                "xf03id": "HXN",
-                "xf05id": "SRX",
-                "xf08bm": "TES",
-                "xf04bm": "XFM",
-            }
+            db = None
+            print(f"Beamline Database is not used in pyxrf: unknown catalog {catalog_info.name!r}")
 
-            for k, v in catalog_names.items():
-                if hostname.startswith(k):
-                    catalog_info.set_name(v)
+    except Exception as ex:
+        db = None
+        print(f"Beamline Database is not used in pyxrf: {ex}")
 
-    if not catalog_info.name:
-        raise Exception("Beamline is not identified")
+    return db
 
-    if catalog_info.name.upper() == "HXN":
-        from pyxrf.db_config.hxn_db_config import db
-    elif catalog_info.name.upper() == "SRX":
-        _failed = False
-        try:
-            db = get_catalog("srx")
-        except Exception as ex:
-            logger.error("Failed to load Tiled catalog: %s", str(ex))
-            _failed = True
-        if _failed:
-            logger.info("Attempting to open databroker ...")
-            from pyxrf.db_config.srx_db_config import db
-    elif catalog_info.name.upper() == "XFM":
-        from pyxrf.db_config.xfm_db_config import db
-    elif catalog_info.name.upper() == "TES":
-        _failed = False
-        try:
-            db = get_catalog("tes")
-        except Exception as ex:
-            logger.error("Failed to load Tiled catalog: %s", str(ex))
-            _failed = True
-        if _failed:
-            logger.info("Attempting to open databroker ...")
-            from pyxrf.db_config.tes_db_config import db
-    else:
-        db = None
-        db_analysis = None
-        print(f"Beamline Database is not used in pyxrf: unknown catalog {catalog_info.name!r}")
 
-except Exception as ex:
-    db = None
-    print(f"Beamline Database is not used in pyxrf: {ex}")
+def _get_db():
+    """
+    Returns the catalog for the beamline or ``None`` if the catalog is not available.
+    The catalog is opened when the function is called for the first time.
+    """
+    global _db, _db_opened
+    with _db_lock:
+        if not _db_opened:
+            _db = _open_db()
+            _db_opened = True
+        return _db
+
+
+def __getattr__(name):
+    # Module attribute 'db' (e.g. 'from pyxrf.model.load_data_from_db import db') opens the catalog
+    if name == "db":
+        return _get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def flip_data(input_data, subscan_dims=None):
@@ -167,7 +204,7 @@ def fetch_run_info(run_id_uid, catalog_name=None):
         if catalog_name:
             catalog = get_catalog(catalog_name)
         else:
-            catalog = db
+            catalog = _get_db()
         hdr = catalog[run_id_uid]
 
         hdr = catalog[run_id_uid]
@@ -195,6 +232,8 @@ def fetch_data_from_db(
     num_end_lines_excluded=None,
     skip_scan_types=None,
     catalog_name=None,
+    stream_to_file=False,
+    live_fitter=None,
 ):
     """
     Read data from databroker.
@@ -243,6 +282,14 @@ def fetch_data_from_db(
     skip_scan_types: list(str) or None
         list of plan type names to ignore, e.g. ['FlyPlan1D']. (Supported only at HXN.)
     catalog_name: str or None
+    stream_to_file : bool, optional
+        write each row of data to the file as it is loaded instead of assembling the map
+        in memory (supported for SRX fly scans, HXN scans except 'pyramid' scans and TES scans
+        loaded using Tiled). The data is not returned in this case (the value of ``"dataset"``
+        key is ``None``).
+    live_fitter : LiveMapFitter or None, optional
+        fit the rows of the map as they are written to the file (streaming mode only).
+        See ``make_hdf`` for details.
 
     Returns
     -------
@@ -251,11 +298,14 @@ def fetch_data_from_db(
     if catalog_name:
         catalog = get_catalog(catalog_name)
     else:
-        catalog = db
+        catalog = _get_db()
     hdr = catalog[run_id_uid]
     beamline_id = hdr.start["beamline_id"]
     print("Loading data from database.")
 
+    if stream_to_file and beamline_id not in ("xf05id", "SRX", "HXN", "TES"):
+        logger.warning(f"Streaming mode is not supported for {beamline_id!r} beamline. Data is loaded in memory.")
+
     if beamline_id == "HXN":
         data = map_data2D_hxn(
             run_id_uid,
@@ -267,6 +317,8 @@ def fetch_data_from_db(
             file_overwrite_existing=file_overwrite_existing,
             output_to_file=output_to_file,
             skip_scan_types=skip_scan_types,
+            stream_to_file=stream_to_file,
+            live_fitter=live_fitter,
         )
     elif beamline_id == "xf05id" or beamline_id == "SRX":
         data = map_data2D_srx(
@@ -281,6 +333,8 @@ def fetch_data_from_db(
             save_scaler=save_scaler,
             num_end_lines_excluded=num_end_lines_excluded,
             catalog=catalog,
+            stream_to_file=stream_to_file,
+            live_fitter=live_fitter,
         )
     elif beamline_id == "XFM":
         data = map_data2D_xfm(
@@ -304,6 +358,8 @@ def fetch_data_from_db(
             file_overwrite_existing=file_overwrite_existing,
             output_to_file=output_to_file,
             catalog=catalog,
+            stream_to_file=stream_to_file,
+            live_fitter=live_fitter,
         )
     else:
         print("Databroker is not setup for this beamline")
@@ -328,6 +384,8 @@ def make_hdf(
     num_end_lines_excluded=None,
     skip_scan_types=None,
     catalog_name=None,
+    stream_to_file=False,
+    live_fitter=None,
 ):
     """
     Load data from database and save it in HDF5 files.
@@ -443,6 +501,28 @@ def make_hdf(
     catalog_name: str or None
         Name of the catalog (e.g. `"srx"`). The function attempts to determine the catalog
         name automatically if the parameter is not specified or `None`.
+    stream_to_file: bool, optional
+        True: write each row of the map to the file as soon as it is loaded instead of
+        assembling the whole map in memory. Significantly reduces peak memory usage for
+        large scans. Currently supported for SRX fly scans (new data format), HXN scans
+        (except 'pyramid' scans) and TES scans loaded using Tiled. Data from other scans
+        is loaded in memory as usual.
+        False: load the whole map in memory before saving it to the file (default).
+    live_fitter: LiveMapFitter or None
+        Reference to the object that is used to fit the rows of the map while the data
+        is loaded ("processing while acquiring" mode). The sum of detector channels is
+        fitted in blocks of rows as the rows are written to the file and the results are
+        appended to the dataset ``xrfmap/detsum/xrf_fit``. While the scan is loaded, the partial
+        maps can be read from the dataset ``xrfmap/detsum/xrf_fit`` of the file with the suffix
+        ``_<detector>_live`` added to the output file name (e.g. ``scan2D_1000_xs_live.h5``)
+        in the output directory. The file must be opened in SWMR mode
+        (``h5py.File(fpath, "r", libver="latest", swmr=True)``) and is deleted once the scan is
+        loaded. Requires ``stream_to_file=True``. The data is not fitted if ``None`` (default).
+
+        .. code-block:: python
+
+            live_fitter = LiveMapFitter("pyxrf_model_parameters.json", rows_per_block=4)
+            make_hdf(run_id, stream_to_file=True, live_fitter=live_fitter)
     """
 
     if wd:
@@ -478,6 +558,8 @@ def make_hdf(
             num_end_lines_excluded=num_end_lines_excluded,
             skip_scan_types=skip_scan_types,
             catalog_name=catalog_name,
+            stream_to_file=stream_to_file,
+            live_fitter=live_fitter,
         )
     else:
         # Both ``start`` and ``end`` are specified. Convert the scans in the range
@@ -502,6 +584,8 @@ def make_hdf(
                     num_end_lines_excluded=num_end_lines_excluded,
                     skip_scan_types=skip_scan_types,
                     catalog_name=catalog_name,
+                    stream_to_file=stream_to_file,
+                    live_fitter=live_fitter,
                 )
                 print(f"Scan #{v}: Conversion completed.\n")
             except Exception as ex:
@@ -517,7 +601,7 @@ def _is_scan_complete(hdr):
 
     hdr : databroker.core.Header
         header of the run
-        hdr = db[scan_id]
+        hdr = _get_db()[scan_id]
         The header must be reloaded each time before the function is called.
 
     Returns
@@ -763,6 +847,8 @@ def map_data2D_hxn(
     file_overwrite_existing=False,
     output_to_file=True,
     skip_scan_types=None,
+    stream_to_file=False,
+    live_fitter=None,
 ):
     """
     Save the data from databroker to hdf file.
@@ -800,8 +886,15 @@ def map_data2D_hxn(
         is raised.
     output_to_file : bool, optional
         save data to hdf5 file if True
+    stream_to_file : bool, optional
+        write each row of the map to the file as soon as it is read instead of assembling
+        the map in memory. The data is not returned in this case (the value of ``"dataset"``
+        key is ``None``). Not supported for 'pyramid' scans (the data is loaded in memory).
+    live_fitter : LiveMapFitter or None, optional
+        fit the rows of the map as they are written to the file (streaming mode only).
+        See ``make_hdf`` for details.
     """
-    hdr = db[run_id_uid]
+    hdr = _get_db()[run_id_uid]
     runid = hdr.start["scan_id"]  # Replace with the true value (runid may be relative, such as -2)
 
     logger.info(f"Loading scan #{runid}")
@@ -998,7 +1091,7 @@ def map_data2D_hxn(
     fields = det_list + scaler_list + pos_list
 
     # Do not use supply 'fields' if Databroker V0 is used
-    if isinstance(db, databroker._core.Broker):
+    if isinstance(_get_db(), databroker._core.Broker):
         fields = None
 
     data = hdr.table(fields=fields, fill=False)  # HXN data is stored in h5 files, load them later in map_data2D.
@@ -1007,46 +1100,114 @@ def map_data2D_hxn(
     if (slow_axis not in data) and (fast_axis in data):
         data[slow_axis] = np.zeros(shape=data[fast_axis].shape)
 
-    data_out = map_data2D(
-        data,
-        datashape,
-        det_list=det_list,
-        pos_list=pos_list,
-        scaler_list=scaler_list,
-        create_each_det=create_each_det,
-        fly_type=fly_type,
-        subscan_dims=subscan_dims,
-        spectrum_len=4096,
-        hdr=hdr,
-    )
+    # Flip the direction of the fast axis for certain angles
+    flip_fast_axis = (theta is not None) and fast_axis.lower().endswith("z") and (theta < 0)
 
-    # Transform coordinates for the fast axis if necessary:
-    #   Flip the direction of the fast axis for certain angles
-    if (theta is not None) and fast_axis.lower().endswith("z") and (theta < 0):
-        logger.info(f"Fast axis: {fast_axis!r}. Angle 'theta': {theta}. Flipping data along the fast axis ...")
-        data_out["pos_data"][fast_axis_index, :, :] = np.fliplr(data_out["pos_data"][fast_axis_index, :, :])
-        data_out["scaler_data"] = np.flip(data_out["scaler_data"], axis=1)
-        data_out["det_sum"] = np.flip(data_out["det_sum"], axis=1)
-        for k in data.keys():
-            if re.search(r"^det[\d]+$", k):  # Individual detectors such as 'det1', 'det2', etc.
-                data_out[k] = np.flip(data_out[k], axis=1)
-    else:
-        logger.info(
-            f"Fast axis: {fast_axis!r}. Angle 'theta': {theta}. Data along the fast axis is not reordered."
+    def transform_fast_axis(data_out):
+        """
+        Transform coordinates for the fast axis if necessary. Flip the maps along the fast axis
+        and correct positions for distortions due to rotation of the stage.
+        """
+        if flip_fast_axis:
+            logger.info(f"Fast axis: {fast_axis!r}. Angle 'theta': {theta}. Flipping data along the fast axis ...")
+            data_out["pos_data"][fast_axis_index, :, :] = np.fliplr(data_out["pos_data"][fast_axis_index, :, :])
+            data_out["scaler_data"] = np.flip(data_out["scaler_data"], axis=1)
+            for k in data_out.keys():
+                # Sum and individual detectors such as 'det1', 'det2', etc.
+                if re.search(r"^det([\d]+|_sum)$", k):
+                    data_out[k] = np.flip(data_out[k], axis=1)
+        else:
+            logger.info(
+                f"Fast axis: {fast_axis!r}. Angle 'theta': {theta}. Data along the fast axis is not reordered."
+            )
+
+        #   Correct positions for distortions due to rotation of the stage
+        if theta is not None:
+            if fast_axis.lower().endswith("x"):
+                logger.info(f"Scaling the positions along fast X-axis ({fast_axis!r}: 'theta'={theta}) ...")
+                data_out["pos_data"][fast_axis_index, :, :] *= np.cos(theta * np.pi / 180.0)
+            elif fast_axis.lower().endswith("z"):
+                logger.info(f"Scaling the positions along fast Z-axis ({fast_axis!r}: 'theta'={theta}) ...")
+                data_out["pos_data"][fast_axis_index, :, :] *= np.sin(theta * np.pi / 180.0)
+            else:
+                logger.info(f"No scaling is applied to the positions along fast axis ({fast_axis!r})")
+
+    # Streaming mode: each row of the map is written to the file as soon as it is read. Flipping
+    #   of the data in 'pyramid' scans requires the whole map, so the data is loaded in memory.
+    stream = stream_to_file and output_to_file and (fly_type not in ("pyramid",))
+    if stream_to_file and not output_to_file:
+        logger.warning("Streaming mode is ignored: the data is not saved to file ('output_to_file=False')")
+    elif stream_to_file and not stream:
+        logger.warning(f"Streaming mode is not supported for {fly_type!r} scans. Data is loaded in memory.")
+    if (live_fitter is not None) and not stream:
+        logger.warning("Live fitting is ignored: the data is not loaded in streaming mode ('stream_to_file=True')")
+
+    if stream:
+        pos_names, pos_data, scaler_names, scaler_data = _get_positions_and_scalers_2D(
+            data,
+            datashape,
+            nv=datashape[0],
+            nh=datashape[1],
+            pos_list=pos_list,
+            scaler_list=scaler_list,
+            hdr=hdr,
         )
+        data_out = {"pos_data": pos_data, "scaler_data": scaler_data}
+        transform_fast_axis(data_out)
 
-    #   Correct positions for distortions due to rotation of the stage
-    if theta is not None:
-        if fast_axis.lower().endswith("x"):
-            logger.info(f"Scaling the positions along fast X-axis ({fast_axis!r}: 'theta'={theta}) ...")
-            data_out["pos_data"][fast_axis_index, :, :] *= np.cos(theta * np.pi / 180.0)
-        elif fast_axis.lower().endswith("z"):
-            logger.info(f"Scaling the positions along fast Z-axis ({fast_axis!r}: 'theta'={theta}) ...")
-            data_out["pos_data"][fast_axis_index, :, :] *= np.sin(theta * np.pi / 180.0)
-        else:
-            logger.info(f"No scaling is applied to the positions along fast axis ({fast_axis!r})")
+        print("Saving data to hdf file.")
+        writer = _HDF5RowWriter(
+            fpath,
+            n_cols=datashape[1],
+            metadata=mdata,
+            fname_add_version=fname_add_version,
+            file_overwrite_existing=file_overwrite_existing,
+            pos_names=pos_names,
+            scaler_names=scaler_names,
+            live_fitter=live_fitter,
+        )
+        try:
+            with writer:
+                n_rows = _write_data2D_rows(
+                    writer,
+                    data,
+                    datashape[1],
+                    det_list=det_list,
+                    pos_data=data_out["pos_data"],
+                    scaler_data=data_out["scaler_data"],
+                    create_each_det=create_each_det,
+                    spectrum_len=4096,
+                    flip_rows=flip_fast_axis,
+                    hdr=hdr,
+                )
+        except Exception:
+            os.remove(writer.fpath)
+            raise
+        if n_rows != datashape[0]:
+            logger.error(
+                "The number of rows saved to file (%d) is not equal to the expected number of rows (%d): "
+                "The scan is incomplete.",
+                n_rows,
+                datashape[0],
+            )
+        fpath, data_out = writer.fpath, None
 
-    if output_to_file:
+    else:
+        data_out = map_data2D(
+            data,
+            datashape,
+            det_list=det_list,
+            pos_list=pos_list,
+            scaler_list=scaler_list,
+            create_each_det=create_each_det,
+            fly_type=fly_type,
+            subscan_dims=subscan_dims,
+            spectrum_len=4096,
+            hdr=hdr,
+        )
+        transform_fast_axis(data_out)
+
+    if output_to_file and not stream:
         # output to file
         print("Saving data to hdf file.")
         fpath = save_data_to_hdf5(
@@ -1108,6 +1269,8 @@ def map_data2D_srx(
     save_scaler=True,
     num_end_lines_excluded=None,
     catalog=None,
+    stream_to_file=False,
+    live_fitter=None,
 ):
     """
     Transfer the data from databroker into a correct format following the
@@ -1154,12 +1317,18 @@ def map_data2D_srx(
         remove the last few bad lines
     catalog
         reference to databroker catalog
+    stream_to_file : bool, optional
+        write each row of data to the file as it is loaded (supported only for fly scans saved
+        in new format and loaded using Databroker). The data is not returned if streaming mode
+        is used (the value of ``"dataset"`` key is ``None``).
+    live_fitter : LiveMapFitter or None, optional
+        fit the rows of the map as they are written to the file (streaming mode only).
 
     Returns
     -------
     dict of data in 2D format matching x,y scanning positions
     """
-    catalog = catalog or db
+    catalog = catalog or _get_db()
 
     using_tiled = "CatalogOfBlueskyRuns" in str(type(catalog))
 
@@ -1167,6 +1336,9 @@ def map_data2D_srx(
     start_doc = hdr.start
     use_new_format = "md_version" in start_doc
 
+    if stream_to_file and (using_tiled or not use_new_format):
+        logger.warning("Streaming mode is not supported for this data format. Data is loaded in memory.")
+
     if using_tiled and use_new_format:
         return map_data2D_srx_new_tiled(
             run_id_uid=run_id_uid,
@@ -1195,6 +1367,8 @@ def map_data2D_srx(
             output_to_file=output_to_file,
             save_scaler=save_scaler,
             num_end_lines_excluded=num_end_lines_excluded,
+            stream_to_file=stream_to_file,
+            live_fitter=live_fitter,
         )
     else:
         return map_data2D_srx_old(
@@ -1271,7 +1445,7 @@ def map_data2D_srx_old(
     -------
     dict of data in 2D format matching x,y scanning positions
     """
-    hdr = db[run_id_uid]
+    hdr = _get_db()[run_id_uid]
     runid = hdr.start["scan_id"]  # Replace with the true value (runid may be relative, such as -2)
 
     print("Scan metadata format: old SRX specification.")
@@ -1494,8 +1668,10 @@ def map_data2D_srx_old(
 
         # Try each data field listed in the config file
         for detector_field, detector_name in detector_field_dict.items():
+            from event_model import Filler
+
             # Assume that Databroker caches the tables locally, so that data will not be reloaded
-            filler = Filler(db.reg.handler_reg, inplace=True)
+            filler = Filler(_get_db().reg.handler_reg, inplace=True)
             docs_stream0 = hdr.documents(fill=False, stream_name=des.name)
 
             new_data = {}
@@ -1768,6 +1944,8 @@ def map_data2D_srx_new(
     output_to_file=True,
     save_scaler=True,
     num_end_lines_excluded=None,
+    stream_to_file=False,
+    live_fitter=None,
 ):
     if num_end_lines_excluded:
         logger.warning(
@@ -1776,7 +1954,7 @@ def map_data2D_srx_new(
             "be included in the output file."
         )
 
-    hdr = db[run_id_uid]
+    hdr = _get_db()[run_id_uid]
     start_doc = hdr.start
     runid = start_doc["scan_id"]  # Replace with the true value (runid may be relative, such as -2)
 
@@ -1869,7 +2047,9 @@ def map_data2D_srx_new(
             slow_key = slow_motor
 
         # Let's get the data using the events! Yay!
-        filler = Filler(db.reg.handler_reg, inplace=True)
+        from event_model import Filler
+
+        filler = Filler(_get_db().reg.handler_reg, inplace=True)
         docs_stream0 = hdr.documents("stream0", fill=False)
         docs_primary = hdr.documents("primary", fill=False)
         d_xs, d_xs_sum, N_xs = [], [], 0
@@ -1879,6 +2059,78 @@ def map_data2D_srx_new(
         sclr_dict = {}
         fast_pos, slow_pos = [], []
 
+        # Streaming mode: each row is written to the file as soon as it is loaded. The lists
+        #   'd_xs', 'd_xs_sum', 'sclr_dict', 'fast_pos' etc. contain only the current row.
+        row_writers = {}
+        if stream_to_file and output_to_file:
+            if fpath is None:
+                fpath = f"scan2D_{runid}.h5"
+            root, ext = os.path.splitext(fpath)
+            for detector_name in dets:
+                # The file is renamed once the number of detector channels is known
+                row_writers[detector_name] = _HDF5RowWriter(
+                    f"{root}_{detector_name}.tmp{ext}",
+                    fpath_live=f"{root}_{detector_name}_live{ext}",
+                    n_cols=n_scan_fast,
+                    metadata=mdata,
+                    file_overwrite_existing=True,
+                    snake=snaking_enabled,
+                    transpose=fast_motor in ("nano_stage_sy", "nano_stage_y"),
+                    pos_names=(
+                        ["y_pos", "x_pos"]
+                        if fast_motor in ("nano_stage_sy", "nano_stage_y")
+                        else ["x_pos", "y_pos"]
+                    ),
+                    live_fitter=live_fitter,
+                )
+        elif stream_to_file:
+            logger.warning("Streaming mode is ignored: the data is not saved to file ('output_to_file=False')")
+        if (live_fitter is not None) and not row_writers:
+            logger.warning(
+                "Live fitting is ignored: the data is not loaded in streaming mode ('stream_to_file=True')"
+            )
+
+        def write_rows_to_file():
+            """
+            Write the current row to the files and clear the lists (streaming mode).
+            """
+
+            def pop_row(rows):
+                row = rows.pop() if rows else None
+                return row if (row is not None and row.size) else None
+
+            row_pos = {"fast": pop_row(fast_pos), "slow": pop_row(slow_pos)}
+            if (row_pos["fast"] is not None) and (row_pos["slow"] is not None):
+                if row_pos["fast"].shape == row_pos["slow"].shape:
+                    if "x" in slow_key:
+                        row_pos = np.stack([row_pos["slow"], row_pos["fast"]])
+                    else:
+                        row_pos = np.stack([row_pos["fast"], row_pos["slow"]])
+                else:
+                    row_pos = None
+            else:
+                row_pos = None
+
+            row_sclr = None
+            if sclr_dict:
+                sclr_rows = [pop_row(_) for _ in sclr_dict.values()]
+                if all([(_ is not None) and (_.shape == (n_scan_fast,)) for _ in sclr_rows]):
+                    row_sclr = np.stack(sclr_rows, axis=-1).astype(float)
+
+            for detector_name, writer in row_writers.items():
+                if detector_name in ("xs", "xs4"):
+                    row_sum, row_channels = pop_row(d_xs_sum), pop_row(d_xs)
+                else:
+                    row_sum, row_channels = pop_row(d_xs2_sum), pop_row(d_xs2)
+                rows = {"det_sum": row_sum, "positions": row_pos}
+                if create_each_det and row_channels is not None:
+                    for n in range(row_channels.shape[1]):
+                        rows[f"det{n + 1}"] = row_channels[:, n, :]
+                if save_scaler:
+                    writer.scaler_names = list(sclr_dict.keys())
+                    rows["scalers"] = row_sclr
+                writer.write_row(rows)
+
         n_recorded_events = 0
 
         try:
@@ -1977,6 +2229,9 @@ def map_data2D_srx_new(
                     row_pos_slow = np.array(data_or_empty_array(v["data"][slow_key]))
                 slow_pos.append(row_pos_slow)
 
+                if row_writers:
+                    write_rows_to_file()
+
                 n_recorded_events = m + 1
 
                 if m > 0 and not (m % 10):
@@ -1994,6 +2249,25 @@ def map_data2D_srx_new(
         except Exception as ex:
             logger.error(f"Error occurred while reading data: {ex}. Trying to retrieve available data ...")
 
+        if row_writers:
+            if n_recorded_events != n_scan_slow:
+                logger.error(
+                    "The number of recorded events (%d) is not equal to the expected number of events (%d): "
+                    "The scan is incomplete.",
+                    n_recorded_events,
+                    n_scan_slow,
+                )
+            n_channels = {"xs": N_xs, "xs4": N_xs, "xs2": N_xs2}
+            return _finalize_streamed_files(
+                row_writers,
+                fpath=fpath,
+                n_channels=n_channels,
+                create_each_det=create_each_det,
+                metadata=mdata,
+                fname_add_version=fname_add_version,
+                file_overwrite_existing=file_overwrite_existing,
+            )
+
         def repair_set(dset_list, n_row_pts, msg):
             """
             Replaces corrupt rows (incorrect number of points) with closest 'good' row. This allows to load
@@ -2707,6 +2981,8 @@ def map_data2D_tes(
     output_to_file=True,
     save_scaler=True,
     catalog=None,
+    stream_to_file=False,
+    live_fitter=None,
 ):
     """
     Transfer the data from databroker into a correct format following the
@@ -2752,12 +3028,19 @@ def map_data2D_tes(
         save data to hdf5 file if True
     catalog
         reference to databroker catalog
+    stream_to_file : bool, optional
+        write each row of the map to the file as soon as it is read instead of loading
+        the map in memory (supported only if the data is loaded using Tiled). The data is not
+        returned in this case (the value of ``"dataset"`` key is ``None``).
+    live_fitter : LiveMapFitter or None, optional
+        fit the rows of the map as they are written to the file (streaming mode only).
+        See ``make_hdf`` for details.
 
     Returns
     -------
     dict of data in 2D format matching x,y scanning positions
     """
-    catalog = catalog or db
+    catalog = catalog or _get_db()
 
     using_tiled = "CatalogOfBlueskyRuns" in str(type(catalog))
 
@@ -2772,8 +3055,12 @@ def map_data2D_tes(
             file_overwrite_existing=file_overwrite_existing,
             output_to_file=output_to_file,
             catalog=catalog,
+            stream_to_file=stream_to_file,
+            live_fitter=live_fitter,
         )
     else:
+        if stream_to_file:
+            logger.warning("Streaming mode is not supported for this data format. Data is loaded in memory.")
         return map_data2D_tes_databroker(
             run_id_uid=run_id_uid,
             fpath=fpath,
@@ -2797,6 +3084,8 @@ def map_data2D_tes_tiled(
     output_to_file=True,
     save_scaler=True,
     catalog=None,
+    stream_to_file=False,
+    live_fitter=None,
 ):
     """
     Transfer the data from databroker into a correct format following the
@@ -2842,6 +3131,13 @@ def map_data2D_tes_tiled(
         save data to hdf5 file if True
     catalog
         reference to databroker catalog
+    stream_to_file : bool, optional
+        write each row of the map to the file as soon as it is read instead of loading
+        the map in memory. The data is not returned in this case (the value of ``"dataset"``
+        key is ``None``).
+    live_fitter : LiveMapFitter or None, optional
+        fit the rows of the map as they are written to the file (streaming mode only).
+        See ``make_hdf`` for details.
 
     Returns
     -------
@@ -3021,14 +3317,6 @@ def map_data2D_tes_tiled(
     #     new_data["scaler_data"] = new_data["scaler_data"][:n_events_min, :, :]
     #     new_data["pos_data"] = new_data["pos_data"][:, :n_events_min, :]
 
-    # Note: the following code assumes that the detector has only one channel.
-    #   If the detector is upgraded, the following code will have to be rewritten, but
-    #   the rest of the data loading procedure will have to be modified anyway.
-    if create_each_det:
-        new_data["det1"] = detector_data
-    else:
-        new_data["det_sum"] = detector_data
-
     num_det = 1
     detector_name = "xs"
     n_detectors_found = 1
@@ -3041,7 +3329,54 @@ def map_data2D_tes_tiled(
         s += f"+{num_det}ch"
     fpath_out = f"{root}{s}{ext}"
 
-    if output_to_file:
+    # Streaming mode: each row of detector data is loaded and written to the file separately
+    #   (positions and scalers are small and are loaded in memory)
+    stream = stream_to_file and output_to_file
+    if stream_to_file and not output_to_file:
+        logger.warning("Streaming mode is ignored: the data is not saved to file ('output_to_file=False')")
+    if (live_fitter is not None) and not stream:
+        logger.warning("Live fitting is ignored: the data is not loaded in streaming mode ('stream_to_file=True')")
+
+    if stream:
+        print(f"Saving data to hdf file #{n_detectors_found}: Detector: {detector_name}.")
+        writer = _HDF5RowWriter(
+            fpath_out,
+            n_cols=pos_data.shape[2],
+            metadata=mdata,
+            fname_add_version=fname_add_version,
+            file_overwrite_existing=file_overwrite_existing,
+            pos_names=new_data["pos_names"],
+            scaler_names=new_data.get("scaler_names", None),
+            live_fitter=live_fitter,
+        )
+        try:
+            with writer:
+                for n in range(detector_data.shape[0]):
+                    # Only one row is loaded. The detector has only one channel (see the note below).
+                    row = np.asarray(detector_data[n])
+                    rows = {"det_sum": row}
+                    if create_each_det:
+                        rows["det1"] = row
+                    if n < pos_data.shape[1]:
+                        rows["positions"] = pos_data[:, n, :]
+                    if ("scaler_data" in new_data) and (n < new_data["scaler_data"].shape[0]):
+                        rows["scalers"] = new_data["scaler_data"][n]
+                    writer.write_row(rows)
+        except Exception:
+            os.remove(writer.fpath)
+            raise
+        fpath_out, new_data = writer.fpath, None
+
+    else:
+        # Note: the following code assumes that the detector has only one channel.
+        #   If the detector is upgraded, the following code will have to be rewritten, but
+        #   the rest of the data loading procedure will have to be modified anyway.
+        if create_each_det:
+            new_data["det1"] = detector_data
+        else:
+            new_data["det_sum"] = detector_data
+
+    if output_to_file and not stream:
         # output to file
         print(f"Saving data to hdf file #{n_detectors_found}: Detector: {detector_name}.")
         fpath_out = save_data_to_hdf5(
@@ -3118,7 +3453,7 @@ def map_data2D_tes_databroker(
     dict of data in 2D format matching x,y scanning positions
     """
 
-    hdr = db[run_id_uid]
+    hdr = _get_db()[run_id_uid]
     runid = hdr.start["scan_id"]  # Replace with the true value (runid may be relative, such as -2)
 
     # The dictionary holding scan metadata
@@ -3272,7 +3607,9 @@ def map_data2D_tes_databroker(
     n_events = data_shape[0]
     n_events_found = 0
 
-    filler = Filler(db.reg.handler_reg, inplace=True)
+    from event_model import Filler
+
+    filler = Filler(_get_db().reg.handler_reg, inplace=True)
     docs_primary = hdr.documents("primary", fill=False)
 
     # Assume that the number of positions reflect the size of the row
@@ -3434,7 +3771,7 @@ def map_data2D_xfm(
     -------
     dict of data in 2D format matching x,y scanning positions
     """
-    hdr = db[run_id_uid]
+    hdr = _get_db()[run_id_uid]
     runid = hdr.start["scan_id"]  # Replace with the true value (runid may be relative, such as -2)
 
     if completed_scans_only and not _is_scan_complete(hdr):
@@ -3471,7 +3808,7 @@ def map_data2D_xfm(
             config_data = json.load(json_data)
 
         # try except can be added later if scan is not completed.
-        data = db.get_table(hdr, fill=True, convert_times=False)
+        data = _get_db().get_table(hdr, fill=True, convert_times=False)
 
         xrf_detector_names = config_data["xrf_detector"]
         data_out = map_data2D(
@@ -3839,7 +4176,7 @@ def map_data2D(
         if c_name in data:
             detname = "det" + str(n + 1)
             logger.info("read data from %s" % c_name)
-            if db.name == "hxn":
+            if _get_db().name == "hxn":
                 channel_data = np.squeeze(np.array(list(hdr.data(c_name))))
             else:
                 channel_data = data[c_name]
@@ -3875,7 +4212,40 @@ def map_data2D(
                 sum_data += new_data
     data_output["det_sum"] = sum_data
 
-    if db.name == "hxn":
+    # Make sure that positions and scalers have the same dimensions as xs3 data
+    nv, nh, _ = sum_data.shape
+    pos_names, pos_data, scaler_names, scaler_data = _get_positions_and_scalers_2D(
+        data,
+        datashape,
+        nv=nv,
+        nh=nh,
+        pos_list=pos_list,
+        scaler_list=scaler_list,
+        fly_type=fly_type,
+        subscan_dims=subscan_dims,
+        hdr=hdr,
+    )
+    data_output["pos_names"] = pos_names
+    data_output["pos_data"] = pos_data
+    data_output["scaler_names"] = scaler_names
+    data_output["scaler_data"] = scaler_data
+    return data_output
+
+
+def _get_positions_and_scalers_2D(
+    data, datashape, *, nv, nh, pos_list, scaler_list, fly_type=None, subscan_dims=None, hdr=None
+):
+    """
+    Extract positions and scalers from the data obtained from databroker (see ``map_data2D``).
+    The maps are cropped or padded with zeros to the shape ``(nv, nh)``.
+
+    Returns
+    -------
+    tuple
+        position names, positions (array of shape ``(n_pos, nv, nh)``), scaler names and
+        scalers (array of shape ``(nv, nh, n_scalers)``)
+    """
+    if _get_db().name == "hxn":
         pos_names = pos_list
         pos_data = np.zeros([datashape[0], datashape[1], len(pos_list)])
         from hxntools.scan_info import get_scan_positions
@@ -3906,8 +4276,6 @@ def map_data2D(
     for i in range(len(pos_names)):
         new_p[i, :, :] = pos_data[:, :, i]
 
-    # Make sure that positions have the same dimensions as xs3 data
-    nv, nh, _ = sum_data.shape
     if new_p.shape[1] > nv:
         new_p = new_p[:, :nv, :]
     elif new_p.shape[1] < nv:
@@ -3917,10 +4285,7 @@ def map_data2D(
     elif new_p.shape[2] < nh:
         new_p = np.pad(new_p, [(0, 0), (0, 0), (0, nh - new_p.shape[2])])
 
-    data_output["pos_names"] = pos_names
-    data_output["pos_data"] = new_p
-
-    if db.name == "hxn":
+    if _get_db().name == "hxn":
         scaler_names = scaler_list
         scaler_data = np.zeros([datashape[0], datashape[1], len(scaler_list)])
         for i in range(len(scaler_list)):
@@ -3942,9 +4307,104 @@ def map_data2D(
     elif scaler_data.shape[1] < nh:
         scaler_data = np.pad(scaler_data, [(0, 0), (0, nh - scaler_data.shape[1]), (0, 0)])
 
-    data_output["scaler_names"] = scaler_names
-    data_output["scaler_data"] = scaler_data
-    return data_output
+    return pos_names, new_p, scaler_names, scaler_data
+
+
+def _write_data2D_rows(
+    writer,
+    data,
+    n_cols,
+    *,
+    det_list,
+    pos_data,
+    scaler_data,
+    create_each_det=False,
+    spectrum_len=4096,
+    flip_rows=False,
+    hdr=None,
+):
+    """
+    Streaming version of ``map_data2D``: the spectra from detector channels are read pixel by pixel
+    and each complete row of the map is written to the file using ``writer`` (``_HDF5RowWriter``),
+    so that only one row of data is held in memory. Positions and scalers are small and
+    are loaded in memory by the caller (see ``_get_positions_and_scalers_2D``). The last incomplete
+    row is discarded, unless the map contains a single row (the row is padded with zeros).
+
+    Parameters
+    ----------
+    writer : _HDF5RowWriter
+        the object used to write rows of data to the file
+    data : pandas.core.frame.DataFrame
+        data from data broker
+    n_cols : int
+        the number of points in each row of the map
+    det_list : list, tuple
+        list of detector channels
+    pos_data : ndarray
+        positions, array of shape ``(n_pos, n_rows, n_cols)``
+    scaler_data : ndarray
+        scalers, array of shape ``(n_rows, n_cols, n_scalers)``
+    create_each_det : bool, optional
+        write data from each detector channel
+    spectrum_len : int, optional
+        standard spectrum length (shorter spectra are padded with zeros)
+    flip_rows : bool, optional
+        flip each row of detector data along the fast axis (positions and scalers are
+        expected to be already flipped)
+    hdr : databroker header
+
+    Returns
+    -------
+    int
+        the number of rows written to the file
+    """
+    channels = {c_name: f"det{n + 1}" for n, c_name in enumerate(det_list) if c_name in data}
+    if not channels:
+        raise RuntimeError(f"No data is found for the detector channels {list(det_list)}")
+    for c_name in channels:
+        logger.info("read data from %s" % c_name)
+    c_first = next(iter(channels))  # All channels contain the same number of pixels
+    if _get_db().name == "hxn":
+        channel_iters = [hdr.data(c_name) for c_name in channels]
+    else:
+        channel_iters = [iter(data[c_name]) for c_name in channels]
+
+    n_rows_written = 0
+
+    def write_row(pixels):
+        rows = {}
+        sum_row = np.zeros([n_cols, spectrum_len], dtype=np.float32)
+        for c_name, det_name in channels.items():
+            d = np.vstack(pixels[c_name]).astype(np.float32, copy=False)
+            row = np.zeros([n_cols, spectrum_len], dtype=np.float32)
+            row[: d.shape[0], : d.shape[1]] = d
+            if flip_rows:
+                row = np.flip(row, axis=0)
+            if create_each_det:
+                rows[det_name] = row
+            sum_row += row
+        rows["det_sum"] = sum_row
+
+        n = n_rows_written
+        rows["positions"] = pos_data[:, n, :] if n < pos_data.shape[1] else np.zeros_like(pos_data[:, 0, :])
+        rows["scalers"] = scaler_data[n] if n < scaler_data.shape[0] else np.zeros_like(scaler_data[0])
+        writer.write_row(rows)
+
+    pixels = {_: [] for _ in channels}
+    for values in zip(*channel_iters):
+        for c_name, v in zip(channels, values):
+            pixels[c_name].append(np.squeeze(np.asarray(v)))
+        if len(pixels[c_first]) == n_cols:
+            write_row(pixels)
+            n_rows_written += 1
+            pixels = {_: [] for _ in channels}
+
+    # Support for incomplete 1 row scan
+    if not n_rows_written and pixels[c_first]:
+        write_row(pixels)
+        n_rows_written += 1
+
+    return n_rows_written
 
 
 def _get_fpath_not_existing(fpath):
@@ -3964,8 +4424,221 @@ def _get_fpath_not_existing(fpath):
     return fpath
 
 
+# The size of HDF5 chunks (bytes) selected for XRF data if ``chunks="auto"``
+_HDF5_CHUNK_NBYTES = 2**20
+
+
+def _get_hdf5_chunk_size(shape, dtype):
+    """
+    Select the shape of HDF5 chunks for 3D XRF data (ny, nx, ne). The chunks are square
+    blocks of pixels that contain the full spectrum for each pixel. The size of the chunk
+    is about 1 MB. The processing blocks selected by ``plan_xrf_map_chunks`` contain
+    whole number of chunks.
+    """
+    ny, nx, ne = shape
+    chunk_pixels = max(_HDF5_CHUNK_NBYTES // (ne * np.dtype(dtype).itemsize), 1)
+    chunk_y, chunk_x = compute_optimal_chunk_size(
+        chunk_pixels=chunk_pixels, data_chunksize=(1, 1), data_shape=(ny, nx), n_chunks_min=1
+    )
+    return chunk_y, chunk_x, ne
+
+
+def _get_output_fpath_and_mode(fpath, *, fname_add_version, file_overwrite_existing):
+    """
+    Returns the path to the new HDF5 file with raw data and the mode for opening the file.
+    See the docstring for ``save_data_to_hdf5`` for the description of the parameters.
+    """
+    file_open_mode = "a"
+    if os.path.exists(fpath):
+        if fname_add_version:
+            # Creates unique file name
+            fpath = _get_fpath_not_existing(fpath)
+        else:
+            if file_overwrite_existing:
+                # Overwrite the existing file. This completely deletes the HDF5 file,
+                #   including all information (possibly processed results).
+                file_open_mode = "w"
+            else:
+                raise IOError(f"Function 'save_data_to_hdf5': File '{fpath}' already exists")
+    return fpath, file_open_mode
+
+
+def _save_metadata_to_hdf5(f, metadata, *, interpath="xrfmap"):
+    """
+    Create the metadata group in the open HDF5 file ``f`` and save the metadata. The dictionary
+    ``metadata`` is modified (the fields describing the file are added).
+    """
+    metadata_grp = f.create_group(f"{interpath}/scan_metadata")
+
+    metadata_additional = {
+        "file_type": "XRF-MAP",
+        "file_format": "NSLS2-XRF-MAP",
+        "file_format_version": "1.0",
+        "file_created_time": ttime.strftime("%Y-%m-%dT%H:%M:%S+00:00", ttime.localtime()),
+    }
+
+    metadata_software_version = {
+        "file_software": "PyXRF",
+        "file_software_version": pyxrf_version,
+    }
+
+    metadata_prepared = metadata or {}
+    metadata_prepared.update(metadata_additional)
+    if "file_software" not in metadata_prepared:
+        metadata_prepared.update(metadata_software_version)
+
+    metadata_prepared2 = metadata_prepared
+    metadata_prepared = {}
+    for k, v in metadata_prepared2.items():
+        if isinstance(v, dict):
+            for k2, v2 in v.items():
+                metadata_prepared[k + "|" + k2] = v2
+        else:
+            metadata_prepared[k] = v
+
+    metadata_prepared2 = metadata_prepared
+    metadata_prepared = {}
+    for k, v in metadata_prepared2.items():
+        if isinstance(v, np.int64):
+            metadata_prepared[k] = int(v)
+        elif isinstance(v, np.float64):
+            metadata_prepared[k] = float(v)
+        elif isinstance(v, np.str_):
+            metadata_prepared[k] = str(v)
+        else:
+            metadata_prepared[k] = v
+
+    if metadata_prepared:
+        # We assume, that metadata does not contain repeated keys. Otherwise the
+        #   entry with the last occurrence of the key will override the previous ones.
+        for key, value in metadata_prepared.items():
+            metadata_grp.attrs[key] = value
+
+
+def _get_hdf5_storage_kwargs(shape, dtype, *, chunks=None, compression="gzip", shuffle=False):
+    """
+    Returns kwargs for ``h5py.Group.create_dataset`` that define storage layout of 3D XRF dataset.
+    See the docstring for ``save_data_to_hdf5`` for the description of the parameters.
+    """
+    supported_compression = ("gzip", "lzf", "lz4", "zstd", "blosc", None)
+    if compression not in supported_compression:
+        raise ValueError(
+            f"Compression method {compression!r} is not supported. Supported methods: {supported_compression}"
+        )
+
+    kwargs = {}
+    if compression in ("gzip", "lzf"):
+        kwargs["compression"] = compression
+    elif compression is not None:
+        try:
+            import hdf5plugin
+        except ImportError as ex:
+            raise RuntimeError(f"Compression method {compression!r} requires 'hdf5plugin' package") from ex
+        if compression == "lz4":
+            kwargs.update(hdf5plugin.LZ4())
+        elif compression == "zstd":
+            kwargs.update(hdf5plugin.Zstd())
+        else:
+            # Blosc applies its own shuffle filter
+            blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+            kwargs.update(hdf5plugin.Blosc(cname="lz4", shuffle=blosc_shuffle))
+            shuffle = False
+
+    if shuffle:
+        kwargs["shuffle"] = True
+
+    if isinstance(chunks, str):
+        if chunks != "auto":
+            raise ValueError(f"Unsupported value of parameter 'chunks': {chunks!r}")
+        kwargs["chunks"] = _get_hdf5_chunk_size(shape, dtype)
+    elif chunks is not None:
+        if len(chunks) != 2:
+            raise ValueError(f"Parameter 'chunks' must be a tuple (chunk_y, chunk_x): chunks={chunks}")
+        kwargs["chunks"] = (min(chunks[0], shape[0]), min(chunks[1], shape[1]), shape[2])
+
+    return kwargs
+
+
+def _download_datasets(
+    download_list, *, dset_sum=None, n_pixels_in_batch=40000, n_download_retries=10, n_threads=4
+):
+    """
+    Download data from Dask arrays (e.g. loaded from Tiled) and save it to HDF5 datasets.
+    The data is downloaded in batches of rows. The batches of all arrays are downloaded
+    concurrently using a pool of threads. The next batch is downloaded while the current
+    batch is written to the file. NaNs are replaced with zeros.
+
+    Parameters
+    ----------
+    download_list: list(tuple)
+        list of tuples ``(dset, data)``, where ``dset`` is HDF5 dataset (or ``None`` if the data
+        should not be saved) and ``data`` is Dask array with the shape ``(ny, nx, ...)``.
+        All arrays must have the same shape.
+    dset_sum: h5py.Dataset or None
+        HDF5 dataset for the sum of the downloaded arrays. The sum is not saved if ``None``.
+    n_pixels_in_batch: int
+        the number of pixels downloaded in one batch (for all arrays). A batch contains at least one row.
+    n_download_retries: int
+        the number of attempts to download each batch.
+    n_threads: int
+        the number of threads used for downloading the data.
+    """
+    if not download_list:
+        return
+
+    n_rows, n_cols = download_list[0][1].shape[0:2]
+    n_rows_batch = max(int(n_pixels_in_batch / n_cols / len(download_list)), 1)  # Save at least one row
+    batches = [(ns, min(ns + n_rows_batch, n_rows)) for ns in range(0, n_rows, n_rows_batch)]
+
+    def download_batch(data, ns, ne):
+        for retry in range(n_download_retries):
+            try:
+                return np.nan_to_num(np.array(data[ns:ne, ...]))
+            except Exception as ex:
+                logger.error(f"Failed to load the batch: {ex}")
+        raise TimeoutError("Failed to download data from Tiled server")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+
+        def submit_batch(n):
+            if n >= len(batches):
+                return []
+            ns, ne = batches[n]
+            return [executor.submit(download_batch, data, ns, ne) for _, data in download_list]
+
+        futures, futures_next = submit_batch(0), []
+        try:
+            for n, (ns, ne) in enumerate(batches):
+                # Start downloading the next batch before writing the current batch
+                futures_next = submit_batch(n + 1)
+                batch_sum = None
+                for (dset, _), fut in zip(download_list, futures):
+                    batch = fut.result()
+                    if dset is not None:
+                        dset[ns:ne, ...] = batch
+                    if dset_sum is not None:
+                        batch_sum = batch if batch_sum is None else batch_sum + batch
+                if dset_sum is not None:
+                    dset_sum[ns:ne, ...] = batch_sum
+                futures = futures_next
+                print(f"  Number of saved rows: {ne}")
+        except Exception:
+            for fut in futures + futures_next:
+                fut.cancel()
+            raise
+
+
 def save_data_to_hdf5(
-    fpath, data, *, metadata=None, fname_add_version=False, file_overwrite_existing=False, create_each_det=True
+    fpath,
+    data,
+    *,
+    metadata=None,
+    fname_add_version=False,
+    file_overwrite_existing=False,
+    create_each_det=True,
+    chunks=None,
+    compression="gzip",
+    shuffle=False,
 ):
     """
     This is the function used to save raw experiment data into HDF5 file. The raw data is
@@ -4009,6 +4682,18 @@ def save_data_to_hdf5(
     create_each_det : boolean
         Save data from individual detectors (``True``) or only the sum of fluorescence from
         all detectors (``False``).
+    chunks : tuple(int, int), str or None
+        Shape of HDF5 chunks of the datasets with fluorescence data: ``(chunk_y, chunk_x)`` - the
+        chunks contain blocks of pixels with full spectra, ``"auto"`` - blocks of pixels
+        with the size of about 1 MB (the blocks are aligned with the blocks used for processing),
+        ``None`` - the chunk shape is selected by ``h5py``.
+    compression : str or None
+        Compression filter applied to the fluorescence data: ``"gzip"`` (default), ``"lzf"``,
+        ``"lz4"``, ``"zstd"``, ``"blosc"`` or ``None`` (no compression). The filters ``"lz4"``,
+        ``"zstd"`` and ``"blosc"`` are much faster than ``"gzip"``, but require ``hdf5plugin``
+        package to be installed for writing and reading the data.
+    shuffle : boolean
+        Apply shuffle filter before compression. Typically improves compression ratio.
 
     Raises
     ------
@@ -4058,121 +4743,58 @@ def save_data_to_hdf5(
                 else:
                     sum_data += data[detname]
 
-    file_open_mode = "a"
-    if os.path.exists(fpath):
-        if fname_add_version:
-            # Creates unique file name
-            fpath = _get_fpath_not_existing(fpath)
-        else:
-            if file_overwrite_existing:
-                # Overwrite the existing file. This completely deletes the HDF5 file,
-                #   including all information (possibly processed results).
-                file_open_mode = "w"
-            else:
-                raise IOError(f"Function 'save_data_to_hdf5': File '{fpath}' already exists")
+    fpath, file_open_mode = _get_output_fpath_and_mode(
+        fpath, fname_add_version=fname_add_version, file_overwrite_existing=file_overwrite_existing
+    )
 
     with h5py.File(fpath, file_open_mode) as f:
         # Create metadata group
-        metadata_grp = f.create_group(f"{interpath}/scan_metadata")
-
-        metadata_additional = {
-            "file_type": "XRF-MAP",
-            "file_format": "NSLS2-XRF-MAP",
-            "file_format_version": "1.0",
-            "file_created_time": ttime.strftime("%Y-%m-%dT%H:%M:%S+00:00", ttime.localtime()),
-        }
+        _save_metadata_to_hdf5(f, metadata, interpath=interpath)
 
-        metadata_software_version = {
-            "file_software": "PyXRF",
-            "file_software_version": pyxrf_version,
-        }
+        def storage_kwargs(data):
+            return _get_hdf5_storage_kwargs(
+                data.shape, data.dtype, chunks=chunks, compression=compression, shuffle=shuffle
+            )
 
-        metadata_prepared = metadata or {}
-        metadata_prepared.update(metadata_additional)
-        if "file_software" not in metadata_prepared:
-            metadata_prepared.update(metadata_software_version)
-
-        metadata_prepared2 = metadata_prepared
-        metadata_prepared = {}
-        for k, v in metadata_prepared2.items():
-            if isinstance(v, dict):
-                for k2, v2 in v.items():
-                    metadata_prepared[k + "|" + k2] = v2
+        def create_counts_dataset(group_name, data, comments):
+            dataGrp = f.create_group(interpath + "/" + group_name)
+            if isinstance(data, da.core.Array):
+                # The data is downloaded later
+                ds_data = dataGrp.create_dataset("counts", data.shape, dtype=data.dtype, **storage_kwargs(data))
             else:
-                metadata_prepared[k] = v
-
-        metadata_prepared2 = metadata_prepared
-        metadata_prepared = {}
-        for k, v in metadata_prepared2.items():
-            if isinstance(v, np.int64):
-                metadata_prepared[k] = int(v)
-            elif isinstance(v, np.float64):
-                metadata_prepared[k] = float(v)
-            elif isinstance(v, np.str_):
-                metadata_prepared[k] = str(v)
-            else:
-                metadata_prepared[k] = v
-
-        if metadata_prepared:
-            # We assume, that metadata does not contain repeated keys. Otherwise the
-            #   entry with the last occurrence of the key will override the previous ones.
-            for key, value in metadata_prepared.items():
-                metadata_grp.attrs[key] = value
-
-        # The following parameters control how data is loaded from Tiled
-        n_pixels_in_batch = 40000
-        n_tiled_download_retries = 10
-
-        def compute_batch_params(shape):
-            n_rows, n_cols = shape[0], shape[1]
-            n_rows_batch = max(int(n_pixels_in_batch / n_cols), 1)  # Save at least one row
-            n_batches = int(n_rows / n_rows_batch)
-            if n_rows % n_rows_batch:
-                n_batches += 1
-            return n_rows, n_rows_batch, n_batches
-
-        def download_dataset(dset, data):
-            n_rows, n_rows_batch, n_batches = compute_batch_params(sum_data.shape)
-            for n in range(n_batches):
-                ns, ne = n * n_rows_batch, min((n + 1) * n_rows_batch, n_rows)
-                for retry in range(n_tiled_download_retries):
-                    try:
-                        dset[ns:ne, ...] = np.nan_to_num(np.array(data[ns:ne, ...]))
-                        # dset[ns:ne, ...] = np.nan_to_num(data[ns:ne, ...].compute())
-                        break
-                    except Exception as ex:
-                        logger.error(f"Failed to load the batch: {ex}")
-                    if retry >= n_tiled_download_retries - 1:
-                        raise TimeoutError("Failed to download data from Tiled server")
-                print(f"  Number of saved rows: {ne}")
+                ds_data = dataGrp.create_dataset("counts", data=data, **storage_kwargs(data))
+            ds_data.attrs["comments"] = comments
+            return ds_data
+
+        if not isinstance(sum_data, da.core.Array):
+            if create_each_det is True:
+                for detname in xrf_det_list:
+                    create_counts_dataset(detname, data[detname], f"Experimental data from {detname}")
+
+            # summed data
+            if sum_data is not None:
+                create_counts_dataset("detsum", sum_data, "Experimental data from channel sum")
 
-        if create_each_det is True:
+        else:
+            # The data is represented as Dask arrays (e.g. loaded from Tiled). The channels are
+            #   downloaded concurrently. If the sum is not provided, then it is computed from
+            #   the downloaded channel data.
+            download_list = []
             for detname in xrf_det_list:
-                if not isinstance(sum_data, da.core.Array):
-                    new_data = data[detname]
-                    dataGrp = f.create_group(interpath + "/" + detname)
-                    ds_data = dataGrp.create_dataset("counts", data=new_data, compression="gzip")
-                    ds_data.attrs["comments"] = "Experimental data from {}".format(detname)
+                if create_each_det is True:
+                    ds_data = create_counts_dataset(detname, data[detname], f"Experimental data from {detname}")
                 else:
-                    new_data = data[detname]
-                    dataGrp = f.create_group(interpath + "/" + detname)
-                    ds_data = dataGrp.create_dataset("counts", new_data.shape, compression="gzip")
-                    print(f"Downloading data: channel {detname!r} ...")
-                    download_dataset(ds_data, new_data)
-                    ds_data.attrs["comments"] = "Experimental data from {}".format(detname)
+                    ds_data = None
+                if (ds_data is not None) or not sum_data_exists:
+                    download_list.append((ds_data, data[detname]))
 
-        # summed data
-        if sum_data is not None:
-            if not isinstance(sum_data, da.core.Array):
-                dataGrp = f.create_group(interpath + "/detsum")
-                ds_data = dataGrp.create_dataset("counts", data=sum_data, compression="gzip")
-                ds_data.attrs["comments"] = "Experimental data from channel sum"
-            else:
-                dataGrp = f.create_group(interpath + "/detsum")
-                ds_data = dataGrp.create_dataset("counts", sum_data.shape, compression="gzip")
-                print("Downloading data: the sum of all channels ...")
-                download_dataset(ds_data, sum_data)
-                ds_data.attrs["comments"] = "Experimental data from channel sum"
+            ds_sum = create_counts_dataset("detsum", sum_data, "Experimental data from channel sum")
+            if sum_data_exists:
+                download_list.append((ds_sum, sum_data))
+                ds_sum = None
+
+            print(f"Downloading data: {len(download_list)} datasets ...")
+            _download_datasets(download_list, dset_sum=ds_sum)
 
         # add positions
         if "pos_names" in data:
@@ -4198,6 +4820,450 @@ def save_data_to_hdf5(
 write_db_to_hdf_base = save_data_to_hdf5  # Backward compatibility
 
 
+class _HDF5RowWriter:
+    """
+    Writes raw XRF data to a new HDF5 file row by row as the rows become available (streaming
+    ingest). The datasets have the same layout as the datasets created by ``save_data_to_hdf5``,
+    but are resizable along the row axis, so that the scan does not need to be assembled in memory:
+    only the current row (and the last good row of each dataset) is held in memory.
+
+    The data is represented as a set of named streams. Each call to ``write_row`` writes one row
+    of the map to each stream. Supported streams:
+
+      ``"det_sum"`` - sum of detector channels, array of shape ``(n_cols, n_bins)``
+
+      ``"det1"``, ``"det2"`` etc. - data from individual channels, arrays of shape ``(n_cols, n_bins)``
+
+      ``"scalers"`` - scaler data, array of shape ``(n_cols, n_scalers)``. Scaler names
+      must be set using the attribute ``scaler_names`` before the writer is closed.
+
+      ``"positions"`` - positional data, array of shape ``(2, n_cols)``
+
+    The datasets are created when the first valid row is received. Corrupt rows (``None``, missing
+    streams or rows with incorrect number of points) are replaced with the closest preceding
+    good row (or the following good row if no preceding good row exists), similarly to the
+    non-streaming loaders. If snaking is enabled, odd rows are flipped as they are written.
+    If ``transpose`` is ``True``, each row is written as a column of the map (used if the fast
+    axis is vertical).
+
+    If ``live_fitter`` is specified, the rows of the ``"det_sum"`` stream are fitted in blocks of
+    ``live_fitter.rows_per_block`` rows as soon as the rows are written and the results are appended
+    to the datasets ``xrfmap/detsum/xrf_fit`` and ``xrfmap/detsum/xrf_fit_name`` (same layout as
+    the datasets created by ``pyxrf_batch``). The remaining rows are fitted when the writer is closed.
+    The output file is not readable while it is written, so the partial maps are also written to
+    the separate file ``fpath_live`` (the same datasets). The file is opened in SWMR mode and flushed
+    after each block, so the maps could be read by other processes while the scan is loaded:
+
+    .. code-block:: python
+
+        with h5py.File(fpath_live, "r", libver="latest", swmr=True) as f:
+            dset = f["xrfmap/detsum/xrf_fit"]
+            dset.refresh()  # Call before each read to see the new rows
+            maps = dset[()]
+
+    The file with partial maps is deleted when the writer is closed (the complete maps are saved
+    in the output file).
+
+    Examples
+    --------
+    .. code-block:: python
+
+        with _HDF5RowWriter(fpath, n_cols=n_cols, snake=True, pos_names=["x_pos", "y_pos"]) as writer:
+            for row in rows:
+                writer.write_row({"det_sum": row_sum, "positions": row_pos})
+
+    Parameters
+    ----------
+    fpath: str
+        path to the new HDF5 file (see ``save_data_to_hdf5``)
+    n_cols: int
+        number of points in each row (the number of points along the fast axis)
+    metadata: dict or None
+        metadata saved to the file (see ``save_data_to_hdf5``)
+    fname_add_version: boolean
+        see ``save_data_to_hdf5``
+    file_overwrite_existing: boolean
+        see ``save_data_to_hdf5``
+    snake: boolean
+        flip the odd rows (snake scan)
+    transpose: boolean
+        write rows of data as columns of the map
+    pos_names: list(str)
+        names of the positions, saved in the file if positions are written
+    scaler_names: list(str) or None
+        names of the scalers, may be set later
+    compression: str or None
+        compression filter applied to fluorescence data (see ``save_data_to_hdf5``)
+    shuffle: boolean
+        apply shuffle filter (see ``save_data_to_hdf5``)
+    live_fitter: LiveMapFitter or None
+        the object used to fit the rows of the map as they are written. The rows are not fitted if `None`.
+    fpath_live: str or None
+        path to the file with partial maps (live fitting only). If `None`, then the suffix ``_live``
+        is added to the name of the output file, e.g. ``scan2D_1000_live.h5``.
+    """
+
+    # Stream name: (group name, dataset name, number of leading axes, comments)
+    _dataset_info = {
+        "det_sum": ("detsum", "counts", 0, "Experimental data from channel sum"),
+        "scalers": ("scalers", "val", 0, None),
+        "positions": ("positions", "pos", 1, None),
+    }
+
+    def __init__(
+        self,
+        fpath,
+        *,
+        n_cols,
+        metadata=None,
+        fname_add_version=False,
+        file_overwrite_existing=False,
+        snake=False,
+        transpose=False,
+        pos_names=("x_pos", "y_pos"),
+        scaler_names=None,
+        compression="gzip",
+        shuffle=False,
+        live_fitter=None,
+        fpath_live=None,
+    ):
+        fpath = os.path.abspath(os.path.expanduser(fpath))
+        self.fpath, file_open_mode = _get_output_fpath_and_mode(
+            fpath, fname_add_version=fname_add_version, file_overwrite_existing=file_overwrite_existing
+        )
+        self.n_cols = n_cols
+        self.snake = snake
+        self.transpose = transpose
+        self.pos_names = list(pos_names)
+        self.scaler_names = scaler_names
+        self.compression = compression
+        self.shuffle = shuffle
+
+        self.n_rows = 0  # The number of written rows
+        self._dsets = {}  # Stream name: HDF5 dataset
+        self._last_good_rows = {}  # Stream name: (row index, row data before flipping)
+        self._missed_rows = {}  # Stream name: list of corrupt rows preceding the first good row
+
+        self.live_fitter = live_fitter
+        self.n_rows_fitted = 0  # The number of fitted rows
+        self._rows_to_fit = {}  # Row index: rows of 'det_sum' stream, which are not fitted yet
+        if fpath_live is None:
+            root, ext = os.path.splitext(self.fpath)
+            fpath_live = f"{root}_live{ext}"
+        self.fpath_live = os.path.abspath(os.path.expanduser(fpath_live))
+        self._file_live = None  # The file with partial maps (opened in SWMR mode)
+
+        self._file = h5py.File(self.fpath, file_open_mode)
+        try:
+            _save_metadata_to_hdf5(self._file, copy.deepcopy(metadata))
+        except Exception:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_info(self, name):
+        if name in self._dataset_info:
+            return self._dataset_info[name]
+        elif re.search(r"^det\d+$", name):
+            return name, "counts", 0, f"Experimental data from {name}"
+        else:
+            raise ValueError(f"Unsupported stream name: {name!r}")
+
+    def _row_axis(self, name):
+        # Index of the axis of the dataset along which rows are appended
+        n_lead = self._get_info(name)[2]
+        return n_lead + 1 if self.transpose else n_lead
+
+    def _is_row_valid(self, name, row):
+        n_lead = self._get_info(name)[2]
+        return (row is not None) and (row.ndim > n_lead) and (row.shape[n_lead] == self.n_cols)
+
+    def _create_dataset(self, name, row):
+        group_name, dset_name, n_lead, comments = self._get_info(name)
+        row_axis = self._row_axis(name)
+        shape = list(row.shape)
+        shape.insert(row_axis, 0)
+        maxshape = list(row.shape)
+        maxshape.insert(row_axis, None)
+
+        kwargs = {}
+        if dset_name == "counts":
+            # Each chunk contains a block of pixels from a single row (the full spectrum for each pixel)
+            kwargs = _get_hdf5_storage_kwargs(
+                (1, *row.shape), row.dtype, compression=self.compression, shuffle=self.shuffle
+            )
+            n_bins = row.shape[-1]
+            chunk_pixels = max(_HDF5_CHUNK_NBYTES // (n_bins * row.dtype.itemsize), 1)
+            chunks = [min(chunk_pixels, self.n_cols), n_bins]
+            chunks.insert(row_axis, 1)
+            kwargs["chunks"] = tuple(chunks)
+        else:
+            kwargs["chunks"] = True
+
+        grp = self._file.require_group(f"xrfmap/{group_name}")
+        dset = grp.create_dataset(
+            dset_name, shape=tuple(shape), maxshape=tuple(maxshape), dtype=row.dtype, **kwargs
+        )
+        if comments:
+            dset.attrs["comments"] = comments
+        return dset
+
+    def _write(self, name, n_row, row):
+        dset = self._dsets[name]
+        n_lead = self._get_info(name)[2]
+        row_axis = self._row_axis(name)
+        if self.snake and (n_row % 2):
+            row = np.flip(row, axis=n_lead)
+        if dset.shape[row_axis] <= n_row:
+            dset.resize(n_row + 1, axis=row_axis)
+        index = [slice(None)] * dset.ndim
+        index[row_axis] = n_row
+        dset[tuple(index)] = row
+        if (self.live_fitter is not None) and (name == "det_sum"):
+            self._rows_to_fit[n_row] = row
+
+    def _fit_rows(self, *, fit_all=False):
+        """
+        Fit the blocks of consecutive rows that are ready for fitting and append the results
+        to the dataset ``xrf_fit``. If ``fit_all`` is ``True``, then the last incomplete block is also fitted.
+        """
+        n_block = self.live_fitter.rows_per_block
+        while True:
+            n_ready = 0
+            while (self.n_rows_fitted + n_ready) in self._rows_to_fit:
+                n_ready += 1
+            if not n_ready or (n_ready < n_block and not fit_all):
+                break
+            n_ready = min(n_ready, n_block)
+
+            n_start, n_end = self.n_rows_fitted, self.n_rows_fitted + n_ready
+            block = np.stack([self._rows_to_fit.pop(_) for _ in range(n_start, n_end)])
+            maps = self.live_fitter.fit_rows(block)
+            if self.transpose:
+                maps = np.swapaxes(maps, 1, 2)
+
+            # The maps are appended along axis 1 (rows) or axis 2 (columns) of the dataset
+            row_axis = 2 if self.transpose else 1
+            if self._file_live is None:
+                map_names = self.live_fitter.get_map_names(block.shape[2])
+                self._file_live = h5py.File(self.fpath_live, "w", libver="latest")
+                for file in (self._file, self._file_live):
+                    self._create_fit_datasets(file.require_group("xrfmap/detsum"), map_names, row_axis)
+                # No new objects can be created in the file after SWMR mode is enabled
+                self._file_live.swmr_mode = True
+
+            index = [slice(None)] * 3
+            index[row_axis] = slice(n_start, n_end)
+            for file in (self._file, self._file_live):
+                dset = file["xrfmap/detsum/xrf_fit"]
+                dset.resize(n_end, axis=row_axis)
+                dset[tuple(index)] = maps
+            self.n_rows_fitted = n_end
+            # Partial maps may be read by other processes
+            self._file_live.flush()
+
+    def _create_fit_datasets(self, grp, map_names, row_axis):
+        """
+        Create the datasets ``xrf_fit`` (empty, resizable along ``row_axis``) and ``xrf_fit_name``.
+        """
+        shape = [len(map_names), self.n_cols]
+        shape.insert(row_axis, 0)
+        maxshape = list(shape)
+        maxshape[row_axis] = None
+        dset = grp.create_dataset(
+            "xrf_fit", shape=tuple(shape), maxshape=tuple(maxshape), dtype="float64", chunks=True
+        )
+        dset.attrs["comments"] = " "
+        dset = grp.create_dataset("xrf_fit_name", data=np.array(map_names).astype("|S20"))
+        dset.attrs["comments"] = " "
+
+    def write_row(self, rows):
+        """
+        Write the next row of data to the file.
+
+        Parameters
+        ----------
+        rows: dict(ndarray)
+            dictionary of rows: key - stream name, value - row data (array or ``None`` if
+            the row is missing). Rows for the streams that are not included in the dictionary
+            are considered corrupt.
+        """
+        n_row = self.n_rows
+        names = set(rows.keys()) | set(self._dsets.keys()) | set(self._missed_rows.keys())
+        for name in sorted(names):
+            _, dset_name, n_lead, _ = self._get_info(name)
+            row = rows.get(name, None)
+            if row is not None:
+                # Fluorescence data is saved as np.float32 (same as in 'save_data_to_hdf5')
+                row = np.asarray(row, dtype=np.float32) if dset_name == "counts" else np.asarray(row)
+
+            if self._is_row_valid(name, row):
+                if name not in self._dsets:
+                    self._dsets[name] = self._create_dataset(name, row)
+                self._write(name, n_row, row)
+                self._last_good_rows[name] = (n_row, row)
+                # Replace the corrupt rows preceding the first good row
+                for nr in self._missed_rows.pop(name, []):
+                    self._write(name, nr, row)
+                    print(f"({name}) Data in row #{nr + 1} is replaced by data from row #{n_row + 1}")
+            else:
+                n_pts = 0 if row is None else (row.shape[n_lead] if row.ndim > n_lead else row.size)
+                print(
+                    f"WARNING: ({name}) Row #{n_row + 1} has {n_pts} data points. "
+                    f"{self.n_cols} points are expected."
+                )
+                if name in self._last_good_rows:
+                    n_good, row_good = self._last_good_rows[name]
+                    self._write(name, n_row, row_good)
+                    print(f"({name}) Data in row #{n_row + 1} is replaced by data from row #{n_good + 1}")
+                else:
+                    self._missed_rows.setdefault(name, []).append(n_row)
+
+        self.n_rows += 1
+        if self.live_fitter is not None:
+            self._fit_rows()
+
+    def flush(self):
+        """
+        Flush the data to disk, so that the file could be read by other processes.
+        """
+        self._file.flush()
+
+    def close(self):
+        """
+        Save the names of scalers and positions and close the file.
+        """
+        if self._file is None:
+            return
+        try:
+            for name in self._missed_rows:
+                logger.error(f"No valid rows were found for the dataset {name!r}. The dataset is not created.")
+
+            if self.live_fitter is not None:
+                self._fit_rows(fit_all=True)
+
+            if "positions" in self._dsets:
+                self._file["xrfmap/positions"].create_dataset("name", data=helper_encode_list(self.pos_names))
+            if "scalers" in self._dsets:
+                scaler_names = self.scaler_names or []
+                self._file["xrfmap/scalers"].create_dataset("name", data=helper_encode_list(scaler_names))
+        finally:
+            self._file.close()
+            self._file = None
+            # The complete maps are saved in the output file
+            if self._file_live is not None:
+                self._file_live.close()
+                self._file_live = None
+                os.remove(self.fpath_live)
+
+
+def _finalize_streamed_files(
+    row_writers, *, fpath, n_channels, create_each_det, metadata, fname_add_version, file_overwrite_existing
+):
+    """
+    Close the files created by ``_HDF5RowWriter`` objects in streaming mode and rename
+    the files so that the names contain the number of detector channels (the same names
+    are generated by the loaders in non-streaming mode).
+
+    Parameters
+    ----------
+    row_writers: dict(_HDF5RowWriter)
+        key - detector name, value - writer object. The writers are writing to temporary files.
+    fpath: str
+        path to the data file (the detector name and the number of channels are added to the name)
+    n_channels: dict(int)
+        key - detector name, value - the number of detector channels
+    create_each_det: boolean
+        indicates if data from each detector channel is saved
+    metadata: dict
+        scan metadata
+    fname_add_version, file_overwrite_existing: boolean
+        see ``save_data_to_hdf5``
+
+    Returns
+    -------
+    list(dict)
+        list of dictionaries with the file information. The data is not loaded in memory,
+        so the value of the key ``"dataset"`` is ``None``.
+    """
+    data_output = []
+    root, ext = os.path.splitext(fpath)
+    for detector_name, writer in row_writers.items():
+        writer.close()
+        num_det = n_channels[detector_name]
+        s = f"_{detector_name}_sum{num_det}ch"
+        if create_each_det:
+            s += f"+{num_det}ch"
+        try:
+            fpath_out, _ = _get_output_fpath_and_mode(
+                f"{root}{s}{ext}",
+                fname_add_version=fname_add_version,
+                file_overwrite_existing=file_overwrite_existing,
+            )
+            os.replace(writer.fpath, fpath_out)
+        except Exception:
+            os.remove(writer.fpath)
+            raise
+        print(f"Data is saved to hdf file '{fpath_out}': Detector: {detector_name}.")
+
+        d_dict = {"dataset": None, "file_name": fpath_out, "detector_name": detector_name, "metadata": metadata}
+        data_output.append(d_dict)
+
+    return data_output
+
+
+def _replay_rows_from_hdf5(fpath, *, snake=False, transpose=False):
+    """
+    Read raw data from the HDF5 file created by ``save_data_to_hdf5`` or ``_HDF5RowWriter``
+    and yield the rows of the map in the order in which they were acquired. The function is
+    a local stand-in for the stream of events: the rows may be passed to ``_HDF5RowWriter.write_row``
+    to replay the scan (e.g. to test or to repeat live processing).
+
+    Parameters
+    ----------
+    fpath: str
+        path to the HDF5 file with raw data
+    snake: boolean
+        the odd rows are flipped back (snake scan)
+    transpose: boolean
+        the columns of the map are returned as rows (the fast axis is vertical)
+
+    Yields
+    ------
+    dict(ndarray)
+        rows of the map: key - stream name, value - row data
+    """
+    with h5py.File(fpath, "r") as f:
+        streams = {}
+        for group_name in f["xrfmap"]:
+            if group_name == "detsum":
+                stream_name = "det_sum"
+            elif group_name in ("scalers", "positions") or re.search(r"^det\d+$", group_name):
+                stream_name = group_name
+            else:
+                continue
+            _, dset_name, n_lead, _ = _HDF5RowWriter._dataset_info.get(stream_name, (None, "counts", 0, None))
+            if dset_name in f[f"xrfmap/{group_name}"]:
+                streams[stream_name] = (f[f"xrfmap/{group_name}/{dset_name}"], n_lead)
+
+        n_rows = min([dset.shape[n_lead + 1 if transpose else n_lead] for dset, n_lead in streams.values()])
+        for n_row in range(n_rows):
+            rows = {}
+            for name, (dset, n_lead) in streams.items():
+                index = [slice(None)] * dset.ndim
+                index[n_lead + 1 if transpose else n_lead] = n_row
+                row = dset[tuple(index)]
+                if snake and (n_row % 2):
+                    row = np.flip(row, axis=n_lead)
+                rows[name] = row
+            yield rows
+
+
 '''
 # This may not be needed, since hdr always goes out of scope
 def clear_handler_cache(hdr):
@@ -4222,6 +5288,7 @@ def free_memory_from_handler():
     """
     # The following check is redundant: Data Broker prior to version 1.0.0 always has '_handler_cache'.
     #   In later versions of databroker the attribute may still be present if 'databroker.v0' is used.
+    db = _get_db()
     if (
         (LooseVersion(databroker.__version__) < LooseVersion("1.0.0"))
         or hasattr(db, "fs")
@@ -4246,6 +5313,7 @@ def export1d(runid, name=None):
     runid : int
         run number
     """
+    db = _get_db()
     t = db.get_table(db[runid], fill=False)
     if name is None:
         name = "scan_" + str(runid) + ".txt"
@@ -4261,7 +5329,7 @@ def helper_decode_list(data, data_type="utf-8"):
 
 
 def get_data_per_event(n, data, e, det_num):
-    db.fill_event(e)
+    _get_db().fill_event(e)
     min_len = e.data["fluor"].shape[0]
     for i in range(det_num):
         data[n, :min_len, :] += e.data["fluor"][:, i, :]
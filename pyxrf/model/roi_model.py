@@ -317,8 +317,6 @@ class ROIModel(Atom):
             roi_dict=roi_dict,
             snip_param=snip_param,
             use_snip=self.subtract_background,
-            chunk_pixels=5000,
-            n_chunks_min=4,
             progress_bar=TerminalProgressBar("Computing ROIs: "),
             client=None,
         )
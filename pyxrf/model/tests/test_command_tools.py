@@ -0,0 +1,287 @@
+import copy
+import json
+import os
+
+import h5py
+import numpy as np
+import numpy.testing as npt
+import pytest
+import tifffile
+
+from pyxrf.api_dev import save_data_to_hdf5
+from pyxrf.core.map_processing import bin_map
+from pyxrf.model import command_tools
+from pyxrf.model.command_tools import fit_pixel_data_and_save, fit_pixel_data_batch
+from pyxrf.model.fileio import read_hdf_APS
+from pyxrf.model.fit_spectrum import multi_channel_fitting_controller, single_pixel_fitting_controller
+from pyxrf.model.param_data import param_data
+from pyxrf.simulation.sim_xrf_scan_data import gen_xrf_map_const
+
+
+@pytest.mark.parametrize("n_files_in_batch", [1, 2, 16])
+def test_fit_pixel_data_batch(tmp_path, n_files_in_batch):
+    """
+    ``fit_pixel_data_batch``: the files are fitted in batches, the results saved to the files
+    are the same as the results of ``single_pixel_fitting_controller``.
+    """
+    param = copy.deepcopy(param_data)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K, Cu_K, Pb_L"
+    param_path = os.path.join(tmp_path, "param.json")
+    with open(param_path, "w") as f:
+        json.dump(param, f)
+
+    # Pb_L is not activated at 12 keV. One of the files can not be loaded.
+    incident_energies = [12.0, 14.0, 12.0, 12.0]
+    map_sizes = [(5, 6), (4, 7), (6, 6), (3, 3)]
+    file_paths, data_list = [], []
+    for n, (energy, (ny, nx)) in enumerate(zip(incident_energies, map_sizes)):
+        data, _ = gen_xrf_map_const(
+            {"Ca_K": {"area": 800}, "Fe_K": {"area": 900}, "Cu_K": {"area": 700}},
+            nx=nx,
+            ny=ny,
+            incident_energy=energy,
+            background_area=100,
+        )
+        data = data * (np.random.random((ny, nx, 1)) + 0.5)
+        fpath = os.path.join(tmp_path, f"scan2D_{n}.h5")
+        if n != 2:
+            save_data_to_hdf5(fpath, {"det_sum": data})
+        file_paths.append(fpath)
+        data_list.append(data)
+
+    files_processed = fit_pixel_data_batch(
+        file_paths,
+        param_file_name=param_path,
+        incident_energy=incident_energies,
+        n_files_in_batch=n_files_in_batch,
+    )
+    assert files_processed == [file_paths[_] for _ in (0, 1, 3)]
+
+    for fpath, data, energy in zip(file_paths, data_list, incident_energies):
+        if fpath not in files_processed:
+            continue
+        result_map, _ = single_pixel_fitting_controller(data, param, incident_energy=energy, dask_client=None)
+        with h5py.File(fpath, "r") as f:
+            map_names = [_.decode() for _ in f["xrfmap/detsum/xrf_fit_name"][()]]
+            xrf_fit = f["xrfmap/detsum/xrf_fit"][()]
+        assert map_names == list(result_map.keys())
+        for n, name in enumerate(map_names):
+            npt.assert_allclose(xrf_fit[n], result_map[name], rtol=1e-5, atol=1e-4, err_msg=name)
+
+
+def test_fit_pixel_data_batch_fail(tmp_path):
+    with pytest.raises(ValueError, match="Parameter 'n_files_in_batch' must be a positive integer"):
+        fit_pixel_data_batch(["f1.h5"], param_file_name="param.json", n_files_in_batch=0)
+    with pytest.raises(ValueError, match=r"The number of values of incident energy \(1\) is not equal"):
+        fit_pixel_data_batch(["f1.h5", "f2.h5"], param_file_name="param.json", incident_energy=[12.0])
+
+
+@pytest.mark.parametrize("interpolate_to_uniform_grid", [False, True])
+def test_fit_pixel_data_and_save_binning(tmp_path, interpolate_to_uniform_grid):
+    """
+    ``fit_pixel_data_and_save``: the maps of binned data are saved to a separate group together with
+    binned scalers (summed) and positions (averaged). The full-resolution results, scalers and positions
+    are not changed. The exported scalers and positions are binned in the same way as the fitted maps,
+    so the maps are normalized and may be interpolated to uniform grid.
+    """
+    ny, nx, energy, pixel_bin = 11, 12, 12.0, 2
+    ny_bin, nx_bin = ny // pixel_bin, nx // pixel_bin
+    param = copy.deepcopy(param_data)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K"
+    with open(os.path.join(tmp_path, "param.json"), "w") as f:
+        json.dump(param, f)
+
+    data, _ = gen_xrf_map_const(
+        {"Ca_K": {"area": 800}, "Fe_K": {"area": 900}},
+        nx=nx,
+        ny=ny,
+        incident_energy=energy,
+        background_area=100,
+    )
+    pos_data = np.asarray(np.meshgrid(np.arange(nx) * 0.1, np.arange(ny) * 0.2))
+    scaler_data = np.random.random((ny, nx, 1)) + 0.5
+    data_dict = {
+        "det_sum": data,
+        "scaler_names": ["i0"],
+        "scaler_data": scaler_data,
+        "pos_names": ["x_pos", "y_pos"],
+        "pos_data": pos_data,
+    }
+    fln = "scan2D_1.h5"
+    save_data_to_hdf5(os.path.join(tmp_path, fln), data_dict)
+
+    # Full-resolution results
+    fit_pixel_data_and_save(
+        str(tmp_path), fln, param_file_name="param.json", incident_energy=energy, save_tiff=False
+    )
+    with h5py.File(os.path.join(tmp_path, fln), "r") as f:
+        xrf_fit = f["xrfmap/detsum/xrf_fit"][()]
+    assert xrf_fit.shape[1:] == (ny, nx)
+
+    fit_pixel_data_and_save(
+        str(tmp_path),
+        fln,
+        param_file_name="param.json",
+        incident_energy=energy,
+        pixel_bin=pixel_bin,
+        scaler_name="i0",
+        interpolate_to_uniform_grid=interpolate_to_uniform_grid,
+    )
+
+    i0_expected = bin_map(scaler_data[:, :, 0], pixel_bin=pixel_bin)
+    x_expected = bin_map(pos_data[0], pixel_bin=pixel_bin, average=True)
+    y_expected = bin_map(pos_data[1], pixel_bin=pixel_bin, average=True)
+
+    with h5py.File(os.path.join(tmp_path, fln), "r") as f:
+        npt.assert_array_equal(f["xrfmap/detsum/xrf_fit"][()], xrf_fit)
+        npt.assert_array_equal(f["xrfmap/positions/pos"][()], pos_data)
+        npt.assert_array_equal(f["xrfmap/scalers/val"][()], scaler_data)
+
+        grp = f[f"xrfmap/bin{pixel_bin}"]
+        assert grp["detsum/xrf_fit"].shape[1:] == (ny_bin, nx_bin)
+        assert [_.decode() for _ in grp["positions/name"][()]] == ["x_pos", "y_pos"]
+        assert [_.decode() for _ in grp["scalers/name"][()]] == ["i0"]
+        npt.assert_allclose(grp["positions/pos"][()], np.stack([x_expected, y_expected]))
+        npt.assert_allclose(grp["scalers/val"][()][:, :, 0], i0_expected)
+
+    # The binned results are not loaded as detector channels
+    img_dict, data_sets, _ = read_hdf_APS(str(tmp_path), fln, load_each_channel=True)
+    assert not any(_.endswith("_det1") for _ in data_sets)
+    assert img_dict["scan2D_1_fit"]["Ca_K"].shape == (ny, nx)
+
+    def _load(name):
+        return tifffile.imread(os.path.join(tmp_path, "output_tiff_scan2D_1", f"{name}.tiff"))
+
+    maps = {_: _load(_) for _ in ("i0", "x_pos", "y_pos", "detsum_Ca_K", "detsum_Ca_K_norm")}
+    for name, data_map in maps.items():
+        assert data_map.shape == (ny_bin, nx_bin), name
+
+    # Binned positions form uniform grid, so interpolation does not change the maps
+    npt.assert_allclose(maps["i0"], i0_expected, rtol=1e-5)
+    npt.assert_allclose(maps["x_pos"], x_expected, rtol=1e-5)
+    npt.assert_allclose(maps["y_pos"], y_expected, rtol=1e-5)
+    npt.assert_allclose(maps["detsum_Ca_K_norm"], maps["detsum_Ca_K"] / maps["i0"], rtol=1e-4)
+
+
+def test_fit_pixel_data_and_save_export_order(tmp_path, monkeypatch):
+    """
+    ``fit_pixel_data_and_save``: each map is exported as soon as it is fitted, so the maps
+    fitted before a failure are exported.
+    """
+    ny, nx, energy = 5, 6, 12.0
+    param = copy.deepcopy(param_data)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K"
+    with open(os.path.join(tmp_path, "param.json"), "w") as f:
+        json.dump(param, f)
+
+    data, _ = gen_xrf_map_const(
+        {"Ca_K": {"area": 800}, "Fe_K": {"area": 900}}, nx=nx, ny=ny, incident_energy=energy
+    )
+    data_dict = {"det_sum": data * 3, "det1": data, "det2": data, "det3": data}
+    fln = "scan2D_1.h5"
+    save_data_to_hdf5(os.path.join(tmp_path, fln), data_dict)
+
+    calls = []
+    fit_controller = command_tools.single_pixel_fitting_controller
+
+    def _fit(data, param, **kwargs):
+        calls.append(("fit", kwargs["output_datapath"]))
+        if kwargs["output_datapath"] == "xrfmap/det2":
+            raise RuntimeError("Fitting failed")
+        return fit_controller(data, param, **kwargs)
+
+    def _output_data(**kwargs):
+        calls.append(("export", kwargs["dataset_name"]))
+
+    monkeypatch.setattr(command_tools, "single_pixel_fitting_controller", _fit)
+    monkeypatch.setattr(command_tools, "output_data", _output_data)
+
+    with pytest.raises(RuntimeError, match="Fitting failed"):
+        fit_pixel_data_and_save(
+            str(tmp_path), fln, param_file_name="param.json", incident_energy=energy, fit_channel_each=True
+        )
+
+    assert calls == [
+        ("fit", "xrfmap/detsum"),
+        ("export", "dataset_fit"),
+        ("fit", "xrfmap/det1"),
+        ("export", "dataset_det1_fit"),
+        ("fit", "xrfmap/det2"),
+    ]
+
+
+@pytest.mark.parametrize("stream_results_to_file", [False, True])
+@pytest.mark.parametrize("pixel_bin", [0, 2])
+def test_fit_pixel_data_and_save_single_pass(tmp_path, stream_results_to_file, pixel_bin):
+    """
+    ``fit_pixel_data_and_save``: the sum and the detector channels fitted in a single pass produce
+    the same maps as the maps fitted for each channel separately. The channels may be fitted
+    using different parameters.
+    """
+    ny, nx, energy = 6, 7, 12.0
+    param = copy.deepcopy(param_data)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K, Cu_K, Pb_L"
+    param_files = ["param.json", "param.json", "param_det.json"]
+    with open(os.path.join(tmp_path, param_files[0]), "w") as f:
+        json.dump(param, f)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K, Cu_K"
+    with open(os.path.join(tmp_path, param_files[2]), "w") as f:
+        json.dump(param, f)
+
+    data, _ = gen_xrf_map_const(
+        {"Ca_K": {"area": 800}, "Fe_K": {"area": 900}, "Cu_K": {"area": 700}},
+        nx=nx,
+        ny=ny,
+        incident_energy=energy,
+        background_area=100,
+    )
+    channels = [data * (np.random.random((ny, nx, 1)) + 0.5) for _ in range(3)]
+    data_dict = {"det_sum": sum(channels), **{f"det{n + 1}": _ for n, _ in enumerate(channels)}}
+
+    file_names = ["scan2D_1.h5", "scan2D_2.h5"]
+    for fln in file_names:
+        save_data_to_hdf5(os.path.join(tmp_path, fln), data_dict, create_each_det=True)
+
+    for fln, single_pass in zip(file_names, (False, True)):
+        fit_pixel_data_and_save(
+            str(tmp_path),
+            fln,
+            param_file_name=param_files[0],
+            fit_channel_each=True,
+            param_channel_list=param_files,
+            incident_energy=energy,
+            pixel_bin=pixel_bin,
+            save_tiff=False,
+            stream_results_to_file=stream_results_to_file,
+            fit_channels_single_pass=single_pass,
+        )
+
+    # The maps of binned data are saved to a separate group
+    fit_group = f"xrfmap/bin{pixel_bin}" if pixel_bin > 1 else "xrfmap"
+    results = []
+    for fln in file_names:
+        with h5py.File(os.path.join(tmp_path, fln), "r") as f:
+            results.append(
+                {
+                    det: (f[f"{fit_group}/{det}/xrf_fit_name"][()], f[f"{fit_group}/{det}/xrf_fit"][()])
+                    for det in ("detsum", "det1", "det2", "det3")
+                }
+            )
+            if pixel_bin > 1:
+                assert "xrf_fit" not in f["xrfmap/detsum"]
+
+    assert [_.decode() for _ in results[1]["det3"][0]][:3] == ["Ca_K", "Fe_K", "Cu_K"]
+    for det, (map_names, xrf_fit) in results[0].items():
+        npt.assert_array_equal(results[1][det][0], map_names)
+        npt.assert_allclose(results[1][det][1], xrf_fit, rtol=1e-10, err_msg=det)
+
+
+def test_multi_channel_fitting_controller_fail():
+    """
+    ``multi_channel_fitting_controller``: invalid list of output data paths.
+    """
+    datasets = [(np.zeros((2, 3, 4096)), copy.deepcopy(param_data))] * 2
+    with pytest.raises(ValueError, match="'output_datapaths' must be specified"):
+        multi_channel_fitting_controller(datasets, output_fpath="test.h5")
+    with pytest.raises(ValueError, match=r"number of output data paths \(1\) is not equal"):
+        multi_channel_fitting_controller(datasets, output_fpath="test.h5", output_datapaths=["xrfmap/detsum"])
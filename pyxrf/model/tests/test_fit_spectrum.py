@@ -0,0 +1,192 @@
+import copy
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from skbeam.core.fitting.xrf_model import construct_linear_model
+
+from pyxrf.api_dev import save_data_to_hdf5
+from pyxrf.core.block_cache import BlockResultCache
+from pyxrf.core.map_processing import RawHDF5Dataset
+from pyxrf.model.fit_spectrum import (
+    _build_linear_model,
+    _linear_model_cache,
+    save_fitted_fig,
+    single_pixel_fitting_controller,
+)
+from pyxrf.model.param_data import param_data
+from pyxrf.simulation.sim_xrf_scan_data import gen_xrf_map_const
+
+
+@pytest.mark.parametrize("pixel_bin, bin_energy", [(2, 1), (3, 1), (1, 2), (2, 3)])
+def test_single_pixel_fitting_controller_binning(pixel_bin, bin_energy):
+    """
+    ``single_pixel_fitting_controller``: fitting of binned data. The maps have the shape of the binned data.
+    Spatial binning is equivalent to fitting of the data with summed pixels. Energy binning produces
+    the same areas of emission lines as fitting of the original spectra.
+    """
+    ny, nx = 7, 8
+    incident_energy = 12.0
+    param = copy.deepcopy(param_data)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K, Cu_K"
+
+    data, _ = gen_xrf_map_const(
+        {"Ca_K": {"area": 800}, "Fe_K": {"area": 900}, "Cu_K": {"area": 700}},
+        nx=nx,
+        ny=ny,
+        incident_energy=incident_energy,
+        background_area=0,
+    )
+    data = data * (np.random.random((ny, nx, 1)) + 0.5)
+
+    result_map, calculation_info = single_pixel_fitting_controller(
+        data,
+        param,
+        incident_energy=incident_energy,
+        pixel_bin=pixel_bin,
+        bin_energy=bin_energy,
+        use_snip=False,
+        dask_client=None,
+    )
+
+    ny_bin, nx_bin = ny // pixel_bin, nx // pixel_bin
+    data_binned = data[: ny_bin * pixel_bin, : nx_bin * pixel_bin, :]
+    data_binned = np.sum(np.reshape(data_binned, (ny_bin, pixel_bin, nx_bin, pixel_bin, -1)), axis=(1, 3))
+    result_expected, info_expected = single_pixel_fitting_controller(
+        data_binned, param, incident_energy=incident_energy, use_snip=False, dask_client=None
+    )
+
+    n_low, n_high = calculation_info["fit_range"]
+    assert n_high - n_low == calculation_info["regression_mat"].shape[0]
+    assert calculation_info["energy_axis"].shape == (n_high - n_low,)
+    # The original data is returned, the results refer to the binned data
+    assert calculation_info["input_data"] is data
+    assert (calculation_info["pixel_bin"], calculation_info["bin_energy"]) == (pixel_bin, bin_energy)
+    assert calculation_info["results"].shape[0:2] == (ny_bin, nx_bin)
+
+    assert list(result_map.keys()) == list(result_expected.keys())
+    for name in ("Ca_K", "Fe_K", "Cu_K"):
+        assert result_map[name].shape == (ny_bin, nx_bin)
+        if bin_energy == 1:
+            npt.assert_allclose(result_map[name], result_expected[name], rtol=1e-5, err_msg=name)
+        else:
+            npt.assert_allclose(result_map[name], result_expected[name], rtol=1e-2, err_msg=name)
+
+
+@pytest.mark.parametrize("pixel_bin, bin_energy", [(1, 1), (2, 1), (2, 2)])
+def test_save_fitted_fig_binning(tmp_path, pixel_bin, bin_energy):
+    """
+    ``save_fitted_fig``: plots of fitted spectra are saved for the data loaded from HDF5 file
+    after the file used for fitting is closed. The selection is specified in the pixel coordinates
+    of the original map and is converted to the coordinates of the binned map.
+    """
+    ny, nx = 6, 8
+    incident_energy = 12.0
+    param = copy.deepcopy(param_data)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K"
+
+    data, _ = gen_xrf_map_const(
+        {"Ca_K": {"area": 800}, "Fe_K": {"area": 900}},
+        nx=nx,
+        ny=ny,
+        incident_energy=incident_energy,
+        background_area=100,
+    )
+    fln = os.path.join(tmp_path, "scan2D_1.h5")
+    save_data_to_hdf5(fln, {"det_sum": data})
+    data_hdf5 = RawHDF5Dataset(fln, "xrfmap/detsum/counts", shape=data.shape)
+
+    result_map, calculation_info = single_pixel_fitting_controller(
+        data_hdf5,
+        param,
+        incident_energy=incident_energy,
+        pixel_bin=pixel_bin,
+        bin_energy=bin_energy,
+        use_snip=True,
+        dask_client=None,
+    )
+
+    output_folder = os.path.join(tmp_path, "pixel_fit")
+    os.mkdir(output_folder)
+    n_elines = len(calculation_info["fit_name"])
+    save_fitted_fig(
+        calculation_info["energy_axis"],
+        calculation_info["regression_mat"],
+        calculation_info["results"][:, :, 0:n_elines],
+        [1, 2],
+        [4, 5],
+        calculation_info["input_data"],
+        calculation_info["data_sel_indices"],
+        param,
+        output_folder,
+        use_snip=True,
+        pixel_bin=calculation_info["pixel_bin"],
+        bin_energy=calculation_info["bin_energy"],
+    )
+
+    p1 = [1 // pixel_bin, 2 // pixel_bin]
+    p2 = [-(-4 // pixel_bin), -(-5 // pixel_bin)]
+    fln_expected = {f"data_out_{m}_{n}.png" for m in range(p1[0], p2[0]) for n in range(p1[1], p2[1])}
+    fln_expected.add(f"pixel_sum_{p1[0]}-{p1[1]}_{p2[0]}-{p2[1]}.png")
+    assert set(os.listdir(output_folder)) == fln_expected
+
+
+def test_build_linear_model_cache(tmp_path):
+    """
+    ``_build_linear_model``: the model built using cached columns is identical to the model
+    built by scikit-beam for the series of incident energies. The spectra of K lines and user/pileup
+    peaks are reused for all energies. The columns are loaded from on-disk cache once the in-memory
+    cache is cleared.
+    """
+    param = copy.deepcopy(param_data)
+    elist = ["Ca_K", "Fe_K", "Pt_L", "Pt_M", "Pb_L", "userpeak1", "Fe_Ka1-Fe_Ka1"]
+    param["non_fitting_values"]["element_list"] = ", ".join(elist)
+    energies = [12.0, 13.0, 13.5, 14.0, 14.5, 15.0]
+    num_energy_bins = 4096
+
+    _linear_model_cache.clear()
+    for energy in energies:
+        n_entries = len(_linear_model_cache)
+        param_out, (n_low, n_high), matv, e_select, elist_non_activated = _build_linear_model(
+            param, num_energy_bins=num_energy_bins, incident_energy=energy
+        )
+        assert param_out["coherent_sct_energy"]["value"] == energy
+        e_expected, matv_expected, _ = construct_linear_model(np.arange(n_low, n_high), param_out, elist)
+        assert e_select == e_expected
+        assert set(elist_non_activated) == set(elist) - set(e_select)
+        npt.assert_allclose(matv, matv_expected, rtol=1e-10, atol=1e-14)
+        if energy != energies[0]:
+            # Only Compton, elastic and L and M lines (Pt_L, Pt_M, Pb_L) may be recomputed
+            assert len(_linear_model_cache) - n_entries <= 5
+
+    # The model is not changed if the returned matrix is modified
+    param_out, _, matv, e_select, _ = _build_linear_model(param, num_energy_bins=num_energy_bins)
+    matv_copy = np.array(matv)
+    matv /= 10
+    _, _, matv, _, _ = _build_linear_model(param, num_energy_bins=num_energy_bins)
+    npt.assert_array_equal(matv, matv_copy)
+
+    # The options are applied to the cached model
+    _, _, matv2, e_select2, _ = _build_linear_model(
+        param, num_energy_bins=num_energy_bins, comp_elastic_combine=True, linear_bg=True
+    )
+    assert e_select2 == e_select[:-2] + ["comp_elastic", "const_bkg"]
+    npt.assert_allclose(matv2[:, :-2], matv[:, :-2])
+    npt.assert_allclose(matv2[:, -2], matv[:, -2] + matv[:, -1])
+    npt.assert_array_equal(matv2[:, -1], 1)
+
+    # On-disk cache
+    result_cache = BlockResultCache(str(tmp_path))
+    _linear_model_cache.clear()
+    _, _, matv, e_select, _ = _build_linear_model(
+        param, num_energy_bins=num_energy_bins, result_cache=result_cache
+    )
+    assert len(os.listdir(tmp_path)) == len(e_select)
+    _linear_model_cache.clear()
+    _, _, matv2, e_select2, _ = _build_linear_model(
+        param, num_energy_bins=num_energy_bins, result_cache=result_cache
+    )
+    assert e_select2 == e_select
+    npt.assert_array_equal(matv2, matv)
+    assert len(_linear_model_cache) == len(e_select)
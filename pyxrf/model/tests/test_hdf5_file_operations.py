@@ -1,11 +1,20 @@
 import copy
 import os
 
+import dask.array as da
+import h5py
 import numpy as np
 import numpy.testing as npt
 import pytest
+import tifffile
 
 from pyxrf.api_dev import read_data_from_hdf5, save_data_to_hdf5
+from pyxrf.core.map_cube import MapCube
+from pyxrf.model.fileio import output_data_to_tiff, read_hdf_APS
+from pyxrf.model.fit_spectrum import LiveMapFitter, single_pixel_fitting_controller
+from pyxrf.model.load_data_from_db import _download_datasets, _HDF5RowWriter, _replay_rows_from_hdf5
+from pyxrf.model.param_data import param_data
+from pyxrf.simulation.sim_xrf_scan_data import gen_xrf_map_const
 
 
 def _prepare_raw_dataset(N=5, M=10, K=4096):
@@ -182,3 +191,405 @@ def test_save_data_to_hdf5_4(tmp_path):
 
     assert metadata_loaded["file_software"] == application
     assert metadata_loaded["file_software_version"] == version
+
+
+# fmt: off
+@pytest.mark.parametrize("kwargs, chunks_expected, compression_expected", [
+    ({}, None, "gzip"),
+    ({"compression": None, "chunks": (2, 3)}, (2, 3, 4096), None),
+    ({"compression": "gzip", "chunks": "auto", "shuffle": True}, (5, 10, 4096), "gzip"),
+    ({"compression": "lzf", "chunks": (20, 20)}, (5, 10, 4096), "lzf"),
+    ({"compression": "lz4", "chunks": "auto"}, (5, 10, 4096), None),
+    ({"compression": "zstd", "chunks": "auto", "shuffle": True}, (5, 10, 4096), None),
+    ({"compression": "blosc", "chunks": (1, 1), "shuffle": True}, (1, 1, 4096), None),
+])
+@pytest.mark.parametrize("use_dask", [False, True])
+# fmt: on
+def test_save_data_to_hdf5_5(tmp_path, kwargs, chunks_expected, compression_expected, use_dask):
+    """
+    Storage layout of the fluorescence data: chunks, compression and shuffle filters.
+    """
+    if kwargs.get("compression", None) in ("lz4", "zstd", "blosc"):
+        pytest.importorskip("hdf5plugin")
+
+    fpath = os.path.join(tmp_path, "test.h5")
+    data, metadata = _prepare_raw_dataset(N=5, M=10, K=4096)
+    data["det_sum"] = np.random.random(data["det_sum"].shape).astype(np.float32)
+    if use_dask:
+        data = {k: da.from_array(v) if isinstance(v, np.ndarray) and v.ndim == 3 else v for k, v in data.items()}
+
+    save_data_to_hdf5(fpath, data, metadata=metadata, **kwargs)
+
+    with h5py.File(fpath, "r") as f:
+        for name in ("detsum", "det1", "det2", "det3"):
+            dset = f[f"xrfmap/{name}/counts"]
+            assert dset.dtype == np.float32
+            if chunks_expected:
+                assert dset.chunks == chunks_expected
+            if kwargs.get("compression", "gzip"):
+                assert dset.chunks is not None
+            if compression_expected:
+                assert dset.compression == compression_expected
+            assert dset.shuffle == (kwargs.get("shuffle", False) and kwargs.get("compression", "gzip") != "blosc")
+
+    data_loaded, _ = read_data_from_hdf5(fpath)
+    npt.assert_array_almost_equal(data_loaded["det_sum"], np.asarray(data["det_sum"]))
+    npt.assert_array_almost_equal(data_loaded["det1"], np.asarray(data["det1"]))
+
+
+# fmt: off
+@pytest.mark.parametrize("kwargs, except_type, err_msg", [
+    ({"compression": "bzip2"}, ValueError, "Compression method 'bzip2' is not supported"),
+    ({"chunks": "some_chunks"}, ValueError, "Unsupported value of parameter 'chunks'"),
+    ({"chunks": (2, 3, 4)}, ValueError, "Parameter 'chunks' must be a tuple"),
+])
+# fmt: on
+def test_save_data_to_hdf5_fail(tmp_path, kwargs, except_type, err_msg):
+    """
+    Failing cases: invalid storage layout parameters.
+    """
+    fpath = os.path.join(tmp_path, "test.h5")
+    data, metadata = _prepare_raw_dataset(N=5, M=10, K=4096)
+    with pytest.raises(except_type, match=err_msg):
+        save_data_to_hdf5(fpath, data, metadata=metadata, **kwargs)
+
+
+# fmt: off
+@pytest.mark.parametrize("sets_to_select", ["all", "channels", "sum"])
+@pytest.mark.parametrize("create_each_det", [True, False])
+# fmt: on
+def test_save_data_to_hdf5_dask(tmp_path, sets_to_select, create_each_det):
+    """
+    Save data represented as Dask arrays. The sum is computed from the downloaded channels
+    if it is not provided. NaNs are replaced with zeros.
+    """
+    fpath = os.path.join(tmp_path, "test.h5")
+    data, metadata = _prepare_raw_dataset(N=5, M=10, K=256)
+    for key in ("det1", "det2", "det3"):
+        data[key] = np.random.random(data[key].shape).astype(np.float32)
+        data[key][2, 3, 5] = np.nan
+    data["det_sum"] = np.random.random(data["det_sum"].shape).astype(np.float32)
+
+    if sets_to_select == "sum":
+        for key in ("det1", "det2", "det3"):
+            del data[key]
+    elif sets_to_select == "channels":
+        del data["det_sum"]
+
+    data_dask = {k: da.from_array(v, chunks=(2, 5, 256)) if k.startswith("det") else v for k, v in data.items()}
+    save_data_to_hdf5(fpath, data_dask, metadata=metadata, create_each_det=create_each_det)
+
+    data_loaded, _ = read_data_from_hdf5(fpath)
+    det_channels = [_ for _ in ("det1", "det2", "det3") if _ in data]
+    for key in det_channels:
+        if create_each_det:
+            npt.assert_array_equal(data_loaded[key], np.nan_to_num(data[key]))
+        else:
+            assert key not in data_loaded
+
+    if "det_sum" in data:
+        sum_expected = data["det_sum"]
+    else:
+        sum_expected = sum([np.nan_to_num(data[_]) for _ in det_channels])
+    npt.assert_array_almost_equal(data_loaded["det_sum"], sum_expected)
+
+
+@pytest.mark.parametrize("n_pixels_in_batch", [1, 7, 30, 1000])
+def test_download_datasets(tmp_path, n_pixels_in_batch):
+    """
+    ``_download_datasets``: data is downloaded in batches and the sum is computed.
+    """
+    shape = (11, 6, 20)
+    arrays = [np.random.random(shape).astype(np.float32) for _ in range(3)]
+    with h5py.File(os.path.join(tmp_path, "test.h5"), "w") as f:
+        dsets = [f.create_dataset(f"d{n}", shape, dtype=np.float32) for n in range(len(arrays))]
+        dset_sum = f.create_dataset("sum", shape, dtype=np.float32)
+        # The second array is not saved, but included in the sum
+        download_list = [(dsets[0], da.from_array(arrays[0])), (None, da.from_array(arrays[1]))]
+        download_list.append((dsets[2], da.from_array(arrays[2])))
+
+        _download_datasets(download_list, dset_sum=dset_sum, n_pixels_in_batch=n_pixels_in_batch)
+
+        npt.assert_array_equal(dsets[0][()], arrays[0])
+        assert not np.any(dsets[1][()])
+        npt.assert_array_equal(dsets[2][()], arrays[2])
+        npt.assert_array_almost_equal(dset_sum[()], sum(arrays))
+
+
+def test_download_datasets_fail(tmp_path):
+    """
+    ``_download_datasets``: failure to download the data.
+    """
+
+    class _FailingArray:
+        shape = (4, 5, 10)
+        n_attempts = 0
+
+        def __getitem__(self, key):
+            self.n_attempts += 1
+            raise RuntimeError("Data is not available")
+
+    data = _FailingArray()
+    with h5py.File(os.path.join(tmp_path, "test.h5"), "w") as f:
+        dset = f.create_dataset("d", data.shape, dtype=np.float32)
+        with pytest.raises(TimeoutError, match="Failed to download data"):
+            _download_datasets([(dset, data)], n_download_retries=3)
+    assert data.n_attempts == 3
+
+
+def test_read_hdf_APS(tmp_path):
+    """
+    ``read_hdf_APS``: scalers and positions are loaded correctly. The file is opened
+    read-only, so it can be loaded while it is open for reading elsewhere.
+    """
+    fln = "test.h5"
+    fpath = os.path.join(tmp_path, fln)
+    data, metadata = _prepare_raw_dataset(N=5, M=10, K=256)
+    data["scaler_data"] = np.random.random(data["scaler_data"].shape)
+    save_data_to_hdf5(fpath, data, metadata=metadata)
+
+    with h5py.File(fpath, "r"):
+        img_dict, data_sets, mdata = read_hdf_APS(tmp_path, fln, load_each_channel=True)
+
+    assert set(data_sets.keys()) == {"test_sum", "test_det1", "test_det2", "test_det3"}
+    assert mdata["scan_id"] == metadata["scan_id"]
+
+    scalers = img_dict["test_scaler"]
+    assert list(scalers.keys()) == data["scaler_names"]
+    for n, name in enumerate(data["scaler_names"]):
+        npt.assert_array_equal(scalers[name], data["scaler_data"][:, :, n])
+        assert scalers[name].flags["C_CONTIGUOUS"]
+
+    positions = img_dict["positions"]
+    assert list(positions.keys()) == data["pos_names"]
+    for n, name in enumerate(data["pos_names"]):
+        npt.assert_array_equal(positions[name], data["pos_data"][n, :, :])
+
+
+def _load_raw_datasets(fpath):
+    """Load all datasets from the 'xrfmap' group of the file into a dictionary"""
+    datasets = {}
+    with h5py.File(fpath, "r") as f:
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                datasets[name] = obj[()]
+
+        f["xrfmap"].visititems(visit)
+        metadata = dict(f["xrfmap/scan_metadata"].attrs)
+    return datasets, metadata
+
+
+@pytest.mark.parametrize("snake, transpose", [(False, False), (True, False), (False, True), (True, True)])
+def test_HDF5RowWriter_1(tmp_path, snake, transpose):
+    """
+    ``_HDF5RowWriter``: the file created by writing the map row by row is identical
+    to the file created by ``save_data_to_hdf5``.
+    """
+    N, M, K = 5, 10, 64
+    data, metadata = _prepare_raw_dataset(N=N, M=M, K=K)
+    for key in ("det_sum", "det1", "det2", "det3", "scaler_data", "pos_data"):
+        data[key] = np.random.random(data[key].shape)
+
+    # Data in the order it is acquired (the odd rows are reversed in snake scans)
+    data_acquired = copy.deepcopy(data)
+    if snake:
+        for key in ("det_sum", "det1", "det2", "det3", "scaler_data"):
+            data_acquired[key][1::2, :, :] = data_acquired[key][1::2, ::-1, :]
+        data_acquired["pos_data"][:, 1::2, :] = data_acquired["pos_data"][:, 1::2, ::-1]
+
+    # Reference file
+    data_expected = copy.deepcopy(data)
+    if transpose:
+        for key in ("det_sum", "det1", "det2", "det3", "scaler_data"):
+            data_expected[key] = np.swapaxes(data_expected[key], 0, 1)
+        data_expected["pos_data"] = np.swapaxes(data_expected["pos_data"], 1, 2)
+    fpath_expected = os.path.join(tmp_path, "expected.h5")
+    save_data_to_hdf5(fpath_expected, data_expected, metadata=metadata)
+
+    fpath = os.path.join(tmp_path, "test.h5")
+    with _HDF5RowWriter(
+        fpath, n_cols=M, metadata=metadata, snake=snake, transpose=transpose, pos_names=data["pos_names"]
+    ) as writer:
+        writer.scaler_names = data["scaler_names"]
+        for n in range(N):
+            rows = {key: data_acquired[key][n] for key in ("det_sum", "det1", "det2", "det3")}
+            rows["scalers"] = data_acquired["scaler_data"][n]
+            rows["positions"] = data_acquired["pos_data"][:, n, :]
+            writer.write_row(rows)
+            writer.flush()
+
+    datasets_expected, metadata_expected = _load_raw_datasets(fpath_expected)
+    datasets, metadata_saved = _load_raw_datasets(fpath)
+
+    assert set(datasets.keys()) == set(datasets_expected.keys())
+    for key, value in datasets_expected.items():
+        assert datasets[key].dtype == value.dtype, key
+        if value.dtype.kind in ("S", "O"):
+            npt.assert_array_equal(datasets[key], value, err_msg=key)
+        else:
+            npt.assert_array_almost_equal(datasets[key], value, err_msg=key)
+
+    metadata_expected.pop("file_created_time")
+    metadata_saved.pop("file_created_time")
+    assert metadata_saved == metadata_expected
+
+
+def test_HDF5RowWriter_2(tmp_path):
+    """
+    ``_HDF5RowWriter``: corrupt rows are replaced with the nearest good row
+    """
+    N, M, K = 6, 10, 32
+    data = np.random.random((N, M, K))
+    rows = list(data)
+    rows[0] = None  # Missing row (replaced with row #1)
+    rows[3] = data[3, :-1, :]  # Incorrect number of points (replaced with row #2)
+    rows[4] = np.zeros((0,))  # Empty row (replaced with row #2)
+
+    fpath = os.path.join(tmp_path, "test.h5")
+    with _HDF5RowWriter(fpath, n_cols=M) as writer:
+        for n, row in enumerate(rows):
+            writer.write_row({"det_sum": row} if n != 5 else {})
+
+    with h5py.File(fpath, "r") as f:
+        data_saved = f["xrfmap/detsum/counts"][()]
+        assert "positions" not in f["xrfmap"]
+
+    data_expected = np.array([data[1], data[1], data[2], data[2], data[2], data[2]], dtype=np.float32)
+    npt.assert_array_equal(data_saved, data_expected)
+
+    # The file already exists
+    with pytest.raises(IOError, match="File .* already exists"):
+        _HDF5RowWriter(fpath, n_cols=M)
+
+
+# fmt: off
+@pytest.mark.parametrize("snake, transpose, rows_per_block", [
+    (False, False, 1),
+    (True, False, 2),
+    (True, True, 4),
+])
+# fmt: on
+def test_HDF5RowWriter_live_fitting(tmp_path, snake, transpose, rows_per_block):
+    """
+    ``_HDF5RowWriter``: rows are fitted while the data is written ('processing while acquiring' mode).
+    The scan is replayed from the file with raw data. The results are the same as the results
+    of ``single_pixel_fitting_controller``.
+    """
+    ny, nx = 5, 6
+    incident_energy = 12.0
+    param = copy.deepcopy(param_data)
+    param["non_fitting_values"]["element_list"] = "Ca_K, Fe_K, Cu_K, Pb_L"
+
+    data, _ = gen_xrf_map_const(
+        {"Ca_K": {"area": 800}, "Fe_K": {"area": 900}, "Cu_K": {"area": 700}},
+        nx=nx,
+        ny=ny,
+        incident_energy=incident_energy,
+        background_area=100,
+    )
+    data = data * (np.random.random((ny, nx, 1)) + 0.5)
+
+    fpath_raw = os.path.join(tmp_path, "raw.h5")
+    save_data_to_hdf5(fpath_raw, {"det_sum": data})
+
+    live_fitter = LiveMapFitter(param, incident_energy=incident_energy, rows_per_block=rows_per_block)
+    n_rows = nx if transpose else ny
+
+    fpath = os.path.join(tmp_path, "test.h5")
+    with _HDF5RowWriter(
+        fpath, n_cols=ny if transpose else nx, snake=snake, transpose=transpose, live_fitter=live_fitter
+    ) as writer:
+        for n, rows in enumerate(_replay_rows_from_hdf5(fpath_raw, snake=snake, transpose=transpose)):
+            writer.write_row(rows)
+            # Partial maps are available while the data is written
+            assert writer.n_rows_fitted == (n + 1) // rows_per_block * rows_per_block
+            if writer.n_rows_fitted:
+                # The partial maps are read from the file opened in SWMR mode
+                with h5py.File(writer.fpath_live, "r", libver="latest", swmr=True) as f:
+                    dset = f["xrfmap/detsum/xrf_fit"]
+                    dset.refresh()
+                    assert dset.shape[2 if transpose else 1] == writer.n_rows_fitted
+        assert n == n_rows - 1
+    # The file with partial maps is deleted
+    assert writer.fpath_live == os.path.join(tmp_path, "test_live.h5")
+    assert not os.path.exists(writer.fpath_live)
+
+    result_map, _ = single_pixel_fitting_controller(data, param, incident_energy=incident_energy, dask_client=None)
+
+    with h5py.File(fpath, "r") as f:
+        npt.assert_array_almost_equal(f["xrfmap/detsum/counts"][()], data.astype(np.float32))
+        map_names = [_.decode() for _ in f["xrfmap/detsum/xrf_fit_name"][()]]
+        xrf_fit = f["xrfmap/detsum/xrf_fit"][()]
+
+    assert map_names == live_fitter.get_map_names(data.shape[2])
+    assert map_names == list(result_map.keys())
+    assert map_names[-1] == "Pb_L"  # The line is not activated (zero map)
+    assert xrf_fit.shape == (len(map_names), ny, nx)
+    for n, name in enumerate(map_names):
+        npt.assert_allclose(xrf_fit[n], result_map[name], rtol=1e-5, atol=1e-4, err_msg=name)
+
+
+@pytest.mark.parametrize("file_format", ["txt", "tiff", "tiff_stack", "npz", "h5"])
+def test_output_data_to_tiff(file_format, tmp_path):
+    """
+    Raw and normalized maps are exported to separate files or to stacked files
+    """
+    ny, nx = 6, 8
+    fit_output = {
+        "Fe_K": np.random.random((ny, nx)) * 100,
+        "Ca_K": np.random.random((ny, nx)) * 50,
+        "i0": np.random.random((ny, nx)) + 1,
+        "x_pos": np.broadcast_to(np.arange(nx, dtype=float), (ny, nx)),
+    }
+    scale = np.mean(fit_output["i0"]) / fit_output["i0"]
+    expected = {
+        "": fit_output,
+        "_norm": {
+            "Fe_K": fit_output["Fe_K"] * scale,
+            "Ca_K": fit_output["Ca_K"] * scale,
+            "i0": fit_output["i0"] * scale,
+        },
+    }
+
+    output_dir = os.path.join(tmp_path, "output")
+    output_data_to_tiff(
+        fit_output,
+        output_dir=output_dir,
+        file_format=file_format,
+        name_prefix_detector="detsum",
+        scaler_name="i0",
+        scaler_name_list=["i0"],
+        use_average=True,
+        n_threads=3,
+    )
+
+    for name_append, maps in expected.items():
+        if file_format in ("txt", "tiff"):
+            assert len(os.listdir(output_dir)) == 7
+            maps_loaded = {}
+            for name in maps:
+                fln = name if name in ("i0", "x_pos") else f"detsum_{name}"
+                fpath = os.path.join(output_dir, f"{fln}{name_append}.{file_format}")
+                maps_loaded[name] = np.loadtxt(fpath) if file_format == "txt" else tifffile.imread(fpath)
+        else:
+            assert len(os.listdir(output_dir)) == 2
+            fpath = os.path.join(
+                output_dir, f"detsum_maps{name_append}.{'tiff' if file_format == 'tiff_stack' else file_format}"
+            )
+            if file_format == "tiff_stack":
+                with tifffile.TiffFile(fpath) as f:
+                    maps_loaded = dict(zip(f.shaped_metadata[0]["names"], f.asarray()))
+            elif file_format == "npz":
+                with np.load(fpath) as f:
+                    maps_loaded = dict(zip(f["names"], f["data"]))
+            else:
+                with h5py.File(fpath, "r") as f:
+                    maps_loaded = MapCube.from_hdf5(f, data_name="maps", names_name="map_names")
+
+        assert list(maps_loaded.keys()) == list(maps.keys())
+        for name in maps:
+            npt.assert_allclose(maps_loaded[name], maps[name], rtol=1e-6, err_msg=name)
+
+    with pytest.raises(RuntimeError, match="The specified format 'abc' not in"):
+        output_data_to_tiff(fit_output, output_dir=output_dir, file_format="abc")
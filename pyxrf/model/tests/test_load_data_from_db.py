@@ -0,0 +1,118 @@
+import types
+
+import h5py
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+
+from pyxrf.model import load_data_from_db
+from pyxrf.model.fit_spectrum import LiveMapFitter
+from pyxrf.model.load_data_from_db import (
+    _get_positions_and_scalers_2D,
+    _HDF5RowWriter,
+    _write_data2D_rows,
+    map_data2D,
+)
+from pyxrf.model.param_data import param_data
+
+
+def _prepare_table_data(n_pixels, *, n_bins=50):
+    """
+    Data in the format returned by Databroker (``hdr.table()``): the spectrum, the positions and
+    the scalers for each pixel of the map. The rows of the table are numbered starting from 1.
+    """
+    det_list = ["xspress3_ch1", "xspress3_ch2"]
+    pos_list = ["zpssx", "zpssy"]
+    scaler_list = ["sclr1_ch3", "sclr1_ch4"]
+    index = range(1, n_pixels + 1)
+    data = {}
+    for name in det_list:
+        data[name] = pd.Series([np.random.random(n_bins) for _ in index], index=index)
+    for name in pos_list + scaler_list:
+        data[name] = pd.Series(np.random.random(n_pixels), index=index)
+    return data, det_list, pos_list, scaler_list
+
+
+# fmt: off
+@pytest.mark.parametrize("n_pixels, create_each_det, flip_rows", [
+    (16, False, False),
+    (14, True, False),  # Incomplete scan: the last incomplete row is discarded
+    (14, False, True),
+])
+# fmt: on
+def test_write_data2D_rows(tmp_path, monkeypatch, n_pixels, create_each_det, flip_rows):
+    """
+    ``_write_data2D_rows``: the maps written to the file row by row are identical to the maps
+    assembled in memory by ``map_data2D``.
+    """
+    monkeypatch.setattr(load_data_from_db, "_get_db", lambda: types.SimpleNamespace(name="srx"))
+
+    datashape, spectrum_len = [4, 4], 64
+    data, det_list, pos_list, scaler_list = _prepare_table_data(n_pixels)
+
+    data_expected = map_data2D(
+        data,
+        datashape,
+        det_list=det_list,
+        pos_list=list(pos_list),
+        scaler_list=scaler_list,
+        create_each_det=create_each_det,
+        spectrum_len=spectrum_len,
+    )
+    if flip_rows:
+        for key in ("det_sum", "det1", "det2"):
+            if key in data_expected:
+                data_expected[key] = np.flip(data_expected[key], axis=1)
+
+    pos_names, pos_data, scaler_names, scaler_data = _get_positions_and_scalers_2D(
+        data, datashape, nv=datashape[0], nh=datashape[1], pos_list=list(pos_list), scaler_list=scaler_list
+    )
+    fpath = tmp_path / "test.h5"
+    with _HDF5RowWriter(fpath, n_cols=datashape[1], pos_names=pos_names, scaler_names=scaler_names) as writer:
+        n_rows = _write_data2D_rows(
+            writer,
+            data,
+            datashape[1],
+            det_list=det_list,
+            pos_data=pos_data,
+            scaler_data=scaler_data,
+            create_each_det=create_each_det,
+            spectrum_len=spectrum_len,
+            flip_rows=flip_rows,
+        )
+    assert n_rows == data_expected["det_sum"].shape[0]
+
+    with h5py.File(fpath, "r") as f:
+        assert ("det1" in f["xrfmap"]) == create_each_det
+        for key, group in (("det_sum", "detsum"), ("det1", "det1"), ("det2", "det2")):
+            if key in data_expected:
+                npt.assert_array_almost_equal(f[f"xrfmap/{group}/counts"][()], data_expected[key], err_msg=key)
+        npt.assert_array_almost_equal(f["xrfmap/positions/pos"][()], data_expected["pos_data"])
+        npt.assert_array_almost_equal(f["xrfmap/scalers/val"][()], data_expected["scaler_data"])
+        assert [_.decode() for _ in f["xrfmap/positions/name"][()]] == data_expected["pos_names"]
+
+
+def test_write_data2D_rows_fail(tmp_path, monkeypatch):
+    """
+    ``_write_data2D_rows``: no data for the detector channels
+    """
+    monkeypatch.setattr(load_data_from_db, "_get_db", lambda: types.SimpleNamespace(name="srx"))
+    data, _, _, _ = _prepare_table_data(8)
+
+    with _HDF5RowWriter(tmp_path / "test.h5", n_cols=4) as writer:
+        with pytest.raises(RuntimeError, match="No data is found for the detector channels"):
+            _write_data2D_rows(
+                writer,
+                data,
+                4,
+                det_list=["xspress3_ch5"],
+                pos_data=np.zeros([2, 2, 4]),
+                scaler_data=np.zeros([2, 4, 1]),
+            )
+
+
+@pytest.mark.parametrize("rows_per_block", [0, -1, 1.5])
+def test_LiveMapFitter_fail(rows_per_block):
+    with pytest.raises(ValueError, match="Parameter 'rows_per_block' must be a positive integer"):
+        LiveMapFitter(param_data, rows_per_block=rows_per_block)
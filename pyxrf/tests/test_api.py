@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import pyxrf
+
+# The modules that are not needed for batch processing and must not be imported with the API
+_heavy_modules = [
+    "matplotlib.pyplot",
+    "event_model",
+    "pyxrf.gui_support.gpc_class",
+    "pyxrf.simulation.sim_xrf_scan_data",
+    "pyxrf.xanes_maps.xanes_maps_api",
+]
+
+
+def _run_python(code):
+    """Run the code in a new Python process and return the output printed as JSON string"""
+    # The process is started from the directory that contains the package, so that the package
+    #   is found even if it is not installed and the current directory was changed by other tests.
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(pyxrf.__file__)))
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=cwd)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("api_module", ["pyxrf.api_dev", "pyxrf.api"])
+def test_api_import_time(api_module):
+    """
+    Importing the API module does not import the modules that implement the API functions.
+    The import time is a small fraction of the time needed to import all modules.
+    """
+    code = f"""
+import json, sys, time
+t0 = time.perf_counter()
+import {api_module}
+t_api = time.perf_counter() - t0
+loaded = [_ for _ in {_heavy_modules + ["pyxrf.model.command_tools"]!r} if _ in sys.modules]
+t0 = time.perf_counter()
+from pyxrf.api_dev import autofind_emission_lines, build_xanes_map, gen_hdf5_qa_dataset, pyxrf_batch
+t_all = time.perf_counter() - t0
+print(json.dumps({{"t_api": t_api, "t_all": t_all, "loaded": loaded}}))
+"""
+    result = _run_python(code)
+    assert result["loaded"] == []
+    assert result["t_api"] < 0.25 * result["t_all"]
+
+
+def test_api_batch_processing_imports():
+    """
+    Importing the functions for batch processing does not import GUI, XANES and simulation
+    modules and does not open the catalog.
+    """
+    code = f"""
+import json, sys
+from pyxrf.api_dev import pyxrf_batch, dask_client_create
+import pyxrf.model.load_data_from_db as ldb
+loaded = [_ for _ in {_heavy_modules!r} if _ in sys.modules]
+print(json.dumps({{"loaded": loaded, "db_opened": ldb._db_opened}}))
+"""
+    result = _run_python(code)
+    assert result["loaded"] == []
+    assert result["db_opened"] is False
+
+
+def test_api_lazy_attributes():
+    import pyxrf.api_dev as api_dev
+    from pyxrf.core.map_processing import dask_client_create
+    from pyxrf.model.command_tools import pyxrf_batch
+
+    assert api_dev.pyxrf_batch is pyxrf_batch
+    assert api_dev.dask_client_create is dask_client_create
+    assert api_dev.db_analysis is None
+    assert set(api_dev.__all__).issubset(dir(api_dev))
+
+    with pytest.raises(AttributeError, match="has no attribute 'abc'"):
+        api_dev.abc
@@ -7,6 +7,9 @@ import numpy as np
 import numpy.testing as npt
 import pandas as pd
 import pytest
+import scipy.ndimage
+import tifffile
+from pystackreg import StackReg
 
 from pyxrf.core.yaml_param_files import (
     _parse_docstring_parameters,
@@ -14,11 +17,16 @@ from pyxrf.core.yaml_param_files import (
     create_yaml_parameter_file,
     read_yaml_parameter_file,
 )
+from pyxrf.model.fileio import save_fitdata_to_hdf
+from pyxrf.model.load_data_from_db import save_data_to_hdf5
 from pyxrf.xanes_maps.xanes_maps_api import (
+    _align_stacks,
     _build_xanes_map_api,
     _build_xanes_map_param_default,
     _build_xanes_map_param_schema,
+    _compute_stack_shifts,
     _save_spectrum_as_csv,
+    _shift_stacks,
     adjust_incident_beam_energies,
     build_xanes_map,
     check_elines_activation_status,
@@ -270,6 +278,10 @@ def test_build_xanes_map_3():
     with pytest.raises(ValueError, match="The parameter 'xrf_subdir' is None or contains an empty string"):
         build_xanes_map(emission_line="Fe_K", xrf_subdir="", allow_exceptions=True)
 
+    # Unsupported alignment method
+    with pytest.raises(ValueError, match="The parameter 'alignment_method' has illegal value 'abc'"):
+        _build_xanes_map_api(emission_line="Fe_K", alignment_method="abc")
+
     # The function should succeed if exceptions are not allowed
     build_xanes_map(emission_line="Fe_K", xrf_subdir="")
 
@@ -294,6 +306,153 @@ def test_build_xanes_map_4(tmp_path):
     build_xanes_map(emission_line="Fe_K", parameter_file_path=file_path, xrf_subdir="")
 
 
+def _create_xanes_dataset(wd_xrf, *, ny=6, nx=8):
+    r"""
+    Creates the set of processed HDF5 files (one file per incident energy) with XRF maps
+    for the emission line 'Fe_K' and CSV file with two references. The XRF maps are linear
+    combinations of the references with known non-negative weights.
+    Returns the path to the reference file, the weights (shape (2, ny, nx)) and
+    the references sampled at incident energies (shape (N, 2)).
+    """
+    energies = np.round(np.linspace(7.10, 7.14, 21), 5)
+    refs = np.zeros(shape=[len(energies), 2])
+    refs[:, 0] = 1.0 / (1.0 + np.exp(-(energies - 7.115) / 0.003))
+    refs[:, 1] = 1.0 / (1.0 + np.exp(-(energies - 7.125) / 0.003)) + 0.5 * np.exp(
+        -(((energies - 7.130) / 0.004) ** 2)
+    )
+
+    rng = np.random.default_rng(0)
+    weights = rng.uniform(0.5, 2.0, size=[2, ny, nx])
+    weights[1, 0, :] = 0  # Some pixels contain only one state
+
+    ref_file_name = os.path.join(os.path.dirname(wd_xrf), "refs.csv")
+    pd.DataFrame({"Energy": energies * 1000, "ref1": refs[:, 0], "ref2": refs[:, 1]}).to_csv(
+        ref_file_name, index=False
+    )
+
+    os.makedirs(wd_xrf, exist_ok=True)
+    pos_data = np.zeros(shape=[2, ny, nx])
+    pos_data[0, :, :] = np.broadcast_to(np.arange(nx) * 0.1, shape=[ny, nx])
+    pos_data[1, :, :] = np.broadcast_to(np.arange(ny)[:, np.newaxis] * 0.1, shape=[ny, nx])
+    for n, energy in enumerate(energies):
+        fpath = os.path.join(wd_xrf, f"scan2D_{1000 + n}.h5")
+        data = {
+            "det_sum": np.ones(shape=[ny, nx, 16]),
+            "scaler_names": ["i0"],
+            "scaler_data": np.ones(shape=[ny, nx, 1]),
+            "pos_names": ["x_pos", "y_pos"],
+            "pos_data": pos_data,
+        }
+        metadata = {"scan_id": 1000 + n, "instrument_mono_incident_energy": energy}
+        save_data_to_hdf5(fpath, data, metadata=metadata, create_each_det=False)
+        xrf_map = np.tensordot(refs[n, :], weights, axes=1)
+        save_fitdata_to_hdf(fpath, {"Fe_K": xrf_map}, datapath="xrfmap/detsum")
+
+    return ref_file_name, weights, refs
+
+
+@pytest.mark.parametrize("fitting_method", ["nnls", "nnls_gram"])
+def test_build_xanes_map_5(tmp_path, fitting_method):
+    """Build XANES maps from processed HDF5 files using each of the NNLS methods"""
+
+    xrf_subdir = "xrf_data"
+    ref_file_name, weights, refs = _create_xanes_dataset(os.path.join(tmp_path, xrf_subdir))
+
+    build_xanes_map(
+        sequence="build_xanes_map",
+        wd=str(tmp_path),
+        xrf_subdir=xrf_subdir,
+        emission_line="Fe_K",
+        ref_file_name=ref_file_name,
+        fitting_method=fitting_method,
+        alignment_enable=False,
+        interpolation_enable=False,
+        subtract_pre_edge_baseline=False,
+        plot_results=False,
+        output_file_formats=["tiff"],
+        results_dir_suffix=fitting_method,
+        allow_exceptions=True,
+    )
+
+    fpath = os.path.join(tmp_path, f"nanoXANES_Analysis_{fitting_method}", "maps_XANES_Fe_K.tiff")
+    assert os.path.isfile(fpath), f"File '{fpath}' was not created"
+    xanes_maps = tifffile.imread(fpath)
+
+    # The saved maps are scaled to represent counts
+    xanes_maps_expected = weights * np.sum(refs, axis=0)[:, np.newaxis, np.newaxis]
+    npt.assert_array_almost_equal(xanes_maps, xanes_maps_expected, decimal=3)
+
+    # Unsupported fitting method
+    with pytest.raises(ValueError, match="The fitting method 'abc' is not supported"):
+        _build_xanes_map_api(emission_line="Fe_K", xrf_subdir=xrf_subdir, fitting_method="abc")
+
+
+def _generate_shifted_stack(offsets, *, ny=40, nx=50):
+    """Generate stack of maps, which are shifted copies of the same random image"""
+    img = scipy.ndimage.gaussian_filter(np.random.random((ny + 20, nx + 20)), 1.5)
+    return np.asarray([img[10 + dy : 10 + dy + ny, 10 + dx : 10 + dx + nx] for dy, dx in offsets])
+
+
+@pytest.mark.parametrize("alignment_starts_from", ["top", "bottom"])
+@pytest.mark.parametrize("alignment_method", ["stackreg", "phase_correlation"])
+def test_align_stacks_1(alignment_starts_from, alignment_method):
+    """
+    Translations are computed using the alignment stack and applied to all stacks.
+    """
+    offsets = [(0, 0), (1, -2), (3, -1), (2, 2), (-1, 3)]
+    n_maps = len(offsets)
+    data = _generate_shifted_stack(offsets)
+    eline_data = {"Fe_K": data * 10, "Ca_K": data * 2}
+
+    shifts = _compute_stack_shifts(
+        data, alignment_starts_from=alignment_starts_from, alignment_method=alignment_method
+    )
+    n_ref = n_maps - 1 if alignment_starts_from == "top" else 0
+    shifts_expected = np.asarray(offsets) - np.asarray(offsets[n_ref])
+    atol = 0.01 if alignment_method == "stackreg" else 0.3
+    npt.assert_allclose(shifts, shifts_expected, atol=atol)
+
+    eline_data_aligned = _align_stacks(
+        eline_data,
+        "Fe_K",
+        alignment_starts_from=alignment_starts_from,
+        alignment_method=alignment_method,
+        n_threads=2,
+    )
+    assert set(eline_data_aligned.keys()) == {"Fe_K", "Ca_K", "ALIGN"}
+    for eline, data_aligned in eline_data_aligned.items():
+        assert data_aligned.shape == data.shape
+        assert np.all(data_aligned >= 0)
+    npt.assert_array_almost_equal(eline_data_aligned["Fe_K"], eline_data_aligned["Ca_K"] * 5)
+
+    if alignment_method == "stackreg":
+        # Aligned maps match the reference map (except pixels shifted from outside the map)
+        data_aligned = eline_data_aligned["Fe_K"]
+        for n in range(n_maps):
+            npt.assert_allclose(data_aligned[n, 5:-5, 5:-5], data_aligned[n_ref, 5:-5, 5:-5], rtol=1e-2)
+
+
+def test_align_stacks_2():
+    """
+    Results of shifting the stacks are the same as the results of ``StackReg.transform_stack``.
+    """
+    stacks = [np.random.random((4, 20, 30)), np.random.random((4, 20, 30)).astype(np.float32)]
+    shifts = np.array([[0, 0], [1.3, -2.7], [-0.4, 0.6], [3, 2]])
+    tmats = np.zeros([len(shifts), 3, 3])
+    tmats[:, :, :] = np.eye(3)
+    tmats[:, 0, 2], tmats[:, 1, 2] = -shifts[:, 1], -shifts[:, 0]
+
+    stacks_shifted = _shift_stacks(stacks, shifts, n_threads=2)
+    sr = StackReg(StackReg.TRANSLATION)
+    for data, data_shifted in zip(stacks, stacks_shifted):
+        assert data_shifted.shape == data.shape
+        assert data_shifted.dtype == np.float64
+        npt.assert_array_almost_equal(data_shifted, sr.transform_stack(data, tmats=tmats), decimal=5)
+
+    with pytest.raises(ValueError, match="Unsupported alignment method"):
+        _compute_stack_shifts(stacks[0], alignment_method="unknown")
+
+
 # fmt: off
 @pytest.mark.parametrize("kwargs", [
     {},
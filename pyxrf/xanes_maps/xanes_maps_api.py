@@ -1,3 +1,4 @@
+import concurrent.futures
 import csv
 import logging
 import os
@@ -9,17 +10,19 @@ import jsonschema
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import scipy.ndimage
 import tifffile
 from matplotlib.patches import FancyArrow, Rectangle
 from matplotlib.widgets import Button, Slider, TextBox
 from pystackreg import StackReg
+from skimage.registration import phase_cross_correlation
 
 from ..core.fitting import fit_spectrum, rfactor_compute
-from ..core.map_processing import dask_client_create
-from ..core.utils import convert_time_to_nexus_string, grid_interpolate, normalize_data_by_scaler
-from ..core.xrf_utils import check_if_eline_is_activated, check_if_eline_supported
+from ..core.map_processing import dask_cluster_manager, fit_xanes_map
+from ..core.utils import GridInterpolator, convert_time_to_nexus_string, grid_interpolate, normalize_data_by_scaler
+from ..core.xrf_utils import check_if_eline_supported, compute_eline_cs
 from ..core.yaml_param_files import create_yaml_parameter_file, read_yaml_parameter_file
-from ..model.command_tools import pyxrf_batch
+from ..model.command_tools import fit_pixel_data_batch
 from ..model.fileio import read_hdf_APS
 from ..model.load_data_from_db import make_hdf
 
@@ -270,6 +273,14 @@ def build_xanes_map(
         the top of the stack.
         Default: ``"top"``
 
+    alignment_method : str
+        The method used to compute translations of the maps of the image stack:
+        "stackreg" - registration using ``pystackreg`` package, "phase_correlation" -
+        FFT-based phase correlation with subpixel precision, which is substantially
+        faster for large stacks. The translations are computed once and applied to
+        the stacks for all emission lines.
+        Default: ``"stackreg"``
+
     interpolation_enable : bool
         enable interpolation of XRF maps to uniform grid before alignment of maps.
         Default: ``True``
@@ -298,12 +309,14 @@ def build_xanes_map(
 
     fitting_method : str
         method used for fitting XANES spectra. The currently supported methods are
-        'nnls' and 'admm'.
+        'nnls', 'nnls_gram' and 'admm'. The 'nnls_gram' method solves the same NNLS problem
+        using the Gram matrix of the references precomputed once for all pixels, which is
+        much faster for large maps.
         Default: ``"nnls"``
 
     fitting_descent_rate : float
         optimization parameter: descent rate for the fitting algorithm.
-        Used only for 'admm' algorithm (rate = 1/lambda), ignored for 'nnls' algorithm.
+        Used only for 'admm' algorithm (rate = 1/lambda), ignored for 'nnls' and 'nnls_gram' algorithms.
         Default: ``0.2``
 
     incident_energy_low_bound : float
@@ -322,6 +335,13 @@ def build_xanes_map(
         this parameter is ignored.
         Default: ``False``
 
+    xrf_fitting_batch_size : int
+        the number of data files fitted concurrently when XRF maps are computed. The fitting
+        graphs for all files in the batch are submitted to Dask client at once, which keeps
+        all workers busy when processing series of small maps. The linear model is computed
+        once for each distinct value of incident energy.
+        Default: ``16``
+
     plot_results : bool
         indicates if results (image stack and XANES maps) are to be plotted. If set to
         False, the processing results are saved to file (if enabled) and the program
@@ -353,17 +373,14 @@ def build_xanes_map(
         Default value: False
 
     dask_client : dask.distributed.Client
-        Dask client object. If None, then Dask client is created automatically.
-        If a batch of files is processed, then creating Dask client and
-        passing the reference to it to the processing functions will save
-        execution time:
+        Dask client object. If None, then the shared local Dask cluster is used. The cluster
+        is created on the first call and reused by the following calls, so the start-up cost
+        is paid only once per process. The cluster may be configured before processing:
 
         .. code:: python
 
-            from pyxrf.api import dask_client_create
-            client = dask_client_create()  # Create Dask client
-            # <-- code that runs computations -->
-            client.close()  # Close Dask client
+            from pyxrf.api import dask_cluster_manager
+            dask_cluster_manager.configure(n_workers=4, memory_limit="4GB")
 
     parameter_file_path : str
         absolute or relative path to the YAML file, which contains the processing parameters.
@@ -489,6 +506,7 @@ _build_xanes_map_param_default = {
     "emission_line_alignment": None,
     "incident_energy_shift_keV": 0,
     "alignment_starts_from": "top",
+    "alignment_method": "stackreg",
     "interpolation_enable": True,
     "alignment_enable": True,
     "normalize_alignment_stack": True,
@@ -498,6 +516,7 @@ _build_xanes_map_param_default = {
     "fitting_descent_rate": 0.2,
     "incident_energy_low_bound": None,
     "use_incident_energy_from_param_file": False,
+    "xrf_fitting_batch_size": 16,
     "plot_results": True,
     "plot_use_position_coordinates": True,
     "plot_position_axes_units": r"$\mu $m",
@@ -526,6 +545,7 @@ _build_xanes_map_param_schema = {
         "emission_line_alignment",
         "incident_energy_shift_keV",
         "alignment_starts_from",
+        "alignment_method",
         "interpolation_enable",
         "alignment_enable",
         "normalize_alignment_stack",
@@ -535,6 +555,7 @@ _build_xanes_map_param_schema = {
         "fitting_descent_rate",
         "incident_energy_low_bound",
         "use_incident_energy_from_param_file",
+        "xrf_fitting_batch_size",
         "plot_results",
         "plot_use_position_coordinates",
         "plot_position_axes_units",
@@ -557,15 +578,17 @@ _build_xanes_map_param_schema = {
         "emission_line_alignment": {"type": ["string", "null"]},
         "incident_energy_shift_keV": {"type": "number"},
         "alignment_starts_from": {"type": "string", "enum": ["top", "bottom"]},
+        "alignment_method": {"type": "string", "enum": ["stackreg", "phase_correlation"]},
         "interpolation_enable": {"type": "boolean"},
         "alignment_enable": {"type": "boolean"},
         "normalize_alignment_stack": {"type": "boolean"},
         "subtract_pre_edge_baseline": {"type": "boolean"},
         "ref_file_name": {"type": ["string", "null"]},
-        "fitting_method": {"type": "string", "enum": ["nnls", "admm"]},
+        "fitting_method": {"type": "string", "enum": ["nnls", "nnls_gram", "admm"]},
         "fitting_descent_rate": {"type": "number", "exclusiveMinimum": 0.0},
         "incident_energy_low_bound": {"type": ["number", "null"], "exclusiveMinimum": 0.0},
         "use_incident_energy_from_param_file": {"type": "boolean"},
+        "xrf_fitting_batch_size": {"type": "integer", "exclusiveMinimum": 0},
         "plot_results": {"type": "boolean"},
         "plot_use_position_coordinates": {"type": "boolean"},
         "plot_position_axes_units": {"type": "string"},
@@ -597,6 +620,7 @@ def _build_xanes_map_api(
     emission_line_alignment=None,
     incident_energy_shift_keV=0,
     alignment_starts_from="top",
+    alignment_method="stackreg",
     interpolation_enable=True,
     alignment_enable=True,
     normalize_alignment_stack=True,
@@ -606,6 +630,7 @@ def _build_xanes_map_api(
     fitting_descent_rate=0.2,
     incident_energy_low_bound=None,
     use_incident_energy_from_param_file=False,
+    xrf_fitting_batch_size=16,
     plot_results=True,
     plot_use_position_coordinates=True,
     plot_position_axes_units=r"$\mu $m",
@@ -743,6 +768,14 @@ def _build_xanes_map_api(
         the top of the stack.
         Default: ``"top"``
 
+    alignment_method : str
+        The method used to compute translations of the maps of the image stack:
+        "stackreg" - registration using ``pystackreg`` package, "phase_correlation" -
+        FFT-based phase correlation with subpixel precision, which is substantially
+        faster for large stacks. The translations are computed once and applied to
+        the stacks for all emission lines.
+        Default: ``"stackreg"``
+
     interpolation_enable : bool
         enable interpolation of XRF maps to uniform grid before alignment of maps.
         Default: ``True``
@@ -771,12 +804,14 @@ def _build_xanes_map_api(
 
     fitting_method : str
         method used for fitting XANES spectra. The currently supported methods are
-        'nnls' and 'admm'.
+        'nnls', 'nnls_gram' and 'admm'. The 'nnls_gram' method solves the same NNLS problem
+        using the Gram matrix of the references precomputed once for all pixels, which is
+        much faster for large maps.
         Default: ``"nnls"``
 
     fitting_descent_rate : float
         optimization parameter: descent rate for the fitting algorithm.
-        Used only for 'admm' algorithm (rate = 1/lambda), ignored for 'nnls' algorithm.
+        Used only for 'admm' algorithm (rate = 1/lambda), ignored for 'nnls' and 'nnls_gram' algorithms.
         Default: ``0.2``
 
     incident_energy_low_bound : float
@@ -795,6 +830,13 @@ def _build_xanes_map_api(
         this parameter is ignored.
         Default: ``False``
 
+    xrf_fitting_batch_size : int
+        the number of data files fitted concurrently when XRF maps are computed. The fitting
+        graphs for all files in the batch are submitted to Dask client at once, which keeps
+        all workers busy when processing series of small maps. The linear model is computed
+        once for each distinct value of incident energy.
+        Default: ``16``
+
     plot_results : bool
         indicates if results (image stack and XANES maps) are to be plotted. If set to
         False, the processing results are saved to file (if enabled) and the program
@@ -886,6 +928,13 @@ def _build_xanes_map_api(
             f"'{alignment_starts_from}' ('_build_xanes_map_api')."
         )
 
+    alignment_method_values = ["stackreg", "phase_correlation"]
+    alignment_method = alignment_method.lower()
+    if alignment_method not in alignment_method_values:
+        raise ValueError(
+            f"The parameter 'alignment_method' has illegal value '{alignment_method}' ('_build_xanes_map_api')."
+        )
+
     # Selected emission lines for XANES and image stack alignment
     eline_selected = emission_line
     if emission_line_alignment:
@@ -909,7 +958,7 @@ def _build_xanes_map_api(
 
     # Check fitting method
     fitting_method = fitting_method.lower()
-    supported_fitting_methods = ("nnls", "admm")
+    supported_fitting_methods = ("nnls", "nnls_gram", "admm")
     if fitting_method not in supported_fitting_methods:
         raise ValueError(
             f"The fitting method '{fitting_method}' is not supported. "
@@ -980,6 +1029,7 @@ def _build_xanes_map_api(
             eline_selected=eline_selected,
             incident_energy_low_bound=incident_energy_low_bound,
             use_incident_energy_from_param_file=use_incident_energy_from_param_file,
+            xrf_fitting_batch_size=xrf_fitting_batch_size,
             dask_client=dask_client,
         )
         logger.info("Processing data files (computing XRF maps): success.")
@@ -1002,9 +1052,11 @@ def _build_xanes_map_api(
             fitting_descent_rate=fitting_descent_rate,
             incident_energy_shift_keV=incident_energy_shift_keV,
             alignment_starts_from=alignment_starts_from,
+            alignment_method=alignment_method,
             ref_energy=ref_energy,
             ref_data=ref_data,
             subtract_pre_edge_baseline=subtract_pre_edge_baseline,
+            dask_client=dask_client,
         )
 
         res_dir = _generate_output_dir_name(wd=wd, dir_suffix=results_dir_suffix)
@@ -1098,6 +1150,7 @@ def _process_xrf_data(
     eline_selected,
     incident_energy_low_bound,
     use_incident_energy_from_param_file,
+    xrf_fitting_batch_size,
     dask_client,
 ):
     r"""
@@ -1145,6 +1198,9 @@ def _process_xrf_data(
         energy from data files. If ``incident_energy_low_bound`` is specified, then
         this parameter is ignored.
 
+    xrf_fitting_batch_size : int
+        the number of data files fitted concurrently.
+
     dask_client : dask.distributed.Client
         Dask client object. If None, then Dask client is created automatically.
         If a batch of files is processed, then creating Dask client and
@@ -1177,7 +1233,7 @@ def _process_xrf_data(
             if v < incident_energy_low_bound:
                 scan_energies_adjusted[n] = incident_energy_low_bound
     elif use_incident_energy_from_param_file:
-        # If 'pyxrf_batch' is called with 'incident_energy' set to None, and
+        # If 'fit_pixel_data_batch' is called with 'incident_energy' set to None, and
         #   'ignore_datafile_metadata' is True, then
         #   the value of the incident energy from the parameter file is used
         scan_energies_adjusted = [None] * len(scan_energies)
@@ -1185,33 +1241,21 @@ def _process_xrf_data(
     else:
         scan_energies_adjusted = adjust_incident_beam_energies(scan_energies, eline_selected)
 
-    # Create Dask client for processing the batch of files unless one is provided
+    # Use the shared Dask client for processing the batch of files unless one is provided
     if dask_client is None:
-        logger.info("Creating local Dask client for processing the batch of files ...")
-        dask_client = dask_client_create()
-        client_is_local = True
-    else:
-        client_is_local = False
-
-    # Process data files from the list. Use adjusted energy value.
-    for fln, energy in zip(files_h5, scan_energies_adjusted):
-        # Process .h5 files in the directory 'wd_xrf'. Processing results are saved
-        #   as additional datasets in the original .h5 files.
-        pyxrf_batch(
-            data_files=fln,  # Process only one data file
-            param_file_name=xrf_fitting_param_fln,
-            ignore_datafile_metadata=ignore_metadata,
-            incident_energy=energy,  # This value overrides incident energy from other sources
-            use_snip=xrf_subtract_baseline,
-            wd=wd_xrf,
-            save_tiff=False,
-            dask_client=dask_client,
-        )
-
-    # Close the client if it was created locally
-    if client_is_local:
-        logger.info("Closing Dask client ...")
-        dask_client.close()
+        dask_client = dask_cluster_manager.get_client()
+
+    # Process data files from the list. Use adjusted energy value. Processing results are saved
+    #   as additional datasets in the original .h5 files.
+    fit_pixel_data_batch(
+        [os.path.join(wd_xrf, _) for _ in files_h5],
+        param_file_name=xrf_fitting_param_fln,
+        incident_energy=scan_energies_adjusted,  # The values override incident energy from other sources
+        ignore_datafile_metadata=ignore_metadata,
+        use_snip=xrf_subtract_baseline,
+        n_files_in_batch=xrf_fitting_batch_size,
+        dask_client=dask_client,
+    )
 
 
 def _compute_xanes_maps(
@@ -1222,6 +1266,7 @@ def _compute_xanes_maps(
     eline_selected,
     eline_alignment,
     alignment_starts_from,
+    alignment_method,
     scaler_name,
     ref_energy,
     ref_data,
@@ -1233,6 +1278,7 @@ def _compute_xanes_maps(
     normalize_alignment_stack,
     subtract_pre_edge_baseline,
     seq_generate_xanes_map,
+    dask_client=None,
 ):
     r"""
     Implements the third step of the processing sequence: computation of XANES maps based
@@ -1264,6 +1310,10 @@ def _compute_xanes_maps(
         "bottom" - start from the bottom of the stack (lowest energy) and proceed to the top.
         This is user defined parameter, which is passed as an argument to the program.
 
+    alignment_method : str
+        The method used to compute translations of the maps of the image stack:
+        "stackreg" or "phase_correlation".
+
     scaler_name : str
         the name of the scaler used for normalization. The name should be valid, i.e.
         present in each scan data. It may be set to None: in this case no normalization
@@ -1279,11 +1329,13 @@ def _compute_xanes_maps(
 
     fitting_method : str
         method used for fitting XANES spectra. The currently supported methods are
-        'nnls' and 'admm'.
+        'nnls', 'nnls_gram' and 'admm'. The 'nnls_gram' method solves the same NNLS problem
+        using the Gram matrix of the references precomputed once for all pixels, which is
+        much faster for large maps.
 
     fitting_descent_rate : float
         optimization parameter: descent rate for the fitting algorithm.
-        Used only for 'admm' algorithm (rate = 1/lambda), ignored for 'nnls' algorithm.
+        Used only for 'admm' algorithm (rate = 1/lambda), ignored for 'nnls' and 'nnls_gram' algorithms.
 
     incident_energy_shift_keV : float
         shift (in keV) applied to incident energy axis of the observed data before
@@ -1312,6 +1364,10 @@ def _compute_xanes_maps(
         indicates if XANES maps should be generated based on the aligned stack. If set to False,
         then the step of generation XANES maps is skipped.
 
+    dask_client : dask.distributed.Client or None
+        Dask client used for fitting of XANES spectra. If None, then the shared
+        local Dask cluster is used.
+
     Returns
     -------
 
@@ -1371,12 +1427,13 @@ def _compute_xanes_maps(
         # Interpolate each image. I tried to use common uniform grid to do interpolation,
         #   but it didn't work very well. In the current implementation, the interpolation
         #   of each set is performed separately using the uniform grid specific for the set.
-        for eline, data in eline_data.items():
-            n_scans, _, _ = data.shape
-            for n in range(n_scans):
-                data[n, :, :], _, _ = grid_interpolate(
-                    data[n, :, :], xx=positions_x_all[n, :, :], yy=positions_y_all[n, :, :]
-                )
+        #   The maps for all emission lines from the same scan are interpolated at once.
+        elines = list(eline_data.keys())
+        for n in range(positions_x_all.shape[0] if elines else 0):
+            interpolator = GridInterpolator(positions_x_all[n, :, :], positions_y_all[n, :, :])
+            data = interpolator.interpolate(np.asarray([eline_data[_][n, :, :] for _ in elines]))
+            for eline, d in zip(elines, data):
+                eline_data[eline][n, :, :] = d
         logger.info("Interpolating XRF maps to uniform grid: success.")
     else:
         logger.info("Interpolating XRF maps to uniform grid: skipped.")
@@ -1388,6 +1445,7 @@ def _compute_xanes_maps(
             eline_alignment=eline_alignment,
             alignment_starts_from=alignment_starts_from,
             normalize_alignment_stack=normalize_alignment_stack,
+            alignment_method=alignment_method,
         )
         logger.info("Alignment of the image stack: success.")
     else:
@@ -1411,15 +1469,15 @@ def _compute_xanes_maps(
             xrf_data = eline_data_aligned[eline_selected]
 
         logger.info(f"Fitting XANES specta using '{fitting_method}' method")
-        xanes_map_data, xanes_map_rfactor, _ = fit_spectrum(
-            xrf_data, scan_absorption_refs, method=fitting_method, rate=fitting_descent_rate
+        # Blocks of pixels are fitted in parallel using Dask client
+        if dask_client is None:
+            dask_client = dask_cluster_manager.get_client()
+        xanes_map_data, xanes_map_rfactor, _ = fit_xanes_map(
+            xrf_data, scan_absorption_refs, method=fitting_method, rate=fitting_descent_rate, client=dask_client
         )
 
         # Scale xanes maps so that the values represent counts
-        n_refs, _, _ = xanes_map_data.shape
-        xanes_map_data_counts = np.zeros(shape=xanes_map_data.shape)
-        for n in range(n_refs):
-            xanes_map_data_counts[n, :, :] = xanes_map_data[n, :, :] * np.sum(scan_absorption_refs[:, n])
+        xanes_map_data_counts = xanes_map_data * np.sum(scan_absorption_refs, axis=0)[:, np.newaxis, np.newaxis]
 
         logger.info("XANES fitting: success.")
     else:
@@ -1577,7 +1635,7 @@ def _plot_processing_results(
         Results of processing returned by the function '_compute_xanes_maps'.
 
     fitting_method : str
-        method used for fitting, the currently supported methods are 'nnls' and 'admm'
+        method used for fitting, the currently supported methods are 'nnls', 'nnls_gram' and 'admm'
 
     fitting_descent_rate : float
         descent rate for fitting algorithm, currently used only for ADMM fitting
@@ -1934,8 +1992,11 @@ def check_elines_activation_status(scan_energies, emission_line):
         the respective energy in the list ``scan_energies``
     """
 
-    is_activated = [check_if_eline_is_activated(emission_line, _) for _ in scan_energies]
-    return is_activated
+    if not len(scan_energies):
+        return []
+    # Cross sections are computed once for each unique energy
+    is_activated = compute_eline_cs(emission_line, scan_energies)[0] != 0
+    return [bool(_) for _ in is_activated]
 
 
 def adjust_incident_beam_energies(scan_energies, emission_line):
@@ -2163,11 +2224,136 @@ def _get_eline_data(scan_img_dict, scaler_name, eline_selected=None, eline_align
     return eline_list, eline_data
 
 
-def _align_stacks(eline_data, eline_alignment, alignment_starts_from="top", normalize_alignment_stack=True):
+def _compute_stack_shifts(data, *, alignment_starts_from="top", alignment_method="stackreg", n_threads=None):
+    r"""
+    Compute translations that align the maps of the stack ``data``. Each map is registered
+    with the previous map in the order of alignment, so the first aligned map is never shifted.
+
+    Parameters
+    ----------
+
+    data : ndarray
+        3D array of the shape (K, M, N), the stack of K maps used for alignment.
+
+    alignment_starts_from : str
+        order of the alignment. The allowed values are ``"top"`` (alignment starts from
+        the last map of the stack) and ``"bottom"`` (the first map of the stack).
+
+    alignment_method : str
+        method used to estimate the translations: ``"stackreg"`` (registration using
+        ``pystackreg``) or ``"phase_correlation"`` (FFT-based phase correlation with
+        subpixel precision, which is typically much faster).
+
+    n_threads : int or None
+        the number of threads used to estimate the translations with phase correlation method.
+        The number is selected automatically if ``None``.
+
+    Returns
+    -------
+
+    ndarray
+        2D array of the shape (K, 2): shifts of the maps along vertical and horizontal axes (pixels).
+        The shifts have the same meaning as in ``scipy.ndimage.shift``.
+    """
+    n_maps = data.shape[0]
+    shifts = np.zeros([n_maps, 2])
+    if n_maps < 2:
+        return shifts
+
+    # Views of the arrays arranged in the order of alignment
+    step = -1 if alignment_starts_from == "top" else 1
+    data_ordered, shifts_ordered = data[::step], shifts[::step]
+
+    if alignment_method == "stackreg":
+        sr = StackReg(StackReg.TRANSLATION)
+        tmats = sr.register_stack(data_ordered, reference="previous")
+        # The transformation matrices contain coordinates of source pixels (x, y)
+        shifts_ordered[:, :] = -tmats[:, (1, 0), 2]
+    elif alignment_method == "phase_correlation":
+        # Suppress the effect of the edges of the maps on the estimated shifts
+        window = np.outer(np.hanning(data.shape[1]), np.hanning(data.shape[2]))
+
+        def estimate_shift(n):
+            reference, moving = [(_ - np.mean(_)) * window for _ in (data_ordered[n - 1], data_ordered[n])]
+            shift, _, _ = phase_cross_correlation(reference, moving, upsample_factor=20)
+            return shift
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            shifts_ordered[1:, :] = list(executor.map(estimate_shift, range(1, n_maps)))
+        shifts_ordered[:, :] = np.cumsum(shifts_ordered, axis=0)
+    else:
+        raise ValueError(f"Unsupported alignment method: {alignment_method!r}")
+
+    return shifts
+
+
+def _shift_stacks(stacks, shifts, *, n_threads=None):
+    r"""
+    Shift the maps of the stacks. The maps with the same index in each stack are shifted
+    by the same translation, so the translations are computed once and applied to all stacks
+    in a single multi-threaded pass. The maps are interpolated using cubic splines and the
+    pixels that are mapped from outside of the original map are set to zero (the results
+    are the same as the results of ``StackReg.transform_stack``).
+
+    Parameters
+    ----------
+
+    stacks : list(ndarray)
+        list of stacks of maps, each stack is a 3D array of the shape (K, M, N)
+
+    shifts : ndarray
+        2D array of the shape (K, 2), shifts of the maps along vertical and horizontal axes,
+        e.g. computed by ``_compute_stack_shifts``.
+
+    n_threads : int or None
+        the number of threads. The number is selected automatically if ``None``.
+
+    Returns
+    -------
+
+    list(ndarray)
+        list of the stacks of shifted maps (float64). The stacks have the same shape as
+        the original stacks.
+    """
+    stacks_shifted = [np.zeros(_.shape) for _ in stacks]
+    if not stacks:
+        return stacks_shifted
+    n_maps, ny, nx = stacks[0].shape
+
+    def shift_maps(n):
+        dy, dx = shifts[n]
+        # Select rows and columns of pixels, which are mapped from inside the original map
+        yy, xx = np.arange(ny) - dy, np.arange(nx) - dx
+        rows_out = (yy < -0.5) | (yy >= ny - 0.5)
+        cols_out = (xx < -0.5) | (xx >= nx - 0.5)
+        for data, data_shifted in zip(stacks, stacks_shifted):
+            if dy == 0 and dx == 0:
+                data_shifted[n, :, :] = data[n, :, :]
+                continue
+            scipy.ndimage.shift(data[n, :, :], (dy, dx), output=data_shifted[n, :, :], order=3, mode="reflect")
+            data_shifted[n, rows_out, :] = 0
+            data_shifted[n, :, cols_out] = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(shift_maps, range(n_maps)))
+
+    return stacks_shifted
+
+
+def _align_stacks(
+    eline_data,
+    eline_alignment,
+    alignment_starts_from="top",
+    normalize_alignment_stack=True,
+    alignment_method="stackreg",
+    n_threads=None,
+):
     r"""
     Align stacks of maps from the dictionary ``eline_data`` based on the stack for
     emission line specified by ``eline_alignment``. Alignment may be performed
     starting from the ``"top"`` (default) or the ``"bottom"`` of the stack.
+    The translations are computed once based on the alignment stack and then
+    applied to the stacks for all emission lines.
 
     Parameters
     ----------
@@ -2189,6 +2375,13 @@ def _align_stacks(eline_data, eline_alignment, alignment_starts_from="top", norm
         enable normalization of the image stack used for alignment
         Default: ``True``
 
+    alignment_method : str
+        method used to compute the translations: ``"stackreg"`` or ``"phase_correlation"``.
+        Default: ``"stackreg"``
+
+    n_threads : int or None
+        the number of threads used for alignment. The number is selected automatically if ``None``.
+
     Returns
     -------
 
@@ -2202,18 +2395,8 @@ def _align_stacks(eline_data, eline_alignment, alignment_starts_from="top", norm
         "bottom",
     ], f"Parameter 'alignment_starts_from' has invalid value: '{alignment_starts_from}'"
 
-    def _flip_stack(img_stack, alignment_starts_from):
-        """Flip image stack if alignment should be started from the top image"""
-        if alignment_starts_from == "top":
-            return np.flip(img_stack, 0)
-        else:
-            return img_stack
-
-    """Align stack of XRF maps for each element"""
-    sr = StackReg(StackReg.TRANSLATION)
-
     # Normalize data used to compute matrix
-    logger.info(f"Stacks are aligned using the map '{eline_alignment}'")
+    logger.info(f"Stacks are aligned using the map '{eline_alignment}' (method: '{alignment_method}')")
     data = np.array(eline_data[eline_alignment])  # Create a copy
     if normalize_alignment_stack:
         logger.info("Normalizing the alignment stack ...")
@@ -2223,14 +2406,16 @@ def _align_stacks(eline_data, eline_alignment, alignment_starts_from="top", norm
     #   It will also be present in the aligned stack
     eline_data["ALIGN"] = data
 
-    sr.register_stack(_flip_stack(data, alignment_starts_from), reference="previous")
+    shifts = _compute_stack_shifts(
+        data, alignment_starts_from=alignment_starts_from, alignment_method=alignment_method, n_threads=n_threads
+    )
+
+    elines = list(eline_data.keys())
+    stacks_aligned = _shift_stacks([eline_data[_] for _ in elines], shifts, n_threads=n_threads)
 
     eline_data_aligned = {}
-    for eline, data in eline_data.items():
-        data_prepared = _flip_stack(data, alignment_starts_from)
-        data_transformed = sr.transform_stack(data_prepared)
-        data_transformed = _flip_stack(data_transformed, alignment_starts_from)
-        eline_data_aligned[eline] = data_transformed.clip(min=0)
+    for eline, data_aligned in zip(elines, stacks_aligned):
+        eline_data_aligned[eline] = data_aligned.clip(min=0)
 
     return eline_data_aligned
 